@@ -238,7 +238,10 @@ test_cfg = dict(
         score_thr=0.001,
         nms=dict(type='nms', iou_thr=0.5),
         max_per_img=100,
-        mask_thr_binary=0.5),
+        mask_thr_binary=0.5,
+        # full image RLEs encoded from the bbox-local masks by 4 threads
+        mask_format='rle',
+        mask_workers=4),
     keep_all_stages=False,
 )
 # dataset settings
@@ -273,9 +276,8 @@ train_pipeline = [
     dict(type='LoadImageFromFile'),
     dict(type='LoadAnnotations', with_bbox=True, with_mask=True,
          with_carcls_rot=True, with_translation=True, with_camera_rot=True),
-    dict(type='CameraRotation'),
-    dict(type='CropBottom', bottom_half=1480),
-    dict(type='Resize', img_scale=(1664, 576), keep_ratio=True),
+    # CameraRotation + CropBottom + Resize in a single warp
+    dict(type='CameraRotationCropResize', bottom_half=1480, img_scale=(1664, 576), keep_ratio=True),
     dict(type='RandomFlip', flip_ratio=0.),
     dict(type='Normalize', **img_norm_cfg),
     dict(type='Pad', size_divisor=32),
@@ -291,7 +293,8 @@ train_pipeline = [
                'scale_factor']),
 ]
 test_pipeline = [
-    dict(type='LoadImageFromFile'),
+    # crop and decode the JPEG at 1/2 scale at once, CropBottom is then a no-op
+    dict(type='LoadImageFromFile', bottom_half=1480, decode_scale=(1664, 576)),
     dict(type='CropBottom', bottom_half=1480),
     #dict(type='CropCentreResize', top=50, bottom=100, left=25, right=50),
     #dict(type='CropCentreResize', top=100, bottom=250, left=50, right=100),
@@ -322,7 +325,8 @@ data = dict(
         ann_file='/data/Kaggle/kaggle_apollo_combined_6691_origin.json',  # 6691 means the final cleaned data
         img_prefix=data_root + 'train_images/',
         pipeline=train_pipeline,
-        rotation_augmenation=True),
+        rotation_augmenation=True,
+        rotation_mask_warp=True),
     val=dict(
         type=dataset_type,
         data_root=data_root,
@@ -353,6 +357,8 @@ data = dict(
 evaluation = dict(
     conf_thresh=0.1,
     interval=1,
+    imgs_per_gpu=2,  # the validation images are forwarded 2 at a time
+    workers_per_gpu=2,
 )
 # optimizer
 optimizer = dict(type='Adam', lr=0.0003)  # We increase the learning rate to 3e-4 (It is supposed to be the best practice)
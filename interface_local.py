@@ -14,7 +14,7 @@ from mmcv.runner import load_checkpoint
 from mmdet.models import build_detector
 
 from mmcv.parallel import collate
-from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle
+from mmdet.datasets.kaggle_pku_utils import get_euler_angles
 from mmdet.datasets.pipelines import Compose
 
 
@@ -56,8 +56,7 @@ def format_return_data(output):
     if len(output[0][CAR_IDX]):
         conf = output[0][CAR_IDX][:, -1]  # output [0] is the bbox
         idx = conf > 0.8
-        # if 'euler_angle' in output[2].keys():
-        eular_angle = np.array([quaternion_to_euler_angle(x) for x in output[2]['quaternion_pred']])
+        eular_angle = get_euler_angles(output[2])
         translation = output[2]['trans_pred_world']
         coords = np.hstack((output[0][CAR_IDX][idx], eular_angle[idx], translation[idx]))
         return coords
@@ -1,9 +1,13 @@
 from .env import get_root_logger, init_dist, set_random_seed
 from .inference import (inference_detector, init_detector, show_result,
                         show_result_pyplot)
+from .inference_server import BatchInferenceServer, decode_image
+from .pipelined_test import StageOccupancy, pipelined_test
 from .train import train_detector
 
 __all__ = [
     'init_dist', 'get_root_logger', 'set_random_seed', 'train_detector',
-    'init_detector', 'inference_detector', 'show_result', 'show_result_pyplot'
+    'init_detector', 'inference_detector', 'show_result', 'show_result_pyplot',
+    'BatchInferenceServer', 'decode_image', 'StageOccupancy',
+    'pipelined_test'
 ]
@@ -0,0 +1,227 @@
+import collections
+import itertools
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+import torch
+from mmcv.parallel import collate
+
+from mmdet.datasets.pipelines import Compose
+
+
+def decode_image(buf):
+    """Decode an encoded image (jpg, png...) straight to a BGR ndarray.
+
+    The EXIF orientation is ignored to get the same pixels as the uploaded
+    files written to disk and read back with ``mmcv.imread`` before.
+    """
+    img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8),
+                       cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        raise ValueError('cannot decode the image')
+    return img
+
+
+class LoadImageArray(object):
+    """First step of the test pipeline for an image already in memory."""
+
+    def __call__(self, results):
+        img = results['img']
+        results.setdefault('filename', None)
+        results['img_shape'] = img.shape
+        results['ori_shape'] = img.shape
+        return results
+
+
+class StageTimer(object):
+    """Rolling latency statistics (in ms) of the inference stages."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self._times = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._times[stage].append(seconds * 1000.)
+
+    def summary(self):
+        with self._lock:
+            times = {k: np.array(v) for k, v in self._times.items()}
+        return {
+            k: dict(count=len(v), mean=float(v.mean()), p50=float(np.percentile(v, 50)),
+                    p95=float(np.percentile(v, 95)), max=float(v.max()))
+            for k, v in times.items() if len(v)
+        }
+
+
+class _Request(object):
+
+    def __init__(self, img, name):
+        self.img = img
+        self.name = name
+        self.submit_time = time.perf_counter()
+        self.timing = dict()
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class BatchInferenceServer(object):
+    """Serve a detector to concurrent callers with micro-batching.
+
+    The model and the test pipeline are built once. The requests submitted
+    by :meth:`infer` (typically from the threads of a web server) are queued,
+    a single worker thread gathers up to ``max_batch_size`` of them, waiting
+    at most ``max_wait_ms`` after the first one, preprocesses and forwards
+    them together (in a single forward for the detectors with
+    ``batch_test``, such as HybridTaskCascade).
+
+    Args:
+        model (nn.Module): detector in eval mode, already on ``device``.
+        cfg (:obj:`mmcv.Config`): config of the model.
+        device (str or torch.device): e.g. 'cuda:0' or 'cpu'.
+        max_batch_size (int): maximum number of images per micro-batch.
+        max_wait_ms (float): how long the first request of a batch waits for
+            others to join.
+        pipeline_start (int): index of the first step of
+            ``cfg.data.test.pipeline`` to keep, the steps before (at least the
+            image loading) are replaced by the in-memory loading.
+        postprocess (callable, optional): applied to the result of each image
+            in the caller's thread.
+    """
+
+    def __init__(self,
+                 model,
+                 cfg,
+                 device='cuda:0',
+                 max_batch_size=4,
+                 max_wait_ms=10.,
+                 pipeline_start=1,
+                 postprocess=None):
+        self.model = model
+        self.device = torch.device(device)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.postprocess = postprocess
+        self.pipeline = Compose([LoadImageArray()] + cfg.data.test.pipeline[pipeline_start:])
+        self.timer = StageTimer()
+        self.batch_sizes = collections.deque(maxlen=self.timer.window)
+
+        self._queue = queue.Queue()
+        self._counter = itertools.count()
+        self._worker = threading.Thread(target=self._run, name='inference-worker', daemon=True)
+        self._worker.start()
+
+    def infer(self, img, timeout=None):
+        """Run the detector on an image.
+
+        Args:
+            img (bytes or ndarray): encoded image or BGR array.
+
+        Returns:
+            tuple: (result, timing), the (post-processed) detector output and
+                the latency of each stage of this request in ms.
+        """
+        start = time.perf_counter()
+        if not isinstance(img, np.ndarray):
+            img = decode_image(img)
+            self.timer.add('decode', time.perf_counter() - start)
+        req = _Request(img, 'request_{}.jpg'.format(next(self._counter)))
+        req.timing['decode'] = (req.submit_time - start) * 1000.
+        self._queue.put(req)
+        if not req.done.wait(timeout):
+            raise TimeoutError('inference timed out')
+        if req.error is not None:
+            raise req.error
+
+        result = req.result
+        if self.postprocess is not None:
+            t = time.perf_counter()
+            result = self.postprocess(result)
+            elapsed = time.perf_counter() - t
+            self.timer.add('postprocess', elapsed)
+            req.timing['postprocess'] = elapsed * 1000.
+        req.timing['total'] = (time.perf_counter() - start) * 1000.
+        self.timer.add('total', req.timing['total'] / 1000.)
+        return result, req.timing
+
+    def stats(self):
+        """Latency of each stage and the mean micro-batch size."""
+        stats = dict(latency_ms=self.timer.summary())
+        batch_sizes = list(self.batch_sizes)
+        if batch_sizes:
+            stats['mean_batch_size'] = float(np.mean(batch_sizes))
+        return stats
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._process(batch)
+            except Exception as e:  # report the failure to all the callers
+                for req in batch:
+                    req.error = e
+            for req in batch:
+                req.done.set()
+
+    def _process(self, batch):
+        start = time.perf_counter()
+        for req in batch:
+            self.timer.add('queue', start - req.submit_time)
+            req.timing['queue'] = (start - req.submit_time) * 1000.
+        self.batch_sizes.append(len(batch))
+
+        datas = [self.pipeline(dict(img=req.img, filename=req.name)) for req in batch]
+        t_forward = time.perf_counter()
+        self._add_batch_timing(batch, 'preprocess', t_forward - start)
+
+        results = self._forward(datas)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self._add_batch_timing(batch, 'forward', time.perf_counter() - t_forward)
+        for req, result in zip(batch, results):
+            req.result = result
+
+    def _add_batch_timing(self, batch, stage, seconds):
+        self.timer.add(stage, seconds)
+        for req in batch:
+            req.timing[stage] = seconds * 1000.
+
+    def _forward(self, datas):
+        model = getattr(self.model, 'module', self.model)
+        with torch.no_grad():
+            if len(datas) > 1 and getattr(model, 'batch_test', False):
+                # the whole micro-batch in a single forward, one result per image
+                data = self._to_device(collate(datas, samples_per_gpu=len(datas)))
+                return self.model(return_loss=False, rescale=True, **data)
+        # the test forward of the other detectors handles a single image, the
+        # images of a micro-batch are forwarded one after the other
+        results = []
+        with torch.no_grad():
+            for data in datas:
+                data = self._to_device(collate([data], samples_per_gpu=1))
+                results.append(self.model(return_loss=False, rescale=True, **data))
+        return results
+
+    def _to_device(self, data):
+        # same as scatter() to a single device, but also valid for the cpu
+        return dict(
+            img=[img.to(self.device) for img in data['img']],
+            img_meta=[img_meta.data[0] for img_meta in data['img_meta']])
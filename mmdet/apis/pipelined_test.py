@@ -0,0 +1,175 @@
+import collections
+import itertools
+import queue
+import threading
+import time
+
+import torch
+from torch.utils.data import Subset
+
+_STOP = object()
+
+
+class StageOccupancy(object):
+    """Busy time of the stages of :func:`pipelined_test`.
+
+    The occupancy of a stage is its busy time over the wall time, divided by
+    the number of workers of the stage. The stage close to 100% limits the
+    throughput, the others wait on it.
+    """
+
+    def __init__(self, num_workers=None):
+        self.num_workers = dict(num_workers or {})
+        self.start = time.perf_counter()
+        self._busy = collections.defaultdict(float)
+        self._count = collections.defaultdict(int)
+        self._queue_len = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._busy[stage] += seconds
+            self._count[stage] += 1
+
+    def sample_queue(self, length):
+        with self._lock:
+            self._queue_len.append(length)
+
+    def summary(self):
+        wall = time.perf_counter() - self.start
+        with self._lock:
+            stats = {
+                stage: dict(count=self._count[stage],
+                            mean_ms=busy / self._count[stage] * 1000.,
+                            occupancy=busy / (wall * self.num_workers.get(stage, 1)))
+                for stage, busy in self._busy.items()
+            }
+            queue_len = list(self._queue_len)
+        return dict(wall_s=wall, stages=stats,
+                    mean_queue_len=sum(queue_len) / len(queue_len) if queue_len else 0.)
+
+    def format(self):
+        summary = self.summary()
+        stages = ', '.join('{} {:.0%} ({:.1f} ms)'.format(stage, s['occupancy'], s['mean_ms'])
+                           for stage, s in sorted(summary['stages'].items()))
+        return 'occupancy: {}, queue {:.1f}'.format(stages, summary['mean_queue_len'])
+
+
+def pipelined_test(model,
+                   data_loader,
+                   writer,
+                   postprocess=None,
+                   num_workers=4,
+                   queue_size=16,
+                   rank=0,
+                   world_size=1,
+                   log_interval=50,
+                   rescale=True,
+                   progress=None):
+    """Test loop overlapping the data loading, the forward and the CPU
+    post-processing of the results.
+
+    The data loader workers prepare the next batches while the model runs in
+    the calling thread. Each image result goes into a bounded queue. A pool of
+    ``num_workers`` threads takes the results from the queue, applies
+    ``postprocess(result, idx)`` and appends the output to ``writer`` as soon
+    as it is ready. When the queue is full the forward waits, so the memory
+    stays bounded.
+
+    Args:
+        model (nn.Module): detector wrapped in (Distributed)DataParallel.
+        data_loader (DataLoader): the sampler gives the images rank,
+            rank + world_size... to a rank, the padded ones are dropped. The
+            images of a ``Subset`` are written with their index in the full
+            dataset, e.g. the images left by an interrupted run.
+        writer (ResultWriter): where the outputs are appended.
+        postprocess (callable, optional): ``postprocess(result, idx)``
+            returns the output to write.
+        num_workers (int): post-processing threads.
+        queue_size (int): maximum number of results waiting for a worker.
+        log_interval (int): batches between two occupancy logs of rank 0,
+            0 to disable.
+        progress (callable, optional): called with the number of images done
+            after every batch.
+
+    Returns:
+        StageOccupancy: the busy time of the load, forward, queue (forward
+            blocked on a full queue), postprocess and write stages.
+    """
+    model.eval()
+    dataset = data_loader.dataset
+    stats = StageOccupancy(dict(postprocess=num_workers))
+    results = queue.Queue(maxsize=queue_size)
+    write_lock = threading.Lock()
+    errors = []
+
+    def _work():
+        while True:
+            item = results.get()
+            if item is _STOP:
+                return
+            if errors:
+                continue
+            idx, result = item
+            try:
+                if postprocess is not None:
+                    start = time.perf_counter()
+                    result = postprocess(result, idx)
+                    stats.add('postprocess', time.perf_counter() - start)
+                start = time.perf_counter()
+                with write_lock:
+                    writer.append(result, idx)
+                stats.add('write', time.perf_counter() - start)
+            except Exception as e:  # re-raised in the main thread
+                errors.append(e)
+
+    workers = [threading.Thread(target=_work, name='test-postprocess-{}'.format(i), daemon=True)
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    num_imgs = 0
+    try:
+        data_iter = iter(data_loader)
+        for i in itertools.count():
+            start = time.perf_counter()
+            try:
+                data = next(data_iter)
+            except StopIteration:
+                break
+            stats.add('load', time.perf_counter() - start)
+
+            start = time.perf_counter()
+            with torch.no_grad():
+                result = model(return_loss=False, rescale=rescale, **data)
+            stats.add('forward', time.perf_counter() - start)
+
+            # the model returns a list of results for a batch of several images
+            batch_size = data['img'][0].size(0)
+            start = time.perf_counter()
+            for img_result in (result if batch_size > 1 else [result]):
+                idx = num_imgs * world_size + rank
+                if idx < len(dataset):
+                    if isinstance(dataset, Subset):
+                        idx = dataset.indices[idx]
+                    results.put((idx, img_result))
+                num_imgs += 1
+            stats.add('queue', time.perf_counter() - start)
+            stats.sample_queue(results.qsize())
+            if errors:
+                break
+
+            if progress is not None:
+                progress(batch_size * world_size)
+            if rank == 0 and log_interval and (i + 1) % log_interval == 0:
+                print('\n[{} images] {}'.format(num_imgs, stats.format()))
+    finally:
+        for _ in workers:
+            results.put(_STOP)
+        for worker in workers:
+            worker.join()
+    if errors:
+        raise errors[0]
+    if rank == 0:
+        print('\n' + stats.format())
+    return stats
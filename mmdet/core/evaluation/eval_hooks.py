@@ -1,11 +1,12 @@
 import os
 import os.path as osp
+import pickle
 
 import mmcv
 import numpy as np
 import torch
 import torch.distributed as dist
-from mmcv.parallel import collate, scatter
+from mmcv.parallel import scatter
 from mmcv.runner import Hook
 from pycocotools.cocoeval import COCOeval
 from torch.utils.data import Dataset
@@ -15,9 +16,45 @@ from .coco_utils import fast_eval_recall, results2json
 from .mean_ap import eval_map
 
 
+def collect_results(part, size):
+    """Merge the ``(idx, result)`` pairs of all the ranks on rank 0.
+
+    The pickled parts are exchanged in memory with ``all_gather`` (on the GPU
+    with nccl, on the CPU with gloo), so no shared directory is needed.
+
+    Returns:
+        list: the results in dataset order on rank 0, None on the others.
+    """
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    part_tensor = torch.tensor(
+        bytearray(pickle.dumps(part)), dtype=torch.uint8, device=device)
+    shape = torch.tensor([part_tensor.numel()], device=device)
+    shapes = [shape.clone() for _ in range(world_size)]
+    dist.all_gather(shapes, shape)
+    # all_gather needs tensors of the same size
+    max_size = int(torch.cat(shapes).max())
+    part_send = part_tensor.new_zeros(max_size)
+    part_send[:part_tensor.numel()] = part_tensor
+    parts = [part_tensor.new_zeros(max_size) for _ in range(world_size)]
+    dist.all_gather(parts, part_send)
+    if rank != 0:
+        return None
+    results = [None for _ in range(size)]
+    for recv, shape in zip(parts, shapes):
+        for idx, result in pickle.loads(
+                recv[:int(shape)].cpu().numpy().tobytes()):
+            results[idx] = result
+    return results
+
+
 class DistEvalHook(Hook):
+    """Distributed evaluation, each rank forwards its shard of the dataset
+    with a DataLoader, ``imgs_per_gpu`` images at a time (only for the
+    detectors with ``batch_test``) prepared by ``workers_per_gpu`` workers.
+    The results are gathered in memory on rank 0."""
 
-    def __init__(self, dataset, interval=1):
+    def __init__(self, dataset, interval=1, imgs_per_gpu=1, workers_per_gpu=2):
         if isinstance(dataset, Dataset):
             self.dataset = dataset
         elif isinstance(dataset, dict):
@@ -27,46 +64,55 @@ class DistEvalHook(Hook):
                 'dataset must be a Dataset object or a dict, not {}'.format(
                     type(dataset)))
         self.interval = interval
+        self.imgs_per_gpu = imgs_per_gpu
+        self.workers_per_gpu = workers_per_gpu
+        self.data_loader = None
+
+    def _build_data_loader(self, runner):
+        model = getattr(runner.model, 'module', runner.model)
+        imgs_per_gpu = self.imgs_per_gpu if getattr(model, 'batch_test', False) else 1
+        return datasets.build_dataloader(
+            self.dataset,
+            imgs_per_gpu,
+            self.workers_per_gpu,
+            dist=True,
+            shuffle=False)
 
     def after_train_epoch(self, runner):
         if not self.every_n_epochs(runner, self.interval):
             return
         runner.model.eval()
-        results = [None for _ in range(len(self.dataset))]
+        if self.data_loader is None:
+            self.data_loader = self._build_data_loader(runner)
         if runner.rank == 0:
             prog_bar = mmcv.ProgressBar(len(self.dataset))
-        for idx in range(runner.rank, len(self.dataset), runner.world_size):
-            data = self.dataset[idx]
-            data_gpu = scatter(
-                collate([data], samples_per_gpu=1),
-                [torch.cuda.current_device()])[0]
+        # the sampler gives the images rank, rank + world_size... to a rank
+        # and pads the last batches with the first images
+        part = []
+        num_imgs = 0
+        for data in self.data_loader:
+            data_gpu = scatter(data, [torch.cuda.current_device()])[0]
 
             # compute output
             with torch.no_grad():
                 result = runner.model(
                     return_loss=False, rescale=True, **data_gpu)
-            results[idx] = result
+            batch_size = data['img'][0].size(0)
+            for img_result in (result if batch_size > 1 else [result]):
+                idx = num_imgs * runner.world_size + runner.rank
+                if idx < len(self.dataset):
+                    part.append((idx, img_result))
+                num_imgs += 1
 
-            batch_size = runner.world_size
             if runner.rank == 0:
-                for _ in range(batch_size):
+                done = min(num_imgs * runner.world_size, len(self.dataset))
+                while prog_bar.completed < done:
                     prog_bar.update()
 
+        results = collect_results(part, len(self.dataset))
         if runner.rank == 0:
             print('\n')
-            dist.barrier()
-            for i in range(1, runner.world_size):
-                tmp_file = osp.join(runner.work_dir, 'temp_{}.pkl'.format(i))
-                tmp_results = mmcv.load(tmp_file)
-                for idx in range(i, len(results), runner.world_size):
-                    results[idx] = tmp_results[idx]
-                os.remove(tmp_file)
             self.evaluate(runner, results)
-        else:
-            tmp_file = osp.join(runner.work_dir,
-                                'temp_{}.pkl'.format(runner.rank))
-            mmcv.dump(results, tmp_file)
-            dist.barrier()
         dist.barrier()
 
     def evaluate(self):
@@ -1,4 +1,9 @@
+from .lazy_masks import LazyMasks
 from .mask_target import mask_target
+from .rle import decode_cropped, decode_segm, encode_cropped
 from .utils import split_combined_polys
 
-__all__ = ['split_combined_polys', 'mask_target']
+__all__ = [
+    'split_combined_polys', 'mask_target', 'LazyMasks', 'encode_cropped',
+    'decode_cropped', 'decode_segm'
+]
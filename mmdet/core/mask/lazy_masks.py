@@ -0,0 +1,174 @@
+import copy
+
+import cv2
+import numpy as np
+import pycocotools.mask as maskUtils
+import torch
+
+
+def _crop_to_bbox(mask):
+    rows = np.flatnonzero(mask.any(axis=1))
+    if not len(rows):
+        return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+    cols = np.flatnonzero(mask.any(axis=0))
+    y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    return np.ascontiguousarray(mask[y0:y1, x0:x1], dtype=np.uint8), (int(x0), int(y0))
+
+
+class LazyMasks(object):
+    """Instance masks of an image kept as RLEs or bbox-cropped bitmaps.
+
+    The geometric transforms of the pipeline (Resize, RandomFlip, Pad) are
+    not applied to the bitmaps, they are recorded as a per-axis affine map
+    from the mask coordinates to the image coordinates. The mask targets are
+    then sampled in the original masks for the RoIs only, see
+    :meth:`crop_and_resize`, so no full image mask is ever allocated.
+
+    Indexing or iterating the masks materialises full image masks at the
+    current geometry, for the transforms that expect a list of arrays.
+
+    Args:
+        masks (list): each mask is either an RLE dict, a (bitmap, (x0, y0))
+            bbox-cropped bitmap or a full image ndarray (cropped here).
+        height (int): height of the image the masks belong to.
+        width (int): width of the image the masks belong to.
+    """
+
+    def __init__(self, masks, height, width):
+        self._masks = []
+        for mask in masks:
+            if isinstance(mask, np.ndarray):
+                mask = _crop_to_bbox(mask)
+            elif isinstance(mask, tuple):
+                mask = (np.ascontiguousarray(mask[0], dtype=np.uint8), tuple(int(v) for v in mask[1]))
+            self._masks.append(mask)
+        self.height = int(height)
+        self.width = int(width)
+        # image = scale * mask + shift, in continuous coordinates (pixel centres at .5)
+        self.scale = np.ones(2)
+        self.shift = np.zeros(2)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __getitem__(self, i):
+        return self.to_ndarray(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.to_ndarray(i)
+
+    @property
+    def nbytes(self):
+        nbytes = 0
+        for mask in self._masks:
+            nbytes += len(mask['counts']) if isinstance(mask, dict) else mask[0].nbytes
+        return nbytes
+
+    def crop(self, i):
+        """(bitmap, (x0, y0)) of a mask in its original coordinates, an RLE
+        is decoded and cropped on first access."""
+        mask = self._masks[i]
+        if isinstance(mask, dict):
+            mask = _crop_to_bbox(maskUtils.decode(mask))
+            self._masks[i] = mask
+        return mask
+
+    def _copy(self):
+        # the transforms return new objects sharing the bitmaps
+        masks = copy.copy(self)
+        masks._masks = self._masks
+        masks.scale, masks.shift = self.scale.copy(), self.shift.copy()
+        return masks
+
+    def rescale(self, out_shape):
+        """Resize to an (h, w) image."""
+        h, w = out_shape[:2]
+        factor = np.array([w / self.width, h / self.height])
+        masks = self._copy()
+        masks.scale *= factor
+        masks.shift *= factor
+        masks.height, masks.width = int(h), int(w)
+        return masks
+
+    def flip(self):
+        """Flip horizontally."""
+        masks = self._copy()
+        masks.scale[0] = -self.scale[0]
+        masks.shift[0] = self.width - self.shift[0]
+        return masks
+
+    def pad(self, out_shape):
+        """Pad to an (h, w) image, at the bottom and right as Pad does."""
+        masks = self._copy()
+        masks.height, masks.width = int(out_shape[0]), int(out_shape[1])
+        return masks
+
+    def to_ndarray(self, i):
+        """Full image uint8 mask ``i`` at the current geometry."""
+        bitmap, (x0, y0) = self.crop(i)
+        if not bitmap.size:
+            return np.zeros((self.height, self.width), dtype=np.uint8)
+        (ax, ay), (bx, by) = self.scale, self.shift
+        matrix = np.array([[ax, 0, ax * (x0 + 0.5) + bx - 0.5],
+                           [0, ay, ay * (y0 + 0.5) + by - 0.5]])
+        return cv2.warpAffine(bitmap, matrix, (self.width, self.height), flags=cv2.INTER_NEAREST)
+
+    def crop_and_resize(self, bboxes, inds, out_size):
+        """Mask targets of RoIs, sampled bilinearly in the original masks.
+
+        The RoI windows of all the proposals of the image are sampled at once
+        on the device of ``bboxes``, from the bitmaps of the masks they are
+        assigned to.
+
+        Args:
+            bboxes (Tensor): (n, 4) RoIs in image coordinates.
+            inds (Tensor): (n, ) index of the mask of each RoI.
+            out_size (tuple): (h, w) of the targets.
+
+        Returns:
+            Tensor: (n, h, w) float binary targets.
+        """
+        device = bboxes.device
+        out_h, out_w = out_size
+        inds = inds.long()
+        used = inds.unique().tolist()
+        crops = [self.crop(i) for i in used]
+        sizes = torch.tensor([c[0].size for c in crops], dtype=torch.long)
+        offsets = torch.zeros(len(self), dtype=torch.long)
+        geometry = torch.zeros((len(self), 4), dtype=torch.long)
+        offsets[used] = torch.cumsum(sizes, 0) - sizes
+        geometry[used] = torch.tensor([[c[1][0], c[1][1], c[0].shape[1], c[0].shape[0]] for c in crops],
+                                      dtype=torch.long).view(-1, 4)
+        flat = np.concatenate([c[0].ravel() for c in crops] + [np.zeros(1, dtype=np.uint8)])
+        flat = torch.from_numpy(flat).to(device).float()
+        offsets, geometry = offsets.to(device)[inds], geometry.to(device)[inds]
+
+        # integer boxes as the former mask_target_single
+        boxes = bboxes.int().float()
+        x1, y1 = boxes[:, 0:1], boxes[:, 1:2]
+        w = (boxes[:, 2:3] - x1 + 1).clamp(min=1)
+        h = (boxes[:, 3:4] - y1 + 1).clamp(min=1)
+        grid_x = x1 + (torch.arange(out_w, device=device).float() + 0.5) * w / out_w
+        grid_y = y1 + (torch.arange(out_h, device=device).float() + 0.5) * h / out_h
+        # back to the pixel coordinates of the cropped bitmaps
+        xs = (grid_x - float(self.shift[0])) / float(self.scale[0]) - 0.5 - geometry[:, 0:1].float()
+        ys = (grid_y - float(self.shift[1])) / float(self.scale[1]) - 0.5 - geometry[:, 1:2].float()
+
+        x0, y0 = xs.floor(), ys.floor()
+        wx, wy = xs - x0, ys - y0
+        x0, y0 = x0.long(), y0.long()
+        crop_w, crop_h = geometry[:, 2:3], geometry[:, 3:4]
+        targets = 0
+        for dy, weight_y in ((0, 1 - wy), (1, wy)):
+            yi = y0 + dy
+            valid_y = (yi >= 0) & (yi < crop_h)
+            for dx, weight_x in ((0, 1 - wx), (1, wx)):
+                xi = x0 + dx
+                valid_x = (xi >= 0) & (xi < crop_w)
+                idx = offsets[:, None, None] + yi[:, :, None] * crop_w[:, :, None] + xi[:, None, :]
+                valid = valid_y[:, :, None] & valid_x[:, None, :]
+                values = flat[torch.where(valid, idx, torch.zeros_like(idx))] * valid.float()
+                targets = targets + values * weight_y[:, :, None] * weight_x[:, None, :]
+        # the former uint8 bilinear resize rounded to 0 / 1
+        return (targets >= 0.5).float()
@@ -3,6 +3,8 @@ import numpy as np
 import torch
 from torch.nn.modules.utils import _pair
 
+from .lazy_masks import LazyMasks
+
 
 def mask_target(pos_proposals_list, pos_assigned_gt_inds_list, gt_masks_list,
                 cfg):
@@ -17,7 +19,10 @@ def mask_target_single(pos_proposals, pos_assigned_gt_inds, gt_masks, cfg):
     mask_size = _pair(cfg.mask_size)
     num_pos = pos_proposals.size(0)
     mask_targets = []
-    if num_pos > 0:
+    if num_pos > 0 and isinstance(gt_masks, LazyMasks):
+        # only the RoI windows are sampled, all at once
+        mask_targets = gt_masks.crop_and_resize(pos_proposals, pos_assigned_gt_inds, mask_size)
+    elif num_pos > 0:
         proposals_np = pos_proposals.cpu().numpy()
         pos_assigned_gt_inds = pos_assigned_gt_inds.cpu().numpy()
         for i in range(num_pos):
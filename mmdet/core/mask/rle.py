@@ -0,0 +1,107 @@
+import numpy as np
+import pycocotools.mask as mask_util
+
+
+def _clip_crop(mask, offset, size):
+    x0, y0 = int(offset[0]), int(offset[1])
+    h, w = size
+    ya, xa = max(-y0, 0), max(-x0, 0)
+    yb, xb = min(h - y0, mask.shape[0]), min(w - x0, mask.shape[1])
+    if yb <= ya or xb <= xa:
+        return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+    return mask[ya:yb, xa:xb], (x0 + xa, y0 + ya)
+
+
+def encode_cropped(mask, offset, size):
+    """RLE of a full (h, w) image whose only non zero pixels are the cropped
+    ``mask`` at ``offset`` (x0, y0), without allocating the full image.
+
+    The result is the same as ``mask_util.encode`` of the pasted mask.
+    """
+    h, w = size
+    mask, (x0, y0) = _clip_crop(np.asarray(mask), offset, size)
+    # column major runs of the crop, one zero pixel above and below each column
+    columns = np.zeros((mask.shape[1], mask.shape[0] + 2), dtype=np.int8)
+    columns[:, 1:-1] = mask.T != 0
+    col, row = np.nonzero(np.diff(columns, axis=1))
+    # the transitions alternate start / end in each column
+    bounds = (x0 + col) * h + y0 + row
+    starts, ends = bounds[0::2], bounds[1::2]
+    # a run ending at the bottom of a column and continuing at the top of
+    # the next one is a single run
+    if len(starts) > 1:
+        keep = np.append(True, starts[1:] != ends[:-1])
+        starts, ends = starts[keep], ends[np.append(keep[1:], True)]
+    counts = np.diff(np.concatenate([[0], np.stack([starts, ends], axis=1).ravel(), [h * w]]))
+    if len(counts) > 1 and not counts[-1]:
+        # pycocotools does not write an empty last run of zeros
+        counts = counts[:-1]
+    return mask_util.frPyObjects({'size': [h, w], 'counts': counts.tolist()}, h, w)
+
+
+def _rle_counts(counts):
+    # the LEB128 like string of pycocotools (rleFrString)
+    values = []
+    p = 0
+    while p < len(counts):
+        x, k, more = 0, 0, True
+        while more:
+            c = counts[p] - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = bool(c & 0x20)
+            p += 1
+            k += 1
+            if not more and c & 0x10:
+                x |= -1 << (5 * k)
+        if len(values) > 2:
+            x += values[-2]
+        values.append(x)
+    return np.array(values, dtype=np.int64)
+
+
+def decode_cropped(segm):
+    """(bitmap, (x0, y0)) of a mask cropped to the bbox of its pixels.
+
+    Args:
+        segm (dict): a compressed RLE or a cropped mask returned by
+            :func:`mmdet.models.mask_heads.FCNMaskHead.get_seg_masks` with
+            ``mask_format='cropped'``, i.e. dict(size, offset, mask).
+    """
+    if 'mask' in segm:
+        return _clip_crop(np.asarray(segm['mask']), segm['offset'], segm['size'])
+    h, w = segm['size']
+    counts = segm['counts']
+    if isinstance(counts, str):
+        counts = counts.encode('ascii')
+    counts = _rle_counts(counts) if isinstance(counts, bytes) else np.asarray(counts, dtype=np.int64)
+    bounds = np.cumsum(np.concatenate([[0], counts]))
+    starts, ends = bounds[1:-1:2], bounds[2::2]
+    valid = ends > starts
+    starts, ends = starts[valid], ends[valid]
+    if not len(starts):
+        return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+    # split the runs in one segment per column
+    first_col, last_col = starts // h, (ends - 1) // h
+    num = last_col - first_col + 1
+    run = np.repeat(np.arange(len(starts)), num)
+    col = first_col[run] + np.arange(run.size) - np.repeat(np.cumsum(num) - num, num)
+    y_start = np.where(col == first_col[run], starts[run] - col * h, 0)
+    y_end = np.where(col == last_col[run], ends[run] - col * h, h)
+
+    x0, y0 = int(col.min()), int(y_start.min())
+    crop_h, crop_w = int(y_end.max()) - y0, int(col.max()) - x0 + 1
+    diff = np.zeros((crop_w, crop_h + 1), dtype=np.int32)
+    np.add.at(diff, (col - x0, y_start - y0), 1)
+    np.add.at(diff, (col - x0, y_end - y0), -1)
+    mask = (np.cumsum(diff[:, :crop_h], axis=1) > 0).T
+    return np.ascontiguousarray(mask, dtype=np.uint8), (x0, y0)
+
+
+def decode_segm(segm):
+    """Full image uint8 mask of an RLE or of a cropped mask."""
+    if 'mask' not in segm:
+        return mask_util.decode(segm)
+    full = np.zeros(segm['size'], dtype=np.uint8)
+    mask, (x0, y0) = _clip_crop(segm['mask'], segm['offset'], segm['size'])
+    full[y0:y0 + mask.shape[0], x0:x0 + mask.shape[1]] = mask
+    return full
@@ -0,0 +1,153 @@
+"""
+    Brief: Packed NumPy cache of the ApolloScape car meshes
+    The 79 ``car_models_json`` files are parsed once and stored as a single
+    ``.npz`` next to the json folder. Vertices already have the y axis flipped
+    and faces are 0-based, so the meshes can be used without any conversion.
+"""
+import json
+import os
+
+import numpy as np
+from scipy.spatial import ConvexHull
+
+
+class CarModelBank(object):
+    """Read-only bank of car meshes backed by contiguous arrays.
+
+    All the models are concatenated into a few flat arrays indexed by
+    per-model offsets, :meth:`get_mesh` only returns views into them. The
+    arrays are never written to, so they stay shared between the parent and
+    forked DataLoader / ``multiprocessing.Pool`` workers, and pickling the
+    bank only sends the cache file path to spawned processes.
+
+    Args:
+        model_dir (str): directory containing ``car_models_json``.
+        cache_file (str, optional): the packed cache, defaults to
+            ``model_dir/car_models_bank.npz``. It is built from the json files
+            when missing.
+        voxel_size (float): cell size (in metres) of the vertex clustering
+            used for the decimated face set.
+    """
+
+    def __init__(self, model_dir, cache_file=None, voxel_size=0.1):
+        self.model_dir = model_dir
+        if cache_file is None:
+            cache_file = os.path.join(model_dir, 'car_models_bank.npz')
+        self.cache_file = cache_file
+        self.voxel_size = voxel_size
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.cache_file):
+            arrays = self.build(os.path.join(self.model_dir, 'car_models_json'), self.voxel_size)
+            # write to a temporary file first as several ranks may race here
+            tmp_file = '{}.{}.tmp.npz'.format(self.cache_file[:-4], os.getpid())
+            np.savez(tmp_file, **arrays)
+            os.replace(tmp_file, self.cache_file)
+
+        with np.load(self.cache_file) as data:
+            arrays = {k: data[k] for k in data.files}
+        for v in arrays.values():
+            v.flags.writeable = False
+
+        self.names = [str(n) for n in arrays['names']]
+        self.name2idx = {n: i for i, n in enumerate(self.names)}
+        self.vertices = arrays['vertices']
+        self.faces = arrays['faces']
+        self.faces_decimated = arrays['faces_decimated']
+        self.hull_points = arrays['hull_points']
+        self.bboxes = arrays['bboxes']
+        self.vertex_offsets = arrays['vertex_offsets']
+        self.face_offsets = arrays['face_offsets']
+        self.decimated_offsets = arrays['decimated_offsets']
+        self.hull_offsets = arrays['hull_offsets']
+
+    @staticmethod
+    def build(json_dir, voxel_size=0.1):
+        """Parse the json car models into the packed arrays."""
+        names = sorted(fn[:-5] for fn in os.listdir(json_dir) if fn.endswith('.json'))
+        vertices, faces, faces_decimated, hull_points, bboxes = [], [], [], [], []
+        for name in names:
+            with open(os.path.join(json_dir, name + '.json')) as json_file:
+                model = json.load(json_file)
+            v = np.array(model['vertices'], dtype=np.float32)
+            v[:, 1] = -v[:, 1]
+            f = np.array(model['faces'], dtype=np.int32) - 1
+
+            vertices.append(v)
+            faces.append(f)
+            faces_decimated.append(decimate_faces(v, f, voxel_size))
+            hull_points.append(v[ConvexHull(v).vertices])
+            bboxes.append(np.stack([v.min(axis=0), v.max(axis=0)]))
+
+        def _offsets(arrays):
+            return np.cumsum([0] + [len(a) for a in arrays]).astype(np.int64)
+
+        return dict(
+            names=np.array(names),
+            vertices=np.concatenate(vertices),
+            faces=np.concatenate(faces),
+            faces_decimated=np.concatenate(faces_decimated),
+            hull_points=np.concatenate(hull_points),
+            bboxes=np.stack(bboxes),
+            vertex_offsets=_offsets(vertices),
+            face_offsets=_offsets(faces),
+            decimated_offsets=_offsets(faces_decimated),
+            hull_offsets=_offsets(hull_points))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name2idx
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getstate__(self):
+        return dict(model_dir=self.model_dir, cache_file=self.cache_file, voxel_size=self.voxel_size)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load()
+
+    def get_mesh(self, name, decimated=False):
+        """Return (vertices, faces) of a car model.
+
+        Vertices are (N, 3) float32 with the y axis flipped, faces are (T, 3)
+        int32 0-based indices into them. Both are read-only views.
+        """
+        i = self.name2idx[name]
+        vertices = self.vertices[self.vertex_offsets[i]:self.vertex_offsets[i + 1]]
+        if decimated:
+            faces = self.faces_decimated[self.decimated_offsets[i]:self.decimated_offsets[i + 1]]
+        else:
+            faces = self.faces[self.face_offsets[i]:self.face_offsets[i + 1]]
+        return vertices, faces
+
+    def get_bbox(self, name):
+        """(2, 3) array of the min and max corner of the model."""
+        return self.bboxes[self.name2idx[name]]
+
+    def get_hull(self, name):
+        """Vertices of the 3D convex hull of the model, enough to get the
+        projected 2D bbox of a car."""
+        i = self.name2idx[name]
+        return self.hull_points[self.hull_offsets[i]:self.hull_offsets[i + 1]]
+
+
+def decimate_faces(vertices, faces, voxel_size):
+    """Vertex clustering decimation.
+
+    Vertices falling in the same ``voxel_size`` cell are merged into the
+    first of them, the faces collapsing to a line or a point and the
+    duplicates are dropped. The returned faces still index ``vertices``.
+    """
+    cells = np.floor(vertices / voxel_size).astype(np.int64)
+    _, first, inverse = np.unique(cells, axis=0, return_index=True, return_inverse=True)
+    remap = first[inverse.reshape(-1)].astype(np.int32)
+    f = remap[faces]
+    keep = (f[:, 0] != f[:, 1]) & (f[:, 1] != f[:, 2]) & (f[:, 0] != f[:, 2])
+    f = f[keep]
+    _, unique_idx = np.unique(np.sort(f, axis=1), axis=0, return_index=True)
+    return f[np.sort(unique_idx)]
@@ -14,10 +14,16 @@ import copy
 from .custom import CustomDataset
 from .registry import DATASETS
 from .car_models import car_id2name
+from .car_model_bank import CarModelBank
+from mmdet.core.mask.lazy_masks import LazyMasks
 
 from .kaggle_pku_utils import euler_to_Rot, euler_angles_to_quaternions, \
-    quaternion_upper_hemispher, quaternion_to_euler_angle, draw_line, draw_points, non_max_suppression_fast
+    quaternion_upper_hemispher, quaternion_to_euler_angle, quaternions_to_euler_angles, get_euler_angles, \
+    draw_line, draw_points, non_max_suppression_fast
 
+from .mesh_rasterizer import project_vertices, rasterize_mesh
+from .mesh_iou_cache import shared_iou_cache
+from .silhouette_bank import SilhouetteBank
 from .visualisation_utils import draw_result_kaggle_pku, draw_box_mesh_kaggle_pku, refine_yaw_and_roll, \
     restore_x_y_from_z_withIOU, get_IOU, nms_with_IOU, nms_with_IOU_and_vote, nms_with_IOU_and_vote_return_index
 
@@ -48,6 +54,15 @@ class NumpyEncoder(json.JSONEncoder):
 class KagglePKUDataset(CustomDataset):
     CLASSES = ('car',)
 
+    def __init__(self, rotation_mask_warp=False, iou_occlusion=False, **kwargs):
+        # With camera rotation augmentation, warp the stored gt RLE masks with
+        # the rotation homography instead of re-rendering every car mesh.
+        self.rotation_mask_warp = rotation_mask_warp
+        # The IoUs of the post-processing are computed with the visible
+        # silhouettes, all the cars of an image drawn in one z-buffer.
+        self.iou_occlusion = iou_occlusion
+        super(KagglePKUDataset, self).__init__(**kwargs)
+
     def load_annotations(self, ann_file, outdir='/data/Kaggle/pku-autonomous-driving'):
 
         # some hard coded parameters
@@ -67,6 +82,8 @@ class KagglePKUDataset(CustomDataset):
 
         print("Loading Car model files...")
         self.car_model_dict = self.load_car_models()
+        # silhouettes and decoded masks shared by the merge, restore-xyz and ignore mask filtering
+        self.iou_cache = shared_iou_cache(self.car_model_dict, self.camera_matrix, self.image_shape)
         self.car_id2name = car_id2name
         annotations = []
         if not self.test_mode:
@@ -146,13 +163,16 @@ class KagglePKUDataset(CustomDataset):
                 imwrite(img_aug, os.path.join(im_out_dir, im_out_file))
 
     def load_car_models(self):
-        car_model_dir = os.path.join(self.outdir, 'car_models_json')
-        car_model_dict = {}
-        for car_name in tqdm(os.listdir(car_model_dir)):
-            with open(os.path.join(self.outdir, 'car_models_json', car_name)) as json_file:
-                car_model_dict[car_name[:-5]] = json.load(json_file)
+        return CarModelBank(self.outdir)
 
-        return car_model_dict
+    def load_silhouette_bank(self):
+        """Silhouette templates of the unique_car_mode models, rendered next
+        to the car models the first time."""
+        if getattr(self, 'silhouette_bank', None) is None:
+            names = [car_id2name[x].name for x in self.unique_car_mode]
+            self.silhouette_bank = SilhouetteBank(self.car_model_dict, os.path.join(self.outdir, 'silhouette_bank'),
+                                                  names=names)
+        return self.silhouette_bank
 
     def RotationDistance(self, p, g):
         true = [g[1], g[0], g[2]]
@@ -214,9 +234,7 @@ class KagglePKUDataset(CustomDataset):
                 # car_id2name is from:
                 # https://github.com/ApolloScapeAuto/dataset-api/blob/master/car_instance/car_models.py
                 car_name = car_id2name[gt_pred['id']].name
-                vertices = np.array(self.car_model_dict[car_name]['vertices'])
-                vertices[:, 1] = -vertices[:, 1]
-                triangles = np.array(self.car_model_dict[car_name]['faces']) - 1
+                vertices, triangles = self.car_model_dict.get_mesh(car_name)
 
                 # project 3D points to 2d image plane
                 yaw, pitch, roll = gt_pred['yaw'], gt_pred['pitch'], gt_pred['roll']
@@ -367,9 +385,7 @@ class KagglePKUDataset(CustomDataset):
                 # car_id2name is from:
                 # https://github.com/ApolloScapeAuto/dataset-api/blob/master/car_instance/car_models.py
                 car_name = car_id2name[labels[gt_car_idx]].name
-                vertices = np.array(self.car_model_dict[car_name]['vertices'])
-                vertices[:, 1] = -vertices[:, 1]
-                triangles = np.array(self.car_model_dict[car_name]['faces']) - 1
+                vertices, triangles = self.car_model_dict.get_mesh(car_name)
                 translation = np.array(translations[gt_car_idx])
 
                 Rt = np.eye(4)
@@ -470,9 +486,7 @@ class KagglePKUDataset(CustomDataset):
                 # car_id2name is from:
                 # https://github.com/ApolloScapeAuto/dataset-api/blob/master/car_instance/car_models.py
                 car_name = car_id2name[labels[gt_car_idx]].name
-                vertices = np.array(self.car_model_dict[car_name]['vertices'])
-                vertices[:, 1] = -vertices[:, 1]
-                triangles = np.array(self.car_model_dict[car_name]['faces']) - 1
+                vertices, triangles = self.car_model_dict.get_mesh(car_name)
                 translation = np.array(translations[gt_car_idx])
 
                 Rt = np.eye(4)
@@ -536,7 +550,7 @@ class KagglePKUDataset(CustomDataset):
                 car_cls_score_pred = six_dof['car_cls_score_pred']
                 quaternion_pred = six_dof['quaternion_pred']
                 trans_pred_world = six_dof['trans_pred_world'].copy()
-                euler_angle = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+                euler_angle = quaternions_to_euler_angles(quaternion_pred)
                 car_labels = np.argmax(car_cls_score_pred, axis=1)
                 kaggle_car_labels = [self.unique_car_mode[x] for x in car_labels]
                 car_names = np.array([car_id2name[x].name for x in kaggle_car_labels])
@@ -552,12 +566,14 @@ class KagglePKUDataset(CustomDataset):
                                                                           self.camera_matrix)
                 if flag:
                     output[2]['quaternion_pred'] = quaternion_semisphere_refined
-                    euler_angle = np.array([quaternion_to_euler_angle(x) for x in output[2]['quaternion_pred']])
+                    euler_angle = get_euler_angles(output[2])
 
                 trans_pred_world_refined = restore_x_y_from_z_withIOU(image, bboxes[car_cls_coco], segms[car_cls_coco],
                                                                       car_names, euler_angle, trans_pred_world,
                                                                       self.car_model_dict,
-                                                                      self.camera_matrix)
+                                                                      self.camera_matrix,
+                                                                      iou_cache=self.iou_cache,
+                                                                      occlusion=self.iou_occlusion)
                 output[2]['trans_pred_world'] = trans_pred_world_refined
 
                 # img_box_mesh_refined = self.visualise_box_mesh(image,bboxes[car_cls_coco], segms[car_cls_coco],car_names, euler_angle,trans_pred_world_refined)
@@ -590,6 +606,8 @@ class KagglePKUDataset(CustomDataset):
         bboxes_merge = outputs[0][img_id][0].copy()
         segms_merge = outputs[0][img_id][1].copy()
         six_dof_merge = outputs[0][img_id][2].copy()
+        # the merged cars get their angles from the merged quaternions
+        six_dof_merge.pop('euler_angle', None)
 
         last_name = ""
         for i, output in enumerate(outputs):
@@ -610,7 +628,8 @@ class KagglePKUDataset(CustomDataset):
             six_dof_list.append(six_dof)
 
             bboxes_with_IOU = get_IOU(image, bboxes[car_cls_coco], segms[car_cls_coco], six_dof,
-                                      car_id2name, self.car_model_dict, self.unique_car_mode, self.camera_matrix)
+                                      car_id2name, self.car_model_dict, self.unique_car_mode, self.camera_matrix,
+                                      iou_cache=self.iou_cache, occlusion=self.iou_occlusion)
 
             new_bboxes_with_IOU = np.zeros((bboxes_with_IOU.shape[0], bboxes_with_IOU.shape[1] + 1))
             for bbox_idx in range(bboxes_with_IOU.shape[0]):
@@ -659,7 +678,7 @@ class KagglePKUDataset(CustomDataset):
             car_cls_score_pred = six_dof_merge['car_cls_score_pred']
             quaternion_pred = six_dof_merge['quaternion_pred']
             trans_pred_world = six_dof_merge['trans_pred_world'].copy()
-            euler_angle = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+            euler_angle = quaternions_to_euler_angles(quaternion_pred)
             car_labels = np.argmax(car_cls_score_pred, axis=1)
             kaggle_car_labels = [self.unique_car_mode[x] for x in car_labels]
             car_names = np.array([car_id2name[x].name for x in kaggle_car_labels])
@@ -671,8 +690,9 @@ class KagglePKUDataset(CustomDataset):
                     os.path.join(args.out[:-4] + '_mes_box_vis_merged/' + img_name.split('/')[-1])[
                     :-4] + '_merged.jpg')
 
-        tmp_file = os.path.join(tmp_dir, "{}.pkl".format(last_name[:-4]))
-        mmcv.dump(output_model_merge, tmp_file)
+        if tmp_dir is not None:
+            tmp_file = os.path.join(tmp_dir, "{}.pkl".format(last_name[:-4]))
+            mmcv.dump(output_model_merge, tmp_file)
         return output_model_merge
 
     def distributed_visualise_pred_merge_postprocessing_weight_merge(self, img_id, outputs, args, vote=0,
@@ -687,6 +707,8 @@ class KagglePKUDataset(CustomDataset):
         bboxes_merge = outputs[0][img_id][0].copy()
         segms_merge = outputs[0][img_id][1].copy()
         six_dof_merge = outputs[0][img_id][2].copy()
+        # the merged cars get their angles from the merged quaternions
+        six_dof_merge.pop('euler_angle', None)
 
         last_name = ""
         if vote == 0:
@@ -709,7 +731,8 @@ class KagglePKUDataset(CustomDataset):
             six_dof_list.append(six_dof)
 
             bboxes_with_IOU = get_IOU(image, bboxes[car_cls_coco], segms[car_cls_coco], six_dof,
-                                      car_id2name, self.car_model_dict, self.unique_car_mode, self.camera_matrix)
+                                      car_id2name, self.car_model_dict, self.unique_car_mode, self.camera_matrix,
+                                      iou_cache=self.iou_cache, occlusion=self.iou_occlusion)
 
             new_bboxes_with_IOU = np.zeros((bboxes_with_IOU.shape[0], bboxes_with_IOU.shape[1] + 1))
             for bbox_idx in range(bboxes_with_IOU.shape[0]):
@@ -768,7 +791,7 @@ class KagglePKUDataset(CustomDataset):
             car_cls_score_pred = six_dof_merge['car_cls_score_pred']
             quaternion_pred = six_dof_merge['quaternion_pred']
             trans_pred_world = six_dof_merge['trans_pred_world'].copy()
-            euler_angle = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+            euler_angle = quaternions_to_euler_angles(quaternion_pred)
             car_labels = np.argmax(car_cls_score_pred, axis=1)
             kaggle_car_labels = [self.unique_car_mode[x] for x in car_labels]
             car_names = np.array([car_id2name[x].name for x in kaggle_car_labels])
@@ -780,8 +803,9 @@ class KagglePKUDataset(CustomDataset):
                     os.path.join(args.out[:-4] + '_mes_box_vis_merged/' + img_name.split('/')[-1])[
                     :-4] + '_merged.jpg')
 
-        tmp_file = os.path.join(tmp_dir, "{}.pkl".format(last_name[:-4]))
-        mmcv.dump(output_model_merge, tmp_file)
+        if tmp_dir is not None:
+            tmp_file = os.path.join(tmp_dir, "{}.pkl".format(last_name[:-4]))
+            mmcv.dump(output_model_merge, tmp_file)
         return output_model_merge
 
     def visualise_pred_merge_postprocessing(self, outputs, args, conf_thred=0.8):
@@ -804,11 +828,15 @@ class KagglePKUDataset(CustomDataset):
                 bboxes_merge = bboxes_a.copy()
                 segms_merge = segms_a.copy()
                 six_dof_merge = six_dof_a.copy()
+                # the merged cars get their angles from the merged quaternions
+                six_dof_merge.pop('euler_angle', None)
 
                 bboxes_a_with_IOU = get_IOU(image, bboxes_a[car_cls_coco], segms_a[car_cls_coco], six_dof_a,
-                                            car_id2name, self.car_model_dict, self.unique_car_mode, self.camera_matrix)
+                                            car_id2name, self.car_model_dict, self.unique_car_mode, self.camera_matrix,
+                                            iou_cache=self.iou_cache, occlusion=self.iou_occlusion)
                 bboxes_b_with_IOU = get_IOU(image, bboxes_b[car_cls_coco], segms_b[car_cls_coco], six_dof_b,
-                                            car_id2name, self.car_model_dict, self.unique_car_mode, self.camera_matrix)
+                                            car_id2name, self.car_model_dict, self.unique_car_mode, self.camera_matrix,
+                                            iou_cache=self.iou_cache, occlusion=self.iou_occlusion)
                 bboxes_with_IOU = np.concatenate([bboxes_a_with_IOU, bboxes_b_with_IOU], axis=0)
                 inds = nms_with_IOU(bboxes_with_IOU)  ## IOU nms filter out processing return output indices
                 inds = np.array(inds)
@@ -829,7 +857,7 @@ class KagglePKUDataset(CustomDataset):
                 car_cls_score_pred = six_dof_merge['car_cls_score_pred']
                 quaternion_pred = six_dof_merge['quaternion_pred']
                 trans_pred_world = six_dof_merge['trans_pred_world'].copy()
-                euler_angle = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+                euler_angle = quaternions_to_euler_angles(quaternion_pred)
                 car_labels = np.argmax(car_cls_score_pred, axis=1)
                 kaggle_car_labels = [self.unique_car_mode[x] for x in car_labels]
                 car_names = np.array([car_id2name[x].name for x in kaggle_car_labels])
@@ -851,7 +879,8 @@ class KagglePKUDataset(CustomDataset):
                                                         self.car_model_dict,
                                                         self.camera_matrix,
                                                         trans_pred_world,
-                                                        euler_angle)
+                                                        euler_angle,
+                                                        occlusion=self.iou_occlusion)
 
         return im_combime, iou_flag
 
@@ -1209,8 +1238,8 @@ class KagglePKUDataset(CustomDataset):
 
         Returns:
             dict: A dict containing the following keys: bboxes, bboxes_ignore,
-                labels, masks, seg_map. "masks" are raw annotations and not
-                decoded into binary masks.
+                labels, masks, seg_map. "masks" is a LazyMasks of the gt RLEs
+                (or of the bbox-cropped rotated masks), decoded on demand.
         """
         gt_bboxes = []
         gt_class_labels = []  # this will always be fixed as car class
@@ -1258,8 +1287,7 @@ class KagglePKUDataset(CustomDataset):
                     gt_label = self.cat2label[ann_info['labels'][i]]
                     gt_labels.append(gt_label)
                     gt_class_labels.append(3)  # coco 3 is "car" class
-                    mask = maskUtils.decode(ann_info['rles'][i])
-                    gt_masks_ann.append(mask)
+                    gt_masks_ann.append(ann_info['rles'][i])
 
                     eular_angles.append(ann_info['eular_angles'][i])
                     quaternion_semispheres.append(ann_info['quaternion_semispheres'][i])
@@ -1281,11 +1309,14 @@ class KagglePKUDataset(CustomDataset):
                     translation_rot = np.array([x_rot, y_rot, z_rot])
 
                     car_name = car_id2name[ann_info['labels'][i]].name
-                    vertices = np.array(self.car_model_dict[car_name]['vertices'])
-                    vertices[:, 1] = -vertices[:, 1]
-                    triangles = np.array(self.car_model_dict[car_name]['faces']) - 1
-
-                    bbox_rot, mask_rot = self.get_box_and_mask(eular_angle_rot, translation_rot, vertices, triangles)
+                    if self.rotation_mask_warp and 'rles' in ann_info:
+                        bbox_rot, mask_rot = self.get_box_and_warped_mask(eular_angle_rot, translation_rot,
+                                                                          self.car_model_dict.get_hull(car_name),
+                                                                          ann_info['rles'][i], Mat)
+                    else:
+                        vertices, triangles = self.car_model_dict.get_mesh(car_name)
+                        bbox_rot, mask_rot = self.get_box_and_mask(eular_angle_rot, translation_rot, vertices,
+                                                                   triangles)
                     # Some rotated bbox might be out of the image
                     if bbox_rot[2] < 0 or bbox_rot[3] < 0 or \
                             bbox_rot[0] > self.image_shape[0] or bbox_rot[1] > self.image_shape[1] - self.bottom_half:
@@ -1322,7 +1353,7 @@ class KagglePKUDataset(CustomDataset):
             labels=gt_class_labels,
             carlabels=gt_labels,
             bboxes_ignore=gt_bboxes_ignore,
-            masks=gt_masks_ann,
+            masks=LazyMasks(gt_masks_ann, self.image_shape[0] - int(self.bottom_half), self.image_shape[1]),
 
             eular_angles=eular_angles,
             quaternion_semispheres=quaternion_semispheres,
@@ -1370,52 +1401,65 @@ class KagglePKUDataset(CustomDataset):
 
     def get_box_and_mask(self, eular_angle, translation, vertices, triangles):
         # project 3D points to 2d image plane
-        yaw, pitch, roll = eular_angle
-        # I think the pitch and yaw should be exchanged
-        yaw, pitch, roll = -pitch, -yaw, -roll
-        Rt = np.eye(4)
-        t = translation
-        Rt[:3, 3] = t
-        Rt[:3, :3] = euler_to_Rot(yaw, pitch, roll).T
-        Rt = Rt[:3, :]
-        P = np.ones((vertices.shape[0], vertices.shape[1] + 1))
-        P[:, :-1] = vertices
-        P = P.T
-
-        img_cor_points = np.dot(self.camera_matrix, np.dot(Rt, P))
-        img_cor_points = img_cor_points.T
-        img_cor_points[:, 0] /= img_cor_points[:, 2]
-        img_cor_points[:, 1] /= img_cor_points[:, 2]
+        img_cor_points = project_vertices(vertices, eular_angle, translation, self.camera_matrix)
 
-        # project 3D points to 2d image plane
         x1, y1, x2, y2 = img_cor_points[:, 0].min(), img_cor_points[:, 1].min(), \
                          img_cor_points[:, 0].max(), img_cor_points[:, 1].max()
         bbox = np.array([x1, y1, x2, y2])
         if self.bottom_half:
             # we only take bottom half image
             bbox = [x1, y1 - self.bottom_half, x2, y2 - self.bottom_half]
-        #### Now draw the mask
-        # project 3D points to 2d image plane
-        mask_seg = np.zeros(self.image_shape, dtype=np.uint8)
-        mask_seg_mesh = np.zeros(self.image_shape, dtype=np.uint8)
-        for t in triangles:
-            coord = np.array([img_cor_points[t[0]][:2], img_cor_points[t[1]][:2], img_cor_points[t[2]][:2]],
-                             dtype=np.int32)
-            # This will draw the mask for segmenation
-            cv2.drawContours(mask_seg, np.int32([coord]), 0, (255, 255, 255), -1)
-            cv2.polylines(mask_seg_mesh, np.int32([coord]), 1, (0, 255, 0))
-
-        ground_truth_binary_mask = np.zeros(mask_seg.shape, dtype=np.uint8)
-        ground_truth_binary_mask[mask_seg == 255] = 1
-        if self.bottom_half > 0:  # this indicate w
-            ground_truth_binary_mask = ground_truth_binary_mask[int(self.bottom_half):, :]
-
-        # kernel_size = int(((y2 - y1) / 2 + (x2 - x1) / 2) / 10)
-        # kernel = np.ones((kernel_size, kernel_size), np.uint8)
-        # # Following is the code to find mask
-        # ground_truth_binary_mask = cv2.dilate(ground_truth_binary_mask, kernel, iterations=1)
-        # ground_truth_binary_mask = cv2.erode(ground_truth_binary_mask, kernel, iterations=1)
-        return bbox, ground_truth_binary_mask
+        #### Now draw the mask, only the projected bbox is rasterised
+        mask_shape = (self.image_shape[0] - int(self.bottom_half), self.image_shape[1])
+        # the mask is kept cropped, (bitmap, (x0, y0)) as LazyMasks takes it
+        cropped_mask = rasterize_mesh(img_cor_points, triangles, mask_shape, y_offset=self.bottom_half)
+
+        return bbox, cropped_mask
+
+    def get_box_and_warped_mask(self, eular_angle, translation, hull_points, rle, Mat):
+        """Fast counterpart of get_box_and_mask for the camera rotation.
+
+        The bbox comes from the projection of the convex hull of the car (same
+        extremes as the full mesh) and the mask is the stored gt RLE warped by
+        the homography `Mat` that CameraRotation applies to the image. Only
+        the bbox of the mask is warped and it is returned cropped, as
+        (bitmap, (x0, y0)).
+        """
+        img_cor_points = project_vertices(hull_points, eular_angle, translation, self.camera_matrix)
+        x1, y1, x2, y2 = img_cor_points[:, 0].min(), img_cor_points[:, 1].min(), \
+                         img_cor_points[:, 0].max(), img_cor_points[:, 1].max()
+        bbox = np.array([x1, y1, x2, y2])
+        if self.bottom_half:
+            # we only take bottom half image
+            bbox = [x1, y1 - self.bottom_half, x2, y2 - self.bottom_half]
+
+        mask_shape = (self.image_shape[0] - int(self.bottom_half), self.image_shape[1])
+        empty_mask = (np.zeros((0, 0), dtype=np.uint8), (0, 0))
+        # the rle may be stored full frame or bottom half only, Mat works on full frame coordinates
+        rle_h = rle['size'][0]
+        src_shift = np.array([[1, 0, 0], [0, 1, self.image_shape[0] - rle_h], [0, 0, 1]])
+        dst_shift = np.array([[1, 0, 0], [0, 1, -self.bottom_half], [0, 0, 1]])
+        homography = dst_shift.dot(Mat).dot(src_shift)
+
+        sx, sy, sw, sh = maskUtils.toBbox(rle)
+        if sw < 1 or sh < 1:
+            return bbox, empty_mask
+        sx1, sy1, sx2, sy2 = int(sx), int(sy), int(np.ceil(sx + sw)), int(np.ceil(sy + sh))
+        corners = np.array([[[sx1, sy1], [sx2, sy1], [sx2, sy2], [sx1, sy2]]], dtype=np.float64)
+        corners = cv2.perspectiveTransform(corners, homography)[0]
+        dx1, dy1 = np.maximum(np.floor(corners.min(axis=0)).astype(np.int64) - 1, 0)
+        dx2 = min(int(np.ceil(corners[:, 0].max())) + 1, mask_shape[1])
+        dy2 = min(int(np.ceil(corners[:, 1].max())) + 1, mask_shape[0])
+        if dx2 <= dx1 or dy2 <= dy1:
+            return bbox, empty_mask
+
+        src = maskUtils.decode(rle)[sy1:sy2, sx1:sx2]
+        crop_homography = np.array([[1, 0, -dx1], [0, 1, -dy1], [0, 0, 1]]).dot(homography).dot(
+            np.array([[1, 0, sx1], [0, 1, sy1], [0, 0, 1]]))
+        warped = cv2.warpPerspective(src, crop_homography, (int(dx2 - dx1), int(dy2 - dy1)),
+                                     flags=cv2.INTER_NEAREST)
+
+        return bbox, (warped, (int(dx1), int(dy1)))
 
     def visualise_pred(self, outputs, args):
         car_cls_coco = 2
@@ -1433,7 +1477,7 @@ class KagglePKUDataset(CustomDataset):
                 car_cls_score_pred = six_dof['car_cls_score_pred']
                 quaternion_pred = six_dof['quaternion_pred']
                 trans_pred_world = six_dof['trans_pred_world']
-                euler_angle = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+                euler_angle = quaternions_to_euler_angles(quaternion_pred)
                 car_labels = np.argmax(car_cls_score_pred, axis=1)
                 kaggle_car_labels = [self.unique_car_mode[x] for x in car_labels]
                 car_names = np.array([car_id2name[x].name for x in kaggle_car_labels])
@@ -1460,7 +1504,7 @@ class KagglePKUDataset(CustomDataset):
             car_cls_score_pred = six_dof['car_cls_score_pred']
             quaternion_pred = six_dof['quaternion_pred']
             trans_pred_world = six_dof['trans_pred_world']
-            euler_angle = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+            euler_angle = quaternions_to_euler_angles(quaternion_pred)
             car_labels = np.argmax(car_cls_score_pred, axis=1)
             kaggle_car_labels = [self.unique_car_mode[x] for x in car_labels]
             car_names = np.array([car_id2name[x].name for x in kaggle_car_labels])
@@ -1472,12 +1516,14 @@ class KagglePKUDataset(CustomDataset):
                                                            euler_angle, trans_pred_world)
             imwrite(im_combime, os.path.join(args.out[:-4] + '_mes_vis/' + img_name.split('/')[-1]))
 
-    def pkl_postprocessing_restore_xyz_multiprocessing(self, outputs):
+    def pkl_postprocessing_restore_xyz_multiprocessing(self, outputs, writer=None):
         """
         Post processing of storing x,y using z prediction (YYJ method)
         We use multiprocessing thread here
         Args:
-            outputs: pkl file generated from a single model
+            outputs: pkl file generated from a single model, or a ResultStore
+            writer: ResultWriter, if given the refined outputs are streamed
+                to it instead of being returned
 
         Returns:
 
@@ -1487,9 +1533,12 @@ class KagglePKUDataset(CustomDataset):
 
         outputs_refined = []
 
-        for output_refined in pool.imap(self.restore_pool, [(idx, output) for idx, output in enumerate(outputs)]):
+        for idx, output_refined in enumerate(pool.imap(self.restore_pool, enumerate(outputs))):
             # print('output_refined',output_refined)
-            outputs_refined.append(output_refined)
+            if writer is not None:
+                writer.append(output_refined, idx)
+            else:
+                outputs_refined.append(output_refined)
 
         return outputs_refined
 
@@ -1498,12 +1547,11 @@ class KagglePKUDataset(CustomDataset):
 
     def restore_xyz_withIOU_single(self, idx, output_origin, car_cls_coco=2):
         output = copy.deepcopy(output_origin)
-        print('idx', idx)
         bboxes, segms, six_dof = output[0], output[1], output[2]
         car_cls_score_pred = six_dof['car_cls_score_pred']
         quaternion_pred = six_dof['quaternion_pred']
         trans_pred_world = six_dof['trans_pred_world'].copy()
-        euler_angle = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+        euler_angle = quaternions_to_euler_angles(quaternion_pred)
         car_labels = np.argmax(car_cls_score_pred, axis=1)
         kaggle_car_labels = [self.unique_car_mode[x] for x in car_labels]
         car_names = np.array([car_id2name[x].name for x in kaggle_car_labels])
@@ -1516,7 +1564,7 @@ class KagglePKUDataset(CustomDataset):
                                                                        quaternion_pred)
         if flag:
             output[2]['quaternion_pred'] = quaternion_semisphere_refined
-            euler_angle = np.array([quaternion_to_euler_angle(x) for x in output[2]['quaternion_pred']])
+            euler_angle = get_euler_angles(output[2])
 
         trans_pred_world_refined = self.restore_x_y_from_z_withIOU(bboxes[car_cls_coco],
                                                                    segms[car_cls_coco],
@@ -1603,34 +1651,31 @@ class KagglePKUDataset(CustomDataset):
                                    refined_threshold2=28,
                                    IOU_threshold=0.3):
 
-        image_shape = np.array(self.image_shape)  # this is generally the case
-        if self.bottom_half:
-            image_shape[0] -= self.bottom_half
+        if self.iou_occlusion:
+            # all the cars are drawn together before and after the restoration
+            inds = np.flatnonzero(bboxes[:, -1] > score_thr)
+            trans_restored = trans_pred_world.copy()
+            for bbox_idx in inds:
+                trans_restored[bbox_idx] = self.get_xy_from_z(bboxes[bbox_idx], trans_pred_world[bbox_idx])
+            ious_before, ious_after = [self.get_visible_iou_scores(segms, class_names, euler_angle, trans, inds)
+                                       for trans in (trans_pred_world, trans_restored)]
+
         trans_pred_world_refined = trans_pred_world.copy()
         for bbox_idx in range(len(bboxes)):
             if bboxes[bbox_idx, -1] <= score_thr:  ## we only restore case when score > score_thr(0.1)
                 continue
 
             bbox = bboxes[bbox_idx]
-            ## below is the predicted mask
-            mask_all_pred = np.zeros(image_shape)  ## this is the background mask
-            mask_all_mesh = np.zeros(image_shape)
-            mask_pred = maskUtils.decode(segms[bbox_idx]).astype(np.bool)
-            mask_all_pred += mask_pred
-            mask_all_pred_area = np.sum(mask_all_pred == 1)
-
             t = trans_pred_world[bbox_idx]
             t_refined = self.get_xy_from_z(bbox, t)
 
-            score_iou_mask_before, score_iou_before = self.get_iou_score(bbox_idx, car_model_dict, camera_matrix,
-                                                                         class_names,
-                                                                         mask_all_pred, mask_all_mesh,
-                                                                         mask_all_pred_area,
-                                                                         euler_angle, t)
-            score_iou_mask_after, score_iou_after = self.get_iou_score(bbox_idx, car_model_dict, camera_matrix,
-                                                                       class_names,
-                                                                       mask_all_pred, mask_all_mesh, mask_all_pred_area,
-                                                                       euler_angle, t_refined)
+            if self.iou_occlusion:
+                score_iou_before, score_iou_after = ious_before[bbox_idx], ious_after[bbox_idx]
+            else:
+                score_iou_mask_before, score_iou_before = self.get_iou_score(segms[bbox_idx], class_names[bbox_idx],
+                                                                             euler_angle[bbox_idx], t)
+                score_iou_mask_after, score_iou_after = self.get_iou_score(segms[bbox_idx], class_names[bbox_idx],
+                                                                           euler_angle[bbox_idx], t_refined)
             if t[2] > refined_threshold2:
                 trans_pred_world_refined[bbox_idx] = t_refined
             elif t[2] < refined_threshold1:
@@ -1660,38 +1705,17 @@ class KagglePKUDataset(CustomDataset):
 
         return np.array([X, Y, z])
 
-    def get_iou_score(self, bbox_idx, car_model_dict, camera_matrix, class_names,
-                      mask_all_pred, mask_all_mesh, mask_all_pred_area, euler_angle, t):
-        vertices = np.array(car_model_dict[class_names[bbox_idx]]['vertices'])
-        vertices[:, 1] = -vertices[:, 1]
-        triangles = np.array(car_model_dict[class_names[bbox_idx]]['faces']) - 1
-
-        ea = euler_angle[bbox_idx]
-        yaw, pitch, roll = ea[0], ea[1], ea[2]
-        yaw, pitch, roll = -pitch, -yaw, -roll
-        Rt = np.eye(4)
-        Rt[:3, 3] = t
-        Rt[:3, :3] = euler_to_Rot(yaw, pitch, roll).T
-        Rt = Rt[:3, :]
-        P = np.ones((vertices.shape[0], vertices.shape[1] + 1))
-        P[:, :-1] = vertices
-        P = P.T
-
-        img_cor_points = np.dot(camera_matrix, np.dot(Rt, P))
-        img_cor_points = img_cor_points.T
-        img_cor_points[:, 0] /= img_cor_points[:, 2]
-        img_cor_points[:, 1] /= img_cor_points[:, 2]
-
-        mask_all_mesh_tmp = mask_all_mesh.copy()
-        for tri in triangles:
-            coord = np.array([img_cor_points[tri[0]][:2], img_cor_points[tri[1]][:2], img_cor_points[tri[2]][:2]],
-                             dtype=np.int32)
-            coord[:, 1] -= 1480
-            cv2.drawContours(mask_all_mesh_tmp, np.int32([coord]), 0, 1, -1)
-            # cv2.drawContours(img,np.int32([coord]),0,color,-1)
-
-        intersection_area = np.sum(mask_all_pred * mask_all_mesh_tmp)
-        union_area = np.sum(np.logical_or(mask_all_pred, mask_all_mesh_tmp))
-        iou_mask_score = intersection_area / mask_all_pred_area
-        iou_score = intersection_area / union_area
-        return iou_mask_score, iou_score
+    def get_iou_score(self, rle, car_name, euler_angle, t):
+        """(intersection / mask area, IoU) of a predicted mask of the bottom
+        half with the mesh of a car, memoised by ``self.iou_cache``."""
+        return self.iou_cache.iou(rle, car_name, euler_angle, t, y_offset=self.bottom_half)
+
+    def get_visible_iou_scores(self, segms, car_names, euler_angle, trans_pred_world, inds):
+        """IoUs of the cars ``inds`` with their visible silhouettes, the cars
+        drawn in one z-buffered pass, nan for the other cars."""
+        ious = np.full(len(trans_pred_world), np.nan)
+        if len(inds):
+            _, ious[inds] = self.iou_cache.instance_ious([segms[i] for i in inds], np.asarray(car_names)[inds],
+                                                         euler_angle[inds], trans_pred_world[inds],
+                                                         y_offset=self.bottom_half)
+        return ious
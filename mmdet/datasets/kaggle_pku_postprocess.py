@@ -0,0 +1,183 @@
+"""
+    Brief: Fused post-processing of the test outputs into a submission
+    The post-processing used to be a chain of scripts exchanging full pickles:
+    restore xyz -> _refined.pkl, model merge -> merged pickle, write_submission
+    -> csv. A PostprocessPipeline chains the same stages for one image: every
+    branch takes the output of a source through its stages, the branches are
+    merged and the merged output is turned into its submission line.
+
+    run_postprocess_pipeline streams the images through a pool of workers
+    which get the dataset (car meshes, camera, IoU cache) once, and writes
+    the csv line by line. The csv is the checkpoint: a crashed run is resumed
+    by skipping the ImageIds already written.
+"""
+import csv
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from mmdet.utils.worker_pool import worker_pool, worker_state
+from .car_models import car_id2name
+from .mesh_iou_cache import share_iou_cache_budget
+from .kaggle_pku_utils import euler_angles_to_quaternions, quaternions_upper_hemisphere, get_euler_angles, \
+    submission_record, filter_record
+from .visualisation_utils import search_pose_with_templates
+
+CAR_IDX = 2  # this is the coco car class
+
+
+def restore_xyz(dataset, output):
+    """Yaw and roll snapped and x, y restored from z with the IoU, as
+    tools/pkl_postprocessing_restore_xyz.py."""
+    return dataset.restore_xyz_withIOU_single(None, output)
+
+
+def search_pose(dataset, output, **kwargs):
+    """Render and compare pose search with the silhouette bank of the
+    dataset, see :func:`search_pose_with_templates`."""
+    bboxes, segms, six_dof = output
+    car_labels = np.argmax(six_dof['car_cls_score_pred'], axis=1)
+    car_names = np.array([car_id2name[dataset.unique_car_mode[x]].name for x in car_labels])
+    euler_angle, trans_pred_world = search_pose_with_templates(bboxes[CAR_IDX], segms[CAR_IDX], car_names,
+                                                               get_euler_angles(six_dof),
+                                                               six_dof['trans_pred_world'],
+                                                               dataset.load_silhouette_bank(),
+                                                               dataset.camera_matrix, **kwargs)
+    quaternion_pred = quaternions_upper_hemisphere(euler_angles_to_quaternions(euler_angle))
+    six_dof = dict(six_dof, trans_pred_world=trans_pred_world, quaternion_pred=quaternion_pred)
+    return bboxes, segms, six_dof
+
+
+def merge(dataset, outputs, vote=0):
+    """IoU nms and weighted translations of the outputs of several models, as
+    tools/model_merge.py."""
+    return dataset.distributed_visualise_pred_merge_postprocessing_weight_merge(
+        0, [[output] for output in outputs], None, vote=vote, tmp_dir=None)
+
+
+STAGES = dict(restore_xyz=restore_xyz, search_pose=search_pose)
+
+
+class PostprocessPipeline(object):
+    """Post-processing of the outputs of one image, from the outputs of the
+    sources to the submission line.
+
+    Example:
+        >>> # refined and raw outputs of the same model merged, the source
+        >>> # is read once for both branches
+        >>> pipeline = PostprocessPipeline(
+        >>>     dataset,
+        >>>     branches=[dict(source=0, stages=[dict(type='restore_xyz')]),
+        >>>               dict(source=0, stages=[])],
+        >>>     merge=dict(vote=0),
+        >>>     conf_thresh=0.1)
+
+    Args:
+        dataset (KagglePKUDataset): the car models, camera and IoU cache.
+        branches (list[dict]): the source index of every branch and its
+            stages, dict(type=name of :data:`STAGES`, **kwargs), in order.
+        merge (dict, optional): kwargs of :func:`merge`, required with
+            several branches.
+        conf_thresh (float): confidence threshold of the submission.
+        filter_mask (bool): drop the cars on the ignore masks.
+    """
+
+    def __init__(self, dataset, branches, merge=None, conf_thresh=0.1, filter_mask=True):
+        assert len(branches) == 1 or merge is not None, 'the branches must be merged'
+        for branch in branches:
+            for stage in branch.get('stages', []):
+                assert stage['type'] in STAGES, 'unknown post-processing stage {}'.format(stage['type'])
+        self.dataset = dataset
+        self.branches = branches
+        self.merge = merge
+        self.conf_thresh = conf_thresh
+        self.filter_mask = filter_mask
+
+    def __call__(self, outputs):
+        """Post-process an image.
+
+        Args:
+            outputs (list): the output of every source for the image.
+
+        Returns:
+            tuple: (output, coords_str), the post-processed output and its
+                PredictionString.
+        """
+        branch_outputs = []
+        for branch in self.branches:
+            output = outputs[branch['source']]
+            # the merge writes to the 6dof dicts, a source may feed several branches
+            output = (output[0], output[1], dict(output[2]))
+            for stage in branch.get('stages', []):
+                kwargs = dict(stage)
+                output = STAGES[kwargs.pop('type')](self.dataset, output, **kwargs)
+            branch_outputs.append(output)
+
+        if self.merge is None:
+            output = branch_outputs[0]
+        else:
+            output = merge(self.dataset, branch_outputs, **self.merge)
+        coords_str, _ = filter_record(submission_record(output), self.conf_thresh, self.dataset.img_prefix,
+                                      self.dataset, filter_mask=self.filter_mask)
+        return output, coords_str
+
+
+def read_submission_checkpoint(csv_file):
+    """ImageIds already written to a submission, the partial last line of an
+    interrupted run is cut from the file."""
+    if not os.path.isfile(csv_file):
+        return []
+    with open(csv_file, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        f.truncate(end)
+    # the first line is the header
+    return [line.split(',', 1)[0] for line in data[:end].decode().splitlines()[1:]]
+
+
+def _pipeline_single(pos):
+    state = worker_state()
+    output, coords_str = state['pipeline']([source[pos] for source in state['sources']])
+    return output if state['keep_outputs'] else None, coords_str
+
+
+def run_postprocess_pipeline(pipeline, sources, image_ids, csv_file, writer=None, num_workers=None):
+    """Post-process all the images with a pool of workers and write the
+    submission incrementally.
+
+    Args:
+        pipeline (callable): e.g. a :class:`PostprocessPipeline`, maps the
+            outputs of the sources for an image to (output, coords_str).
+        sources (list): the outputs of every source, aligned on
+            ``image_ids``, e.g. lists or result stores.
+        image_ids (list[str]): ImageId of every position of the sources.
+        csv_file (str): the submission, appended to when it exists.
+        writer (ResultWriter, optional): the post-processed outputs are also
+            streamed to it, the workers only return the csv lines otherwise.
+        num_workers (int, optional): default to all the cpus.
+
+    Returns:
+        dict: the number of images processed and of images already done.
+    """
+    done = set(read_submission_checkpoint(csv_file))
+    todo = [pos for pos, image_id in enumerate(image_ids) if image_id not in done]
+    num_workers = num_workers or os.cpu_count()
+    # small chunks keep the workers balanced, the images have very different
+    # numbers of cars
+    chunksize = max(1, len(todo) // (num_workers * 8))
+    # the workers split the budgets of the IoU caches
+    with worker_pool(num_workers, initializer=share_iou_cache_budget, initargs=(num_workers,), pipeline=pipeline,
+                     sources=sources, keep_outputs=writer is not None) as pool, \
+            open(csv_file, 'a', newline='') as f:
+        csv_writer = csv.writer(f)
+        if f.tell() == 0:
+            csv_writer.writerow(['ImageId', 'PredictionString'])
+        results = pool.imap(_pipeline_single, todo, chunksize=chunksize)
+        for pos, (output, coords_str) in zip(todo, tqdm(results, total=len(todo))):
+            if writer is not None:
+                # the csv line is written last, it marks the image as done
+                writer.append(output, pos, image_ids[pos])
+            csv_writer.writerow([image_ids[pos], coords_str])
+            f.flush()
+    return dict(images=len(todo), done=len(done))
@@ -12,6 +12,8 @@ from math import sin, cos
 import os
 from pycocotools import mask as maskUtils
 
+from mmdet.utils.worker_pool import worker_pool, worker_state
+
 
 def mesh_point_to_bbox(img):
     rows = np.any(img, axis=1)
@@ -178,6 +180,55 @@ def quaternion_to_euler_angle_apollo(q):
     return roll, pitch, yaw
 
 
+def quaternions_upper_hemisphere(q):
+    """Vectorised :func:`quaternion_upper_hemispher`.
+
+    Every quaternion is negated when its first non zero component among
+    (a, b, c) is negative, d is set to 1 when a = b = c = 0.
+
+    Input:
+        q: n x 4 matrix
+    Output:
+        q: n x 4 matrix, a copy of the input on the upper half of S3
+    """
+    q = np.array(q, dtype=np.float64).reshape(-1, 4)
+    nonzero = q[:, :3] != 0
+    lead = q[np.arange(len(q)), np.argmax(nonzero, axis=1)]
+    q[lead < 0] *= -1
+    q[~nonzero.any(axis=1), 3] = 1
+    return q
+
+
+def quaternions_to_euler_angles(q):
+    """Vectorised :func:`quaternion_to_euler_angle`.
+
+    Input:
+        q: n x 4 matrix (a list of n quaternions is accepted as well)
+    Output:
+        angle: n x 3 matrix, each row is [yaw, pitch, roll] in the label
+            convention (the same order as :func:`quaternion_to_euler_angle`)
+    """
+    q = np.asarray(q, dtype=np.float64).reshape(-1, 4)
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    roll = np.arctan2(2.0 * (w * x + y * z), 1.0 - 2.0 * (x * x + y * y))
+    pitch = np.arcsin(np.clip(2.0 * (w * y - z * x), -1.0, 1.0))
+    yaw = np.arctan2(2.0 * (w * z + x * y), 1.0 - 2.0 * (y * y + z * z))
+
+    # transform label RPY: yaw, pitch, roll => pitch, yaw, roll
+    return np.stack([pitch, yaw, roll], axis=1)
+
+
+def get_euler_angles(output_6dof):
+    """n x 3 euler angles of a 6dof test output.
+
+    'quaternion_pred' is the rotation of record, the post-processing (merge,
+    yaw and roll refinement, NMR) replaces it, so the angles are always
+    converted from it. An 'euler_angle' key of older outputs may be stale and
+    is ignored.
+    """
+    return quaternions_to_euler_angles(output_6dof['quaternion_pred'])
+
+
 def intrinsic_vec_to_mat(intrinsic, shape=None):
     """Convert a 4 dim intrinsic vector to a 3x3 intrinsic
        matrix
@@ -602,6 +653,11 @@ def filter_igore_masked_images(
     return idx_keep_mask
 
 
+def _load_ignore_mask(mask_file):
+    # same as np.mean(mask_im, axis=2) > 0 for the uint8 channels
+    return cv2.imread(mask_file).any(axis=2)
+
+
 def filter_igore_masked_using_RT(
         img_name,
         six_dof,
@@ -614,6 +670,8 @@ def filter_igore_masked_using_RT(
     :param img_prefix:
     :return:
     """
+    # imported here as mesh_rasterizer itself depends on this module
+    from .mesh_iou_cache import shared_iou_cache
 
     # a hard coded path for extractin ignore test mask region
     if 'valid' in img_prefix:
@@ -622,13 +680,13 @@ def filter_igore_masked_using_RT(
         mask_dir = img_prefix.replace('test_images', 'test_masks')
 
     mask_file = os.path.join(mask_dir, img_name + '.jpg')
-    if os.path.isfile(mask_file):
-        mask_im = cv2.imread(mask_file)
-        mask_im = np.mean(mask_im, axis=2)
-        mask_im[mask_im > 0] = 1
-    else:
+    if not os.path.isfile(mask_file):
         # there is no ignore mask
         return [True] * six_dof['quaternion_pred'].shape[0]
+    iou_cache = getattr(dataset, 'iou_cache', None)
+    if iou_cache is None:
+        iou_cache = shared_iou_cache(dataset.car_model_dict, dataset.camera_matrix)
+    mask_im, mask_key = iou_cache.file_mask(mask_file, _load_ignore_mask)
 
     idx_keep_mask = [False] * six_dof['quaternion_pred'].shape[0]
 
@@ -636,7 +694,7 @@ def filter_igore_masked_using_RT(
     car_cls_score_pred = six_dof['car_cls_score_pred']
     quaternion_pred = six_dof['quaternion_pred']
     trans_pred_world = six_dof['trans_pred_world']
-    euler_angle = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+    euler_angle = quaternions_to_euler_angles(quaternion_pred)
     car_labels = np.argmax(car_cls_score_pred, axis=1)
     kaggle_car_labels = [dataset.unique_car_mode[x] for x in car_labels]
     car_names = [dataset.car_id2name[x].name for x in kaggle_car_labels]
@@ -647,43 +705,9 @@ def filter_igore_masked_using_RT(
         # now we draw mesh
         # car_id2name is from:
         # https://github.com/ApolloScapeAuto/dataset-api/blob/master/car_instance/car_models.py
-        car_name = car_names[i]
-        vertices = np.array(dataset.car_model_dict[car_name]['vertices'])
-        vertices[:, 1] = -vertices[:, 1]
-        triangles = np.array(dataset.car_model_dict[car_name]['faces']) - 1
-
-        # project 3D points to 2d image plane
-        yaw, pitch, roll = euler_angle[i]
-        # I think the pitch and yaw should be exchanged
-        yaw, pitch, roll = -pitch, -yaw, -roll
-        Rt = np.eye(4)
-        t = np.array(trans_pred_world[i])
-        Rt[:3, 3] = t
-        Rt[:3, :3] = euler_to_Rot(yaw, pitch, roll).T
-        Rt = Rt[:3, :]
-        P = np.ones((vertices.shape[0], vertices.shape[1] + 1))
-        P[:, :-1] = vertices
-        P = P.T
-
-        img_cor_points = np.dot(dataset.camera_matrix, np.dot(Rt, P))
-        img_cor_points = img_cor_points.T
-        img_cor_points[:, 0] /= img_cor_points[:, 2]
-        img_cor_points[:, 1] /= img_cor_points[:, 2]
-
-        # project 3D points to 2d image plane
-        mask_seg = np.zeros(dataset.image_shape, dtype=np.uint8)
-        for t in triangles:
-            coord = np.array([img_cor_points[t[0]][:2], img_cor_points[t[1]][:2], img_cor_points[t[2]][:2]],
-                             dtype=np.int32)
-            # This will draw the mask for segmenation
-            cv2.drawContours(mask_seg, np.int32([coord]), 0, (255, 255, 255), -1)
-            # cv2.polylines(mask_seg_mesh, np.int32([coord]), 1, (0, 255, 0))
-
-        # now we calculate the IoU:
-        area_car = mask_seg.sum()
-        interception = mask_seg * mask_im
-        area_interception = interception.sum()
-        iou_car = area_interception / area_car
+        # the silhouette is rasterised once per pose and cropped to its bbox,
+        # as the ignore mask, by the cache
+        iou_car = iou_cache.mesh_overlap(mask_im, mask_key, car_names[i], euler_angle[i], trans_pred_world[i])
         if iou_car < iou_threshold:
             idx_keep_mask[i] = True
         # else:
@@ -705,35 +729,95 @@ def coords2str(coords):
 
 
 def filter_output(output_idx, outputs, conf_thresh, img_prefix, dataset):
-    output = outputs[output_idx]
+    return filter_record(submission_record(outputs[output_idx]), conf_thresh, img_prefix, dataset)
+
+
+def submission_record(output):
+    """The part of an output needed for its submission line: the ImageId,
+    the car bboxes and the pose arrays, without the masks."""
+    CAR_IDX = 2  # this is the coco car class
     file_name = os.path.basename(output[2]["file_name"])
     ImageId = ".".join(file_name.split(".")[:-1])
-    CAR_IDX = 2  # this is the coco car class
+    six_dof = {k: output[2][k] for k in ('car_cls_score_pred', 'quaternion_pred', 'trans_pred_world')}
+    return ImageId, output[0][CAR_IDX], six_dof
 
-    # Wudi change the conf to car prediction
-    if len(output[0][CAR_IDX]):
-        conf = output[0][CAR_IDX][:, -1]  # output [0] is the bbox
-        idx_conf = conf > conf_thresh
 
+def record_coords(record, img_prefix, dataset, filter_mask=True):
+    """(coords, idx_keep_mask) of all the cars of a record: the n x 7 euler
+    angles, translations and confidences of the submission, and the cars
+    kept by the ignore mask filtering (all of them without ``filter_mask``)."""
+    ImageId, car_bboxes, six_dof = record
+    if not len(car_bboxes):
+        return np.zeros((0, 7)), np.zeros(0, dtype=bool)
+
+    # Wudi change the conf to car prediction
+    conf = car_bboxes[:, -1]  # output [0] is the bbox
+    if filter_mask:
         # this filtering step will takes 2 second per iterations
         # idx_keep_mask = filter_igore_masked_images(ImageId[idx_img], output[1][CAR_IDX], img_prefix)
-        idx_keep_mask = filter_igore_masked_using_RT(ImageId, output[2], img_prefix, dataset)
+        idx_keep_mask = np.array(filter_igore_masked_using_RT(ImageId, six_dof, img_prefix, dataset), dtype=bool)
+    else:
+        idx_keep_mask = np.ones(len(conf), dtype=bool)
+    euler_angle = get_euler_angles(six_dof)
+    # This is a new modification because in CYH's new json file;
+    translation = six_dof['trans_pred_world']
+    return np.hstack((euler_angle, translation, conf[:, None])), idx_keep_mask
+
+
+def filter_record(record, conf_thresh, img_prefix, dataset, filter_mask=True):
+    ImageId, car_bboxes, six_dof = record
+
+    if len(car_bboxes):
+        coords, idx_keep_mask = record_coords(record, img_prefix, dataset, filter_mask)
         # the final id should require both
-        idx = idx_conf * idx_keep_mask
-        if 'euler_angle' in output[2].keys():
-            euler_angle = output[2]['euler_angle']
-        else:
-            euler_angle = np.array([quaternion_to_euler_angle(x) for x in output[2]['quaternion_pred']])
-        # This is a new modification because in CYH's new json file;
-        translation = output[2]['trans_pred_world']
-        coords = np.hstack((euler_angle[idx], translation[idx], conf[idx, None]))
-        coords_str = coords2str(coords)
+        idx = (coords[:, -1] > conf_thresh) & idx_keep_mask
+        coords_str = coords2str(coords[idx])
     else:
         coords_str = ""
 
     return coords_str, ImageId
 
 
+def _filter_record_worker(record):
+    state = worker_state()
+    return filter_record(record, state['conf_thresh'], state['img_prefix'], state['dataset'])
+
+
+def _record_coords_worker(record):
+    state = worker_state()
+    return record[0], record_coords(record, state['img_prefix'], state['dataset'], state['filter_mask'])
+
+
+def filter_outputs_pool(outputs, conf_thresh, img_prefix, dataset, max_workers=20):
+    """Filter the outputs by confidence and ignore mask with a pool of
+    workers, yield (coords_str, ImageId) in the order of ``outputs``.
+
+    The dataset is handed to each worker once by :func:`worker_pool`, only the
+    small per-image records of :func:`submission_record` go through the task
+    queue. Each worker keeps its own ignore masks and car silhouettes cached,
+    within its share of the cache budgets.
+    """
+    from .mesh_iou_cache import share_iou_cache_budget
+    chunksize = max(1, len(outputs) // (max_workers * 8))
+    with worker_pool(max_workers, initializer=share_iou_cache_budget, initargs=(max_workers,),
+                     conf_thresh=conf_thresh, img_prefix=img_prefix, dataset=dataset) as pool:
+        for result in pool.imap(_filter_record_worker, (submission_record(output) for output in outputs), chunksize):
+            yield result
+
+
+def record_coords_pool(outputs, img_prefix, dataset, filter_mask=True, max_workers=20):
+    """Yield (ImageId, (coords, idx_keep_mask)) of :func:`record_coords` for
+    the outputs, in order, with the pool of :func:`filter_outputs_pool`.
+    Nothing is thresholded or formatted, the confidence can be chosen
+    afterwards."""
+    from .mesh_iou_cache import share_iou_cache_budget
+    chunksize = max(1, len(outputs) // (max_workers * 8))
+    with worker_pool(max_workers, initializer=share_iou_cache_budget, initargs=(max_workers,),
+                     img_prefix=img_prefix, dataset=dataset, filter_mask=filter_mask) as pool:
+        for result in pool.imap(_record_coords_worker, (submission_record(output) for output in outputs), chunksize):
+            yield result
+
+
 def non_max_suppression_fast(boxes, overlapThresh):
     """
     https://www.pyimagesearch.com/2015/02/16/faster-non-maximum-suppression-python/
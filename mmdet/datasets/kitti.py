@@ -2,7 +2,6 @@ import os
 import cv2
 from PIL import Image
 import math
-import json
 import numpy as np
 from collections import namedtuple
 from tqdm import tqdm
@@ -21,6 +20,7 @@ from matplotlib import transforms
 
 
 from .car_models import car_id2name
+from .car_model_bank import CarModelBank
 from .kitti_utils import bbox_corners, perspective
 
 KITTI_CLASS_NAMES = ['Car', 'Van', 'Truck', 'Pedestrian', 'Person_sitting',
@@ -78,13 +78,7 @@ class KittiObjectDataset(CustomDataset):
         return len(self.img_infos)
 
     def load_car_models(self, json_model_dir='/data/Kaggle/pku-autonomous-driving'):
-        car_model_dir = os.path.join(json_model_dir, 'car_models_json')
-        car_model_dict = {}
-        for car_name in tqdm(os.listdir(car_model_dir)):
-            with open(os.path.join(self.outdir, 'car_models_json', car_name)) as json_file:
-                car_model_dict[car_name[:-5]] = json.load(json_file)
-
-        return car_model_dict
+        return CarModelBank(json_model_dir)
 
     def load_anno_idx(self, index):
         idx = self.indices[index]
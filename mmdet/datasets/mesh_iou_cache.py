@@ -0,0 +1,388 @@
+"""
+    Brief: Memoised IoU between the projected car meshes and the masks
+    The merge (get_IOU), the x, y restoration from z and the ignore mask
+    filtering all compare the silhouette of a (car model, R, T) with a
+    predicted RLE or an ignore mask. The silhouettes are rasterised once per
+    quantised pose and the masks decoded once, both are kept cropped to their
+    bbox so the intersection only touches the overlapping window.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from mmdet.core.mask.rle import decode_cropped
+from .mesh_rasterizer import project_vertices, rasterize_mesh, crop_mask, shift_mask, cropped_intersection, \
+    rasterize_instances, instance_overlaps
+
+IMAGE_SHAPE = (2710, 3384)
+# default budgets of a cache
+MAX_MESH_BYTES = 512 * 1024 ** 2
+MAX_MASK_BYTES = 256 * 1024 ** 2
+MAX_INTERSECTIONS = 2 ** 20
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+
+class _LRUCache(object):
+    """OrderedDict based LRU bounded by the total size of its values, shared
+    by the post-processing threads of the test."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return value[0]
+
+    def put(self, key, value, nbytes):
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self._items) > 1:
+            _, (_, evicted) = self._items.popitem(last=False)
+            self.nbytes -= evicted
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+class _CroppedMask(object):
+    """A bbox-cropped binary mask with its per-row cumulative area, so the
+    area left after cropping the top rows of the image is O(1)."""
+
+    __slots__ = ('mask', 'offset', 'row_area')
+
+    def __init__(self, mask, offset):
+        self.mask = mask.astype(bool)
+        self.offset = offset
+        self.row_area = np.concatenate([[0], np.cumsum(np.count_nonzero(self.mask, axis=1))])
+
+    @property
+    def area(self):
+        return int(self.row_area[-1])
+
+    @property
+    def nbytes(self):
+        return self.mask.nbytes + self.row_area.nbytes
+
+    def intersection(self, mask, offset):
+        return cropped_intersection(self.mask, self.offset, mask, offset)
+
+    def shifted(self, y_offset):
+        """(mask, offset, area) in the image cropped by its top ``y_offset``
+        rows."""
+        if not y_offset:
+            return self.mask, self.offset, self.area
+        mask, offset = shift_mask(self.mask, self.offset, y_offset)
+        dropped = len(self.mask) - len(mask)
+        return mask, offset, int(self.row_area[-1] - self.row_area[dropped])
+
+
+class _PackedMask(object):
+    """A bbox-cropped binary mask packed 8 pixels per byte along x, for the
+    masks kept for a whole run such as the ignore masks. Intersections are
+    computed on the packed bits of the overlapping window."""
+
+    __slots__ = ('bits', 'offset', 'shape', 'area')
+
+    def __init__(self, mask, offset):
+        mask = mask.astype(bool)
+        self.bits = np.packbits(mask, axis=1)
+        self.offset = offset
+        self.shape = mask.shape
+        self.area = int(np.count_nonzero(mask))
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def intersection(self, mask, offset):
+        """Number of pixels shared with a cropped (unpacked) mask."""
+        xa, ya = self.offset
+        xb, yb = offset
+        x0, y0 = max(xa, xb), max(ya, yb)
+        x1 = min(xa + self.shape[1], xb + mask.shape[1])
+        y1 = min(ya + self.shape[0], yb + mask.shape[0])
+        if x1 <= x0 or y1 <= y0:
+            return 0
+        # align the window of the other mask on the byte grid of the bits
+        c0, c1 = (x0 - xa) // 8, (x1 - xa + 7) // 8
+        start = x0 - xa - c0 * 8
+        aligned = np.zeros((y1 - y0, (c1 - c0) * 8), dtype=bool)
+        aligned[:, start:start + x1 - x0] = mask[y0 - yb:y1 - yb, x0 - xb:x1 - xb]
+        shared = np.bitwise_and(np.packbits(aligned, axis=1), self.bits[y0 - ya:y1 - ya, c0:c1])
+        return int(_POPCOUNT[shared].sum())
+
+
+def _ratio(a, b):
+    # same result as the numpy division of the original code, nan for 0 / 0
+    return a / b if b else np.nan
+
+
+class MeshIoUCache(object):
+    """IoU service shared by the post-processing steps of a run.
+
+    The poses are quantised with ``angle_step`` (rad) and ``trans_step`` (m)
+    and the mesh is rasterised at the quantised pose, so a key always maps to
+    the same silhouette. The steps are far below one pixel of displacement.
+
+    The budgets hold for the process owning the cache. The workers of a
+    process pool each keep their own copy, they split the budgets of the
+    process wide caches with :func:`share_iou_cache_budget`.
+
+    Args:
+        car_model_dict (CarModelBank): the car meshes.
+        camera_matrix (ndarray): 3x3 intrinsic matrix.
+        image_shape (tuple): (h, w) of the full images, the silhouettes are
+            rasterised in full image coordinates and shifted to the
+            ``bottom_half`` crop of the predictions on demand.
+        max_mesh_bytes (int): memory budget of the silhouette LRU.
+        max_mask_bytes (int): memory budget of the decoded mask LRU.
+        max_intersections (int): number of memoised intersections.
+    """
+
+    def __init__(self,
+                 car_model_dict,
+                 camera_matrix,
+                 image_shape=IMAGE_SHAPE,
+                 angle_step=1e-5,
+                 trans_step=1e-4,
+                 max_mesh_bytes=MAX_MESH_BYTES,
+                 max_mask_bytes=MAX_MASK_BYTES,
+                 max_intersections=MAX_INTERSECTIONS):
+        self.car_model_dict = car_model_dict
+        self.camera_matrix = np.asarray(camera_matrix)
+        self.image_shape = tuple(image_shape)
+        self.angle_step = angle_step
+        self.trans_step = trans_step
+        self.max_mesh_bytes = max_mesh_bytes
+        self.max_mask_bytes = max_mask_bytes
+        self.max_intersections = max_intersections
+        # a process wide cache of shared_iou_cache
+        self.shared = False
+        self._reset()
+
+    def _reset(self):
+        self._meshes = _LRUCache(self.max_mesh_bytes)
+        self._masks = _LRUCache(self.max_mask_bytes)
+        # an LRU of a unit size per entry, bounded by the number of entries
+        self._intersections = _LRUCache(self.max_intersections)
+
+    def __getstate__(self):
+        # the cached silhouettes are not sent to spawned workers
+        state = self.__dict__.copy()
+        for k in ('_meshes', '_masks', '_intersections'):
+            state.pop(k)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+        if self.shared:
+            # a spawned worker finds the cache of its dataset with shared_iou_cache
+            _shared_caches.setdefault(_shared_key(self.car_model_dict, self.camera_matrix, self.image_shape), self)
+            self.set_budget(*_shared_budget())
+
+    def pose_key(self, car_name, euler_angle, translation):
+        euler_q = np.round(np.asarray(euler_angle, dtype=np.float64) / self.angle_step).astype(np.int64)
+        trans_q = np.round(np.asarray(translation, dtype=np.float64) / self.trans_step).astype(np.int64)
+        return str(car_name), tuple(euler_q.tolist()), tuple(trans_q.tolist())
+
+    def mesh(self, car_name, euler_angle, translation):
+        """Cropped silhouette of a car in full image coordinates."""
+        key = self.pose_key(car_name, euler_angle, translation)
+        return self._mesh(key), key
+
+    def _mesh(self, key):
+        silhouette = self._meshes.get(key)
+        if silhouette is None:
+            car_name, euler_q, trans_q = key
+            vertices, triangles = self.car_model_dict.get_mesh(car_name)
+            img_cor_points = project_vertices(vertices,
+                                              np.array(euler_q) * self.angle_step,
+                                              np.array(trans_q) * self.trans_step,
+                                              self.camera_matrix)
+            silhouette = _CroppedMask(*rasterize_mesh(img_cor_points, triangles, self.image_shape))
+            self._meshes.put(key, silhouette, silhouette.nbytes)
+        return silhouette
+
+    def rle_mask(self, rle, image_id=None):
+        """Cropped decoded mask of a predicted RLE (or of a cropped mask of
+        ``get_seg_masks``), in the coordinates of the image the RLE was
+        encoded in. The RLE is decoded in its bbox only."""
+        # the masks are keyed by a digest of their content, the keys of the
+        # caches stay small whatever the size of the masks
+        if 'mask' in rle:
+            key = ('crop', image_id, tuple(rle['offset']), rle['mask'].shape,
+                   hashlib.sha1(rle['mask'].tobytes()).digest())
+        else:
+            counts = rle['counts']
+            counts = counts if isinstance(counts, bytes) else str(counts).encode()
+            key = ('rle', image_id, tuple(rle['size']), hashlib.sha1(counts).digest())
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = _CroppedMask(*crop_mask(*decode_cropped(rle)))
+            self._masks.put(key, mask, mask.nbytes)
+        return mask, key
+
+    def file_mask(self, mask_file, loader):
+        """Cropped mask read from an image file with ``loader(mask_file)``,
+        stored as packed bits."""
+        key = ('file', mask_file)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = _PackedMask(*crop_mask(loader(mask_file)))
+            self._masks.put(key, mask, mask.nbytes)
+        return mask, key
+
+    def _intersection(self, mask, mask_key, silhouette, mesh_key, y_offset):
+        key = (mask_key, mesh_key, y_offset)
+        shifted = silhouette.shifted(y_offset)
+        intersection = self._intersections.get(key)
+        if intersection is None:
+            intersection = mask.intersection(shifted[0], shifted[1])
+            self._intersections.put(key, intersection, 1)
+        return intersection, shifted[2]
+
+    def iou(self, rle, car_name, euler_angle, translation, y_offset=0, image_id=None):
+        """IoU of a predicted RLE with the silhouette of a car.
+
+        Args:
+            rle (dict): predicted mask, encoded in the image cropped by its
+                top ``y_offset`` rows.
+            y_offset (int): e.g. the ``bottom_half`` crop.
+
+        Returns:
+            tuple: (intersection / mask area, intersection / union)
+        """
+        mask, mask_key = self.rle_mask(rle, image_id)
+        silhouette, mesh_key = self.mesh(car_name, euler_angle, translation)
+        intersection, mesh_area = self._intersection(mask, mask_key, silhouette, mesh_key, y_offset)
+        union = mask.area + mesh_area - intersection
+        return _ratio(intersection, mask.area), _ratio(intersection, union)
+
+    def instance_ious(self, rles, car_names, euler_angles, translations, y_offset=0, image_id=None):
+        """IoU of the predicted RLEs with the visible part of the silhouettes
+        of their cars, the cars hiding each other.
+
+        All the cars are drawn in a single z-buffered pass, the scene is not
+        memoised as it changes with the pose of any car.
+
+        Args:
+            rles (list[dict]): predicted mask of every car, encoded in the
+                image cropped by its top ``y_offset`` rows.
+
+        Returns:
+            tuple: (intersection / mask area, intersection / union) arrays
+        """
+        points_list, triangles_list = [], []
+        for car_name, euler_angle, translation in zip(car_names, euler_angles, translations):
+            vertices, triangles = self.car_model_dict.get_mesh(car_name)
+            points_list.append(project_vertices(vertices, euler_angle, translation, self.camera_matrix))
+            triangles_list.append(triangles)
+        image_shape = (self.image_shape[0] - y_offset, self.image_shape[1])
+        instance_map, _ = rasterize_instances(points_list, triangles_list, image_shape, y_offset=y_offset)
+
+        masks = [self.rle_mask(rle, image_id)[0] for rle in rles]
+        intersection, visible = instance_overlaps(instance_map, [(mask.mask, mask.offset) for mask in masks])
+        area = np.array([mask.area for mask in masks], dtype=np.int64)
+        union = area + visible - intersection
+        # same as _ratio, nan for 0 / 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return intersection / area, intersection / union
+
+    def mesh_overlap(self, mask, mask_key, car_name, euler_angle, translation):
+        """Fraction of the silhouette of a car covered by a full image mask
+        returned by :meth:`file_mask`."""
+        silhouette, mesh_key = self.mesh(car_name, euler_angle, translation)
+        intersection, mesh_area = self._intersection(mask, mask_key, silhouette, mesh_key, 0)
+        return _ratio(intersection, mesh_area)
+
+    def stats(self):
+        return dict(meshes=len(self._meshes), mesh_hits=self._meshes.hits, mesh_misses=self._meshes.misses,
+                    masks=len(self._masks), mask_hits=self._masks.hits, mask_misses=self._masks.misses,
+                    intersections=len(self._intersections))
+
+    def set_budget(self, max_mesh_bytes, max_mask_bytes, max_intersections):
+        """Change the budgets, the least recently used entries above them
+        are evicted."""
+        self.max_mesh_bytes = max_mesh_bytes
+        self.max_mask_bytes = max_mask_bytes
+        self.max_intersections = max_intersections
+        self._meshes.resize(max_mesh_bytes)
+        self._masks.resize(max_mask_bytes)
+        self._intersections.resize(max_intersections)
+
+    def clear(self):
+        self._reset()
+
+
+_shared_caches = dict()
+# number of processes the default budgets of the process wide caches are
+# split between, see share_iou_cache_budget
+_budget_share = 1
+
+
+def _shared_budget():
+    return [max(1, budget // _budget_share) for budget in (MAX_MESH_BYTES, MAX_MASK_BYTES, MAX_INTERSECTIONS)]
+
+
+def _shared_key(car_model_dict, camera_matrix, image_shape):
+    return id(car_model_dict), np.asarray(camera_matrix).tobytes(), tuple(image_shape)
+
+
+def shared_iou_cache(car_model_dict, camera_matrix, image_shape=IMAGE_SHAPE):
+    """Process wide :class:`MeshIoUCache` of a car model bank, so the
+    functions called without an explicit cache still share the silhouettes."""
+    key = _shared_key(car_model_dict, camera_matrix, image_shape)
+    if key not in _shared_caches:
+        # the cache keeps a reference to car_model_dict, its id stays valid
+        max_mesh_bytes, max_mask_bytes, max_intersections = _shared_budget()
+        cache = MeshIoUCache(car_model_dict, camera_matrix, image_shape, max_mesh_bytes=max_mesh_bytes,
+                             max_mask_bytes=max_mask_bytes, max_intersections=max_intersections)
+        cache.shared = True
+        _shared_caches[key] = cache
+    return _shared_caches[key]
+
+
+def share_iou_cache_budget(num_processes):
+    """Split the default budgets of the process wide caches between
+    ``num_processes`` processes.
+
+    Called in every worker of a pool, e.g. as the initializer of
+    :func:`mmdet.utils.worker_pool`, the caches of all the workers together
+    stay within the budgets of a single process. The caches inherited from
+    the parent are trimmed.
+    """
+    global _budget_share
+    _budget_share = max(1, num_processes)
+    for cache in _shared_caches.values():
+        cache.set_budget(*_shared_budget())
@@ -0,0 +1,280 @@
+"""
+    Brief: Vectorised silhouette rasterisation of projected car meshes
+    All the triangles of a mesh are scan-converted in a single NumPy pass
+    inside the projected bounding box, so no full-frame canvas is allocated.
+"""
+import numpy as np
+
+from .kaggle_pku_utils import euler_to_Rot
+
+
+def project_vertices(vertices, euler_angle, translation, camera_matrix):
+    """Project the mesh vertices of a car onto the image plane.
+
+    Args:
+        vertices (ndarray): (N, 3) mesh vertices with the y axis already
+            flipped.
+        euler_angle (ndarray): (yaw, pitch, roll) in the Kaggle convention.
+        translation (ndarray): (x, y, z) in camera coordinates.
+        camera_matrix (ndarray): 3x3 intrinsic matrix.
+
+    Returns:
+        ndarray: (N, 3) array of (u, v, z), u and v in pixels.
+    """
+    yaw, pitch, roll = euler_angle
+    # I think the pitch and yaw should be exchanged
+    yaw, pitch, roll = -pitch, -yaw, -roll
+    rot = euler_to_Rot(yaw, pitch, roll).T
+    cam_points = np.dot(vertices, rot.T) + np.asarray(translation, dtype=np.float64)
+    img_cor_points = np.dot(cam_points, np.asarray(camera_matrix).T)
+    img_cor_points[:, 0] /= img_cor_points[:, 2]
+    img_cor_points[:, 1] /= img_cor_points[:, 2]
+    return img_cor_points
+
+
+def _triangle_spans(tri, y0, y1, inv_z=None):
+    """Horizontal spans of triangles, one per (triangle, pixel row) pair in
+    the rows [y0, y1].
+
+    Args:
+        tri (ndarray): (T, 3, 2) integer pixel coordinates of the triangles.
+        inv_z (ndarray, optional): (T, 3) 1 / z of the triangle vertices, it
+            is interpolated along the edges to the ends of the spans.
+
+    Returns:
+        tuple: (tri_idx, y, x_left, x_right[, w_left, w_right]), the span
+            ends are not rounded and ``w_*`` are the 1 / z at the ends.
+    """
+    tx, ty = tri[..., 0], tri[..., 1]
+    row_min = np.maximum(ty.min(axis=1), y0)
+    row_max = np.minimum(ty.max(axis=1), y1)
+    num_rows = np.maximum(row_max - row_min + 1, 0)
+    tri_idx = np.repeat(np.arange(len(tri)), num_rows)
+    first = np.cumsum(num_rows) - num_rows
+    y = row_min[tri_idx] + (np.arange(tri_idx.size) - first[tri_idx])
+
+    x_left = np.full(y.shape, np.inf)
+    x_right = np.full(y.shape, -np.inf)
+    if inv_z is not None:
+        w_left = np.zeros(y.shape)
+        w_right = np.zeros(y.shape)
+    for a, b in ((0, 1), (1, 2), (2, 0)):
+        xa, ya = tx[tri_idx, a].astype(np.float64), ty[tri_idx, a]
+        xb, yb = tx[tri_idx, b].astype(np.float64), ty[tri_idx, b]
+        crossing = (y >= np.minimum(ya, yb)) & (y <= np.maximum(ya, yb))
+        dy = yb - ya
+        horizontal = dy == 0
+        x_cross = xa + (y - ya) * (xb - xa) / np.where(horizontal, 1, dy)
+        lo = np.where(horizontal, np.minimum(xa, xb), x_cross)
+        hi = np.where(horizontal, np.maximum(xa, xb), x_cross)
+        if inv_z is not None:
+            wa, wb = inv_z[tri_idx, a], inv_z[tri_idx, b]
+            w_cross = wa + (y - ya) * (wb - wa) / np.where(horizontal, 1, dy)
+            w_lo = np.where(horizontal, np.where(xa <= xb, wa, wb), w_cross)
+            w_hi = np.where(horizontal, np.where(xa <= xb, wb, wa), w_cross)
+            w_left = np.where(crossing & (lo < x_left), w_lo, w_left)
+            w_right = np.where(crossing & (hi > x_right), w_hi, w_right)
+        x_left = np.where(crossing, np.minimum(x_left, lo), x_left)
+        x_right = np.where(crossing, np.maximum(x_right, hi), x_right)
+    if inv_z is not None:
+        return tri_idx, y, x_left, x_right, w_left, w_right
+    return tri_idx, y, x_left, x_right
+
+
+def _round_spans(x_left, x_right, x0, x1):
+    """Pixel spans [x_left, x_right) relative to x0, clipped to [x0, x1]."""
+    x_left = np.clip(np.floor(x_left + 0.5), x0, x1 + 1).astype(np.int64) - x0
+    x_right = np.clip(np.floor(x_right + 0.5), x0 - 1, x1).astype(np.int64) - x0 + 1
+    return x_left, x_right
+
+
+def rasterize_mesh(points, triangles, image_shape=None, y_offset=0):
+    """Fill all the triangles of a projected mesh in one pass.
+
+    Every triangle is split into horizontal spans (one per pixel row), the
+    spans are accumulated into a difference image and a cumulative sum along
+    x gives the union of the triangles. Only the projected bounding box is
+    rasterised.
+
+    Args:
+        points (ndarray): (N, >=2) projected vertices, the first two columns
+            are pixel coordinates. They are truncated to int32 as with
+            ``cv2.drawContours``.
+        triangles (ndarray): (T, 3) 0-based vertex indices.
+        image_shape (tuple, optional): (h, w) of the image the mask belongs
+            to, the mask is clipped to it.
+        y_offset (int): subtracted from the y coordinates after truncation,
+            e.g. the ``bottom_half`` crop.
+
+    Returns:
+        tuple: (mask, offset). ``mask`` is a uint8 {0, 1} array covering the
+            (clipped) projected bbox and ``offset`` its (x0, y0) top-left
+            corner in image coordinates.
+    """
+    pts = np.asarray(points)[:, :2].astype(np.int32).astype(np.int64)
+    pts[:, 1] -= int(y_offset)
+    tri = pts[np.asarray(triangles)]
+
+    x0, y0 = pts.min(axis=0)
+    x1, y1 = pts.max(axis=0)
+    if image_shape is not None:
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, image_shape[1] - 1), min(y1, image_shape[0] - 1)
+    if x1 < x0 or y1 < y0:
+        return np.zeros((0, 0), dtype=np.uint8), (int(x0), int(y0))
+    h, w = int(y1 - y0 + 1), int(x1 - x0 + 1)
+
+    _, y, x_left, x_right = _triangle_spans(tri, y0, y1)
+    x_left, x_right = _round_spans(x_left, x_right, x0, x1)
+    valid = x_right > x_left
+    rows = y[valid] - y0
+    size = h * (w + 1)
+    diff = np.bincount(rows * (w + 1) + x_left[valid], minlength=size) - \
+        np.bincount(rows * (w + 1) + x_right[valid], minlength=size)
+    mask = np.cumsum(diff.reshape(h, w + 1)[:, :w], axis=1) > 0
+    return mask.astype(np.uint8), (int(x0), int(y0))
+
+
+def rasterize_instances(points_list, triangles_list, image_shape, y_offset=0):
+    """Draw the projected meshes of all the cars of an image into one
+    z-buffer, so every pixel belongs to the nearest car only.
+
+    The spans of :func:`rasterize_mesh` are expanded into pixels with their
+    1 / z, which is linear in image space, and the buffer keeps the largest
+    1 / z of every pixel.
+
+    Args:
+        points_list (list[ndarray]): (N, 3) projected vertices (u, v, z) of
+            every mesh, as returned by :func:`project_vertices`.
+        triangles_list (list[ndarray]): (T, 3) triangles of every mesh.
+        image_shape (tuple): (h, w) of the maps.
+        y_offset (int): as in :func:`rasterize_mesh`.
+
+    Returns:
+        tuple: (instance_map, depth). ``instance_map`` is an int32 (h, w) map
+            of the index of the visible mesh, -1 for the background, and
+            ``depth`` the float32 z of the visible surface, inf for the
+            background.
+    """
+    h, w = image_shape
+    inv_depth = np.zeros(h * w)
+    instance_map = np.full(h * w, -1, dtype=np.int32)
+    for i, (points, triangles) in enumerate(zip(points_list, triangles_list)):
+        points = np.asarray(points, dtype=np.float64)
+        triangles = np.asarray(triangles)
+        # the triangles crossing the image plane have no valid projection
+        triangles = triangles[(points[triangles, 2] > 0).all(axis=1)]
+        pts = points[:, :2].astype(np.int32).astype(np.int64)
+        pts[:, 1] -= int(y_offset)
+        tri_idx, y, x_left_f, x_right_f, w_left, w_right = _triangle_spans(
+            pts[triangles], 0, h - 1, inv_z=1. / points[triangles, 2])
+        x_left, x_right = _round_spans(x_left_f, x_right_f, 0, w - 1)
+        length = np.maximum(x_right - x_left, 0)
+        if not length.any():
+            continue
+
+        span = np.repeat(np.arange(len(y)), length)
+        first = np.cumsum(length) - length
+        x = x_left[span] + (np.arange(span.size) - first[span])
+        width = x_right_f[span] - x_left_f[span]
+        ratio = np.clip((x - x_left_f[span]) / np.where(width > 0, width, 1), 0, 1)
+        inv_z = w_left[span] + ratio * (w_right[span] - w_left[span])
+        pixel = y[span] * w + x
+
+        # the buffer only moves forward, the mesh owns the pixels it moved
+        np.maximum.at(inv_depth, pixel, inv_z)
+        front = pixel[inv_z == inv_depth[pixel]]
+        instance_map[front] = i
+
+    with np.errstate(divide='ignore'):
+        depth = (1. / inv_depth).astype(np.float32)
+    return instance_map.reshape(h, w), depth.reshape(h, w)
+
+
+def instance_overlaps(instance_map, masks):
+    """Visible area of every instance of ``instance_map`` and its overlap
+    with its own mask, in a single ``bincount``.
+
+    Args:
+        instance_map (ndarray): returned by :func:`rasterize_instances`.
+        masks (list[tuple]): (mask, offset) cropped mask of every instance,
+            in the coordinates of ``instance_map``.
+
+    Returns:
+        tuple: (intersection, visible_area) int64 arrays.
+    """
+    n = len(masks)
+    h, w = instance_map.shape
+    labels, pixels = [], []
+    for i, (mask, (x0, y0)) in enumerate(masks):
+        ys, xs = np.nonzero(mask)
+        ys, xs = ys + y0, xs + x0
+        inside = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+        pixels.append(ys[inside] * w + xs[inside])
+        labels.append(np.full(np.count_nonzero(inside), i))
+    labels = np.concatenate(labels + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+    pixels = np.concatenate(pixels + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+    instances = instance_map.ravel()
+    hits = labels[instances[pixels] == labels]
+    visible = instances[instances >= 0]
+    # bins [0, n) count the visible pixels and [n, 2n) the shared ones
+    counts = np.bincount(np.concatenate([visible, hits + n]), minlength=2 * n)
+    return counts[n:], counts[:n]
+
+
+def paste_mask(mask, offset, image_shape, dtype=np.uint8):
+    """Paste a cropped mask returned by :func:`rasterize_mesh` into a
+    full-size canvas."""
+    canvas = np.zeros(image_shape, dtype=dtype)
+    x0, y0 = offset
+    h, w = mask.shape
+    canvas[y0:y0 + h, x0:x0 + w] = mask
+    return canvas
+
+
+def mask_intersection(mask, offset, full_mask):
+    """Number of pixels shared by a cropped mask and a full-size mask."""
+    x0, y0 = offset
+    h, w = mask.shape
+    window = full_mask[y0:y0 + h, x0:x0 + w]
+    return int(np.count_nonzero(window[mask.astype(bool)]))
+
+
+def crop_mask(mask, offset=(0, 0)):
+    """Crop a full-size mask (or a mask already cropped at ``offset``) to the
+    bbox of its non zero pixels.
+
+    Returns:
+        tuple: (mask, offset) as returned by :func:`rasterize_mesh`.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if not len(rows):
+        return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+    cols = np.flatnonzero(mask.any(axis=0))
+    y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    return (mask[y0:y1, x0:x1] > 0).astype(np.uint8), (int(x0 + offset[0]), int(y0 + offset[1]))
+
+
+def shift_mask(mask, offset, y_offset):
+    """Move a cropped mask to the image cropped by its top ``y_offset`` rows,
+    the rows falling above the crop are dropped."""
+    x0, y0 = offset
+    y0 -= int(y_offset)
+    if y0 < 0:
+        mask = mask[-y0:]
+        y0 = 0
+    return mask, (x0, y0)
+
+
+def cropped_intersection(mask_a, offset_a, mask_b, offset_b):
+    """Number of pixels shared by two cropped masks."""
+    xa, ya = offset_a
+    xb, yb = offset_b
+    x0, y0 = max(xa, xb), max(ya, yb)
+    x1 = min(xa + mask_a.shape[1], xb + mask_b.shape[1])
+    y1 = min(ya + mask_a.shape[0], yb + mask_b.shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return 0
+    window_a = mask_a[y0 - ya:y1 - ya, x0 - xa:x1 - xa]
+    window_b = mask_b[y0 - yb:y1 - yb, x0 - xb:x1 - xb]
+    return int(np.count_nonzero(window_a.astype(bool) & window_b.astype(bool)))
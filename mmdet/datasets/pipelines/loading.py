@@ -1,18 +1,100 @@
 import os.path as osp
+import struct
 import warnings
 
+import cv2
 import mmcv
 import numpy as np
 import pycocotools.mask as maskUtils
 
+from mmdet.core.mask.lazy_masks import LazyMasks
 from ..registry import PIPELINES
 
+# libjpeg scales the IDCT by 1/2, 1/4 or 1/8 while decoding
+REDUCED_DECODE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def jpeg_size(buf):
+    """(h, w) read from the SOF marker of a JPEG, None if ``buf`` is not a
+    JPEG. Only the header is parsed."""
+    if buf[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    while pos + 4 <= len(buf):
+        if buf[pos] != 0xFF:
+            return None
+        marker = buf[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        length = struct.unpack('>H', buf[pos + 2:pos + 4])[0]
+        # SOF0..SOF15 except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            h, w = struct.unpack('>HH', buf[pos + 5:pos + 9])
+            return h, w
+        pos += 2 + length
+    return None
+
 
 @PIPELINES.register_module
 class LoadImageFromFile(object):
-
-    def __init__(self, to_float32=False):
+    """Load an image from file.
+
+    With ``bottom_half`` the top rows are dropped as by ``CropBottom``, which
+    then becomes a no-op. With ``decode_scale`` as well, a JPEG is decoded at
+    the largest reduction (1/2, 1/4...) of ``reductions`` for which the
+    cropped image is still at least as large as what the following
+    ``Resize(img_scale=decode_scale)`` produces, so the full resolution image
+    is never materialised. ``ori_shape`` is the full resolution crop and
+    ``decode_scale`` the reduction applied, ``Resize`` composes it into
+    ``scale_factor`` so the boxes are still mapped back to the full
+    resolution crop.
+
+    Args:
+        to_float32 (bool): convert the image to float32.
+        bottom_half (int): number of top rows to drop.
+        decode_scale (tuple, optional): the (long, short) ``img_scale`` of the
+            following keep-ratio ``Resize``.
+        reductions (tuple): the allowed reduction factors.
+    """
+
+    def __init__(self, to_float32=False, bottom_half=0, decode_scale=None, reductions=(2, 4)):
         self.to_float32 = to_float32
+        self.bottom_half = bottom_half
+        self.decode_scale = decode_scale
+        self.reductions = tuple(sorted(reductions, reverse=True))
+        assert all(r in REDUCED_DECODE_FLAGS for r in self.reductions)
+
+    def _reduction(self, full_shape):
+        if self.decode_scale is None or full_shape is None:
+            return 1
+        h, w = full_shape[0] - self.bottom_half, full_shape[1]
+        scale_factor = min(max(self.decode_scale) / max(h, w), min(self.decode_scale) / min(h, w))
+        for r in self.reductions:
+            # Resize must still down-sample and the crop must fall on a row of the reduced image
+            if scale_factor * r <= 1 and self.bottom_half % r == 0:
+                return r
+        return 1
+
+    def _load(self, filename):
+        """Return the image, the reduction it was decoded at and the (h, w)
+        of the full resolution image."""
+        if self.decode_scale is None:
+            img = mmcv.imread(filename)
+            return img, 1, img.shape[:2]
+        with open(filename, 'rb') as f:
+            buf = f.read()
+        full_shape = jpeg_size(buf)
+        reduction = self._reduction(full_shape)
+        flags = REDUCED_DECODE_FLAGS[reduction] if reduction > 1 else cv2.IMREAD_COLOR
+        img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), flags)
+        if img is None:
+            raise IOError('cannot decode {}'.format(filename))
+        return img, reduction, full_shape or img.shape[:2]
 
     def __call__(self, results):
         if results['img_prefix'] is not None:
@@ -20,18 +102,24 @@ class LoadImageFromFile(object):
                                 results['img_info']['filename'])
         else:
             filename = results['img_info']['filename']
-        img = mmcv.imread(filename)
+        img, reduction, (h, w) = self._load(filename)
+        if self.bottom_half:
+            img = img[self.bottom_half // reduction:]
+            results['bottom_cropped'] = self.bottom_half
+        if reduction > 1:
+            results['decode_scale'] = 1. / reduction
+        ori_shape = (h - self.bottom_half, w, img.shape[2])
         if self.to_float32:
             img = img.astype(np.float32)
         results['filename'] = filename
         results['img'] = img
         results['img_shape'] = img.shape
-        results['ori_shape'] = img.shape
+        results['ori_shape'] = ori_shape
         return results
 
     def __repr__(self):
-        return self.__class__.__name__ + '(to_float32={})'.format(
-            self.to_float32)
+        return self.__class__.__name__ + '(to_float32={}, bottom_half={}, decode_scale={})'.format(
+            self.to_float32, self.bottom_half, self.decode_scale)
 
 
 @PIPELINES.register_module
@@ -96,7 +184,7 @@ class LoadAnnotations(object):
     def _load_masks(self, results):
         h, w = results['img_info']['height'], results['img_info']['width']
         gt_masks = results['ann_info']['masks']
-        if self.poly2mask:
+        if self.poly2mask and not isinstance(gt_masks, LazyMasks):
             if not isinstance(gt_masks[0], np.ndarray):
                 gt_masks = [self._poly2mask(mask, h, w) for mask in gt_masks]
         results['gt_masks'] = gt_masks
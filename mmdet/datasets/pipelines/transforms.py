@@ -8,8 +8,9 @@ from imagecorruptions import corrupt
 from numpy import random
 
 from mmdet.core.evaluation.bbox_overlaps import bbox_overlaps
+from mmdet.core.mask.lazy_masks import LazyMasks
 from ..registry import PIPELINES
-from ..kaggle_pku_utils import euler_angles_to_quaternions, quaternion_upper_hemispher
+from ..kaggle_pku_utils import euler_angles_to_quaternions, quaternions_upper_hemisphere
 
 
 @PIPELINES.register_module
@@ -109,8 +110,32 @@ class Resize(object):
         results['scale'] = scale
         results['scale_idx'] = scale_idx
 
-    def _resize_img(self, results):
+    def _target_size(self, h, w, scale):
+        """(w, h) output size and scale factor of an (h, w) image, as computed
+        by ``mmcv.imrescale`` / ``mmcv.imresize``."""
         if self.keep_ratio:
+            long_edge, short_edge = max(scale), min(scale)
+            scale_factor = min(long_edge / max(h, w), short_edge / min(h, w))
+            new_size = (int(w * scale_factor + 0.5), int(h * scale_factor + 0.5))
+        else:
+            new_size = tuple(scale)
+            w_scale, h_scale = new_size[0] / w, new_size[1] / h
+            scale_factor = np.array([w_scale, h_scale, w_scale, h_scale],
+                                    dtype=np.float32)
+        return new_size, scale_factor
+
+    def _resize_reduced_img(self, results):
+        """The image was decoded at a reduced scale by LoadImageFromFile, the
+        output size and scale factor are those of the full resolution image
+        ``ori_shape`` so they are the same as without the reduction."""
+        h, w = results['ori_shape'][:2]
+        new_size, scale_factor = self._target_size(h, w, results['scale'])
+        return mmcv.imresize(results['img'], new_size), scale_factor
+
+    def _resize_img(self, results):
+        if 'decode_scale' in results:
+            img, scale_factor = self._resize_reduced_img(results)
+        elif self.keep_ratio:
             img, scale_factor = mmcv.imrescale(
                 results['img'], results['scale'], return_scale=True)
         else:
@@ -136,7 +161,9 @@ class Resize(object):
         for key in results.get('mask_fields', []):
             if results[key] is None:
                 continue
-            if self.keep_ratio:
+            if isinstance(results[key], LazyMasks):
+                masks = results[key].rescale(results['img_shape'])
+            elif self.keep_ratio:
                 masks = [
                     mmcv.imrescale(
                         mask, results['scale_factor'], interpolation='nearest')
@@ -211,22 +238,23 @@ class RandomFlip(object):
                                               results['img_shape'])
             # flip masks
             for key in results.get('mask_fields', []):
-                results[key] = [mask[:, ::-1] for mask in results[key]]
+                if isinstance(results[key], LazyMasks):
+                    results[key] = results[key].flip()
+                else:
+                    results[key] = [mask[:, ::-1] for mask in results[key]]
 
             # flip eular angles and quaterion_semispheres
 
-            for idx in range(len(results.get('ann_info', {}).get('eular_angles', []))):
+            eular_angles = results.get('ann_info', {}).get('eular_angles', [])
+            if len(eular_angles):
                 ### the eular angles sequence should correspond to yaw, pitch, roll, otherwise it may mixup below
-                yaw_inverse = results['ann_info']['eular_angles'][idx][0]  ## yaw inverse(no inverse)
-                pitch_inverse = -results['ann_info']['eular_angles'][idx][1]  ## pitch inverse
-                roll_inverse = -results['ann_info']['eular_angles'][idx][2]  ## roll inverse
-
-                eular_angle_flip = np.array([yaw_inverse, pitch_inverse, roll_inverse])
+                ## yaw inverse(no inverse), pitch inverse, roll inverse
+                eular_angles_flip = np.array(eular_angles, dtype=np.float64).reshape(-1, 3) * [1, -1, -1]
 
-                quaternion = euler_angles_to_quaternions(eular_angle_flip)
-                quaternion_semisphere = quaternion_upper_hemispher(quaternion)
-                quaternion_semisphere = np.array(quaternion_semisphere, dtype=np.float32)
-                results['quaternion_semispheres'][idx] = quaternion_semisphere
+                quaternions = euler_angles_to_quaternions(eular_angles_flip)
+                quaternion_semispheres = quaternions_upper_hemisphere(quaternions)
+                results['quaternion_semispheres'][:len(quaternion_semispheres)] = \
+                    quaternion_semispheres.astype(np.float32)
 
             # flip transation
 
@@ -279,6 +307,9 @@ class Pad(object):
     def _pad_masks(self, results):
         pad_shape = results['pad_shape'][:2]
         for key in results.get('mask_fields', []):
+            if isinstance(results[key], LazyMasks):
+                results[key] = results[key].pad(pad_shape)
+                continue
             padded_masks = [
                 mmcv.impad(mask, pad_shape, pad_val=self.pad_val)
                 for mask in results[key]
@@ -339,6 +370,9 @@ class CropBottom(object):
         self.bottom_half = bottom_half
 
     def __call__(self, results):
+        if results.get('bottom_cropped') == self.bottom_half:
+            # already cropped while decoding by LoadImageFromFile
+            return results
         img = results['img']
 
         # crop the image
@@ -415,6 +449,8 @@ class CameraRotation(object):
         self.gamma = gamma * np.pi / 180
 
     def __call__(self, results):
+        assert 'bottom_cropped' not in results and 'decode_scale' not in results, \
+            'CameraRotation needs the full image, load it without bottom_half / decode_scale'
         img = results['img']
         trans = results['Mat']
         h, w = img.shape[:2]
@@ -422,6 +458,85 @@ class CameraRotation(object):
         return results
 
 
+@PIPELINES.register_module
+class CameraRotationCropResize(Resize):
+    """CameraRotation, CropBottom and Resize fused in a single warp.
+
+    ``results['Mat']`` (identity when absent), the bottom crop and the
+    resize are composed into one homography, ``cv2.warpPerspective`` then
+    samples the output image directly from the loaded one: no full frame
+    intermediate is produced. The boxes and masks, already rotated and
+    cropped by the dataset, are rescaled as by ``Resize``. An image decoded
+    at a reduced scale by LoadImageFromFile (``decode_scale`` without
+    ``bottom_half``) is handled by composing the reduction as well.
+
+    Args:
+        bottom_half (int): number of top rows cropped.
+        interpolation (str): 'nearest', 'bilinear', 'bicubic', 'area' or
+            'lanczos' as CameraRotation.
+        **kwargs: the arguments of :class:`Resize`.
+    """
+
+    interp_codes = {
+        'nearest': cv2.INTER_NEAREST,
+        'bilinear': cv2.INTER_LINEAR,
+        'bicubic': cv2.INTER_CUBIC,
+        'area': cv2.INTER_AREA,
+        'lanczos': cv2.INTER_LANCZOS4
+    }
+
+    def __init__(self, bottom_half=0, interpolation='lanczos', **kwargs):
+        super(CameraRotationCropResize, self).__init__(**kwargs)
+        self.bottom_half = bottom_half
+        self.interpolation = interpolation
+
+    @staticmethod
+    def _pixel_scale(sx, sy):
+        # scaling about the pixel centres, as cv2.resize does
+        return np.array([[sx, 0, 0.5 * sx - 0.5],
+                         [0, sy, 0.5 * sy - 0.5],
+                         [0, 0, 1]])
+
+    def _homography(self, results, new_size, full_shape):
+        """Map from the pixels of the loaded image to the output ones."""
+        h, w = full_shape
+        crop = np.array([[1, 0, 0], [0, 1, -self.bottom_half], [0, 0, 1]], dtype=np.float64)
+        resize = self._pixel_scale(new_size[0] / w, new_size[1] / (h - self.bottom_half))
+        mat = np.asarray(results.get('Mat', np.eye(3)), dtype=np.float64)
+        homography = resize.dot(crop).dot(mat)
+        if 'decode_scale' in results:
+            img_h, img_w = results['img'].shape[:2]
+            homography = homography.dot(self._pixel_scale(w / img_w, h / img_h))
+        return homography
+
+    def __call__(self, results):
+        assert 'bottom_cropped' not in results, 'the image is already cropped'
+        if 'scale' not in results:
+            self._random_scale(results)
+        if 'decode_scale' in results:
+            full_shape = results['ori_shape'][:2]
+        else:
+            full_shape = results['img'].shape[:2]
+        h, w = full_shape[0] - self.bottom_half, full_shape[1]
+        new_size, scale_factor = self._target_size(h, w, results['scale'])
+
+        img = cv2.warpPerspective(results['img'], self._homography(results, new_size, full_shape), new_size,
+                                  flags=self.interp_codes[self.interpolation])
+        results['img'] = img
+        results['ori_shape'] = (h, w) + results['img'].shape[2:]
+        results['img_shape'] = img.shape
+        results['pad_shape'] = img.shape  # in case that there is no padding
+        results['scale_factor'] = scale_factor
+        results['keep_ratio'] = self.keep_ratio
+        self._resize_bboxes(results)
+        self._resize_masks(results)
+        return results
+
+    def __repr__(self):
+        repr_str = super(CameraRotationCropResize, self).__repr__()
+        return repr_str[:-1] + ', bottom_half={}, interpolation={})'.format(self.bottom_half, self.interpolation)
+
+
 @PIPELINES.register_module
 class RandomCrop(object):
     """Random crop the image & bboxes & masks.
@@ -0,0 +1,217 @@
+"""
+    Brief: Pre-rendered silhouette templates of the car models
+    The silhouette of every car model is rendered offline over a grid of
+    Kaggle euler angles, with the car on the optical axis of a canonical
+    camera. A pose hypothesis is then scored by warping the nearest template
+    into the image instead of rasterising the mesh, so dozens of hypotheses
+    per car stay cheap on CPU.
+"""
+import json
+import os
+
+import cv2
+import numpy as np
+
+from .kaggle_pku_utils import euler_to_Rot
+from .mesh_rasterizer import project_vertices, rasterize_mesh, cropped_intersection
+
+# yaw, pitch, roll grid in the Kaggle convention, the pitch is the heading.
+# The yaw range covers the elevation of the rays of the bottom half.
+DEFAULT_YAWS = np.linspace(-0.4, 0.8, 13)
+DEFAULT_PITCHES = np.linspace(-np.pi, np.pi, 72, endpoint=False)
+DEFAULT_ROLLS = np.pi + np.array([-0.1, 0., 0.1])
+# the canonical camera, a 4.5 m car is about 180 pixels long. The templates
+# are exact at this distance, the perspective of nearer cars is approximate.
+DEFAULT_DISTANCE = 20.
+DEFAULT_FOCAL = 800.
+# principal point of the canonical camera, keeps the template coordinates
+# positive before they are truncated by the rasteriser
+_CANONICAL_CENTER = 4096.
+
+
+def pose_rotation(euler_angle):
+    """Rotation matrix of the Kaggle euler angles, as in
+    :func:`project_vertices`."""
+    yaw, pitch, roll = euler_angle
+    return euler_to_Rot(-pitch, -yaw, -roll).T
+
+
+def ray_rotation(translation):
+    """Smallest rotation taking the optical axis to the ray of a translation."""
+    ray = np.asarray(translation, dtype=np.float64)
+    ray = ray / np.linalg.norm(ray)
+    axis = np.cross([0., 0., 1.], ray)
+    sin = np.linalg.norm(axis)
+    if sin < 1e-12:
+        return np.eye(3)
+    return cv2.Rodrigues(axis / sin * np.arctan2(sin, ray[2]))[0]
+
+
+class SilhouetteBank(object):
+    """Memory-mapped bank of bit-packed silhouette templates.
+
+    Every template is the silhouette of a model at the rotation of a grid
+    point, placed at (0, 0, ``distance``) in front of a camera of focal
+    ``focal``. A car at any translation t looks like the template of the
+    rotation seen along its ray, shrunk by distance / |t| and turned to the
+    ray under the pinhole model (:meth:`project`).
+
+    The bank is a directory of ``.npy`` files opened with ``mmap_mode='r'``,
+    so the templates stay shared between the workers, and pickling the bank
+    only sends its path. It is built from the meshes when missing.
+
+    Args:
+        car_model_dict (CarModelBank): the car meshes, only read to build.
+        bank_dir (str): directory of the bank.
+        names (list[str], optional): car models of the bank, defaults to all
+            the models of ``car_model_dict``.
+        yaws, pitches, rolls (ndarray): the euler angle grid.
+        distance (float): canonical distance in metres.
+        focal (float): canonical focal length in pixels.
+    """
+
+    def __init__(self,
+                 car_model_dict,
+                 bank_dir,
+                 names=None,
+                 yaws=DEFAULT_YAWS,
+                 pitches=DEFAULT_PITCHES,
+                 rolls=DEFAULT_ROLLS,
+                 distance=DEFAULT_DISTANCE,
+                 focal=DEFAULT_FOCAL):
+        self.bank_dir = bank_dir
+        if not os.path.isfile(os.path.join(bank_dir, 'meta.json')):
+            names = list(car_model_dict) if names is None else list(names)
+            grid = np.stack(np.meshgrid(yaws, pitches, rolls, indexing='ij'), axis=-1).reshape(-1, 3)
+            self.build(car_model_dict, bank_dir, names, grid, distance, focal)
+        self._load()
+
+    def _load(self):
+        with open(os.path.join(self.bank_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.names = meta['names']
+        self.name2idx = {n: i for i, n in enumerate(self.names)}
+        self.distance = meta['distance']
+        self.focal = meta['focal']
+        arrays = {k: np.load(os.path.join(self.bank_dir, k + '.npy'), mmap_mode='r')
+                  for k in ('euler_angles', 'bits', 'templates')}
+        self.euler_angles = np.array(arrays['euler_angles'])
+        self.rotations = np.stack([pose_rotation(ea) for ea in self.euler_angles])
+        self.bits = arrays['bits']
+        # (byte offset, height, width, x0, y0) of every template, (x0, y0) is
+        # the top-left corner relative to the projection of the car centre
+        self.templates = np.array(arrays['templates'])
+
+    @staticmethod
+    def build(car_model_dict, bank_dir, names, euler_angles, distance=DEFAULT_DISTANCE, focal=DEFAULT_FOCAL):
+        """Render the templates of ``names`` at the ``euler_angles`` grid."""
+        camera_matrix = np.array([[focal, 0, _CANONICAL_CENTER],
+                                  [0, focal, _CANONICAL_CENTER],
+                                  [0, 0, 1]])
+        bits, templates = [], []
+        num_bytes = 0
+        for name in names:
+            vertices, triangles = car_model_dict.get_mesh(name)
+            for euler_angle in euler_angles:
+                points = project_vertices(vertices, euler_angle, [0, 0, distance], camera_matrix)
+                mask, (x0, y0) = rasterize_mesh(points, triangles)
+                packed = np.packbits(mask.astype(bool), axis=1)
+                templates.append([num_bytes, mask.shape[0], mask.shape[1],
+                                  x0 - _CANONICAL_CENTER, y0 - _CANONICAL_CENTER])
+                bits.append(packed.ravel())
+                num_bytes += packed.size
+
+        if not os.path.isdir(bank_dir):
+            os.makedirs(bank_dir)
+        np.save(os.path.join(bank_dir, 'euler_angles.npy'), np.asarray(euler_angles, dtype=np.float64))
+        np.save(os.path.join(bank_dir, 'bits.npy'), np.concatenate(bits))
+        np.save(os.path.join(bank_dir, 'templates.npy'), np.array(templates, dtype=np.int64))
+        # the meta file is written last, a bank without it is rebuilt
+        tmp_file = os.path.join(bank_dir, 'meta.{}.tmp'.format(os.getpid()))
+        with open(tmp_file, 'w') as f:
+            json.dump(dict(names=list(names), distance=float(distance), focal=float(focal)), f)
+        os.replace(tmp_file, os.path.join(bank_dir, 'meta.json'))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name2idx
+
+    def __getstate__(self):
+        return dict(bank_dir=self.bank_dir)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load()
+
+    def template(self, name, grid_idx):
+        """(mask, (x0, y0)) of a template, the offset is relative to the
+        projection of the car centre in the canonical camera."""
+        offset, h, w, x0, y0 = self.templates[self.name2idx[name] * len(self.euler_angles) + grid_idx]
+        packed = self.bits[offset:offset + h * ((w + 7) // 8)].reshape(h, -1)
+        return np.unpackbits(packed, axis=1, count=w), (int(x0), int(y0))
+
+    def lookup(self, euler_angle, translation):
+        """Index of the grid rotation nearest to the pose seen along the ray
+        of ``translation``, and the rotation of that ray."""
+        rot_ray = ray_rotation(translation)
+        rot = np.dot(rot_ray.T, pose_rotation(euler_angle))
+        # the trace of R_g^T R is 1 + 2 cos(angle between them)
+        return int(np.argmax(np.einsum('gij,ij->g', self.rotations, rot))), rot_ray
+
+    def project(self, name, euler_angle, translation, camera_matrix, image_shape=None, y_offset=0):
+        """Silhouette of a car from the nearest template.
+
+        Returns:
+            tuple: (mask, offset) as returned by :func:`rasterize_mesh`.
+        """
+        translation = np.asarray(translation, dtype=np.float64)
+        if translation[2] <= 0:
+            return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+        grid_idx, rot_ray = self.lookup(euler_angle, translation)
+        mask, (x0, y0) = self.template(name, grid_idx)
+
+        # template pixel -> direction of the canonical ray, shrunk to the
+        # distance of the car -> direction turned to its ray -> pixel
+        scale = self.distance / (np.linalg.norm(translation) * self.focal)
+        homography = np.dot(np.dot(np.asarray(camera_matrix, dtype=np.float64), rot_ray),
+                            [[scale, 0, scale * x0], [0, scale, scale * y0], [0, 0, 1]])
+        homography[1] -= y_offset * homography[2]
+
+        h, w = mask.shape
+        corners = np.dot(homography, [[0, w, 0, w], [0, 0, h, h], [1, 1, 1, 1]])
+        corners = corners[:2] / corners[2]
+        bx0, by0 = np.floor(corners.min(axis=1)).astype(np.int64)
+        bx1, by1 = np.ceil(corners.max(axis=1)).astype(np.int64)
+        if image_shape is not None:
+            bx0, by0 = max(bx0, 0), max(by0, 0)
+            bx1, by1 = min(bx1, image_shape[1]), min(by1, image_shape[0])
+        if bx1 <= bx0 or by1 <= by0:
+            return np.zeros((0, 0), dtype=np.uint8), (int(bx0), int(by0))
+        homography = np.dot([[1, 0, -bx0], [0, 1, -by0], [0, 0, 1]], homography)
+        warped = cv2.warpPerspective(mask * 255, homography, (int(bx1 - bx0), int(by1 - by0)),
+                                     flags=cv2.INTER_LINEAR)
+        return (warped > 127).astype(np.uint8), (int(bx0), int(by0))
+
+    def ious(self, mask, offset, name, euler_angles, translations, camera_matrix, image_shape=None, y_offset=0):
+        """IoUs of a cropped mask with the silhouettes of many pose
+        hypotheses of the same car.
+
+        Args:
+            mask (ndarray), offset (tuple): cropped mask as returned by
+                :func:`crop_mask`, in the image cropped by its top
+                ``y_offset`` rows.
+
+        Returns:
+            ndarray: intersection / union of every hypothesis.
+        """
+        area = int(np.count_nonzero(mask))
+        ious = np.zeros(len(translations))
+        for i, (euler_angle, translation) in enumerate(zip(euler_angles, translations)):
+            silhouette, silhouette_offset = self.project(name, euler_angle, translation, camera_matrix,
+                                                         image_shape, y_offset)
+            intersection = cropped_intersection(mask, offset, silhouette, silhouette_offset)
+            union = area + int(np.count_nonzero(silhouette)) - intersection
+            ious[i] = intersection / union if union else np.nan
+        return ious
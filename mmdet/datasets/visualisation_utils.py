@@ -4,7 +4,6 @@ import math
 import matplotlib.pyplot as plt
 import mmcv
 import numpy as np
-import pycocotools.mask as maskUtils
 import cv2
 import copy
 
@@ -12,7 +11,10 @@ from mmcv.image import imread, imwrite
 from mmcv.visualization.color import color_val
 
 from mmdet.datasets.kaggle_pku_utils import euler_to_Rot, euler_angles_to_quaternions, \
-    quaternion_upper_hemispher, euler_angles_to_rotation_matrix, quaternion_to_euler_angle, draw_line, draw_points
+    quaternion_upper_hemispher, euler_angles_to_rotation_matrix, quaternions_to_euler_angles, draw_line, draw_points
+from mmdet.datasets.mesh_rasterizer import project_vertices, rasterize_mesh, mask_intersection, crop_mask
+from mmdet.datasets.mesh_iou_cache import shared_iou_cache
+from mmdet.core.mask.rle import decode_segm, decode_cropped
 
 
 def nms_with_IOU(bboxes_with_IOU, thresh=0.55):
@@ -293,7 +295,7 @@ def show_result_kaggle_pku(img,
         inds = np.where(bboxes[:, -1] > score_thr)[0]
         for i in inds:
             color_mask = np.random.randint(0, 256, (1, 3), dtype=np.uint8)
-            mask = maskUtils.decode(segms[i]).astype(np.bool)
+            mask = decode_segm(segms[i]).astype(np.bool)
             img[mask] = img[mask] * (1 - transparency) + color_mask * transparency
     # draw bounding boxes
     labels = [
@@ -317,43 +319,6 @@ def show_result_kaggle_pku(img,
         return img
 
 
-def get_iou_score(bbox_idx, car_model_dict, camera_matrix, class_names,
-                  mask_all_pred, mask_all_mesh, mask_all_pred_area, euler_angle, t):
-    vertices = np.array(car_model_dict[class_names[bbox_idx]]['vertices'])
-    vertices[:, 1] = -vertices[:, 1]
-    triangles = np.array(car_model_dict[class_names[bbox_idx]]['faces']) - 1
-
-    ea = euler_angle[bbox_idx]
-    yaw, pitch, roll = ea[0], ea[1], ea[2]
-    yaw, pitch, roll = -pitch, -yaw, -roll
-    Rt = np.eye(4)
-    Rt[:3, 3] = t
-    Rt[:3, :3] = euler_to_Rot(yaw, pitch, roll).T
-    Rt = Rt[:3, :]
-    P = np.ones((vertices.shape[0], vertices.shape[1] + 1))
-    P[:, :-1] = vertices
-    P = P.T
-
-    img_cor_points = np.dot(camera_matrix, np.dot(Rt, P))
-    img_cor_points = img_cor_points.T
-    img_cor_points[:, 0] /= img_cor_points[:, 2]
-    img_cor_points[:, 1] /= img_cor_points[:, 2]
-
-    mask_all_mesh_tmp = mask_all_mesh.copy()
-    for tri in triangles:
-        coord = np.array([img_cor_points[tri[0]][:2], img_cor_points[tri[1]][:2], img_cor_points[tri[2]][:2]],
-                         dtype=np.int32)
-        coord[:, 1] -= 1480
-        cv2.drawContours(mask_all_mesh_tmp, np.int32([coord]), 0, 1, -1)
-        # cv2.drawContours(img,np.int32([coord]),0,color,-1)
-
-    intersection_area = np.sum(mask_all_pred * mask_all_mesh_tmp)
-    union_area = np.sum(np.logical_or(mask_all_pred, mask_all_mesh_tmp))
-    iou_mask_score = intersection_area / mask_all_pred_area
-    iou_score = intersection_area / union_area
-    return iou_mask_score, iou_score
-
-
 def refine_yaw_and_roll(img_original, bboxes, segms, class_names, euler_angle, quaternion_pred, trans_pred_world,
                         car_model_dict,
                         camera_matrix,
@@ -396,6 +361,18 @@ def refine_yaw_and_roll(img_original, bboxes, segms, class_names, euler_angle, q
     return quaternion_pred_refined, flag
 
 
+def visible_ious(iou_cache, inds, segms, class_names, euler_angle, trans_pred_world, image_id=None):
+    """IoU of the cars ``inds`` with their visible silhouettes, drawn together
+    so they hide each other, nan for the other cars."""
+    ious = np.full(len(trans_pred_world), np.nan)
+    inds = np.flatnonzero(inds) if np.asarray(inds).dtype == bool else np.asarray(inds, dtype=np.int64)
+    if len(inds):
+        _, ious[inds] = iou_cache.instance_ious([segms[i] for i in inds], np.asarray(class_names)[inds],
+                                                np.asarray(euler_angle)[inds], np.asarray(trans_pred_world)[inds],
+                                                y_offset=1480, image_id=image_id)
+    return ious
+
+
 def restore_x_y_from_z_withIOU(img_original, bboxes, segms, class_names, euler_angle, trans_pred_world,
                                car_model_dict,
                                camera_matrix,
@@ -403,8 +380,22 @@ def restore_x_y_from_z_withIOU(img_original, bboxes, segms, class_names, euler_a
                                # refined_threshold1=5,
                                refined_threshold1=10,
                                refined_threshold2=28,
-                               IOU_threshold=0.3):
-    img = img_original[1480:, :, :].copy()
+                               IOU_threshold=0.3,
+                               iou_cache=None,
+                               image_id=None,
+                               occlusion=False):
+    """With ``occlusion`` the IoUs are those of the visible silhouettes, the
+    IoUs after are computed with all the cars moved to their restored x, y."""
+    if iou_cache is None:
+        iou_cache = shared_iou_cache(car_model_dict, camera_matrix)
+
+    if occlusion:
+        inds = bboxes[:, -1] > score_thr
+        trans_restored = trans_pred_world.copy()
+        for bbox_idx in np.flatnonzero(inds):
+            trans_restored[bbox_idx] = get_xy_from_z(bboxes[bbox_idx], trans_pred_world[bbox_idx])
+        ious_before = visible_ious(iou_cache, inds, segms, class_names, euler_angle, trans_pred_world, image_id)
+        ious_after = visible_ious(iou_cache, inds, segms, class_names, euler_angle, trans_restored, image_id)
 
     trans_pred_world_refined = trans_pred_world.copy()
     for bbox_idx in range(len(bboxes)):
@@ -412,22 +403,19 @@ def restore_x_y_from_z_withIOU(img_original, bboxes, segms, class_names, euler_a
             continue
 
         bbox = bboxes[bbox_idx]
-        ## below is the predicted mask
-        mask_all_pred = np.zeros(img.shape[:-1])  ## this is the background mask
-        mask_all_mesh = np.zeros(img.shape[:-1])
-        mask_pred = maskUtils.decode(segms[bbox_idx]).astype(np.bool)
-        mask_all_pred += mask_pred
-        mask_all_pred_area = np.sum(mask_all_pred == 1)
-
         t = trans_pred_world[bbox_idx]
         t_refined = get_xy_from_z(bbox, t)
 
-        score_iou_mask_before, score_iou_before = get_iou_score(bbox_idx, car_model_dict, camera_matrix, class_names,
-                                                                mask_all_pred, mask_all_mesh, mask_all_pred_area,
-                                                                euler_angle, t)
-        score_iou_mask_after, score_iou_after = get_iou_score(bbox_idx, car_model_dict, camera_matrix, class_names,
-                                                              mask_all_pred, mask_all_mesh, mask_all_pred_area,
-                                                              euler_angle, t_refined)
+        if occlusion:
+            score_iou_before, score_iou_after = ious_before[bbox_idx], ious_after[bbox_idx]
+        else:
+            ## the predicted mask is decoded and the mesh rasterised once by the cache
+            score_iou_mask_before, score_iou_before = iou_cache.iou(segms[bbox_idx], class_names[bbox_idx],
+                                                                    euler_angle[bbox_idx], t,
+                                                                    y_offset=1480, image_id=image_id)
+            score_iou_mask_after, score_iou_after = iou_cache.iou(segms[bbox_idx], class_names[bbox_idx],
+                                                                  euler_angle[bbox_idx], t_refined,
+                                                                  y_offset=1480, image_id=image_id)
         if t[2] > refined_threshold2:
             trans_pred_world_refined[bbox_idx] = t_refined
         elif t[2] < refined_threshold1:
@@ -449,34 +437,39 @@ def restore_x_y_from_z_withIOU(img_original, bboxes, segms, class_names, euler_a
 def restore_x_y_from_z_withIOU_mutual(img_original, bboxes, segms, class_names, euler_angle, trans_pred_world,
                                       car_model_dict,
                                       camera_matrix,
-                                      score_thr=0.1, ):
-    img = img_original[1480:, :, :].copy()
+                                      score_thr=0.1,
+                                      iou_cache=None,
+                                      image_id=None,
+                                      occlusion=False):
+    """With ``occlusion`` the IoUs are those of the visible silhouettes, every
+    candidate is scored with all the cars moved to the same candidate."""
+    if iou_cache is None:
+        iou_cache = shared_iou_cache(car_model_dict, camera_matrix)
+    if occlusion:
+        inds = bboxes[:, -1] > score_thr
+        trans_candidates = np.repeat(trans_pred_world[None], 3, axis=0)
+        for bbox_idx in np.flatnonzero(inds):
+            trans_candidates[:, bbox_idx] = get_xy_from_z_mutually(bboxes[bbox_idx], trans_pred_world[bbox_idx])
+        ious = [visible_ious(iou_cache, inds, segms, class_names, euler_angle, trans, image_id)
+                for trans in [trans_pred_world] + list(trans_candidates)]
     trans_pred_world_refined = trans_pred_world.copy()
     for bbox_idx in range(len(bboxes)):
         if bboxes[bbox_idx, -1] <= score_thr:  ## we only restore case when score > score_thr(0.1)
             continue
 
         bbox = bboxes[bbox_idx]
-
-        ## below is the predicted mask
-        mask_all_pred = np.zeros(img.shape[:-1])  ## this is the background mask
-        mask_all_mesh = np.zeros(img.shape[:-1])
-        mask_pred = maskUtils.decode(segms[bbox_idx]).astype(np.bool)
-        mask_all_pred += mask_pred
-        mask_all_pred_area = np.sum(mask_all_pred == 1)
-
         t = trans_pred_world[bbox_idx]
         # t_refined = get_xy_from_z(bbox,t)
         T_refined = get_xy_from_z_mutually(bbox, t)
 
-        _, score_iou_before = get_iou_score(bbox_idx, car_model_dict, camera_matrix, class_names, mask_all_pred,
-                                            mask_all_mesh, mask_all_pred_area, euler_angle, t)
-        _, score_iou_after_1 = get_iou_score(bbox_idx, car_model_dict, camera_matrix, class_names, mask_all_pred,
-                                             mask_all_mesh, mask_all_pred_area, euler_angle, T_refined[0])
-        _, score_iou_after_2 = get_iou_score(bbox_idx, car_model_dict, camera_matrix, class_names, mask_all_pred,
-                                             mask_all_mesh, mask_all_pred_area, euler_angle, T_refined[1])
-        _, score_iou_after_3 = get_iou_score(bbox_idx, car_model_dict, camera_matrix, class_names, mask_all_pred,
-                                             mask_all_mesh, mask_all_pred_area, euler_angle, T_refined[2])
+        if occlusion:
+            score_iou_before, score_iou_after_1, score_iou_after_2, score_iou_after_3 = [
+                iou[bbox_idx] for iou in ious]
+        else:
+            score_iou_before, score_iou_after_1, score_iou_after_2, score_iou_after_3 = [
+                iou_cache.iou(segms[bbox_idx], class_names[bbox_idx], euler_angle[bbox_idx], t_candidate,
+                              y_offset=1480, image_id=image_id)[1]
+                for t_candidate in (t, T_refined[0], T_refined[1], T_refined[2])]
 
         ## we find the highest score_iou_after
         score_concat = np.array([score_iou_after_1, score_iou_after_2, score_iou_after_3])
@@ -493,59 +486,87 @@ def restore_x_y_from_z_withIOU_mutual(img_original, bboxes, segms, class_names,
     return trans_pred_world_refined
 
 
+def search_pose_with_templates(bboxes, segms, class_names, euler_angle, trans_pred_world,
+                               silhouette_bank,
+                               camera_matrix,
+                               score_thr=0.1,
+                               pitch_offsets=(-0.2, -0.1, 0.1, 0.2),
+                               yaw_threshold=(0, 0.3),
+                               iou_gain=0.05):
+    """Render and compare search of the pose of every car with the
+    silhouette templates.
+
+    The hypotheses are the predicted translation and the three of
+    get_xy_from_z_mutually, combined with the predicted rotation, its yaw and
+    roll snapped as in refine_yaw_and_roll and the predicted heading (pitch)
+    turned by ``pitch_offsets``. A car takes its best hypothesis when it beats
+    the predicted pose by ``iou_gain``.
+
+    Returns:
+        tuple: (euler_angle_refined, trans_pred_world_refined)
+    """
+    candidate_rolls = np.array([-math.pi, 0, math.pi])
+    euler_angle_refined = euler_angle.copy()
+    trans_pred_world_refined = trans_pred_world.copy()
+    for bbox_idx in range(len(bboxes)):
+        if bboxes[bbox_idx, -1] <= score_thr:
+            continue
+        mask, offset = crop_mask(*decode_cropped(segms[bbox_idx]))
+        if not mask.size:
+            continue
+
+        ea, t = euler_angle[bbox_idx], trans_pred_world[bbox_idx]
+        yaw, pitch, roll = ea
+        if yaw < yaw_threshold[0] or yaw > yaw_threshold[1]:
+            yaw = 0.15
+        snapped = np.array([yaw, pitch, candidate_rolls[np.argmin(np.abs(candidate_rolls - roll))]])
+        rotations = [ea, snapped] + [ea + [0, offset_pitch, 0] for offset_pitch in pitch_offsets]
+        translations = [t] + [t_candidate for t_candidate in get_xy_from_z_mutually(bboxes[bbox_idx], t)
+                              if np.isfinite(t_candidate).all() and t_candidate[2] > 0]
+        hypotheses = [(r, t_candidate) for t_candidate in translations for r in rotations]
+
+        ious = silhouette_bank.ious(mask, offset, class_names[bbox_idx],
+                                    [r for r, _ in hypotheses], [t_candidate for _, t_candidate in hypotheses],
+                                    camera_matrix, image_shape=(2710 - 1480, 3384), y_offset=1480)
+        best = np.nanargmax(ious) if not np.isnan(ious).all() else 0
+        # the first hypothesis is the predicted pose
+        if ious[best] > ious[0] + iou_gain:
+            euler_angle_refined[bbox_idx], trans_pred_world_refined[bbox_idx] = hypotheses[best]
+
+    return euler_angle_refined, trans_pred_world_refined
+
+
 def get_IOU(img_original, bboxes, segms, six_dof, car_id2name,
             car_model_dict,
             unique_car_mode,
-            camera_matrix):
-    img = img_original[1480:, :, :].copy()
+            camera_matrix,
+            iou_cache=None,
+            occlusion=False):
+    """The boxes with the IoU of their cars appended, with ``occlusion`` the
+    IoU of the visible silhouettes of all the cars drawn in one pass."""
+    if iou_cache is None:
+        iou_cache = shared_iou_cache(car_model_dict, camera_matrix)
+    image_id = six_dof.get('file_name')
     bboxes_with_IOU = np.zeros((bboxes.shape[0], bboxes.shape[1] + 1)).astype(
         bboxes.dtype)  ## we add IOU score for each line
 
     quaternion_pred = six_dof['quaternion_pred']
-    euler_angles = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+    euler_angles = quaternions_to_euler_angles(quaternion_pred)
     car_cls_score_pred = six_dof['car_cls_score_pred']
     trans_pred_world = six_dof['trans_pred_world']
     car_labels = np.argmax(car_cls_score_pred, axis=1)
     kaggle_car_labels = [unique_car_mode[x] for x in car_labels]
     car_names = np.array([car_id2name[x].name for x in kaggle_car_labels])
+    if occlusion:
+        bboxes_with_IOU[:, :-1] = bboxes
+        bboxes_with_IOU[:, -1] = visible_ious(iou_cache, np.arange(len(bboxes)), segms, car_names, euler_angles,
+                                              trans_pred_world, image_id)
+        return bboxes_with_IOU
     for bbox_idx in range(len(bboxes)):
         box = bboxes[bbox_idx]
         t = trans_pred_world[bbox_idx]
-        ## below is the predicted mask
-        mask_all_pred = np.zeros(img.shape[:-1])  ## this is the background mask
-        mask_all_mesh = np.zeros(img.shape[:-1])
-        mask_pred = maskUtils.decode(segms[bbox_idx]).astype(np.bool)
-        mask_all_pred += mask_pred
-
-        vertices = np.array(car_model_dict[car_names[bbox_idx]]['vertices'])
-        vertices[:, 1] = -vertices[:, 1]
-        triangles = np.array(car_model_dict[car_names[bbox_idx]]['faces']) - 1
-
-        ea = euler_angles[bbox_idx]
-        yaw, pitch, roll = ea[0], ea[1], ea[2]
-        yaw, pitch, roll = -pitch, -yaw, -roll
-        Rt = np.eye(4)
-        Rt[:3, 3] = t
-        Rt[:3, :3] = euler_to_Rot(yaw, pitch, roll).T
-        Rt = Rt[:3, :]
-        P = np.ones((vertices.shape[0], vertices.shape[1] + 1))
-        P[:, :-1] = vertices
-        P = P.T
-
-        img_cor_points = np.dot(camera_matrix, np.dot(Rt, P))
-        img_cor_points = img_cor_points.T
-        img_cor_points[:, 0] /= img_cor_points[:, 2]
-        img_cor_points[:, 1] /= img_cor_points[:, 2]
-
-        for tri in triangles:
-            coord = np.array([img_cor_points[tri[0]][:2], img_cor_points[tri[1]][:2], img_cor_points[tri[2]][:2]],
-                             dtype=np.int32)
-            coord[:, 1] -= 1480
-            cv2.drawContours(mask_all_mesh, np.int32([coord]), 0, 1, -1)
-
-        intersection_area = np.sum(mask_all_pred * mask_all_mesh)
-        union_area = np.sum(np.logical_or(mask_all_pred, mask_all_mesh))
-        iou_score = intersection_area / union_area
+        _, iou_score = iou_cache.iou(segms[bbox_idx], car_names[bbox_idx], euler_angles[bbox_idx], t,
+                                     y_offset=1480, image_id=image_id)
         bboxes_with_IOU[bbox_idx] = np.append(box, iou_score)
     return bboxes_with_IOU
 
@@ -559,7 +580,10 @@ def draw_box_mesh_kaggle_pku(img_original, bboxes, segms, class_names,
                              thickness=1,
                              transparency=0.5,
                              font_scale=0.8,
+                             occlusion=False,
                              ):
+    """With ``occlusion`` the printed IoUs are those of the visible
+    silhouettes, the cars hiding each other."""
     img = img_original[1480:, :, :].copy()  ## crop half
 
     iou_flag = False
@@ -571,6 +595,9 @@ def draw_box_mesh_kaggle_pku(img_original, bboxes, segms, class_names,
         trans_pred_world = trans_pred_world[inds, :]
         euler_angle = euler_angle[inds, :]
         class_names = class_names[inds]
+    if occlusion:
+        ious_visible = visible_ious(shared_iou_cache(car_model_dict, camera_matrix), np.arange(len(bboxes)),
+                                    segms, class_names, euler_angle, trans_pred_world)
 
     for bbox_idx in range(len(bboxes)):
         color_ndarray = np.random.randint(0, 256, (1, 3), dtype=np.uint8)
@@ -579,8 +606,7 @@ def draw_box_mesh_kaggle_pku(img_original, bboxes, segms, class_names,
 
         ## below is the predicted mask
         mask_all_pred = np.zeros(img.shape[:-1])  ## this is the background mask
-        mask_all_mesh = np.zeros(img.shape[:-1])
-        mask_pred = maskUtils.decode(segms[bbox_idx]).astype(np.bool)
+        mask_pred = decode_segm(segms[bbox_idx]).astype(np.bool)
         mask_all_pred += mask_pred
         mask_all_pred_area = np.sum(mask_all_pred == 1)
         # img[mask_pred] = img[mask_pred] * (1-transparency) + color_ndarray * transparency
@@ -592,38 +618,20 @@ def draw_box_mesh_kaggle_pku(img_original, bboxes, segms, class_names,
         t = trans_pred_world[bbox_idx]
 
         ## time to draw mesh
-        vertices = np.array(car_model_dict[class_names[bbox_idx]]['vertices'])
-        vertices[:, 1] = -vertices[:, 1]
-        triangles = np.array(car_model_dict[class_names[bbox_idx]]['faces']) - 1
+        vertices, triangles = car_model_dict.get_mesh(class_names[bbox_idx])
 
-        ea = euler_angle[bbox_idx]
-        yaw, pitch, roll = ea[0], ea[1], ea[2]
-        yaw, pitch, roll = -pitch, -yaw, -roll
-        Rt = np.eye(4)
-        Rt[:3, 3] = t
-        Rt[:3, :3] = euler_to_Rot(yaw, pitch, roll).T
-        Rt = Rt[:3, :]
-        P = np.ones((vertices.shape[0], vertices.shape[1] + 1))
-        P[:, :-1] = vertices
-        P = P.T
-
-        img_cor_points = np.dot(camera_matrix, np.dot(Rt, P))
-        img_cor_points = img_cor_points.T
-        img_cor_points[:, 0] /= img_cor_points[:, 2]
-        img_cor_points[:, 1] /= img_cor_points[:, 2]
-
-        for tri in triangles:
-            coord = np.array([img_cor_points[tri[0]][:2], img_cor_points[tri[1]][:2], img_cor_points[tri[2]][:2]],
-                             dtype=np.int32)
-            coord[:, 1] -= 1480
-            cv2.polylines(img, np.int32([coord]), 1, color, thickness=1)
-            cv2.drawContours(mask_all_mesh, np.int32([coord]), 0, 1, -1)
-            # cv2.drawContours(img,np.int32([coord]),0,color,-1)
+        img_cor_points = project_vertices(vertices, euler_angle[bbox_idx], t, camera_matrix)
+        coords = img_cor_points[:, :2].astype(np.int32)
+        coords[:, 1] -= 1480
+        cv2.polylines(img, list(coords[triangles]), 1, color, thickness=1)
+        mask_mesh, offset = rasterize_mesh(img_cor_points, triangles, mask_all_pred.shape, y_offset=1480)
 
-        intersection_area = np.sum(mask_all_pred * mask_all_mesh)
-        union_area = np.sum(np.logical_or(mask_all_pred, mask_all_mesh))
+        intersection_area = mask_intersection(mask_mesh, offset, mask_all_pred)
+        union_area = mask_all_pred_area + mask_mesh.sum() - intersection_area
         iou_mask_score = round(intersection_area / mask_all_pred_area, 3)
         iou_score = round(intersection_area / union_area, 3)
+        if occlusion:
+            iou_score = round(ious_visible[bbox_idx], 3)
         label_text_t = ''
         cls_score = bboxes[bbox_idx][-1]
 
@@ -685,7 +693,7 @@ def draw_result_kaggle_pku(img_original, bboxes, segms, car_names,
         for i in inds:
             color_mask = np.random.randint(0, 256, (1, 3), dtype=np.uint8)
             color_lists.append(color_mask)
-            mask = maskUtils.decode(segms[i]).astype(np.bool)
+            mask = decode_segm(segms[i]).astype(np.bool)
             img[mask] = img[mask] * (1 - transparency) + color_mask * transparency
     # draw bounding boxes
     im_combime = img_original.copy()
@@ -764,9 +772,7 @@ def imdraw_det_bboxes(img,
                     cv2.FONT_HERSHEY_COMPLEX, font_scale, text_color)
 
         # now we draw mesh
-        vertices = np.array(car_model_dict[class_names[bbox_idx]]['vertices'])
-        vertices[:, 1] = -vertices[:, 1]
-        triangles = np.array(car_model_dict[class_names[bbox_idx]]['faces']) - 1
+        vertices, triangles = car_model_dict.get_mesh(class_names[bbox_idx])
 
         t = trans_pred_world[bbox_idx]
         ea = euler_angle[bbox_idx]
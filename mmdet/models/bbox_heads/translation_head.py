@@ -49,6 +49,7 @@ class FCTranslationHead(nn.Module):
             try:
                 self.bboxes_with_translation_pick = mmcv.load(bboxes_file_name)
                 print('Finish loading file: %s' % bboxes_file_name)
+                self._register_anchor_boxes(self.bboxes_with_translation_pick)
                 # The translational prediction will now be dependend upon anchor boxes
                 num_anchor_boxes = self.bboxes_with_translation_pick.shape[0]
                 self.trans_pred = nn.Linear(fc_out_channels + fc_out_channels, num_anchor_boxes * num_translation_reg)
@@ -65,6 +66,51 @@ class FCTranslationHead(nn.Module):
         self.t_x_mean, self.t_y_mean, self.t_z_mean = -3, 9, 50
         self.t_x_std, self.t_y_std, self.t_z_std = 14.015, 4.695, 29.596
 
+    def _register_anchor_boxes(self, bboxes_with_translation):
+        # the anchor boxes follow the model to its device
+        boxes = torch.from_numpy(np.asarray(bboxes_with_translation, dtype=np.float32))
+        anchor_boxes = boxes[:, :4].clone()
+        # Because we crop the bottom
+        anchor_boxes[:, 1] -= 1480
+        anchor_boxes[:, 3] -= 1480
+        anchor_world_xyz = boxes[:, 4:7].contiguous()
+        self.register_buffer('anchor_boxes', anchor_boxes)
+        self.register_buffer('anchor_world_xyz', anchor_world_xyz)
+        self.register_buffer('anchor_distance', torch.sqrt(torch.sum(anchor_world_xyz ** 2, dim=1)))
+
+    def anchor_overlaps(self, rois):
+        """IoU (n, num_anchors) of RoIs in the cropped original image with the
+        anchor boxes, for all the RoIs at once on their device."""
+        rois = rois[:, :4].float()
+        boxes = self.anchor_boxes.to(rois.device)
+        area = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+        area_roi = (rois[:, 2] - rois[:, 0] + 1) * (rois[:, 3] - rois[:, 1] + 1)
+        lt = torch.max(rois[:, None, :2], boxes[None, :, :2])
+        rb = torch.min(rois[:, None, 2:], boxes[None, :, 2:])
+        wh = (rb - lt + 1).clamp(min=0)
+        inter = wh[..., 0] * wh[..., 1]
+        return inter / (area[None, :] + area_roi[:, None] - inter)
+
+    def match_anchors(self, rois, iou_thresh):
+        """Anchors of each RoI as in SSD: the ones with IoU > iou_thresh and
+        the max IoU one.
+
+        Returns:
+            tuple: (matched, idx_max), (n, num_anchors) bool and (n, ).
+        """
+        overlap = self.anchor_overlaps(rois)
+        idx_max = overlap.argmax(dim=1)
+        matched = overlap > iou_thresh
+        matched[torch.arange(len(overlap), device=overlap.device), idx_max] = True
+        return matched, idx_max
+
+    def anchor_world_coord(self, trans_pred):
+        """(n, num_anchors, 3) world coordinates regressed from every anchor."""
+        trans_pred = trans_pred.view(trans_pred.shape[0], -1, 3)
+        anchor_world_xyz = self.anchor_world_xyz.type_as(trans_pred)
+        anchor_distance = self.anchor_distance.type_as(trans_pred)
+        return trans_pred * anchor_distance[None, :, None] + anchor_world_xyz[None]
+
     def init_weights(self):
         super(FCTranslationHead, self).init_weights()
         for module_list in [self.bboxes_linear_1, self.bboxes_linear_2, self.car_cls_rot_linear,
@@ -113,75 +159,35 @@ class FCTranslationHead(nn.Module):
         pos_gt_assigned_translations = torch.cat(pos_gt_assigned_translations, 0)
 
         rois = rois_resize / scale_factor  # We transform it back to the original pixel space before resizing
-        rois = rois.cpu().data.numpy()
-        # Now we find the IoU > iou_thresh
-        boxes = self.bboxes_with_translation_pick.copy()
-        # Because we crop the bottom
-        boxes[:, 1] -= 1480
-        boxes[:, 3] -= 1480
-
-        x1 = boxes[:, 0]
-        y1 = boxes[:, 1]
-        x2 = boxes[:, 2]
-        y2 = boxes[:, 3]
-        area = (x2 - x1 + 1) * (y2 - y1 + 1)
-
-        # get the real world coordinate [x, y, z]
-        # pred_boxes denote the world coornidates of the referenced boxes
-        boxes_world_xyz = torch.from_numpy(boxes[:, 4:].astype(rois.dtype)).cuda(device_id)
-        distance = torch.sqrt(torch.sum(boxes_world_xyz ** 2, dim=1))
-
-        losses = dict()
-        losses['loss_translation'] = 0
-        losses['translation_distance'] = 0
-        losses['translation_distance_relative'] = 0
-        for i, roi in enumerate(rois):
-            area_roi = (roi[2] - roi[0] + 1) * (roi[3] - roi[1] + 1)
-            xx1 = np.maximum(roi[0], x1)
-            xx2 = np.minimum(roi[2], x2)
-            yy1 = np.maximum(roi[1], y1)
-            yy2 = np.minimum(roi[3], y2)
-            # compute the width and height of the bounding box
-            w = np.maximum(0, xx2 - xx1 + 1)
-            h = np.maximum(0, yy2 - yy1 + 1)
-
-            overlap = (w * h) / (area + area_roi - w * h)
-            idx_overlap = overlap > iou_thresh
-            # We follow SSD, find the max and other criterion
-            idx_max = np.argmax(overlap)
-            idx_overlap[idx_max] = True
-
-            matched_idx = torch.Tensor(idx_overlap) == True
-            matched_expand = matched_idx[:, None].expand(matched_idx.shape[0], 3).contiguous().view(-1)
-            matched_expand = matched_expand.float().cuda(device_id)
-            # calculate the reference g as in SSD paper eq. (2)
-            g = (pos_gt_assigned_translations[i] - boxes_world_xyz) / distance[:, None]
-
-            target_translations = g.view(-1) * matched_expand
-            trans_pred[i] = trans_pred[i] * matched_expand
-
-            # We still have smooth L1 loss with beta=0.1, because the translation threshold starts from 0.1
-            diff = torch.abs(trans_pred[i] - target_translations)
-            loss = torch.where(diff < beta, 0.5 * diff * diff / beta, diff - 0.5 * beta)
-            losses['loss_translation'] += loss.sum() / matched_expand.sum()
-
-            # Get the world coordinate and distance
-            translation_pred = self.get_trans_by_SSD_regression(trans_pred[i], boxes_world_xyz, distance, idx_max)
-            translation_target = pos_gt_assigned_translations[i]
-            diff_distance = translation_pred - translation_target
-            distance_i = torch.sqrt(torch.sum(translation_target ** 2))
-            translation_world = torch.sqrt(torch.sum(diff_distance ** 2))
-            translation_world_relative = translation_world / distance_i
-            losses['translation_distance'] += translation_world
-            losses['translation_distance_relative'] += translation_world_relative
+        # Now we find the IoU > iou_thresh, we follow SSD, find the max and other criterion
+        matched, idx_max = self.match_anchors(rois, iou_thresh)
+        num_rois, num_anchors = matched.shape
+        matched_expand = matched[:, :, None].expand(num_rois, num_anchors, 3).reshape(num_rois, -1)
+        matched_expand = matched_expand.type_as(trans_pred)
+
+        # calculate the reference g as in SSD paper eq. (2)
+        anchor_world_xyz = self.anchor_world_xyz.type_as(trans_pred)
+        anchor_distance = self.anchor_distance.type_as(trans_pred)
+        g = (pos_gt_assigned_translations[:, None, :] - anchor_world_xyz[None]) / anchor_distance[None, :, None]
+        target_translations = g.view(num_rois, -1) * matched_expand
+        trans_pred = trans_pred * matched_expand
+
+        # We still have smooth L1 loss with beta=0.1, because the translation threshold starts from 0.1
+        diff = torch.abs(trans_pred - target_translations)
+        loss = torch.where(diff < beta, 0.5 * diff * diff / beta, diff - 0.5 * beta)
+
+        # Get the world coordinate and distance
+        translation_pred = self.anchor_world_coord(trans_pred)[torch.arange(num_rois, device=idx_max.device), idx_max]
+        diff_distance = translation_pred - pos_gt_assigned_translations
+        distance = torch.sqrt(torch.sum(pos_gt_assigned_translations ** 2, dim=1))
+        translation_world = torch.sqrt(torch.sum(diff_distance ** 2, dim=1))
 
         # We still need to devide loss by the car number in an image
-        losses['loss_translation'] /= len(rois)
-        losses['translation_distance'] /= len(rois)
-        losses['translation_distance_relative'] /= len(rois)
+        losses = dict()
+        losses['loss_translation'] = (loss.sum(dim=1) / matched_expand.sum(dim=1)).mean()
         # The metrics are detached from backpropagation
-        losses['translation_distance'] = losses['translation_distance'].detach()
-        losses['translation_distance_relative'] = losses['translation_distance_relative'].detach()
+        losses['translation_distance'] = translation_world.mean().detach()
+        losses['translation_distance_relative'] = (translation_world / distance).mean().detach()
 
         return losses
 
@@ -205,7 +211,7 @@ class FCTranslationHead(nn.Module):
         ctr_x = rois[:, 0] + 0.5 * widths
         ctr_y = rois[:, 1] + 0.5 * heights
 
-        pred_boxes = torch.zeros(rois.shape, dtype=rois.dtype).cuda(device_id)
+        pred_boxes = rois.new_zeros(rois.shape)
 
         pred_boxes[:, 0] = ctr_x
         pred_boxes[:, 1] = ctr_y
@@ -240,7 +246,7 @@ class FCTranslationHead(nn.Module):
         ctr_x = rois[:, 0] + 0.5 * widths
         ctr_y = rois[:, 1] + 0.5 * heights
 
-        pred_boxes = torch.zeros(rois.shape, dtype=rois.dtype).cuda(device_id)
+        pred_boxes = rois.new_zeros(rois.shape)
 
         pred_boxes[:, 0] = ctr_x
         pred_boxes[:, 1] = ctr_y
@@ -308,47 +314,19 @@ class FCTranslationHead(nn.Module):
                                 device_id):
 
         rois = rois_resize / scale_factor  # We transform it back to the original pixel space before resizing
-        rois = rois.cpu().data.numpy()
-
-        # Now we find the IoU > iou_thresh
-        boxes = self.bboxes_with_translation_pick.copy()
-        # Because we crop the bottom
-        boxes[:, 1] -= 1480
-        boxes[:, 3] -= 1480
-
-        x1 = boxes[:, 0]
-        y1 = boxes[:, 1]
-        x2 = boxes[:, 2]
-        y2 = boxes[:, 3]
-        area = (x2 - x1 + 1) * (y2 - y1 + 1)
-
-        # get the real world coordinate [x, y, z]
-        boxes_world_xyz = torch.from_numpy(boxes[:, 4:].astype(rois.dtype)).cuda(device_id)
-        distance = torch.sqrt(torch.sum(boxes_world_xyz ** 2, dim=1))
-
-        translation_pred = torch.zeros((rois.shape[0], 3), dtype=trans_pred.dtype).cuda(device_id)
-        for i, roi in enumerate(rois):
-            area_roi = (roi[2] - roi[0] + 1) * (roi[3] - roi[1] + 1)
-            xx1 = np.maximum(roi[0], x1)
-            xx2 = np.minimum(roi[2], x2)
-            yy1 = np.maximum(roi[1], y1)
-            yy2 = np.minimum(roi[3], y2)
-            # compute the width and height of the bounding box
-            w = np.maximum(0, xx2 - xx1 + 1)
-            h = np.maximum(0, yy2 - yy1 + 1)
-
-            overlap = (w * h) / (area + area_roi - w * h)
-            # We follow SSD, find the max and other criterion
-            idx_max = np.argmax(overlap)
-            if self.bboxes_regression['type'] == 'maxIoU':
-                # Get the world coordinate and distance use only the max IoU
-                translation_pred[i] = self.get_trans_by_SSD_regression(trans_pred[i], boxes_world_xyz, distance, idx_max)
-            elif self.bboxes_regression['type'] == 'allIoU':
-                # Get the world coordinate from the bboxes that has IoU larger then a threshold
-                idx_overlap = np.where(overlap > self.bboxes_regression['iou_thresh'])
-                idx_overlap = np.union1d(idx_max, idx_overlap)
-                translation_pred_list = [self.get_trans_by_SSD_regression(trans_pred[i], boxes_world_xyz, distance, idx) for idx in idx_overlap]
-                translation_pred[i] = torch.stack(translation_pred_list).mean(dim=0)
+        # Now we find the IoU > iou_thresh, we follow SSD, find the max and other criterion
+        matched, idx_max = self.match_anchors(rois, self.bboxes_regression.get('iou_thresh', 0.1))
+        # get the real world coordinate [x, y, z] regressed from every anchor box
+        world_coord = self.anchor_world_coord(trans_pred)
+        if self.bboxes_regression['type'] == 'maxIoU':
+            # Get the world coordinate and distance use only the max IoU
+            translation_pred = world_coord[torch.arange(len(world_coord), device=idx_max.device), idx_max]
+        elif self.bboxes_regression['type'] == 'allIoU':
+            # Get the world coordinate from the bboxes that has IoU larger then a threshold
+            matched = matched.type_as(world_coord)
+            translation_pred = (world_coord * matched[:, :, None]).sum(dim=1) / matched.sum(dim=1, keepdim=True)
+        else:
+            translation_pred = world_coord.new_zeros((len(world_coord), 3))
         return translation_pred
 
 
@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
@@ -12,6 +13,8 @@ from .cascade_rcnn import CascadeRCNN
 
 @DETECTORS.register_module
 class HybridTaskCascade(CascadeRCNN):
+    # simple_test handles several images per batch
+    batch_test = True
 
     def __init__(self,
                  num_stages,
@@ -216,9 +219,10 @@ class HybridTaskCascade(CascadeRCNN):
         return cls_score, bbox_pred
 
     def _mask_forward_test(self, stage, x, bboxes, semantic_feat=None):
+        """bboxes is a Tensor of one image or a list with one per image."""
         mask_roi_extractor = self.mask_roi_extractor[stage]
         mask_head = self.mask_head[stage]
-        mask_rois = bbox2roi([bboxes])
+        mask_rois = bbox2roi(bboxes if isinstance(bboxes, list) else [bboxes])
         mask_feats = mask_roi_extractor(
             x[:len(mask_roi_extractor.featmap_strides)], mask_rois)
         if self.with_semantic and 'mask' in self.semantic_fusion:
@@ -248,10 +252,12 @@ class HybridTaskCascade(CascadeRCNN):
                               x,
                               _bboxes,
                               semantic_feat=None):
+        """_bboxes is a Tensor of one image or a list with one per image, the
+        predictions of all the cars of the batch are returned in order."""
         # We have only one extractor
         car_cls_rot_roi_extractor = self.car_cls_rot_roi_extractor[-1]
         ## Another bug here between training and inferencing
-        pos_rois = bbox2roi([_bboxes])
+        pos_rois = bbox2roi(_bboxes if isinstance(_bboxes, list) else [_bboxes])
         # pos_rois_shift = pos_rois
         # pos_rois_shift[:, 1:] = pos_rois[:, :4]
         car_cls_rot_feats = car_cls_rot_roi_extractor(x[:car_cls_rot_roi_extractor.num_inputs], pos_rois)
@@ -273,18 +279,29 @@ class HybridTaskCascade(CascadeRCNN):
         return car_cls_score_pred, quaternion_pred, car_cls_rot_feat
 
     def _translation_forward_test(self, pos_bboxes, scale_factor, car_cls_rot_feat, ori_shape):
-
-        # TODO: this is a dangerous hack: we assume only one image per batch
+        """pos_bboxes, scale_factor and ori_shape are those of one image or
+        lists with one item per image, car_cls_rot_feat holds the features of
+        the cars of all the images in order."""
+        if not isinstance(pos_bboxes, list):
+            pos_bboxes, scale_factor, ori_shape = [pos_bboxes], [scale_factor], [ori_shape]
         device_id = car_cls_rot_feat.get_device()
 
-        if self.translation_head.bbox_relative:
-            # then we use relative information instead the absolute world space
-            pred_boxes = self.translation_head.bbox_transform_pytorch_relative(pos_bboxes, scale_factor, device_id, ori_shape)
-        else:
-            pred_boxes = self.translation_head.bbox_transform_pytorch(pos_bboxes, scale_factor, device_id)
-        trans_pred = self.translation_head(pred_boxes, car_cls_rot_feat)
+        pred_boxes = []
+        for bboxes, img_scale_factor, img_ori_shape in zip(pos_bboxes, scale_factor, ori_shape):
+            if self.translation_head.bbox_relative:
+                # then we use relative information instead the absolute world space
+                pred_boxes.append(self.translation_head.bbox_transform_pytorch_relative(
+                    bboxes, img_scale_factor, device_id, img_ori_shape))
+            else:
+                pred_boxes.append(self.translation_head.bbox_transform_pytorch(bboxes, img_scale_factor, device_id))
+        # one forward for the cars of all the images
+        trans_pred = self.translation_head(torch.cat(pred_boxes), car_cls_rot_feat)
         if self.translation_head.translation_bboxes_regression:
-            trans_pred_world = self.translation_head.pred_to_world_coord_SSD(trans_pred, pos_bboxes, scale_factor, device_id)
+            trans_pred_world = [
+                self.translation_head.pred_to_world_coord_SSD(img_trans_pred, bboxes, img_scale_factor, device_id)
+                for img_trans_pred, bboxes, img_scale_factor in zip(
+                    trans_pred.split([len(b) for b in pos_bboxes]), pos_bboxes, scale_factor)]
+            trans_pred_world = torch.cat(trans_pred_world)
         else:
             trans_pred_world = self.translation_head.pred_to_world_coord(trans_pred)
         trans_pred_world = trans_pred_world.cpu().numpy()
@@ -538,7 +555,51 @@ class HybridTaskCascade(CascadeRCNN):
 
         return losses
 
+    def forward_test(self, imgs, img_metas, **kwargs):
+        # the single scale test runs on all the images of the batch
+        if isinstance(imgs, list) and len(imgs) == 1:
+            return self.simple_test(imgs[0], img_metas[0], **kwargs)
+        return super(HybridTaskCascade, self).forward_test(imgs, img_metas, **kwargs)
+
+    @staticmethod
+    def _img_inds(rois, num_imgs):
+        return [rois[:, 0] == j for j in range(num_imgs)]
+
+    def _regress_by_class(self, bbox_head, rois, label, bbox_pred, img_meta):
+        # the rois are clipped to the shape of their own image
+        if len(img_meta) == 1:
+            return bbox_head.regress_by_class(rois, label, bbox_pred, img_meta[0])
+        new_rois = torch.empty_like(rois)
+        for inds, meta in zip(self._img_inds(rois, len(img_meta)), img_meta):
+            new_rois[inds] = bbox_head.regress_by_class(rois[inds], label[inds], bbox_pred[inds], meta)
+        return new_rois
+
+    def _get_det_bboxes(self, bbox_head, rois, cls_score, bbox_pred, img_meta, rescale):
+        """(det_bboxes, det_labels) of each image of the batch."""
+        dets = []
+        for inds, meta in zip(self._img_inds(rois, len(img_meta)), img_meta):
+            dets.append(bbox_head.get_det_bboxes(
+                rois[inds],
+                cls_score[inds],
+                bbox_pred[inds],
+                meta['img_shape'],
+                meta['scale_factor'],
+                rescale=rescale,
+                cfg=self.test_cfg.rcnn))
+        return dets
+
+    def _mask_bboxes(self, dets, img_meta, rescale):
+        return [det_bboxes[:, :4] * meta['scale_factor'] if rescale else det_bboxes
+                for (det_bboxes, _), meta in zip(dets, img_meta)]
+
     def simple_test(self, img, img_meta, proposals=None, rescale=False):
+        """Test without augmentation on the N images of the batch, the RoIs
+        of all the images go through the heads together.
+
+        Returns:
+            The results of the image if N is 1, else a list with the results
+            of each image.
+        """
         x = self.extract_feat(img)
         proposal_list = self.simple_test_rpn(x, img_meta, self.test_cfg.rpn) if proposals is None else proposals
 
@@ -547,15 +608,12 @@ class HybridTaskCascade(CascadeRCNN):
         else:
             semantic_feat = None
 
-        file_name = img_meta[0]['filename']
-        img_shape = img_meta[0]['img_shape']
-        ori_shape = img_meta[0]['ori_shape']
-        scale_factor = img_meta[0]['scale_factor']
+        num_imgs = len(img_meta)
 
         # "ms" in variable names means multi-stage
-        ms_bbox_result = {}
-        ms_segm_result = {}
-        ms_6dof_result = {}
+        ms_bbox_result = [{} for _ in range(num_imgs)]
+        ms_segm_result = [{} for _ in range(num_imgs)]
+        ms_6dof_result = [{} for _ in range(num_imgs)]
         ms_scores = []
         rcnn_test_cfg = self.test_cfg.rcnn
 
@@ -566,62 +624,42 @@ class HybridTaskCascade(CascadeRCNN):
             ms_scores.append(cls_score)
 
             if self.test_cfg.keep_all_stages:
-                det_bboxes, det_labels = bbox_head.get_det_bboxes(
-                    rois,
-                    cls_score,
-                    bbox_pred,
-                    img_shape,
-                    scale_factor,
-                    rescale=rescale,
-                    cfg=rcnn_test_cfg)
-                bbox_result = bbox2result(det_bboxes, det_labels,
-                                          bbox_head.num_classes)
-                ms_bbox_result['stage{}'.format(i)] = bbox_result
+                dets = self._get_det_bboxes(bbox_head, rois, cls_score, bbox_pred, img_meta, rescale)
+                for j, (det_bboxes, det_labels) in enumerate(dets):
+                    ms_bbox_result[j]['stage{}'.format(i)] = bbox2result(det_bboxes, det_labels,
+                                                                         bbox_head.num_classes)
 
                 if self.with_mask:
                     mask_head = self.mask_head[i]
-                    if det_bboxes.shape[0] == 0:
-                        mask_classes = mask_head.num_classes - 1
-                        segm_result = [[] for _ in range(mask_classes)]
-                    else:
-                        _bboxes = (
-                            det_bboxes[:, :4] *
-                            scale_factor if rescale else det_bboxes)
-                        mask_pred = self._mask_forward_test(
-                            i, x, _bboxes, semantic_feat=semantic_feat)
-                        segm_result = mask_head.get_seg_masks(
-                            mask_pred, _bboxes, det_labels, rcnn_test_cfg,
-                            ori_shape, scale_factor, rescale)
-                    ms_segm_result['stage{}'.format(i)] = segm_result
+                    _bboxes = self._mask_bboxes(dets, img_meta, rescale)
+                    if sum(len(b) for b in _bboxes):
+                        mask_preds = self._mask_forward_test(
+                            i, x, _bboxes, semantic_feat=semantic_feat).split([len(b) for b in _bboxes])
+                    for j, (det_bboxes, det_labels) in enumerate(dets):
+                        if det_bboxes.shape[0] == 0:
+                            mask_classes = mask_head.num_classes - 1
+                            segm_result = [[] for _ in range(mask_classes)]
+                        else:
+                            segm_result = mask_head.get_seg_masks(
+                                mask_preds[j], _bboxes[j], det_labels, rcnn_test_cfg,
+                                img_meta[j]['ori_shape'], img_meta[j]['scale_factor'], rescale)
+                        ms_segm_result[j]['stage{}'.format(i)] = segm_result
 
             if i < self.num_stages - 1:
                 bbox_label = cls_score.argmax(dim=1)
-                rois = bbox_head.regress_by_class(rois, bbox_label, bbox_pred,
-                                                  img_meta[0])
+                rois = self._regress_by_class(bbox_head, rois, bbox_label, bbox_pred, img_meta)
 
         cls_score = sum(ms_scores) / float(len(ms_scores))
-        det_bboxes, det_labels = self.bbox_head[-1].get_det_bboxes(
-            rois,
-            cls_score,
-            bbox_pred,
-            img_shape,
-            scale_factor,
-            rescale=rescale,
-            cfg=rcnn_test_cfg)
-        bbox_result = bbox2result(det_bboxes, det_labels,
-                                  self.bbox_head[-1].num_classes)
-        ms_bbox_result['ensemble'] = bbox_result
+        dets = self._get_det_bboxes(self.bbox_head[-1], rois, cls_score, bbox_pred, img_meta, rescale)
+        for j, (det_bboxes, det_labels) in enumerate(dets):
+            ms_bbox_result[j]['ensemble'] = bbox2result(det_bboxes, det_labels,
+                                                        self.bbox_head[-1].num_classes)
 
         if self.with_mask:
-            if det_bboxes.shape[0] == 0:
-                mask_classes = self.mask_head[-1].num_classes - 1
-                segm_result = [[] for _ in range(mask_classes)]
-            else:
-                _bboxes = (
-                    det_bboxes[:, :4] *
-                    scale_factor if rescale else det_bboxes)
-
-                mask_rois = bbox2roi([_bboxes])
+            _bboxes = self._mask_bboxes(dets, img_meta, rescale)
+            num_dets = [len(b) for b in _bboxes]
+            if sum(num_dets):
+                mask_rois = bbox2roi(_bboxes)
                 aug_masks = []
                 mask_roi_extractor = self.mask_roi_extractor[-1]
                 mask_feats = mask_roi_extractor(
@@ -638,13 +676,20 @@ class HybridTaskCascade(CascadeRCNN):
                     else:
                         mask_pred = mask_head(mask_feats)
                     aug_masks.append(mask_pred.sigmoid().cpu().numpy())
-                merged_masks = merge_aug_masks(aug_masks,
-                                               [img_meta] * self.num_stages,
-                                               self.test_cfg.rcnn)
-                segm_result = self.mask_head[-1].get_seg_masks(
-                    merged_masks, _bboxes, det_labels, rcnn_test_cfg,
-                    ori_shape, scale_factor, rescale)
-            ms_segm_result['ensemble'] = segm_result
+                split_inds = np.cumsum(num_dets)[:-1]
+                aug_masks = [np.split(aug_mask, split_inds) for aug_mask in aug_masks]
+            for j, (det_bboxes, det_labels) in enumerate(dets):
+                if det_bboxes.shape[0] == 0:
+                    mask_classes = self.mask_head[-1].num_classes - 1
+                    segm_result = [[] for _ in range(mask_classes)]
+                else:
+                    merged_masks = merge_aug_masks([aug_mask[j] for aug_mask in aug_masks],
+                                                   [[img_meta[j]]] * self.num_stages,
+                                                   self.test_cfg.rcnn)
+                    segm_result = self.mask_head[-1].get_seg_masks(
+                        merged_masks, _bboxes[j], det_labels, rcnn_test_cfg,
+                        img_meta[j]['ori_shape'], img_meta[j]['scale_factor'], rescale)
+                ms_segm_result[j]['ensemble'] = segm_result
 
         if self.with_car_cls_rot:
             if self.test_cfg.keep_all_stages:
@@ -652,43 +697,61 @@ class HybridTaskCascade(CascadeRCNN):
             else:
                 car_cls_coco = 2
                 stage_num = self.num_stages-1
-                pos_box = det_bboxes[det_labels == car_cls_coco]
-                # !!!!!!!!!!!!!!!!!!!!! Quite import bug below, scale is needed!!!!!!!!!!!!!
-                pos_box = (pos_box * scale_factor if rescale else det_bboxes)
-
-                if len(pos_box):
-                    car_cls_score_pred, quaternion_pred, car_cls_rot_feats = self._carcls_rot_forward_test(stage_num, x, pos_box, semantic_feat)
+                pos_boxes = []
+                for (det_bboxes, det_labels), meta in zip(dets, img_meta):
+                    pos_box = det_bboxes[det_labels == car_cls_coco]
+                    # !!!!!!!!!!!!!!!!!!!!! Quite import bug below, scale is needed!!!!!!!!!!!!!
+                    pos_boxes.append(pos_box * meta['scale_factor'] if rescale else det_bboxes)
+                num_cars = [len(pos_box) for pos_box in pos_boxes]
+
+                if sum(num_cars):
+                    # the cars of all the images go through the heads together
+                    car_cls_score_pred, quaternion_pred, car_cls_rot_feats = \
+                        self._carcls_rot_forward_test(stage_num, x, pos_boxes, semantic_feat)
+            if self.with_translation and sum(num_cars):
+                trans_pred_world = self._translation_forward_test([pos_box[:, :4] for pos_box in pos_boxes],
+                                                                  [meta['scale_factor'] for meta in img_meta],
+                                                                  car_cls_rot_feats,
+                                                                  [meta['ori_shape'] for meta in img_meta])
+            if sum(num_cars):
+                split_inds = np.cumsum(num_cars)[:-1]
+                car_cls_score_pred, quaternion_pred = [
+                    np.split(pred, split_inds) for pred in (car_cls_score_pred, quaternion_pred)]
+                if self.with_translation:
+                    trans_pred_world = np.split(trans_pred_world, split_inds)
+            for j, meta in enumerate(img_meta):
+                if num_cars[j]:
+                    img_6dof = {'car_cls_score_pred': car_cls_score_pred[j],
+                                'quaternion_pred': quaternion_pred[j],
+                                'trans_pred_world': trans_pred_world[j] if self.with_translation else []}
                 else:
-                    car_cls_score_pred, quaternion_pred, car_cls_rot_feats = [], [], []
-            if self.with_translation:
-                if len(pos_box):
-                    trans_pred_world = self._translation_forward_test(pos_box[:, :4], scale_factor, car_cls_rot_feats, ori_shape)
+                    img_6dof = {'car_cls_score_pred': [], 'quaternion_pred': [], 'trans_pred_world': []}
+                img_6dof['file_name'] = meta['filename']
+                ms_6dof_result[j]['ensemble'] = img_6dof
+
+        results = []
+        for j in range(num_imgs):
+            if not self.test_cfg.keep_all_stages:
+                if self.with_translation:
+                    result = (ms_bbox_result[j]['ensemble'],
+                              ms_segm_result[j]['ensemble'],
+                              ms_6dof_result[j]['ensemble'])
+                elif self.with_mask:
+                    result = (ms_bbox_result[j]['ensemble'],
+                              ms_segm_result[j]['ensemble'])
                 else:
-                    trans_pred_world = []
-            ms_6dof_result['ensemble'] = {'car_cls_score_pred': car_cls_score_pred,
-                                          'quaternion_pred': quaternion_pred,
-                                          'trans_pred_world': trans_pred_world,
-                                          'file_name': file_name}
-        if not self.test_cfg.keep_all_stages:
-            if self.with_translation:
-                results = (ms_bbox_result['ensemble'],
-                           ms_segm_result['ensemble'],
-                           ms_6dof_result['ensemble'])
-            elif self.with_mask:
-                results = (ms_bbox_result['ensemble'],
-                           ms_segm_result['ensemble'])
-            else:
-                results = ms_bbox_result['ensemble']
-        else:
-            if self.with_mask:
-                results = {
-                    stage: (ms_bbox_result[stage], ms_segm_result[stage])
-                    for stage in ms_bbox_result
-                }
+                    result = ms_bbox_result[j]['ensemble']
             else:
-                results = ms_bbox_result
+                if self.with_mask:
+                    result = {
+                        stage: (ms_bbox_result[j][stage], ms_segm_result[j][stage])
+                        for stage in ms_bbox_result[j]
+                    }
+                else:
+                    result = ms_bbox_result[j]
+            results.append(result)
 
-        return results
+        return results[0] if num_imgs == 1 else results
 
     def aug_test(self, imgs, img_metas, proposals=None, rescale=False):
         """Test with augmentations.
@@ -1,11 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import mmcv
 import numpy as np
-import pycocotools.mask as mask_util
 import torch
 import torch.nn as nn
 from torch.nn.modules.utils import _pair
 
-from mmdet.core import auto_fp16, force_fp32, mask_target
+from mmdet.core import auto_fp16, encode_cropped, force_fp32, mask_target
 from ..builder import build_loss
 from ..registry import HEADS
 from ..utils import ConvModule
@@ -134,7 +135,10 @@ class FCNMaskHead(nn.Module):
             det_bboxes (Tensor): shape (n, 4/5)
             det_labels (Tensor): shape (n, )
             img_shape (Tensor): shape (3, )
-            rcnn_test_cfg (dict): rcnn testing config
+            rcnn_test_cfg (dict): rcnn testing config, ``mask_format`` is
+                'rle' (default) for full image RLEs or 'cropped' for
+                dict(size, offset, mask) with the bbox-local masks, and
+                ``mask_workers`` the threads pasting / encoding the masks.
             ori_shape: original image size
 
         Returns:
@@ -158,7 +162,11 @@ class FCNMaskHead(nn.Module):
             img_w = np.round(ori_shape[1] * scale_factor).astype(np.int32)
             scale_factor = 1.0
 
-        for i in range(bboxes.shape[0]):
+        mask_format = rcnn_test_cfg.get('mask_format', 'rle')
+        assert mask_format in ('rle', 'cropped')
+        img_size = (int(img_h), int(img_w))
+
+        def seg_mask(i):
             bbox = (bboxes[i, :] / scale_factor).astype(np.int32)
             label = labels[i]
             w = max(bbox[2] - bbox[0] + 1, 1)
@@ -168,14 +176,32 @@ class FCNMaskHead(nn.Module):
                 mask_pred_ = mask_pred[i, label, :, :]
             else:
                 mask_pred_ = mask_pred[i, 0, :, :]
-            im_mask = np.zeros((img_h, img_w), dtype=np.uint8)
 
             bbox_mask = mmcv.imresize(mask_pred_, (w, h))
             bbox_mask = (bbox_mask > rcnn_test_cfg.mask_thr_binary).astype(
                 np.uint8)
-            im_mask[bbox[1]:bbox[1] + h, bbox[0]:bbox[0] + w] = bbox_mask
-            rle = mask_util.encode(
-                np.array(im_mask[:, :, np.newaxis], order='F'))[0]
-            cls_segms[label - 1].append(rle)
+            # the mask is never pasted into a full image canvas
+            offset = (int(bbox[0]), int(bbox[1]))
+            if mask_format == 'cropped':
+                return dict(size=list(img_size), offset=offset, mask=bbox_mask)
+            return encode_cropped(bbox_mask, offset, img_size)
+
+        num_workers = rcnn_test_cfg.get('mask_workers', 4)
+        if num_workers > 1 and bboxes.shape[0] > 1:
+            segms = list(_mask_executor(num_workers).map(seg_mask, range(bboxes.shape[0])))
+        else:
+            segms = [seg_mask(i) for i in range(bboxes.shape[0])]
+        for label, segm in zip(labels, segms):
+            cls_segms[label - 1].append(segm)
 
         return cls_segms
+
+
+_executors = dict()
+
+
+def _mask_executor(num_workers):
+    # cv2 releases the GIL while resizing the masks
+    if num_workers not in _executors:
+        _executors[num_workers] = ThreadPoolExecutor(num_workers)
+    return _executors[num_workers]
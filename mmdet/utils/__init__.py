@@ -1,5 +1,9 @@
 from .flops_counter import get_model_complexity_info
 from .registry import Registry, build_from_cfg
-from .map_calculation import check_match, RotationDistance, TranslationDistance, str2coords, expand_df, coords2str
+from .map_calculation import check_match, RotationDistance, TranslationDistance, str2coords, expand_df, coords2str, \
+    MapEvaluator
+from .result_store import ResultStore, ResultWriter, dump_results, load_results
+from .worker_pool import worker_pool, worker_state
 
-__all__ = ['Registry', 'build_from_cfg', 'get_model_complexity_info']
+__all__ = ['Registry', 'build_from_cfg', 'get_model_complexity_info', 'ResultStore', 'ResultWriter', 'dump_results',
+           'load_results', 'worker_pool', 'worker_state']
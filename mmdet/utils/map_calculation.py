@@ -150,3 +150,163 @@ def RotationDistance_q(q1, q2):
     if W > 180:
         W = 360 - W
     return W
+
+
+def parse_prediction_strings(df):
+    """Parse the PredictionString column once into {ImageId: (n, 7) array}.
+
+    Later rows override earlier ones with the same ImageId, as in check_match.
+    """
+    coords = {}
+    for img_id, s in zip(df['ImageId'], df['PredictionString']):
+        if not isinstance(s, str):
+            s = ''
+        coords[img_id] = np.array(s.split()).reshape([-1, 7]).astype('float')
+    return coords
+
+
+class MapEvaluator(object):
+    """Kaggle PKU mAP over the ten (translation, rotation) thresholds.
+
+    The GT is parsed once at construction, each evaluate() parses the
+    predictions once and runs the greedy matching of all the thresholds in a
+    single pass. The per-image pred x GT translation and rotation distance
+    matrices are computed with NumPy, the result is the same as running
+    check_match for every threshold.
+
+    Args:
+        gt_df (DataFrame): ImageId, PredictionString with
+            model type, pitch, yaw, roll, x, y, z.
+        flip_mode (bool): evaluate predictions of horizontally flipped images.
+    """
+
+    def __init__(self, gt_df, flip_mode=False):
+        self.thres_tr = np.array(thres_tr_list)
+        self.thres_ro = np.array(thres_ro_list)
+        self.num_gt = len(expand_df(gt_df, ['model_type', 'pitch', 'yaw', 'roll', 'x', 'y', 'z']))
+        self.gt_coords = parse_prediction_strings(gt_df)
+        if flip_mode:
+            for gt in self.gt_coords.values():
+                gt[:, 1] = -gt[:, 1]
+                gt[:, 3] = -gt[:, 3]
+                gt[:, 4] = 2 * delta_x * gt[:, 6] / fx - gt[:, 4]
+
+    def match(self, pred_df):
+        """Greedy matching of the predictions for all the thresholds.
+
+        Returns:
+            tuple: (result_flg, scores), result_flg is (num_thresholds, n)
+                with 1 for TP and 0 for FP, scores is (n, ).
+        """
+        return self.match_coords(parse_prediction_strings(pred_df))
+
+    def match_coords(self, pred_coords):
+        """Same as match() with the predictions already parsed into
+        {ImageId: (n, 7) array} of pitch, yaw, roll, x, y, z, score."""
+        num_thres = len(self.thres_tr)
+        empty = np.zeros((0, 7))
+
+        # pred x gt distance matrices, padded to the largest image
+        images = []
+        for img_id, pred in pred_coords.items():
+            order = np.argsort(-pred[:, 6], kind='stable')
+            images.append((pred[order], self.gt_coords.get(img_id, empty)))
+        max_pred = max([len(p) for p, _ in images] + [0])
+        max_gt = max([len(g) for _, g in images] + [1])
+        tr_dist = np.full((len(images), max_pred, max_gt), np.inf)
+        ro_dist = np.full((len(images), max_pred, max_gt), np.inf)
+
+        pairs_pred, pairs_gt, pairs_idx = [], [], []
+        for i, (pred, gt) in enumerate(images):
+            if not len(pred) or not len(gt):
+                continue
+            diff = pred[:, None, 3:6] - gt[None, :, 4:7]
+            dist = np.sqrt(diff[..., 0] ** 2 + diff[..., 1] ** 2 + diff[..., 2] ** 2)
+            norm = np.sqrt(gt[:, 4] ** 2 + gt[:, 5] ** 2 + gt[:, 6] ** 2)
+            tr_dist[i, :len(pred), :len(gt)] = dist / norm[None, :]
+            pred_idx, gt_idx = np.divmod(np.arange(len(pred) * len(gt)), len(gt))
+            pairs_idx.append((np.full_like(pred_idx, i), pred_idx, gt_idx))
+            pairs_pred.append(pred[pred_idx, 0:3])
+            pairs_gt.append(gt[gt_idx, 1:4])
+        if pairs_pred:
+            # same as RotationDistance, for all the pairs at once
+            q1 = R.from_euler('xyz', np.concatenate(pairs_gt))
+            q2 = R.from_euler('xyz', np.concatenate(pairs_pred))
+            w = np.clip((q2.inv() * q1).as_quat()[:, -1], -1., 1.)
+            angle = np.arccos(w) * 360 / pi
+            angle = np.where(angle > 180, 360 - angle, angle)
+            img_idx, pred_idx, gt_idx = [np.concatenate(idx) for idx in zip(*pairs_idx)]
+            ro_dist[img_idx, pred_idx, gt_idx] = angle
+        tr_dist[np.isnan(tr_dist)] = np.inf
+
+        # greedy matching: the k-th best prediction of every image at once
+        num_imgs = len(images)
+        used = np.zeros((num_thres, num_imgs, max_gt), dtype=bool)
+        result_flg = np.zeros((num_thres, num_imgs, max_pred), dtype=np.int64)
+        img_range = np.arange(num_imgs)
+        for k in range(max_pred):
+            dist = np.where(used, np.inf, tr_dist[None, :, k, :])
+            nearest = dist.argmin(axis=2)
+            min_tr = np.take_along_axis(dist, nearest[..., None], axis=2)[..., 0]
+            min_ro = ro_dist[img_range[None, :], k, nearest]
+            matched = (min_tr < self.thres_tr[:, None]) & (min_ro < self.thres_ro[:, None])
+            thres_idx, img_idx = np.nonzero(matched)
+            used[thres_idx, img_idx, nearest[thres_idx, img_idx]] = True
+            result_flg[:, :, k] = matched
+
+        valid = np.zeros((num_imgs, max_pred), dtype=bool)
+        scores = np.zeros((num_imgs, max_pred))
+        for i, (pred, _) in enumerate(images):
+            valid[i, :len(pred)] = True
+            scores[i, :len(pred)] = pred[:, 6]
+        return result_flg[:, valid], scores[valid]
+
+    def evaluate(self, pred_df):
+        """Return the mAP and the AP of every threshold."""
+        result_flg, scores = self.match(pred_df)
+        ap_list = []
+        for flg in result_flg:
+            if np.sum(flg) > 0:
+                recall = np.sum(flg) / self.num_gt
+                ap = average_precision_score(flg, scores) * recall
+            else:
+                ap = 0
+            ap_list.append(ap)
+        return np.mean(ap_list), ap_list
+
+    def sweep(self, pred_coords, conf_thresholds):
+        """mAP of the predictions above every confidence threshold, from a
+        single matching.
+
+        The greedy matching takes the predictions of an image by decreasing
+        score, so a prediction is matched the same whether the lower ones are
+        kept or not. The predictions above a threshold are a prefix of the
+        full matching, and their AP x recall is the sum of
+        delta TP * precision / num_gt over the distinct scores above it, as
+        in average_precision_score.
+
+        Args:
+            pred_coords (dict): {ImageId: (n, 7) array} of pitch, yaw, roll,
+                x, y, z, score, with the predictions of the lowest threshold.
+            conf_thresholds (list[float]): the predictions with a score
+                strictly above a threshold are kept.
+
+        Returns:
+            tuple: (maps, ap_lists), the mAP of every confidence threshold
+                and its (num_conf_thresholds, num_thresholds) APs.
+        """
+        conf_thresholds = np.asarray(conf_thresholds, dtype=np.float64)
+        result_flg, scores = self.match_coords(pred_coords)
+        ap_lists = np.zeros((len(conf_thresholds), len(self.thres_tr)))
+        if len(scores):
+            order = np.argsort(-scores, kind='stable')
+            scores = scores[order]
+            # the last prediction of every distinct score
+            last = np.append(np.flatnonzero(np.diff(scores)), len(scores) - 1)
+            tp = np.cumsum(result_flg[:, order], axis=1)[:, last]
+            precision = tp / (last + 1)
+            ap = np.cumsum(np.diff(tp, axis=1, prepend=0) * precision, axis=1) / self.num_gt
+            # number of distinct scores above every confidence threshold
+            num_kept = np.searchsorted(-scores[last], -conf_thresholds, side='left')
+            ap_lists = np.hstack([np.zeros((len(ap), 1)), ap])[:, num_kept].T
+        return ap_lists.mean(axis=1), ap_lists
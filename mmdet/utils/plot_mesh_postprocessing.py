@@ -1,17 +1,16 @@
 import os
-import json
 
 import cv2
 import copy
 from mmcv.image import imread, imwrite
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
 import multiprocessing
 
 from mmdet.datasets.car_models import car_id2name
+from mmdet.datasets.car_model_bank import CarModelBank
 from mmdet.datasets.kaggle_pku_utils import euler_to_Rot, euler_angles_to_quaternions, quaternion_upper_hemispher, \
-    quaternion_to_euler_angle
+    quaternion_to_euler_angle, quaternions_to_euler_angles, get_euler_angles
 from demo.visualisation_utils import draw_box_mesh_kaggle_pku, refine_yaw_and_roll, restore_x_y_from_z_withIOU
 
 
@@ -61,13 +60,7 @@ class Plot_Mesh_Postprocessing:
         return coords
 
     def load_car_models(self):
-        car_model_dir = os.path.join(self.car_model_json_dir, 'car_models_json')
-        car_model_dict = {}
-        for car_name in tqdm(os.listdir(car_model_dir)):
-            with open(os.path.join(self.car_model_json_dir, 'car_models_json', car_name)) as json_file:
-                car_model_dict[car_name[:-5]] = json.load(json_file)
-
-        return car_model_dict
+        return CarModelBank(self.car_model_json_dir)
 
     def restore_pool(self, t):
         # print('t',t)
@@ -94,7 +87,7 @@ class Plot_Mesh_Postprocessing:
         car_cls_score_pred = six_dof['car_cls_score_pred']
         quaternion_pred = six_dof['quaternion_pred']
         trans_pred_world = six_dof['trans_pred_world'].copy()
-        euler_angle = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+        euler_angle = quaternions_to_euler_angles(quaternion_pred)
         car_labels = np.argmax(car_cls_score_pred, axis=1)
         kaggle_car_labels = [self.unique_car_mode[x] for x in car_labels]
         car_names = np.array([car_id2name[x].name for x in kaggle_car_labels])
@@ -109,7 +102,7 @@ class Plot_Mesh_Postprocessing:
                                                                   self.camera_matrix)
         if flag:
             output[2]['quaternion_pred'] = quaternion_semisphere_refined
-            euler_angle = np.array([quaternion_to_euler_angle(x) for x in output[2]['quaternion_pred']])
+            euler_angle = get_euler_angles(output[2])
 
         trans_pred_world_refined = restore_x_y_from_z_withIOU(image, bboxes[car_cls_coco], segms[car_cls_coco],
                                                               car_names, euler_angle, trans_pred_world,
@@ -160,9 +153,7 @@ class Plot_Mesh_Postprocessing:
             # car_id2name is from:
             # https://github.com/ApolloScapeAuto/dataset-api/blob/master/car_instance/car_models.py
             car_name = car_id2name[gt_pred['id']].name
-            vertices = np.array(self.car_model_dict[car_name]['vertices'])
-            vertices[:, 1] = -vertices[:, 1]
-            triangles = np.array(self.car_model_dict[car_name]['faces']) - 1
+            vertices, triangles = self.car_model_dict.get_mesh(car_name)
 
             # project 3D points to 2d image plane
             yaw, pitch, roll = gt_pred['yaw'], gt_pred['pitch'], gt_pred['roll']
@@ -0,0 +1,226 @@
+"""
+    Brief: Append-only sharded store of the per-image test results
+    A store is a directory of shards, every writer (e.g. every rank) appends
+    to its own shard. A shard is made of three files:
+        <shard>.npy    the columnar arrays of the records, as consecutive
+                       .npy blobs: the bboxes of all the classes concatenated
+                       with their per-class counts, and every array of the
+                       6dof dict (quaternions, translations, scores...)
+        <shard>.rle    the segmentation RLEs, one pickle per record, only
+                       read when the masks are needed
+        <shard>.index  one json line per record with its ImageId, dataset
+                       index and offsets in the two files above
+    The index line is written last, a record interrupted by a crash is never
+    visible. When an image is written several times, e.g. by a post-processing
+    resumed over its partial output, its last record wins.
+"""
+import json
+import os
+import pickle
+
+import mmcv
+import numpy as np
+
+INDEX_SUFFIX = '.index'
+ARRAY_SUFFIX = '.npy'
+RLE_SUFFIX = '.rle'
+
+
+def image_id_from_output(output, default=None):
+    if len(output) > 2 and output[2].get('file_name'):
+        file_name = os.path.basename(output[2]['file_name'])
+        return '.'.join(file_name.split('.')[:-1])
+    return default
+
+
+class ResultWriter(object):
+    """Append the test outputs of one process to a shard of a store.
+
+    Args:
+        store_dir (str): directory of the store, created if needed.
+        shard (str): name of the shard, unique per writer, e.g. 'part_0'.
+        resume (bool): append to the store of an interrupted run. Otherwise
+            the store is written from scratch, the shards of a previous run
+            are removed, which is only safe with a single writer.
+    """
+
+    def __init__(self, store_dir, shard='part_0', resume=False):
+        mmcv.mkdir_or_exist(store_dir)
+        if not resume:
+            for fn in os.listdir(store_dir):
+                if fn.endswith((INDEX_SUFFIX, ARRAY_SUFFIX, RLE_SUFFIX)):
+                    os.remove(os.path.join(store_dir, fn))
+        prefix = os.path.join(store_dir, shard)
+        self._arrays = open(prefix + ARRAY_SUFFIX, 'ab')
+        self._rles = open(prefix + RLE_SUFFIX, 'ab')
+        self._index = open(prefix + INDEX_SUFFIX, 'a')
+
+    def append(self, output, idx, image_id=None):
+        """Append the output of the detector for one image.
+
+        Args:
+            output (tuple): (bbox_result, segm_result[, six_dof]) as returned
+                by the detector or the post-processing.
+            idx (int): index of the image in the dataset, the records of a
+                store are iterated in this order.
+            image_id (str, optional): defaults to the name of
+                ``output[2]['file_name']``.
+        """
+        bbox_result = output[0]
+        record = dict(idx=int(idx), image_id=image_id or image_id_from_output(output, str(idx)))
+
+        arrays = [('bboxes', np.concatenate([np.asarray(b, dtype=np.float32).reshape(-1, 5) for b in bbox_result])),
+                  ('bbox_counts', np.array([len(b) for b in bbox_result], dtype=np.int64))]
+        meta = dict()
+        if len(output) > 2:
+            for k, v in output[2].items():
+                if isinstance(v, str) or v is None:
+                    meta[k] = v
+                else:
+                    arrays.append(('6dof/' + k, np.asarray(v)))
+        record['meta'] = meta
+
+        record['arrays'] = self._arrays.tell()
+        record['names'] = [name for name, _ in arrays]
+        for _, array in arrays:
+            np.save(self._arrays, array, allow_pickle=False)
+        record['rles'] = None
+        if len(output) > 1 and output[1] is not None:
+            record['rles'] = self._rles.tell()
+            pickle.dump(output[1], self._rles, protocol=pickle.HIGHEST_PROTOCOL)
+        record['has_6dof'] = len(output) > 2
+
+        self._arrays.flush()
+        self._rles.flush()
+        self._index.write(json.dumps(record) + '\n')
+        self._index.flush()
+
+    def close(self):
+        for f in (self._arrays, self._rles, self._index):
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResultStore(object):
+    """Read-only view of a result store with random access by ImageId.
+
+    Only the index is loaded, the records are read from the shards when
+    accessed. Iterating the store yields the outputs in dataset order, in the
+    same (bbox_result, segm_result, six_dof) format as the detector, so it can
+    replace the list loaded from a pickle.
+
+    Args:
+        store_dir (str): directory of the store.
+        load_masks (bool): read the segmentation RLEs. When False
+            ``output[1]`` is None, which is enough for the 6dof
+            post-processing and the submission.
+    """
+
+    def __init__(self, store_dir, load_masks=True):
+        self.store_dir = store_dir
+        self.load_masks = load_masks
+        records = []
+        for fn in sorted(os.listdir(store_dir)):
+            if not fn.endswith(INDEX_SUFFIX):
+                continue
+            shard = fn[:-len(INDEX_SUFFIX)]
+            with open(os.path.join(store_dir, fn)) as f:
+                for line in f:
+                    if line.endswith('\n'):
+                        record = json.loads(line)
+                        record['shard'] = shard
+                        records.append(record)
+        # the last record of an index wins, an image written again replaces its
+        # output of an earlier pass
+        by_idx = dict()
+        for record in records:
+            by_idx[record['idx']] = record
+        self.records = [by_idx[i] for i in sorted(by_idx)]
+        self.image_id2pos = {r['image_id']: pos for pos, r in enumerate(self.records)}
+        self._files = dict()
+        self._pid = os.getpid()
+
+    @property
+    def image_ids(self):
+        return [r['image_id'] for r in self.records]
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, image_id):
+        return image_id in self.image_id2pos
+
+    def __iter__(self):
+        for record in self.records:
+            yield self._read(record)
+
+    def __getitem__(self, key):
+        """Output of an image, by ImageId (str) or position (int)."""
+        if isinstance(key, str):
+            key = self.image_id2pos[key]
+        return self._read(self.records[key])
+
+    def __getstate__(self):
+        return dict(store_dir=self.store_dir, load_masks=self.load_masks,
+                    records=self.records, image_id2pos=self.image_id2pos)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._files = dict()
+        self._pid = os.getpid()
+
+    def _file(self, shard, suffix):
+        if self._pid != os.getpid():
+            # a forked worker does not share the file offsets of the parent's handles
+            self._files = dict()
+            self._pid = os.getpid()
+        key = shard + suffix
+        if key not in self._files:
+            self._files[key] = open(os.path.join(self.store_dir, key), 'rb')
+        return self._files[key]
+
+    def _read(self, record):
+        f = self._file(record['shard'], ARRAY_SUFFIX)
+        f.seek(record['arrays'])
+        arrays = {name: np.load(f, allow_pickle=False) for name in record['names']}
+
+        split = np.cumsum(arrays['bbox_counts'])[:-1]
+        bbox_result = np.split(arrays['bboxes'], split)
+        segm_result = None
+        if self.load_masks and record['rles'] is not None:
+            f = self._file(record['shard'], RLE_SUFFIX)
+            f.seek(record['rles'])
+            segm_result = pickle.load(f)
+        if not record['has_6dof']:
+            return bbox_result, segm_result
+
+        six_dof = dict(record['meta'])
+        for name, array in arrays.items():
+            if name.startswith('6dof/'):
+                six_dof[name[len('6dof/'):]] = array
+        return bbox_result, segm_result, six_dof
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = dict()
+
+
+def dump_results(outputs, store_dir, shard='part_0'):
+    """Write a list of outputs in dataset order to a store."""
+    with ResultWriter(store_dir, shard) as writer:
+        for idx, output in enumerate(outputs):
+            writer.append(output, idx)
+
+
+def load_results(path, load_masks=True):
+    """Load the results saved by a test script, either a legacy pickle
+    (loaded in full) or a result store (read lazily)."""
+    if os.path.isdir(path):
+        return ResultStore(path, load_masks=load_masks)
+    return mmcv.load(path)
@@ -0,0 +1,59 @@
+"""
+    Brief: Process pools whose workers share a read-only state
+    The post-processing pools (submission filtering, model merge, fused
+    post-processing) need the dataset (car meshes, camera, IoU cache) and the
+    outputs of the models in every task. The state is handed to each worker
+    once through the pool initializer: with the fork start method the
+    workers inherit it, with spawn it is pickled once per worker. Only the
+    small per-image arguments go through the task queue.
+"""
+import contextlib
+import multiprocessing
+
+_worker_state = dict()
+
+
+def _init_worker(state, initializer, initargs):
+    _worker_state.clear()
+    _worker_state.update(state)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def worker_state():
+    """The state of the pool of the current worker process."""
+    return _worker_state
+
+
+@contextlib.contextmanager
+def worker_pool(num_workers=None, initializer=None, initargs=(), **state):
+    """Process pool whose workers read ``state`` with :func:`worker_state`.
+
+    The pool is closed and joined when the block exits normally. On an error
+    (or when a generator consuming the results is closed early) it is
+    terminated, the chunks still queued are not computed.
+
+    Example:
+        >>> def _square(i):
+        >>>     return worker_state()['scale'] * i ** 2
+        >>> with worker_pool(4, scale=2) as pool:
+        >>>     results = list(pool.imap(_square, range(10)))
+
+    Args:
+        num_workers (int, optional): default to all the cpus.
+        initializer (callable, optional): called with ``initargs`` in every
+            worker once its state is set.
+        initargs (tuple): arguments of ``initializer``.
+        state: picklable objects, e.g. the dataset or the outputs.
+    """
+    pool = multiprocessing.Pool(num_workers or multiprocessing.cpu_count(), initializer=_init_worker,
+                                initargs=(state, initializer, initargs))
+    try:
+        yield pool
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
@@ -17,7 +17,7 @@ current_dir = os.path.dirname(os.path.realpath(__file__))
 data_dir = os.path.join(current_dir, 'data')
 from nr_kaggle_utils import load_json_car_model, make_gif
 
-from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle, euler_to_Rot, rotation_matrix_to_euler_angles
+from mmdet.datasets.kaggle_pku_utils import quaternions_to_euler_angles, euler_to_Rot, rotation_matrix_to_euler_angles
 
 from mmdet.datasets.car_models import car_id2name
 
@@ -43,7 +43,7 @@ class Model(nn.Module):
         car_names = [car_id2name[x].name for x in kaggle_car_labels]
 
         # get rotation initialisation for a indiviual car
-        euler_angle = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+        euler_angle = quaternions_to_euler_angles(quaternion_pred)
         ea = euler_angle[car_idx]
         yaw, pitch, roll = ea[0], ea[1], ea[2]
         yaw, pitch, roll = -pitch, -yaw, -roll
@@ -5,7 +5,11 @@ import torch
 import numpy as np
 from skimage.io import imread
 
-import neural_renderer.cuda.load_textures as load_textures_cuda
+try:
+    import neural_renderer.cuda.load_textures as load_textures_cuda
+except ImportError:
+    # the textures need the CUDA kernels
+    load_textures_cuda = None
 
 texture_wrapping_dict = {'REPEAT': 0, 'MIRRORED_REPEAT': 1,
                          'CLAMP_TO_EDGE': 2, 'CLAMP_TO_BORDER': 3}
@@ -106,10 +110,11 @@ def load_textures(filename_obj, filename_mtl, texture_size, texture_wrapping='RE
     return textures
 
 def load_obj(filename_obj, normalization=True, texture_size=4, load_texture=False,
-             texture_wrapping='REPEAT', use_bilinear=True):
+             texture_wrapping='REPEAT', use_bilinear=True, device='cuda'):
     """
     Load Wavefront .obj file.
     This function only supports vertices (v x x x) and faces (f x x x).
+    The textures are loaded on the GPU, the vertices and faces on device.
     """
 
     # load vertices
@@ -122,7 +127,7 @@ def load_obj(filename_obj, normalization=True, texture_size=4, load_texture=Fals
             continue
         if line.split()[0] == 'v':
             vertices.append([float(v) for v in line.split()[1:4]])
-    vertices = torch.from_numpy(np.vstack(vertices).astype(np.float32)).cuda()
+    vertices = torch.from_numpy(np.vstack(vertices).astype(np.float32)).to(device)
 
     # load faces
     faces = []
@@ -137,7 +142,7 @@ def load_obj(filename_obj, normalization=True, texture_size=4, load_texture=Fals
                 v1 = int(vs[i + 1].split('/')[0])
                 v2 = int(vs[i + 2].split('/')[0])
                 faces.append((v0, v1, v2))
-    faces = torch.from_numpy(np.vstack(faces).astype(np.int32)).cuda() - 1
+    faces = torch.from_numpy(np.vstack(faces).astype(np.int32)).to(device) - 1
 
     # load textures
     textures = None
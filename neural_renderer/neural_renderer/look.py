@@ -27,7 +27,7 @@ def look(vertices, eye, direction=[0, 1, 0], up=None):
         eye = eye.to(device)
 
     if up is None:
-        up = torch.cuda.FloatTensor([0, 1, 0])
+        up = torch.tensor([0, 1, 0], dtype=torch.float32, device=device)
     if eye.ndimension() == 1:
         eye = eye[None, :]
     if direction.ndimension() == 1:
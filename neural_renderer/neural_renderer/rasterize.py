@@ -3,7 +3,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Function
 
-import neural_renderer.cuda.rasterize as rasterize_cuda
+try:
+    import neural_renderer.cuda.rasterize as rasterize_cuda
+except ImportError:
+    # only the cpu backend is available
+    rasterize_cuda = None
+from .rasterize_cpu import DEFAULT_SIGMA, DEFAULT_TILE_SIZE, rasterize_maps
 
 DEFAULT_IMAGE_SIZE = torch.tensor([256, 256]).int()
 DEFAULT_ANTI_ALIASING = True
@@ -11,6 +16,7 @@ DEFAULT_NEAR = 0.1
 DEFAULT_FAR = 100
 DEFAULT_EPS = 1e-4
 DEFAULT_BACKGROUND_COLOR = (0, 0, 0)
+DEFAULT_BACKEND = 'cuda'
 
 class RasterizeFunction(Function):
     '''
@@ -229,10 +235,12 @@ class RasterizeFunction(Function):
 class Rasterize(nn.Module):
     '''
     Wrapper around the autograd function RasterizeFunction
-    Currently implemented only for cuda Tensors
+    Currently implemented only for cuda Tensors, backend='cpu' uses the PyTorch soft rasterizer of
+    rasterize_cpu instead
     '''
     def __init__(self, image_size, near, far, eps, background_color,
-                 return_rgb=False, return_alpha=False, return_depth=False):
+                 return_rgb=False, return_alpha=False, return_depth=False,
+                 backend=DEFAULT_BACKEND, sigma=DEFAULT_SIGMA, tile_size=DEFAULT_TILE_SIZE):
         super(Rasterize, self).__init__()
         self.image_size = image_size
         self.image_size = image_size
@@ -243,8 +251,15 @@ class Rasterize(nn.Module):
         self.return_rgb = return_rgb
         self.return_alpha = return_alpha
         self.return_depth = return_depth
+        self.backend = backend
+        self.sigma = sigma
+        self.tile_size = tile_size
 
     def forward(self, faces, textures):
+        if self.backend == 'cpu':
+            return rasterize_maps(faces, textures, self.image_size, self.near, self.far, self.eps,
+                                  self.background_color, self.return_rgb, self.return_alpha, self.return_depth,
+                                  self.sigma, self.tile_size)
         if faces.device == "cpu" or (textures is not None and textures.device == "cpu"):
             raise TypeError('Rasterize module supports only cuda Tensors')
         return RasterizeFunction.apply(faces, textures, self.image_size, self.near, self.far,
@@ -263,6 +278,9 @@ def rasterize_rgbad(
         return_rgb=True,
         return_alpha=True,
         return_depth=True,
+        backend=DEFAULT_BACKEND,
+        sigma=DEFAULT_SIGMA,
+        tile_size=DEFAULT_TILE_SIZE,
 ):
     """
     Generate RGB, alpha channel, and depth images from faces and textures (for RGB).
@@ -280,6 +298,9 @@ def rasterize_rgbad(
         return_rgb (bool): generate RGB images or not.
         return_alpha (bool): generate alpha channels or not.
         return_depth (bool): generate depth images or not.
+        backend (str): 'cuda' for the CUDA kernels, 'cpu' for the PyTorch soft rasterizer.
+        sigma (float): sharpness of the soft silhouette of the cpu backend, in squared pixels.
+        tile_size (int): the cpu backend renders tile_size x tile_size pixels at a time.
 
     Returns:
         dict:
@@ -298,10 +319,12 @@ def rasterize_rgbad(
     if anti_aliasing:
         # 2x super-sampling
         rgb, alpha, depth = Rasterize(
-            image_size * 2, near, far, eps, background_color, return_rgb, return_alpha, return_depth)(*inputs)
+            image_size * 2, near, far, eps, background_color, return_rgb, return_alpha, return_depth,
+            backend, sigma, tile_size)(*inputs)
     else:
         rgb, alpha, depth = Rasterize(
-            image_size, near, far, eps, background_color, return_rgb, return_alpha, return_depth)(*inputs)
+            image_size, near, far, eps, background_color, return_rgb, return_alpha, return_depth,
+            backend, sigma, tile_size)(*inputs)
 
     # transpose & vertical flip
     if return_rgb:
@@ -344,6 +367,9 @@ def rasterize(
         far=DEFAULT_FAR,
         eps=DEFAULT_EPS,
         background_color=DEFAULT_BACKGROUND_COLOR,
+        backend=DEFAULT_BACKEND,
+        sigma=DEFAULT_SIGMA,
+        tile_size=DEFAULT_TILE_SIZE,
 ):
     """
     Generate RGB images from faces and textures.
@@ -357,13 +383,17 @@ def rasterize(
         far: see `rasterize_rgbad`.
         eps: see `rasterize_rgbad`.
         background_color: see `rasterize_rgbad`.
+        backend: see `rasterize_rgbad`.
+        sigma: see `rasterize_rgbad`.
+        tile_size: see `rasterize_rgbad`.
 
     Returns:
         ~torch.Tensor: RGB images. The shape is [batch size, 3, image_size, image_size].
 
     """
     return rasterize_rgbad(
-        faces, textures, image_size, anti_aliasing, near, far, eps, background_color, True, False, False)['rgb']
+        faces, textures, image_size, anti_aliasing, near, far, eps, background_color, True, False, False,
+        backend, sigma, tile_size)['rgb']
 
 def rasterize(
         faces,
@@ -373,7 +403,10 @@ def rasterize(
         near=DEFAULT_NEAR,
         far=DEFAULT_FAR,
         eps=DEFAULT_EPS,
-        background_color=DEFAULT_BACKGROUND_COLOR):
+        background_color=DEFAULT_BACKGROUND_COLOR,
+        backend=DEFAULT_BACKEND,
+        sigma=DEFAULT_SIGMA,
+        tile_size=DEFAULT_TILE_SIZE):
     """
     Generate RGB images from faces and textures.
 
@@ -386,13 +419,17 @@ def rasterize(
         far: see `rasterize_rgbad`.
         eps: see `rasterize_rgbad`.
         background_color: see `rasterize_rgbad`.
+        backend: see `rasterize_rgbad`.
+        sigma: see `rasterize_rgbad`.
+        tile_size: see `rasterize_rgbad`.
 
     Returns:
         ~torch.Tensor: RGB images. The shape is [batch size, 3, image_size, image_size].
 
     """
     return rasterize_rgbad(
-        faces, textures, image_size, anti_aliasing, near, far, eps, background_color, True, False, False)['rgb']
+        faces, textures, image_size, anti_aliasing, near, far, eps, background_color, True, False, False,
+        backend, sigma, tile_size)['rgb']
 
 
 def rasterize_silhouettes(
@@ -402,6 +439,9 @@ def rasterize_silhouettes(
         near=DEFAULT_NEAR,
         far=DEFAULT_FAR,
         eps=DEFAULT_EPS,
+        backend=DEFAULT_BACKEND,
+        sigma=DEFAULT_SIGMA,
+        tile_size=DEFAULT_TILE_SIZE,
 ):
     """
     Generate alpha channels from faces.
@@ -413,12 +453,16 @@ def rasterize_silhouettes(
         near: see `rasterize_rgbad`.
         far: see `rasterize_rgbad`.
         eps: see `rasterize_rgbad`.
+        backend: see `rasterize_rgbad`.
+        sigma: see `rasterize_rgbad`.
+        tile_size: see `rasterize_rgbad`.
 
     Returns:
         ~torch.Tensor: Alpha channels. The shape is [batch size, image_size, image_size].
 
     """
-    return rasterize_rgbad(faces, None, image_size, anti_aliasing, near, far, eps, None, False, True, False)['alpha']
+    return rasterize_rgbad(faces, None, image_size, anti_aliasing, near, far, eps, None, False, True, False,
+                           backend, sigma, tile_size)['alpha']
 
 
 def rasterize_depth(
@@ -428,6 +472,9 @@ def rasterize_depth(
         near=DEFAULT_NEAR,
         far=DEFAULT_FAR,
         eps=DEFAULT_EPS,
+        backend=DEFAULT_BACKEND,
+        sigma=DEFAULT_SIGMA,
+        tile_size=DEFAULT_TILE_SIZE,
 ):
     """
     Generate depth images from faces.
@@ -439,9 +486,13 @@ def rasterize_depth(
         near: see `rasterize_rgbad`.
         far: see `rasterize_rgbad`.
         eps: see `rasterize_rgbad`.
+        backend: see `rasterize_rgbad`.
+        sigma: see `rasterize_rgbad`.
+        tile_size: see `rasterize_rgbad`.
 
     Returns:
         ~torch.Tensor: Depth images. The shape is [batch size, image_size, image_size].
 
     """
-    return rasterize_rgbad(faces, None, image_size, anti_aliasing, near, far, eps, None, False, False, True)['depth']
+    return rasterize_rgbad(faces, None, image_size, anti_aliasing, near, far, eps, None, False, False, True,
+                           backend, sigma, tile_size)['depth']
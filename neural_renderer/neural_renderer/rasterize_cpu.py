@@ -0,0 +1,314 @@
+from __future__ import division
+import math
+
+import torch
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+DEFAULT_SIGMA = 2.
+DEFAULT_TILE_SIZE = 32
+# pixels x faces evaluated at once in a tile
+DEFAULT_MAX_ELEMENTS = 2 ** 21
+
+
+def _pixel_coords(faces, width, height):
+    '''
+    faces: [nf, 3, 3] in normalized coordinates, returns [nf, 3, 2] in pixels
+    '''
+    x = 0.5 * (faces[:, :, 0] * width + width - 1)
+    y = 0.5 * (faces[:, :, 1] * height + height - 1)
+    return torch.stack((x, y), dim=2)
+
+
+def _barycentric(p, xi, yi):
+    '''
+    Clamped and normalized barycentric weights [P, nf, 3] of the pixels (xi, yi) as in the CUDA kernel
+    p: [nf, 3, 2] face vertices in pixels, xi, yi: [P]
+    '''
+    i1, i2 = [1, 2, 0], [2, 0, 1]
+    a = p[:, i1, 1] - p[:, i2, 1]
+    b = p[:, i2, 0] - p[:, i1, 0]
+    c = p[:, i1, 0] * p[:, i2, 1] - p[:, i2, 0] * p[:, i1, 1]
+    denominator = (p[:, :, 0] * a).sum(1)
+    w = (a[None] * xi[:, None, None] + b[None] * yi[:, None, None] + c[None]) / denominator[None, :, None]
+    w = w.clamp(0, 1)
+    return w / w.sum(2, keepdim=True)
+
+
+def _inside(faces, xp, yp):
+    '''
+    [P, nf] whether the pixel centers (xp, yp) in normalized coordinates are inside the faces,
+    with the same test as the CUDA kernel
+    '''
+    inside = torch.ones((xp.shape[0], faces.shape[0]), dtype=torch.bool, device=faces.device)
+    for k in range(3):
+        ax, ay = faces[None, :, k, 0], faces[None, :, k, 1]
+        bx, by = faces[None, :, (k + 1) % 3, 0], faces[None, :, (k + 1) % 3, 1]
+        inside &= (yp[:, None] - ay) * (bx - ax) >= (xp[:, None] - ax) * (by - ay)
+    return inside
+
+
+def _soft_coverage_log(p, inside, xi, yi, sigma):
+    '''
+    sum over the faces of log(1 - D), D = sigmoid(+-d^2 / sigma) the soft coverage of the pixels by the faces,
+    d the distance in pixels to the closest edge, + inside and - outside (Soft Rasterizer, Liu et al. 2019)
+    '''
+    dist2 = None
+    for k in range(3):
+        a, e = p[:, k], p[:, (k + 1) % 3] - p[:, k]
+        px, py = xi[:, None] - a[None, :, 0], yi[:, None] - a[None, :, 1]
+        t = ((px * e[None, :, 0] + py * e[None, :, 1]) / (e[:, 0] ** 2 + e[:, 1] ** 2 + 1e-12)[None]).clamp(0, 1)
+        d2 = (px - t * e[None, :, 0]) ** 2 + (py - t * e[None, :, 1]) ** 2
+        dist2 = d2 if dist2 is None else torch.min(dist2, d2)
+    sign = inside.to(dist2.dtype) * 2 - 1
+    coverage = torch.sigmoid(sign * dist2 / sigma).clamp(max=1 - 1e-6)
+    return torch.log1p(-coverage).sum(1)
+
+
+class _TileRasterizer(object):
+    '''
+    Rasterization of the faces of one image, one tile of pixels at a time.
+    Only the faces whose bounding box (grown by the reach of the soft coverage) overlaps the tile
+    are evaluated, in chunks of at most max_elements pixels x faces.
+    '''
+
+    def __init__(self, faces, width, height, near, far, sigma, tile_size, max_elements):
+        self.width, self.height = width, height
+        self.near, self.far = near, far
+        self.sigma = sigma
+        self.tile_size = tile_size
+        self.max_elements = max_elements
+        self.faces = faces
+        with torch.no_grad():
+            f = faces.detach()
+            # backside and degenerated faces are never drawn
+            front = (f[:, 2, 1] - f[:, 0, 1]) * (f[:, 1, 0] - f[:, 0, 0]) >= \
+                (f[:, 1, 1] - f[:, 0, 1]) * (f[:, 2, 0] - f[:, 0, 0])
+            p = _pixel_coords(f, width, height)
+            area = (p[:, 1, 0] - p[:, 0, 0]) * (p[:, 2, 1] - p[:, 0, 1]) - \
+                (p[:, 1, 1] - p[:, 0, 1]) * (p[:, 2, 0] - p[:, 0, 0])
+            self.valid = front & (area != 0)
+            # sigmoid(-d^2 / sigma) < 5e-5 beyond the reach
+            self.reach = (10 * sigma) ** 0.5
+            self.bbox_min = p.min(1)[0]
+            self.bbox_max = p.max(1)[0]
+
+    def window(self):
+        '''
+        Pixels (x0, x1, y0, y1) that the faces can cover or reach, None if no face is drawn
+        '''
+        if not self.valid.any():
+            return None
+        margin = int(math.ceil(self.reach)) + 1
+        x0, y0 = (self.bbox_min[self.valid].min(0)[0].floor() - margin).tolist()
+        x1, y1 = (self.bbox_max[self.valid].max(0)[0].ceil() + margin + 1).tolist()
+        x0, y0 = max(int(x0), 0), max(int(y0), 0)
+        x1, y1 = min(int(x1), self.width), min(int(y1), self.height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return x0, x1, y0, y1
+
+    def tiles(self, xi, yi):
+        '''
+        Groups the pixels by tile, yields (x0, x1, y0, y1) and the positions of the pixels in xi, yi
+        '''
+        ts = self.tile_size
+        num_x = (self.width + ts - 1) // ts
+        tile = (yi.long() // ts) * num_x + xi.long() // ts
+        tile, order = tile.sort()
+        tile_ids, counts = torch.unique_consecutive(tile, return_counts=True)
+        for tile_id, pixels in zip(tile_ids.tolist(), order.split(counts.tolist())):
+            x0, y0 = (tile_id % num_x) * ts, (tile_id // num_x) * ts
+            yield (x0, min(x0 + ts, self.width), y0, min(y0 + ts, self.height)), pixels
+
+    def tile_faces(self, x0, x1, y0, y1, margin):
+        keep = self.valid & \
+            (self.bbox_max[:, 0] >= x0 - margin) & (self.bbox_min[:, 0] <= x1 - 1 + margin) & \
+            (self.bbox_max[:, 1] >= y0 - margin) & (self.bbox_min[:, 1] <= y1 - 1 + margin)
+        return keep.nonzero()[:, 0]
+
+    def chunks(self, num_pixels, face_index):
+        step = max(self.max_elements // max(num_pixels, 1), 1)
+        for i in range(0, len(face_index), step):
+            yield face_index[i:i + step]
+
+    def zbuffer(self, xi, yi):
+        '''
+        Closest face [P] (-1 for none) of the pixels and its depth [P]
+        '''
+        depth = torch.full_like(xi, self.far)
+        index = torch.full(xi.shape, -1, dtype=torch.long, device=xi.device)
+        with torch.no_grad():
+            for bounds, pixels in self.tiles(xi, yi):
+                txi, tyi = xi[pixels], yi[pixels]
+                xp = (2. * txi + 1 - self.width) / self.width
+                yp = (2. * tyi + 1 - self.height) / self.height
+                tile_depth = depth[pixels]
+                tile_index = index[pixels]
+                face_index = self.tile_faces(*bounds, margin=1)
+                for chunk in self.chunks(len(pixels), face_index):
+                    f = self.faces[chunk].detach()
+                    w = _barycentric(_pixel_coords(f, self.width, self.height), txi, tyi)
+                    zp = 1. / (w / f[None, :, :, 2]).sum(2)
+                    visible = _inside(f, xp, yp) & (zp > self.near) & (zp < self.far)
+                    zp = torch.where(visible, zp, torch.full_like(zp, float('inf')))
+                    zmin, argmin = zp.min(1)
+                    closer = zmin < tile_depth
+                    tile_depth = torch.where(closer, zmin, tile_depth)
+                    tile_index = torch.where(closer, chunk[argmin], tile_index)
+                depth[pixels] = tile_depth
+                index[pixels] = tile_index
+        return index, depth
+
+    def depth(self, xi, yi, index):
+        '''
+        Differentiable depth and barycentric weights of the pixels covered by the faces index
+        '''
+        f = self.faces[index]
+        p = _pixel_coords(f, self.width, self.height)
+        i1, i2 = [1, 2, 0], [2, 0, 1]
+        a = p[:, i1, 1] - p[:, i2, 1]
+        b = p[:, i2, 0] - p[:, i1, 0]
+        c = p[:, i1, 0] * p[:, i2, 1] - p[:, i2, 0] * p[:, i1, 1]
+        denominator = (p[:, :, 0] * a).sum(1, keepdim=True)
+        w = ((a * xi[:, None] + b * yi[:, None] + c) / denominator).clamp(0, 1)
+        w = w / w.sum(1, keepdim=True)
+        return 1. / (w / f[:, :, 2]).sum(1), w
+
+    def soft_alpha(self, xi, yi):
+        '''
+        Soft silhouette 1 - prod(1 - D) of the pixels
+        '''
+        alpha = []
+        positions = []
+        for bounds, pixels in self.tiles(xi, yi):
+            txi, tyi = xi[pixels], yi[pixels]
+            xp = (2. * txi + 1 - self.width) / self.width
+            yp = (2. * tyi + 1 - self.height) / self.height
+            log_transparency = torch.zeros_like(txi)
+            for chunk in self.chunks(len(pixels), self.tile_faces(*bounds, margin=self.reach)):
+                f = self.faces[chunk]
+                inside = _inside(f.detach(), xp, yp)
+                p = _pixel_coords(f, self.width, self.height)
+                if p.requires_grad:
+                    # the pixels x faces intermediates are recomputed in backward instead of being kept
+                    log_transparency = log_transparency + checkpoint(
+                        _soft_coverage_log, p, inside, txi, tyi, self.sigma, use_reentrant=False)
+                else:
+                    log_transparency = log_transparency + _soft_coverage_log(p, inside, txi, tyi, self.sigma)
+            alpha.append(1 - torch.exp(log_transparency))
+            positions.append(pixels)
+        if not alpha:
+            return xi.new_zeros(0), torch.zeros(0, dtype=torch.long, device=xi.device)
+        return torch.cat(alpha), torch.cat(positions)
+
+    def boundary(self, mask):
+        '''
+        Pixels closer than the reach of the soft coverage to the silhouette, mask [h, w]
+        '''
+        radius = int(math.ceil(self.reach))
+        mask = mask[None, None]
+
+        def dilate(x):
+            # separable square window
+            x = F.max_pool2d(x, (2 * radius + 1, 1), stride=1, padding=(radius, 0))
+            return F.max_pool2d(x, (1, 2 * radius + 1), stride=1, padding=(0, radius))
+
+        return (dilate(mask) != -dilate(-mask)).view(-1).nonzero()[:, 0]
+
+
+def _sample_textures(faces, textures, index, weight, depth, eps):
+    '''
+    Trilinear sampling of the textures [nf, ts, ts, ts, 3] of the faces index, as in the CUDA kernel
+    '''
+    ts = textures.shape[1]
+    # as in the CUDA kernel, the sampling positions do not propagate gradients to the faces
+    texture_index = weight * (ts - 1) * (depth[:, None] / faces[index][:, :, 2].detach())
+    texture_index = texture_index.clamp(0, ts - 1 - eps)
+    base = texture_index.floor()
+    frac = texture_index - base
+    base = base.long()
+    textures = textures.reshape(-1, 3)
+    rgb = 0
+    for pn in range(8):
+        w = 1
+        isc = index * ts ** 3
+        for k, scale in enumerate((ts * ts, ts, 1)):
+            if (pn >> k) % 2 == 0:
+                w = w * (1 - frac[:, k])
+                isc = isc + base[:, k] * scale
+            else:
+                w = w * frac[:, k]
+                isc = isc + (base[:, k] + 1).clamp(max=ts - 1) * scale
+        rgb = rgb + w[:, None] * textures[isc]
+    return rgb
+
+
+def rasterize_maps(faces, textures, image_size, near, far, eps, background_color,
+                   return_rgb=False, return_alpha=False, return_depth=False,
+                   sigma=DEFAULT_SIGMA, tile_size=DEFAULT_TILE_SIZE, max_elements=DEFAULT_MAX_ELEMENTS):
+    '''
+    CPU counterpart of RasterizeFunction, in pure PyTorch.
+
+    The forward pass is the same as the CUDA kernels: the visible face of each pixel is found with a
+    z-buffer, its perspective correct depth and texture are interpolated. The depth and the texture
+    gradients are the gradients of the interpolation. The silhouette gradient comes from a soft
+    rasterizer: the alpha map is the hard coverage in forward, its gradient is the gradient of the soft
+    coverage 1 - prod(1 - sigmoid(+-d^2 / sigma)), d the distance in pixels of the pixel to the face.
+    The soft coverage is only evaluated around the silhouette, where its gradient is not negligible.
+
+    Only the window of the image around the faces is rasterized, by tiles of tile_size x tile_size
+    pixels, so the memory is bounded by the number of faces around a tile and not by the image size.
+
+    Returns:
+        rgb [bs, height, width, 3], alpha [bs, height, width], depth [bs, height, width] before the
+        vertical flip, empty tensors for the maps not returned
+    '''
+    width, height = int(image_size[0]), int(image_size[1])
+    device = faces.device
+    # the soft silhouette is only evaluated for the gradients
+    soft = (return_alpha or return_rgb) and faces.requires_grad and torch.is_grad_enabled()
+    background = torch.as_tensor(background_color, dtype=faces.dtype, device=device) if return_rgb else None
+
+    rgb_maps, alpha_maps, depth_maps = [], [], []
+    for bn in range(faces.shape[0]):
+        rasterizer = _TileRasterizer(faces[bn], width, height, near, far, sigma, tile_size, max_elements)
+        x0, x1, y0, y1 = rasterizer.window() or (0, 1, 0, 1)
+        w, h = x1 - x0, y1 - y0
+        # the maps of the window are padded to the image with the values of the background
+        padding = (x0, width - x1, y0, height - y1)
+        yi = torch.arange(y0, y1, device=device, dtype=faces.dtype)[:, None].expand(h, w).reshape(-1)
+        xi = torch.arange(x0, x1, device=device, dtype=faces.dtype)[None, :].expand(h, w).reshape(-1)
+        index, depth = rasterizer.zbuffer(xi, yi)
+        covered = (index >= 0).nonzero()[:, 0]
+        mask = (index >= 0).to(faces.dtype)
+
+        if return_depth or return_rgb:
+            depth_covered, weight = rasterizer.depth(xi[covered], yi[covered], index[covered])
+        if return_depth:
+            depth = depth.index_put((covered,), depth_covered).view(h, w)
+            depth_maps.append(F.pad(depth, padding, value=far))
+
+        alpha = mask
+        if soft:
+            band = rasterizer.boundary(mask.view(h, w))
+            soft_alpha, positions = rasterizer.soft_alpha(xi[band], yi[band])
+            band = band[positions]
+            # straight-through: hard silhouette in forward, soft gradient in backward
+            alpha = mask.index_put((band,), mask[band] + (soft_alpha - soft_alpha.detach()))
+        if return_alpha:
+            alpha_maps.append(F.pad(alpha.view(h, w), padding))
+
+        if return_rgb:
+            rgb = faces.new_zeros((h * w, 3))
+            rgb = rgb.index_put((covered,), _sample_textures(
+                faces[bn], textures[bn], index[covered], weight.detach(), depth_covered.detach(), eps))
+            color = background[bn] if background.ndimension() == 2 else background
+            rgb = rgb * alpha[:, None] + (1 - alpha[:, None]) * color[None]
+            rgb = torch.stack([F.pad(rgb[:, k].view(h, w), padding, value=float(color[k])) for k in range(3)], 2)
+            rgb_maps.append(rgb)
+
+    empty = torch.tensor([])
+    return (torch.stack(rgb_maps) if return_rgb else empty,
+            torch.stack(alpha_maps) if return_alpha else empty,
+            torch.stack(depth_maps) if return_depth else empty)
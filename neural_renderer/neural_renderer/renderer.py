@@ -6,6 +6,7 @@ import torch.nn as nn
 import numpy
 
 import neural_renderer as nr
+from .rasterize_cpu import DEFAULT_SIGMA, DEFAULT_TILE_SIZE
 
 
 class Renderer(nn.Module):
@@ -16,8 +17,15 @@ class Renderer(nn.Module):
                  near=0.1, far=150,
                  light_intensity_ambient=0.5, light_intensity_directional=0.5,
                  light_color_ambient=[1, 1, 1], light_color_directional=[1, 1, 1],
-                 light_direction=[0, 1, 0]):
+                 light_direction=[0, 1, 0], backend='cuda', sigma=DEFAULT_SIGMA,
+                 tile_size=DEFAULT_TILE_SIZE):
         super(Renderer, self).__init__()
+        # 'cuda' kernels or 'cpu' PyTorch soft rasterizer
+        self.backend = backend
+        self.device = 'cpu' if backend == 'cpu' else 'cuda'
+        self.sigma = sigma
+        self.tile_size = tile_size
+
         # setters for properties
         self.image_size_ = None
         self.orig_size_ = None
@@ -35,11 +43,11 @@ class Renderer(nn.Module):
             self.R = R
             self.t = t
             if isinstance(self.K, numpy.ndarray):
-                self.K = torch.cuda.FloatTensor(self.K)
+                self.K = torch.tensor(self.K, dtype=torch.float32, device=self.device)
             if isinstance(self.R, numpy.ndarray):
-                self.R = torch.cuda.FloatTensor(self.R)
+                self.R = torch.tensor(self.R, dtype=torch.float32, device=self.device)
             if isinstance(self.t, numpy.ndarray):
-                self.t = torch.cuda.FloatTensor(self.t)
+                self.t = torch.tensor(self.t, dtype=torch.float32, device=self.device)
             # if self.K is None or self.K.ndimension() != 3 or self.K.shape[1] != 3 or self.K.shape[2] != 3:
             #     raise ValueError('You need to provide a valid (batch_size)x3x3 intrinsic camera matrix')
             # if self.R is None or self.R.ndimension() != 3 or self.R.shape[1] != 3 or self.R.shape[2] != 3:
@@ -48,7 +56,7 @@ class Renderer(nn.Module):
             #     raise ValueError('You need to provide a valid (batch_size)x3 translation vector matrix')
             self.dist_coeffs = dist_coeffs
             if dist_coeffs is None:
-                self.dist_coeffs = torch.cuda.FloatTensor([[0., 0., 0., 0., 0.]])
+                self.dist_coeffs = torch.zeros((1, 5), dtype=torch.float32, device=self.device)
             self.orig_size = orig_size
         elif self.camera_mode in ['look', 'look_at']:
             self.perspective = perspective
@@ -72,34 +80,34 @@ class Renderer(nn.Module):
         self.rasterizer_eps = 1e-3
 
     @staticmethod
-    def toShapeTensor(value):
+    def toShapeTensor(value, device='cuda'):
         if isinstance(value, tuple) or isinstance(value, list) \
                 or isinstance(value, numpy.ndarray) or isinstance(value, torch.Tensor):
-            return torch.cuda.IntTensor(list(value))
+            return torch.tensor([int(v) for v in value], dtype=torch.int32, device=device)
         elif isinstance(value, int) or isinstance(value, float):
-            return torch.cuda.IntTensor([value, value])
+            return torch.tensor([value, value], dtype=torch.int32, device=device)
         else:
             assert False
 
     @property
     def image_size(self):
         if self.image_size_ is None:
-            return torch.cuda.IntTensor([256, 256])
+            return torch.tensor([256, 256], dtype=torch.int32, device=self.device)
         return self.image_size_
 
     @image_size.setter
     def image_size(self, value):
-        self.image_size_ = Renderer.toShapeTensor(value)
+        self.image_size_ = Renderer.toShapeTensor(value, self.device)
 
     @property
     def orig_size(self):
         if self.orig_size_ is None:
-            return torch.cuda.IntTensor([1024, 768])
+            return torch.tensor([1024, 768], dtype=torch.int32, device=self.device)
         return self.orig_size_
 
     @orig_size.setter
     def orig_size(self, value):
-        self.orig_size_ = Renderer.toShapeTensor(value)
+        self.orig_size_ = Renderer.toShapeTensor(value, self.device)
 
     def forward(self, vertices, faces, textures=None, mode='rgb', K=None, R=None, t=None, dist_coeffs=None,
                 orig_size=None):
@@ -151,7 +159,8 @@ class Renderer(nn.Module):
 
         # rasterization
         faces = nr.vertices_to_faces(vertices, faces)
-        images = nr.rasterize_silhouettes(faces, self.image_size, self.anti_aliasing)
+        images = nr.rasterize_silhouettes(faces, self.image_size, self.anti_aliasing, backend=self.backend,
+                                          sigma=self.sigma, tile_size=self.tile_size)
         return images
 
     def render_depth(self, vertices, faces, K=None, R=None, t=None, dist_coeffs=None, orig_size=None):
@@ -186,7 +195,8 @@ class Renderer(nn.Module):
 
         # rasterization
         faces = nr.vertices_to_faces(vertices, faces)
-        images = nr.rasterize_depth(faces, self.image_size, self.anti_aliasing)
+        images = nr.rasterize_depth(faces, self.image_size, self.anti_aliasing, backend=self.backend,
+                                    sigma=self.sigma, tile_size=self.tile_size)
         return images
 
     def render_rgb(self, vertices, faces, textures, K=None, R=None, t=None, dist_coeffs=None, orig_size=None):
@@ -234,7 +244,7 @@ class Renderer(nn.Module):
         faces = nr.vertices_to_faces(vertices, faces)
         images = nr.rasterize(
             faces, textures, self.image_size, self.anti_aliasing, self.near, self.far, self.rasterizer_eps,
-            self.background_color)
+            self.background_color, self.backend, self.sigma, self.tile_size)
         return images
 
     def render(self, vertices, faces, textures, K=None, R=None, t=None, dist_coeffs=None, orig_size=None):
@@ -282,5 +292,5 @@ class Renderer(nn.Module):
         faces = nr.vertices_to_faces(vertices, faces)
         out = nr.rasterize_rgbad(
             faces, textures, self.image_size, self.anti_aliasing, self.near, self.far, self.rasterizer_eps,
-            self.background_color)
+            self.background_color, backend=self.backend, sigma=self.sigma, tile_size=self.tile_size)
         return out['rgb'], out['depth'], out['alpha']
@@ -4,7 +4,11 @@ import os
 import torch
 from skimage.io import imsave
 
-import neural_renderer.cuda.create_texture_image as create_texture_image_cuda
+try:
+    import neural_renderer.cuda.create_texture_image as create_texture_image_cuda
+except ImportError:
+    # the textures need the CUDA kernels
+    create_texture_image_cuda = None
 
 
 def create_texture_image(textures, texture_size_out=16):
@@ -6,6 +6,7 @@ from skimage.io import imsave
 
 import neural_renderer as nr
 import torch
+import utils
 
 current_dir = os.path.dirname(os.path.realpath(__file__))
 data_dir = os.path.join(current_dir, 'data')
@@ -28,19 +29,20 @@ class TestCore(unittest.TestCase):
             'int32')
 
         obj_file = os.path.join(data_dir, 'tetrahedron.obj')
-        vertices, faces = nr.load_obj(obj_file, False)
+        vertices, faces = nr.load_obj(obj_file, False, device=utils.device)
         assert (np.allclose(vertices_ref, vertices.detach().cpu().numpy()))
         assert (np.allclose(faces_ref, faces.detach().cpu().numpy()))
-        vertices, faces = nr.load_obj(obj_file, True)
+        vertices, faces = nr.load_obj(obj_file, True, device=utils.device)
         assert (np.allclose(vertices_ref * 2 - 1.0, vertices.detach().cpu().numpy()))
         assert (np.allclose(faces_ref, faces.detach().cpu().numpy()))
 
     def test_teapot(self):
         obj_file = os.path.join(data_dir, 'teapot.obj')
-        vertices, faces = nr.load_obj(obj_file)
+        vertices, faces = nr.load_obj(obj_file, device=utils.device)
         assert (faces.shape[0] == 2464)
         assert (vertices.shape[0] == 1292)
 
+    @unittest.skipIf(utils.backend == 'cpu', 'the textures are loaded by the CUDA kernels')
     def test_texture(self):
         renderer = nr.Renderer(camera_mode='look_at')
 
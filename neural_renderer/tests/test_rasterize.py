@@ -17,12 +17,12 @@ class TestRasterize(unittest.TestCase):
 
         # load teapot
         vertices, faces, textures = utils.load_teapot_batch()
-        vertices = vertices.cuda()
-        faces = faces.cuda()
-        textures = textures.cuda()
+        vertices = vertices.to(utils.device)
+        faces = faces.to(utils.device)
+        textures = textures.to(utils.device)
 
         # create renderer
-        renderer = nr.Renderer(camera_mode='look_at')
+        renderer = nr.Renderer(camera_mode='look_at', backend=utils.backend)
         renderer.image_size = 256
         renderer.anti_aliasing = False
 
@@ -39,12 +39,12 @@ class TestRasterize(unittest.TestCase):
 
         # load teapot
         vertices, faces, textures = utils.load_teapot_batch()
-        vertices = vertices.cuda()
-        faces = faces.cuda()
-        textures = textures.cuda()
+        vertices = vertices.to(utils.device)
+        faces = faces.to(utils.device)
+        textures = textures.to(utils.device)
 
         # create renderer
-        renderer = nr.Renderer(camera_mode='look_at')
+        renderer = nr.Renderer(camera_mode='look_at', backend=utils.backend)
         renderer.eye = [1, 1, -2.7]
 
         # render
@@ -60,12 +60,12 @@ class TestRasterize(unittest.TestCase):
 
         # load teapot
         vertices, faces, textures = utils.load_teapot_batch()
-        vertices = vertices.cuda()
-        faces = faces.cuda()
-        textures = textures.cuda()
+        vertices = vertices.to(utils.device)
+        faces = faces.to(utils.device)
+        textures = textures.to(utils.device)
 
         # create renderer
-        renderer = nr.Renderer(camera_mode='look_at')
+        renderer = nr.Renderer(camera_mode='look_at', backend=utils.backend)
         renderer.image_size = 256
         renderer.anti_aliasing = False
         renderer.light_intensity_ambient = 1.0
@@ -81,6 +81,7 @@ class TestRasterize(unittest.TestCase):
 
         assert(np.allclose(ref, image))
 
+    @unittest.skipIf(utils.backend == 'cpu', 'the soft rasterizer gradients differ from the CUDA references')
     def test_backward_case1(self):
         """Backward if non-zero gradient is out of a face."""
 
@@ -97,19 +98,19 @@ class TestRasterize(unittest.TestCase):
             [0., 0., 0.],
         ]
 
-        renderer = nr.Renderer(camera_mode='look_at')
+        renderer = nr.Renderer(camera_mode='look_at', backend=utils.backend)
         renderer.image_size = 64
         renderer.anti_aliasing = False
         renderer.perspective = False
         renderer.light_intensity_ambient = 1.0
         renderer.light_intensity_directional = 0.0
 
-        vertices = torch.from_numpy(np.array(vertices, dtype=np.float32)).cuda()
-        faces = torch.from_numpy(np.array(faces, dtype=np.int32)).cuda()
-        textures = torch.ones(faces.shape[0], 4, 4, 4, 3, dtype=torch.float32).cuda()
-        grad_ref = torch.from_numpy(np.array(grad_ref, dtype=np.float32)).cuda()
+        vertices = torch.from_numpy(np.array(vertices, dtype=np.float32)).to(utils.device)
+        faces = torch.from_numpy(np.array(faces, dtype=np.int32)).to(utils.device)
+        textures = torch.ones(faces.shape[0], 4, 4, 4, 3, dtype=torch.float32).to(utils.device)
+        grad_ref = torch.from_numpy(np.array(grad_ref, dtype=np.float32)).to(utils.device)
         vertices, faces, textures, grad_ref = utils.to_minibatch((vertices, faces, textures, grad_ref))
-        vertices, faces, textures, grad_ref = vertices.cuda(), faces.cuda(), textures.cuda(), grad_ref.cuda()
+        vertices, faces, textures, grad_ref = [d.to(utils.device) for d in (vertices, faces, textures, grad_ref)]
         vertices.requires_grad = True
         images = renderer(vertices, faces, textures)
         images = torch.mean(images, dim=1)
@@ -118,6 +119,7 @@ class TestRasterize(unittest.TestCase):
 
         assert(torch.allclose(vertices.grad, grad_ref, rtol=1e-2))
 
+    @unittest.skipIf(utils.backend == 'cpu', 'the soft rasterizer gradients differ from the CUDA references')
     def test_backward_case2(self):
         """Backward if non-zero gradient is on a face."""
 
@@ -134,17 +136,17 @@ class TestRasterize(unittest.TestCase):
             [3.00094461, - 1.55173182, 0.],
         ]
 
-        renderer = nr.Renderer(camera_mode='look_at')
+        renderer = nr.Renderer(camera_mode='look_at', backend=utils.backend)
         renderer.image_size = 64
         renderer.anti_aliasing = False
         renderer.perspective = False
         renderer.light_intensity_ambient = 1.0
         renderer.light_intensity_directional = 0.0
 
-        vertices = torch.from_numpy(np.array(vertices, dtype=np.float32)).cuda()
-        faces = torch.from_numpy(np.array(faces, dtype=np.int32)).cuda()
-        textures = torch.ones(faces.shape[0], 4, 4, 4, 3, dtype=torch.float32).cuda()
-        grad_ref = torch.from_numpy(np.array(grad_ref, dtype=np.float32)).cuda()
+        vertices = torch.from_numpy(np.array(vertices, dtype=np.float32)).to(utils.device)
+        faces = torch.from_numpy(np.array(faces, dtype=np.int32)).to(utils.device)
+        textures = torch.ones(faces.shape[0], 4, 4, 4, 3, dtype=torch.float32).to(utils.device)
+        grad_ref = torch.from_numpy(np.array(grad_ref, dtype=np.float32)).to(utils.device)
         vertices, faces, textures, grad_ref = utils.to_minibatch((vertices, faces, textures, grad_ref))
         vertices.requires_grad=True
 
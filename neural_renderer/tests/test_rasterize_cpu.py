@@ -0,0 +1,103 @@
+import unittest
+import os
+
+import torch
+import numpy as np
+from skimage.io import imread
+
+import neural_renderer as nr
+import utils
+
+current_dir = os.path.dirname(os.path.realpath(__file__))
+data_dir = os.path.join(current_dir, 'data')
+
+
+class TestRasterizeCPU(unittest.TestCase):
+    def test_forward_case1(self):
+        """Whether the silhouette and the depth of the CPU backend match those by Blender."""
+
+        vertices, faces, _ = utils.load_teapot_batch(device='cpu')
+
+        renderer = nr.Renderer(camera_mode='look_at', backend='cpu')
+        renderer.image_size = 256
+        renderer.anti_aliasing = False
+
+        ref = imread(os.path.join(data_dir, 'teapot_blender.png'))
+        ref = (ref.min(-1) != 255).astype(np.float32)
+        image = renderer(vertices, faces, mode='silhouettes').numpy()[2]
+        assert(np.allclose(ref, image))
+
+        image = renderer(vertices, faces, mode='depth').numpy()[2]
+        assert(np.allclose(ref, image != image.max()))
+        image[image == image.max()] = image.min()
+        image = (image - image.min()) / (image.max() - image.min())
+        ref = imread(os.path.join(data_dir, 'test_depth.png')).astype(np.float32) / 255.
+        assert(np.allclose(image, ref, atol=1e-2))
+
+    def test_backward_case1(self):
+        """Whether the soft silhouette gradients point as the CUDA ones, out of and on a face."""
+
+        cases = [
+            ([[0.8, 0.8, 1.], [0.0, -0.5, 1.], [0.2, -0.4, 1.]], 25, 35, 1,
+             [[1.6725862, -0.26021874, 0.], [1.41986704, -1.64284933, 0.], [0., 0., 0.]]),
+            ([[0.8, 0.8, 1.], [-0.5, -0.8, 1.], [0.8, -0.8, 1.]], 40, 50, 0,
+             [[0.98646867, 1.04628897, 0.], [-1.03415668, -0.10403691, 0.], [3.00094461, -1.55173182, 0.]]),
+        ]
+        for vertices, pyi, pxi, target, grad_ref in cases:
+            # the pixels are several pixels away from the edges, out of reach of the default sigma
+            renderer = nr.Renderer(camera_mode='look_at', backend='cpu', sigma=20.)
+            renderer.image_size = 64
+            renderer.anti_aliasing = False
+            renderer.perspective = False
+
+            vertices = torch.from_numpy(np.array(vertices, np.float32))
+            faces = torch.from_numpy(np.array([[0, 1, 2]], np.int32))
+            vertices, faces = utils.to_minibatch((vertices, faces))
+            vertices.requires_grad = True
+            images = renderer(vertices, faces, mode='silhouettes')
+            loss = torch.sum(torch.abs(images[:, pyi, pxi] - target))
+            loss.backward()
+
+            grad = vertices.grad[2].flatten()
+            grad_ref = torch.tensor(grad_ref).flatten()
+            assert(torch.dot(grad, grad_ref) / (grad.norm() * grad_ref.norm()) > 0.75)
+
+    def test_backward_case2(self):
+        """Whether the depth gradients match the finite differences."""
+
+        vertices = [
+            [-0.9, -0.9, 2.],
+            [-0.8, 0.8, 1.],
+            [0.8, 0.8, 0.5]]
+        faces = [[0, 1, 2]]
+        pyi = 15
+        pxi = 20
+
+        renderer = nr.Renderer(camera_mode='look_at', backend='cpu')
+        renderer.image_size = 64
+        renderer.anti_aliasing = False
+        renderer.perspective = False
+        renderer.camera_mode = 'none'
+
+        vertices = torch.from_numpy(np.array(vertices, np.float32))
+        faces = torch.from_numpy(np.array(faces, np.int32))
+        vertices, faces = utils.to_minibatch((vertices, faces))
+        vertices.requires_grad = True
+        images = renderer(vertices, faces, mode='depth')
+        loss = torch.sum((images[2, pyi, pxi] - 1) ** 2)
+        loss.backward()
+
+        grad_fd = torch.zeros_like(vertices)
+        for i in range(3):
+            for j in range(3):
+                vertices2 = vertices.detach().clone()
+                vertices2[2, i, j] += 1e-3
+                loss2 = torch.sum((renderer(vertices2, faces, mode='depth')[2, pyi, pxi] - 1) ** 2)
+                grad_fd[2, i, j] = (loss2 - loss) / 1e-3
+
+        assert(vertices.grad[2].abs().sum() > 0)
+        assert(torch.allclose(vertices.grad, grad_fd, atol=1e-2))
+
+
+if __name__ == '__main__':
+    unittest.main()
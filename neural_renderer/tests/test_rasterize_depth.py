@@ -19,7 +19,7 @@ class TestRasterizeDepth(unittest.TestCase):
         vertices, faces, _ = utils.load_teapot_batch()
 
         # create renderer
-        renderer = nr.Renderer(camera_mode='look_at')
+        renderer = nr.Renderer(camera_mode='look_at', backend=utils.backend)
         renderer.image_size = 256
         renderer.anti_aliasing = False
 
@@ -39,7 +39,7 @@ class TestRasterizeDepth(unittest.TestCase):
         vertices, faces, _ = utils.load_teapot_batch()
 
         # create renderer
-        renderer = nr.Renderer(camera_mode='look_at')
+        renderer = nr.Renderer(camera_mode='look_at', backend=utils.backend)
         renderer.image_size = 256
         renderer.anti_aliasing = False
 
@@ -60,14 +60,14 @@ class TestRasterizeDepth(unittest.TestCase):
             [0.8, 0.8, 0.5]]
         faces = [[0, 1, 2]]
 
-        renderer = nr.Renderer(camera_mode='look_at')
+        renderer = nr.Renderer(camera_mode='look_at', backend=utils.backend)
         renderer.image_size = 64
         renderer.anti_aliasing = False
         renderer.perspective = False
         renderer.camera_mode = 'none'
 
-        vertices = torch.from_numpy(np.array(vertices, np.float32)).cuda()
-        faces = torch.from_numpy(np.array(faces, np.int32)).cuda()
+        vertices = torch.from_numpy(np.array(vertices, np.float32)).to(utils.device)
+        faces = torch.from_numpy(np.array(faces, np.int32)).to(utils.device)
         vertices, faces = utils.to_minibatch((vertices, faces))
         vertices.requires_grad = True
 
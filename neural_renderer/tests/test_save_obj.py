@@ -5,6 +5,7 @@ import numpy as np
 
 import neural_renderer as nr
 import torch
+import utils
 
 current_dir = os.path.dirname(os.path.realpath(__file__))
 data_dir = os.path.join(current_dir, 'data')
@@ -13,9 +14,9 @@ class TestCore(unittest.TestCase):
     def test_save_obj(self):
         teapot = os.path.join(data_dir, 'teapot.obj')
         teapot2 = os.path.join(data_dir, 'teapot2.obj')
-        vertices, faces = nr.load_obj(teapot)
+        vertices, faces = nr.load_obj(teapot, device=utils.device)
         nr.save_obj(teapot2, vertices, faces)
-        vertices2, faces2 = nr.load_obj(teapot2)
+        vertices2, faces2 = nr.load_obj(teapot2, device=utils.device)
         os.remove(teapot2)
         assert torch.allclose(vertices, vertices2)
         assert torch.allclose(faces, faces2)
@@ -6,6 +6,9 @@ import neural_renderer as nr
 
 current_dir = os.path.dirname(os.path.realpath(__file__))
 data_dir = os.path.join(current_dir, 'data')
+# NR_BACKEND=cpu runs the tests against the PyTorch rasterizer
+backend = os.environ.get('NR_BACKEND', 'cuda')
+device = 'cpu' if backend == 'cpu' else 'cuda'
 
 
 def to_minibatch(data, batch_size=4, target_num=2):
@@ -20,8 +23,8 @@ def to_minibatch(data, batch_size=4, target_num=2):
         ret.append(d2)
     return ret
 
-def load_teapot_batch(batch_size=4, target_num=2):
-    vertices, faces = nr.load_obj(os.path.join(data_dir, 'teapot.obj'))
-    textures = torch.ones((faces.shape[0], 4, 4, 4, 3), dtype=torch.float32)
+def load_teapot_batch(batch_size=4, target_num=2, device=device):
+    vertices, faces = nr.load_obj(os.path.join(data_dir, 'teapot.obj'), device=device)
+    textures = torch.ones((faces.shape[0], 4, 4, 4, 3), dtype=torch.float32, device=device)
     vertices, faces, textures = to_minibatch((vertices, faces, textures), batch_size, target_num)
     return vertices, faces, textures
@@ -0,0 +1,41 @@
+import cv2
+import numpy as np
+
+from mmdet.datasets.pipelines.transforms import (CameraRotation, CameraRotationCropResize, CropBottom,
+                                                 Resize)
+
+
+def _rotation(alpha, beta, gamma, fx=1000., cx=800., cy=500.):
+    # homography of a camera rotation, as KagglePKUDataset.rotateImage
+    K = np.array([[fx, 0, cx], [0, fx, cy], [0, 0, 1]])
+    rx = np.array([[1, 0, 0], [0, np.cos(alpha), -np.sin(alpha)], [0, np.sin(alpha), np.cos(alpha)]])
+    ry = np.array([[np.cos(beta), 0, -np.sin(beta)], [0, 1, 0], [np.sin(beta), 0, np.cos(beta)]])
+    rz = np.array([[np.cos(gamma), -np.sin(gamma), 0], [np.sin(gamma), np.cos(gamma), 0], [0, 0, 1]])
+    return K.dot(rz.dot(rx.dot(ry))).dot(np.linalg.inv(K))
+
+
+def test_camera_rotation_crop_resize():
+    y, x = np.mgrid[:1000, :1600]
+    img = np.stack([x % 256, y % 256, (x + y) // 16 % 256], axis=-1).astype(np.uint8)
+    img = cv2.GaussianBlur(img, (0, 0), 4)
+    gt_masks = [np.zeros((600, 1600), dtype=np.uint8)]
+    gt_masks[0][100:300, 200:700] = 1
+
+    def _results():
+        return dict(img=img.copy(), Mat=_rotation(0.02, 0.1, 0.04),
+                    gt_bboxes=np.array([[200., 100., 700., 300.]], dtype=np.float32),
+                    bbox_fields=['gt_bboxes'], gt_masks=list(gt_masks), mask_fields=['gt_masks'])
+
+    ref = _results()
+    for transform in (CameraRotation(), CropBottom(bottom_half=400), Resize(img_scale=(800, 300))):
+        ref = transform(ref)
+    fused = CameraRotationCropResize(bottom_half=400, img_scale=(800, 300))(_results())
+
+    for key in ('ori_shape', 'img_shape', 'pad_shape'):
+        assert fused[key] == ref[key]
+    np.testing.assert_allclose(fused['scale_factor'], ref['scale_factor'])
+    np.testing.assert_allclose(fused['gt_bboxes'], ref['gt_bboxes'])
+    np.testing.assert_array_equal(fused['gt_masks'][0], ref['gt_masks'][0])
+    diff = np.abs(fused['img'].astype(np.float32) - ref['img'].astype(np.float32))
+    # away from the borders filled by the warp
+    assert diff[20:-20, 20:-20].mean() < 2
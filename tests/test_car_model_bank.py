@@ -0,0 +1,40 @@
+import json
+import os.path as osp
+import pickle
+
+import numpy as np
+
+from mmdet.datasets.car_model_bank import CarModelBank
+
+
+def _write_box_model(json_dir, name, size):
+    corners = np.array([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.float64) * size
+    faces = [[1, 2, 4], [1, 4, 3], [5, 7, 8], [5, 8, 6], [1, 5, 6], [1, 6, 2],
+             [3, 4, 8], [3, 8, 7], [1, 3, 7], [1, 7, 5], [2, 6, 8], [2, 8, 4]]
+    with open(osp.join(json_dir, name + '.json'), 'w') as f:
+        json.dump(dict(car_type=name, vertices=corners.tolist(), faces=faces), f)
+    return corners, faces
+
+
+def test_car_model_bank(tmpdir):
+    json_dir = tmpdir.mkdir('car_models_json')
+    corners, faces = _write_box_model(str(json_dir), 'small', 1.)
+    _write_box_model(str(json_dir), 'big', 4.)
+
+    bank = CarModelBank(str(tmpdir))
+    assert osp.isfile(str(tmpdir.join('car_models_bank.npz')))
+    assert len(bank) == 2 and 'small' in bank
+
+    vertices, triangles = bank.get_mesh('small')
+    assert vertices.dtype == np.float32 and triangles.dtype == np.int32
+    np.testing.assert_allclose(vertices[:, 1], -corners[:, 1])
+    np.testing.assert_array_equal(triangles, np.array(faces) - 1)
+    assert not vertices.flags.writeable
+
+    np.testing.assert_allclose(bank.get_bbox('big'), [[0, -4, 0], [4, 0, 4]])
+    assert len(bank.get_hull('big')) == 8
+    _, decimated = bank.get_mesh('small', decimated=True)
+    assert len(decimated) <= len(triangles)
+
+    bank = pickle.loads(pickle.dumps(bank))
+    np.testing.assert_array_equal(bank.get_mesh('small')[1], triangles)
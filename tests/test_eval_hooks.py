@@ -0,0 +1,25 @@
+import os.path as osp
+
+import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from mmdet.core.evaluation.eval_hooks import collect_results
+
+
+def _collect(rank, world_size, init_file, size, out_file):
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=world_size)
+    # rank r holds the images r, r + world_size... of different result sizes
+    part = [(idx, np.full(idx + 1, idx)) for idx in range(rank, size, world_size)]
+    results = collect_results(part, size)
+    if rank == 0:
+        np.save(out_file, np.array([r.sum() for r in results]))
+    else:
+        assert results is None
+    dist.destroy_process_group()
+
+
+def test_collect_results(tmpdir):
+    out_file = osp.join(str(tmpdir), 'sums.npy')
+    mp.spawn(_collect, args=(2, osp.join(str(tmpdir), 'init'), 7, out_file), nprocs=2)
+    assert np.load(out_file).tolist() == [idx * (idx + 1) for idx in range(7)]
@@ -0,0 +1,80 @@
+import threading
+
+import cv2
+import mmcv
+import numpy as np
+import torch
+from torch import nn
+
+from mmdet.apis.inference_server import BatchInferenceServer, decode_image
+
+
+class _DummyDetector(nn.Module):
+
+    def __init__(self):
+        super(_DummyDetector, self).__init__()
+        self.calls = 0
+
+    def forward(self, img, img_meta, return_loss=False, rescale=True):
+        self.calls += 1
+        return img[0].shape, img_meta[0][0]['filename'], float(img[0].mean())
+
+
+class _BatchDetector(_DummyDetector):
+    batch_test = True
+
+    def forward(self, img, img_meta, return_loss=False, rescale=True):
+        self.calls += 1
+        results = [(img[0][j:j + 1].shape, meta['filename'], float(img[0][j].mean()))
+                   for j, meta in enumerate(img_meta[0])]
+        return results[0] if len(results) == 1 else results
+
+
+def _serve(model):
+    cfg = mmcv.Config(dict(data=dict(test=dict(pipeline=[
+        dict(type='LoadImageFromFile'),
+        dict(type='ImageToTensor', keys=['img']),
+        dict(type='Collect', keys=['img'], meta_keys=('filename', 'ori_shape', 'img_shape')),
+    ]))))
+    server = BatchInferenceServer(model, cfg, 'cpu', max_batch_size=4, max_wait_ms=50,
+                                  postprocess=lambda r: r[:2])
+
+    img = np.full((20, 30, 3), 7, dtype=np.uint8)
+    buf = cv2.imencode('.png', img)[1].tobytes()
+    np.testing.assert_array_equal(decode_image(buf), img)
+
+    results = [None] * 8
+
+    def _request(i):
+        results[i] = server.infer(buf if i % 2 else img + i, timeout=10)
+
+    threads = [threading.Thread(target=_request, args=(i, )) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    names = set()
+    for (shape, name), timing in results:
+        assert tuple(shape) == (1, 3, 20, 30)
+        names.add(name)
+        assert {'decode', 'queue', 'preprocess', 'forward', 'postprocess', 'total'} <= set(timing)
+    assert len(names) == 8
+
+    stats = server.stats()
+    assert 1 <= stats['mean_batch_size'] <= 4
+    assert stats['latency_ms']['forward']['count'] >= 2
+    return server
+
+
+def test_batch_inference_server():
+    model = _DummyDetector()
+    _serve(model)
+    assert model.calls == 8
+
+
+def test_batch_inference_server_batched_forward():
+    # one forward per micro-batch
+    model = _BatchDetector()
+    server = _serve(model)
+    assert model.calls == len(server.batch_sizes)
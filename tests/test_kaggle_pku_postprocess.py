@@ -0,0 +1,129 @@
+import cv2
+import numpy as np
+import pandas as pd
+import pycocotools.mask as maskUtils
+
+from mmdet.datasets import KagglePKUDataset
+from mmdet.datasets.kaggle_pku_postprocess import (PostprocessPipeline, read_submission_checkpoint,
+                                                   run_postprocess_pipeline)
+from mmdet.datasets.kaggle_pku_utils import euler_angles_to_quaternions, quaternions_to_euler_angles, \
+    quaternions_upper_hemisphere
+from mmdet.datasets.mesh_iou_cache import MeshIoUCache
+from mmdet.datasets.mesh_rasterizer import project_vertices, rasterize_instances
+from mmdet.utils.map_calculation import str2coords
+from mmdet.utils.result_store import ResultStore, ResultWriter
+
+CAMERA_MATRIX = np.array([[2304.5479, 0, 1686.2379],
+                          [0, 2305.8757, 1354.9849],
+                          [0, 0, 1]], dtype=np.float32)
+BOTTOM_HALF = 1480
+
+
+class _CountCars(object):
+    """The number of cars of every source of an image."""
+
+    def __call__(self, outputs):
+        return outputs[0], ' '.join(str(len(output[2]['cars'])) for output in outputs)
+
+
+def _output(i):
+    six_dof = dict(cars=list(range(i % 4)), file_name='ID_{:04d}.jpg'.format(i))
+    return [np.zeros((0, 5), dtype=np.float32)] * 3, None, six_dof
+
+
+def test_run_postprocess_pipeline(tmpdir):
+    outputs = [_output(i) for i in range(9)]
+    image_ids = ['ID_{:04d}'.format(i) for i in range(9)]
+    csv_file = str(tmpdir.join('submission.csv'))
+    expected = ['{} {}'.format(i % 4, i % 4) for i in range(9)]
+
+    # a crashed run, the third line is cut
+    with open(csv_file, 'w') as f:
+        f.write('ImageId,PredictionString\nID_0000,0 0\nID_0001,1 1\nID_00')
+    assert read_submission_checkpoint(csv_file) == ['ID_0000', 'ID_0001']
+
+    store_dir = str(tmpdir.join('results'))
+    with ResultWriter(store_dir) as writer:
+        stats = run_postprocess_pipeline(_CountCars(), [outputs, outputs], image_ids, csv_file, writer,
+                                         num_workers=2)
+    assert stats == dict(images=7, done=2)
+    df = pd.read_csv(csv_file, keep_default_na=False)
+    assert list(df.ImageId) == image_ids
+    assert list(df.PredictionString) == expected
+    assert ResultStore(store_dir, load_masks=False).image_ids == image_ids[2:]
+
+    # a finished run has nothing left to do
+    stats = run_postprocess_pipeline(_CountCars(), [outputs], image_ids, csv_file, num_workers=2)
+    assert stats == dict(images=0, done=9)
+    assert len(pd.read_csv(csv_file)) == 9
+
+
+class _BoxModels(object):
+    """Every car model is a box."""
+
+    def __init__(self):
+        self.corners = np.array([[x, y, z] for x in (-1, 1) for y in (-0.7, 0.7) for z in (-2.2, 2.2)])
+        self.faces = np.array([[0, 1, 3], [0, 3, 2], [4, 5, 7], [4, 7, 6], [0, 1, 5], [0, 5, 4],
+                               [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 3, 7], [1, 7, 5]])
+
+    def get_mesh(self, name):
+        return self.corners, self.faces
+
+
+def _dataset(img_prefix):
+    # the attributes used by the post-processing, without the annotations
+    dataset = KagglePKUDataset.__new__(KagglePKUDataset)
+    dataset.img_prefix = img_prefix
+    dataset.bottom_half = BOTTOM_HALF
+    dataset.unique_car_mode = [2, 6]
+    dataset.camera_matrix = CAMERA_MATRIX
+    dataset.car_model_dict = _BoxModels()
+    dataset.iou_cache = MeshIoUCache(dataset.car_model_dict, CAMERA_MATRIX)
+    dataset.iou_occlusion = False
+    return dataset
+
+
+def _model_output(euler_angles, translations, file_name):
+    """Output of a model whose masks are the silhouettes of its poses, with
+    the 'euler_angle' of an older detector."""
+    models = _BoxModels()
+    points = [project_vertices(models.corners, ea, t, CAMERA_MATRIX) for ea, t in zip(euler_angles, translations)]
+    instance_map, _ = rasterize_instances(points, [models.faces] * len(points), (2710 - BOTTOM_HALF, 3384),
+                                          y_offset=BOTTOM_HALF)
+    bboxes, segms = [], []
+    for i in range(len(points)):
+        ys, xs = np.nonzero(instance_map == i)
+        bboxes.append([xs.min(), ys.min(), xs.max(), ys.max(), 0.9])
+        segms.append(maskUtils.encode(np.asfortranarray((instance_map == i).astype(np.uint8))))
+    six_dof = dict(car_cls_score_pred=np.eye(2)[np.arange(len(points)) % 2],
+                   quaternion_pred=quaternions_upper_hemisphere(euler_angles_to_quaternions(euler_angles)),
+                   euler_angle=np.zeros((len(points), 3)),
+                   trans_pred_world=np.array(translations, dtype=np.float64),
+                   file_name=file_name)
+    return [np.zeros((0, 5), dtype=np.float32)] * 2 + [np.array(bboxes, dtype=np.float32)], [[], [], segms], six_dof
+
+
+def test_postprocess_pipeline_merge(tmpdir):
+    cv2.imwrite(str(tmpdir.join('ID_0000.jpg')), np.zeros((8, 8, 3), dtype=np.uint8))
+    dataset = _dataset(str(tmpdir))
+    euler_angles = np.array([[0.1, 0.5, -np.pi], [0.1, -1., -np.pi], [0.1, 2., -np.pi]])
+    translations = np.array([[-6., 4., 20.], [0., 5., 30.], [7., 4., 25.]])
+    # the second model misses a car and has its own number of stale angles
+    outputs = [_model_output(euler_angles, translations, 'ID_0000.jpg'),
+               _model_output(euler_angles[:2], translations[:2] * 1.01, 'ID_0000.jpg')]
+
+    pipeline = PostprocessPipeline(dataset,
+                                   branches=[dict(source=0, stages=[dict(type='restore_xyz')]),
+                                             dict(source=1, stages=[])],
+                                   merge=dict(vote=2),
+                                   filter_mask=False)
+    output, coords_str = pipeline(outputs)
+    six_dof = output[2]
+    assert 'euler_angle' not in six_dof and 'euler_angle' in outputs[0][2]
+    num_cars = len(six_dof['quaternion_pred'])
+    assert len(output[0][2]) == len(six_dof['trans_pred_world']) == num_cars == 2
+
+    coords = np.array([[c[k] for k in ('pitch', 'yaw', 'roll', 'x', 'y', 'z', 'score')]
+                       for c in str2coords(coords_str, ['pitch', 'yaw', 'roll', 'x', 'y', 'z', 'score'])])
+    np.testing.assert_allclose(coords[:, :3], quaternions_to_euler_angles(six_dof['quaternion_pred']), atol=1e-5)
+    np.testing.assert_allclose(coords[:, 3:6], six_dof['trans_pred_world'], atol=1e-5)
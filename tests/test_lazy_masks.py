@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+import pycocotools.mask as maskUtils
+import torch
+
+from mmdet.core.mask.lazy_masks import LazyMasks
+
+
+def _random_masks(rng, num, shape):
+    masks = []
+    for _ in range(num):
+        mask = np.zeros(shape, dtype=np.uint8)
+        cx, cy = rng.randint(40, shape[1] - 40), rng.randint(40, shape[0] - 40)
+        cv2.ellipse(mask, (cx, cy), tuple(rng.randint(10, 40, size=2).tolist()), rng.randint(0, 180), 0, 360, 1, -1)
+        masks.append(mask)
+    return masks
+
+
+def _legacy_targets(masks, bboxes, inds, out_size):
+    # former mask_target_single on full image masks
+    targets = []
+    for bbox, i in zip(bboxes.astype(np.int32), inds):
+        x1, y1, x2, y2 = bbox
+        w, h = max(x2 - x1 + 1, 1), max(y2 - y1 + 1, 1)
+        targets.append(cv2.resize(masks[i][y1:y1 + h, x1:x1 + w], out_size[::-1]))
+    return np.stack(targets)
+
+
+def test_lazy_masks_transforms():
+    rng = np.random.RandomState(0)
+    height, width = 123, 338
+    masks = _random_masks(rng, 4, (height, width))
+    rles = [maskUtils.encode(np.asfortranarray(m)) for m in masks]
+    lazy = LazyMasks(rles[:2] + masks[2:3] + [(masks[3][10:, 5:], (5, 10))], height, width)
+    assert len(lazy) == 4 and lazy.nbytes < sum(m.nbytes for m in masks)
+
+    # resize x2, flip then pad, as the pipeline does to the full masks
+    new_h, new_w = height * 2, width * 2
+    transformed = lazy.rescale((new_h, new_w)).flip().pad((256, 704))
+    assert transformed is not lazy and np.all(lazy.scale == 1)
+    for mask, lazy_mask in zip(masks, transformed):
+        ref = cv2.resize(mask, (new_w, new_h), interpolation=cv2.INTER_NEAREST)[:, ::-1]
+        ref = np.pad(ref, ((0, 256 - new_h), (0, 704 - new_w)), mode='constant')
+        assert lazy_mask.shape == ref.shape
+        assert np.count_nonzero(lazy_mask != ref) <= 0.02 * ref.sum()
+
+    # targets sampled in the original masks agree with the legacy ones
+    ref_masks = [np.pad(cv2.resize(m, (new_w, new_h), interpolation=cv2.INTER_NEAREST)[:, ::-1],
+                        ((0, 256 - new_h), (0, 704 - new_w)), mode='constant') for m in masks]
+    inds = rng.randint(0, 4, size=16)
+    bboxes = []
+    for i in inds:
+        ys, xs = np.nonzero(ref_masks[i])
+        jitter = rng.randint(-4, 5, size=4)
+        bboxes.append([xs.min() + jitter[0], ys.min() + jitter[1], xs.max() + jitter[2], ys.max() + jitter[3]])
+    bboxes = np.clip(np.array(bboxes, dtype=np.float32), 0, None)
+    targets = transformed.crop_and_resize(torch.from_numpy(bboxes), torch.from_numpy(inds), (28, 28))
+    ref = _legacy_targets(ref_masks, bboxes, inds, (28, 28))
+    assert targets.shape == (16, 28, 28) and targets.dtype == torch.float32
+    assert np.count_nonzero(targets.numpy() != ref) <= 0.03 * ref.size
+
+
+def test_lazy_masks_empty():
+    lazy = LazyMasks([(np.zeros((0, 0), dtype=np.uint8), (0, 0))], 20, 30)
+    assert lazy[0].shape == (20, 30) and not lazy[0].any()
+    targets = lazy.crop_and_resize(torch.tensor([[0., 0., 10., 10.]]), torch.tensor([0]), (7, 7))
+    assert targets.shape == (1, 7, 7) and not targets.any()
@@ -0,0 +1,35 @@
+import os.path as osp
+
+import cv2
+import numpy as np
+
+from mmdet.datasets.pipelines.loading import LoadImageFromFile, jpeg_size
+from mmdet.datasets.pipelines.transforms import CropBottom, Resize
+
+
+def _load(tmpdir, loader, scale):
+    results = dict(img_prefix=str(tmpdir), img_info=dict(filename='img.jpg'))
+    for transform in (loader, CropBottom(bottom_half=400), Resize(img_scale=scale, keep_ratio=True)):
+        results = transform(results)
+    return results
+
+
+def test_reduced_decode_with_crop(tmpdir):
+    # a smooth image so that decoding at a reduced scale barely changes it
+    y, x = np.mgrid[:1000, :1600]
+    img = np.stack([x % 256, y % 256, (x + y) // 16 % 256], axis=-1).astype(np.uint8)
+    img = cv2.GaussianBlur(img, (0, 0), 4)
+    cv2.imwrite(osp.join(str(tmpdir), 'img.jpg'), img)
+    with open(osp.join(str(tmpdir), 'img.jpg'), 'rb') as f:
+        assert jpeg_size(f.read()) == (1000, 1600)
+
+    for scale, reduction in (((800, 300), 2), ((400, 150), 4), ((1600, 600), 1)):
+        ref = _load(tmpdir, LoadImageFromFile(), scale)
+        fused = _load(tmpdir, LoadImageFromFile(bottom_half=400, decode_scale=scale), scale)
+
+        assert fused.get('decode_scale', 1.) == 1. / reduction
+        for key in ('ori_shape', 'img_shape', 'pad_shape'):
+            assert fused[key] == ref[key]
+        np.testing.assert_allclose(fused['scale_factor'], ref['scale_factor'])
+        diff = np.abs(fused['img'].astype(np.float32) - ref['img'].astype(np.float32))
+        assert diff.mean() < 3
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from sklearn.metrics import average_precision_score
+
+from mmdet.utils.map_calculation import MapEvaluator, check_match, coords2str, expand_df, parse_prediction_strings
+
+
+def _random_dfs(num_imgs=30, seed=0):
+    rng = np.random.RandomState(seed)
+    gt, pred = [], []
+    for i in range(num_imgs):
+        num_gt = rng.randint(1, 8)
+        cars = np.hstack([rng.randint(0, 79, (num_gt, 1)),
+                          rng.uniform(-0.3, 0.3, (num_gt, 1)),
+                          rng.uniform(-np.pi, np.pi, (num_gt, 1)),
+                          rng.uniform(-np.pi, np.pi, (num_gt, 1)),
+                          rng.uniform(-20, 20, (num_gt, 1)),
+                          rng.uniform(3, 10, (num_gt, 1)),
+                          rng.uniform(5, 80, (num_gt, 1))])
+        gt.append(('img_%d' % i, coords2str(cars)))
+        # noisy copies of some gt cars plus a few false positives
+        num_pred = rng.randint(0, 10)
+        idx = rng.randint(0, num_gt, num_pred)
+        angles = cars[idx, 1:4] + rng.normal(0, 0.1, (num_pred, 3))
+        trans = cars[idx, 4:7] * (1 + rng.normal(0, 0.04, (num_pred, 3)))
+        scores = np.round(rng.uniform(0, 1, (num_pred, 1)), 1)
+        pred.append(('img_%d' % i, coords2str(np.hstack([angles, trans, scores]))))
+    gt_df = pd.DataFrame(gt, columns=['ImageId', 'PredictionString'])
+    pred_df = pd.DataFrame(pred, columns=['ImageId', 'PredictionString'])
+    return gt_df, pred_df
+
+
+def test_map_evaluator_matches_check_match():
+    gt_df, pred_df = _random_dfs()
+    num_gt = len(expand_df(gt_df, ['model_type', 'pitch', 'yaw', 'roll', 'x', 'y', 'z']))
+    for flip_mode in (False, True):
+        evaluator = MapEvaluator(gt_df, flip_mode=flip_mode)
+        result_flgs, scores = evaluator.match(pred_df)
+        _, ap_list = evaluator.evaluate(pred_df)
+        for i in range(10):
+            result_flg, ref_scores = check_match(i, gt_df.copy(), pred_df, flip_mode)
+            assert list(result_flgs[i]) == result_flg
+            assert list(scores) == ref_scores
+            if np.sum(result_flg) > 0:
+                ap = average_precision_score(result_flg, ref_scores) * (np.sum(result_flg) / num_gt)
+            else:
+                ap = 0
+            assert ap_list[i] == ap
+
+
+def test_map_evaluator_sweep():
+    gt_df, pred_df = _random_dfs(seed=1)
+    evaluator = MapEvaluator(gt_df)
+    pred_coords = parse_prediction_strings(pred_df)
+    conf_thresholds = [0., 0.05, 0.3, 0.5, 0.55, 0.9, 1.]
+    maps, ap_lists = evaluator.sweep(pred_coords, conf_thresholds)
+    assert ap_lists.shape == (len(conf_thresholds), 10)
+    for conf_thresh, mean_ap, ap_list in zip(conf_thresholds, maps, ap_lists):
+        kept = {img_id: coords[coords[:, 6] > conf_thresh] for img_id, coords in pred_coords.items()}
+        ref_df = pd.DataFrame([(img_id, coords2str(coords)) for img_id, coords in kept.items()],
+                              columns=['ImageId', 'PredictionString'])
+        ref_map, ref_ap_list = evaluator.evaluate(ref_df)
+        np.testing.assert_allclose(ap_list, ref_ap_list, atol=1e-12)
+        assert np.isclose(mean_ap, ref_map)
+    assert maps[-1] == 0
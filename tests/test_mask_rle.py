@@ -0,0 +1,30 @@
+import numpy as np
+import pycocotools.mask as mask_util
+
+from mmdet.core.mask.rle import decode_cropped, decode_segm, encode_cropped
+
+
+def test_cropped_rle():
+    rng = np.random.RandomState(0)
+    for _ in range(100):
+        h, w = rng.randint(1, 40, size=2)
+        mask = (rng.rand(*rng.randint(1, 50, size=2)) > rng.rand()).astype(np.uint8)
+        # partly outside of the image
+        offset = tuple(rng.randint(-20, 40, size=2))
+        cropped = dict(size=[h, w], offset=offset, mask=mask)
+        full = decode_segm(cropped)
+        assert full.shape == (h, w)
+
+        rle = encode_cropped(mask, offset, (h, w))
+        assert rle == mask_util.encode(np.asfortranarray(full))
+
+        for segm in (rle, cropped):
+            bitmap, (x0, y0) = decode_cropped(segm)
+            pasted = np.zeros((h, w), dtype=np.uint8)
+            pasted[y0:y0 + bitmap.shape[0], x0:x0 + bitmap.shape[1]] = bitmap
+            np.testing.assert_array_equal(pasted, full)
+        if full.any():
+            ys, xs = np.nonzero(full)
+            bitmap, offset = decode_cropped(rle)
+            assert offset == (xs.min(), ys.min())
+            assert bitmap.shape == (ys.max() - ys.min() + 1, xs.max() - xs.min() + 1)
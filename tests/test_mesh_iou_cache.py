@@ -0,0 +1,154 @@
+import pickle
+
+import numpy as np
+import pycocotools.mask as maskUtils
+
+from mmdet.datasets.mesh_iou_cache import MeshIoUCache
+from mmdet.datasets.mesh_rasterizer import (mask_intersection, project_vertices,
+                                            rasterize_mesh)
+
+CAMERA_MATRIX = np.array([[2304.5479, 0, 1686.2379],
+                          [0, 2305.8757, 1354.9849],
+                          [0, 0, 1]], dtype=np.float32)
+BOTTOM_HALF = 1480
+
+
+class _BoxModels(object):
+
+    def __init__(self):
+        corners = np.array([[x, y, z] for x in (-1, 1) for y in (-0.7, 0.7) for z in (-2.2, 2.2)])
+        faces = np.array([[0, 1, 3], [0, 3, 2], [4, 5, 7], [4, 7, 6], [0, 1, 5], [0, 5, 4],
+                          [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 3, 7], [1, 7, 5]])
+        self.meshes = {'box': (corners, faces), 'long-box': (corners * [1, 1, 1.5], faces)}
+
+    def get_mesh(self, name):
+        return self.meshes[name]
+
+
+def _direct_iou(models, rle, name, euler_angle, t):
+    mask_all_pred = maskUtils.decode(rle).astype(np.float64)
+    vertices, triangles = models.get_mesh(name)
+    img_cor_points = project_vertices(vertices, euler_angle, t, CAMERA_MATRIX)
+    mask_mesh, offset = rasterize_mesh(img_cor_points, triangles, mask_all_pred.shape, y_offset=BOTTOM_HALF)
+    intersection = mask_intersection(mask_mesh, offset, mask_all_pred)
+    area = mask_all_pred.sum()
+    return intersection / area, intersection / (area + mask_mesh.sum() - intersection)
+
+
+def test_mesh_iou_cache():
+    models = _BoxModels()
+    cache = MeshIoUCache(models, CAMERA_MATRIX)
+
+    pred = np.zeros((2710 - BOTTOM_HALF, 3384), dtype=np.uint8)
+    pred[100:700, 1400:2200] = 1
+    rle = maskUtils.encode(np.asfortranarray(pred))
+
+    poses = [('box', [0.1, 0.2, 0.], [0., 3., 12.]),
+             ('long-box', [-0.3, 0.05, 3.1], [1., 2.5, 10.]),
+             # crosses the top of the bottom half crop
+             ('box', [0., 0., 0.], [0.5, 0.3, 6.])]
+    for name, euler_angle, t in poses:
+        score_mask, score_iou = cache.iou(rle, name, euler_angle, t, y_offset=BOTTOM_HALF)
+        ref_mask, ref_iou = _direct_iou(models, rle, name, np.array(euler_angle), np.array(t))
+        assert score_iou > 0
+        np.testing.assert_allclose([score_mask, score_iou], [ref_mask, ref_iou], rtol=1e-3)
+
+    # the poses are rasterised and the mask decoded only once
+    for name, euler_angle, t in poses:
+        cache.iou(rle, name, np.array(euler_angle) + 1e-7, t, y_offset=BOTTOM_HALF)
+    stats = cache.stats()
+    assert stats['mesh_misses'] == len(poses) and stats['mask_misses'] == 1
+
+    # the silhouette of the full image is shared with the ignore mask overlap
+    ignore = np.zeros((2710, 3384), dtype=bool)
+    ignore[BOTTOM_HALF:] = pred
+    mask, key = cache.file_mask('ignore.jpg', lambda _: ignore)
+    name, euler_angle, t = poses[0]
+    vertices, triangles = models.get_mesh(name)
+    mask_mesh, offset = rasterize_mesh(project_vertices(vertices, euler_angle, t, CAMERA_MATRIX),
+                                       triangles, ignore.shape)
+    np.testing.assert_allclose(cache.mesh_overlap(mask, key, name, euler_angle, t),
+                               mask_intersection(mask_mesh, offset, ignore) / mask_mesh.sum(), rtol=1e-3)
+    assert cache.stats()['mesh_misses'] == len(poses)
+
+    # the bbox-local masks of get_seg_masks give the same scores
+    cropped = dict(size=list(pred.shape), offset=(1390, 90), mask=pred[90:710, 1390:2210])
+    np.testing.assert_allclose(cache.iou(cropped, name, euler_angle, t, y_offset=BOTTOM_HALF),
+                               cache.iou(rle, name, euler_angle, t, y_offset=BOTTOM_HALF))
+
+    # the cached entries are not pickled
+    assert pickle.loads(pickle.dumps(cache)).stats()['meshes'] == 0
+
+    # the memoised intersections are bounded too
+    cache = MeshIoUCache(models, CAMERA_MATRIX, max_intersections=2)
+    for name, euler_angle, t in poses:
+        cache.iou(rle, name, euler_angle, t, y_offset=BOTTOM_HALF)
+    assert cache.stats()['intersections'] == 2
+
+
+def test_packed_mask_intersection():
+    from mmdet.datasets.mesh_iou_cache import _PackedMask
+    from mmdet.datasets.mesh_rasterizer import cropped_intersection
+
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        mask_a = rng.rand(*rng.randint(1, 60, size=2)) > 0.5
+        mask_b = rng.rand(*rng.randint(1, 60, size=2)) > 0.5
+        offset_a, offset_b = tuple(rng.randint(0, 40, size=2)), tuple(rng.randint(0, 40, size=2))
+        packed = _PackedMask(mask_a, offset_a)
+        assert packed.area == mask_a.sum()
+        assert packed.intersection(mask_b, offset_b) == cropped_intersection(mask_a, offset_a, mask_b, offset_b)
+
+
+def test_instance_ious_occlusion():
+    from mmdet.datasets.mesh_rasterizer import rasterize_instances
+
+    models = _BoxModels()
+    cache = MeshIoUCache(models, CAMERA_MATRIX)
+    names = ['box', 'long-box']
+    euler_angles = np.array([[0., 0., 0.], [0.3, 0., 0.]])
+    # the second car is partly hidden by the first one
+    translations = np.array([[0., 1.5, 10.], [1.5, 1.5, 20.]])
+    points = [project_vertices(models.get_mesh(name)[0], ea, t, CAMERA_MATRIX)
+              for name, ea, t in zip(names, euler_angles, translations)]
+    instance_map, depth = rasterize_instances(points, [models.get_mesh(name)[1] for name in names],
+                                              (2710 - BOTTOM_HALF, 3384), y_offset=BOTTOM_HALF)
+    assert np.isinf(depth[instance_map < 0]).all() and (depth[instance_map >= 0] > 7).all()
+
+    # the masks of the visible parts match the z-buffered silhouettes only
+    rles = [maskUtils.encode(np.asfortranarray((instance_map == i).astype(np.uint8))) for i in range(2)]
+    scores_mask, scores_iou = cache.instance_ious(rles, names, euler_angles, translations, y_offset=BOTTOM_HALF)
+    np.testing.assert_allclose(scores_mask, 1)
+    np.testing.assert_allclose(scores_iou, 1)
+    assert cache.iou(rles[0], names[0], euler_angles[0], translations[0], y_offset=BOTTOM_HALF)[1] > 0.99
+    assert cache.iou(rles[1], names[1], euler_angles[1], translations[1], y_offset=BOTTOM_HALF)[1] < 0.9
+
+
+def test_share_iou_cache_budget():
+    from mmdet.datasets import mesh_iou_cache
+    from mmdet.datasets.mesh_iou_cache import shared_iou_cache, share_iou_cache_budget
+
+    models = _BoxModels()
+    cache = shared_iou_cache(models, CAMERA_MATRIX)
+    mask = np.zeros((2710 - BOTTOM_HALF, 3384), dtype=np.uint8)
+    mask[100:600, 1400:2200] = 1
+    rle = maskUtils.encode(np.asfortranarray(mask))
+    for z in (10., 12., 14.):
+        cache.iou(rle, 'box', [0., 0., 0.], [0., 1.5, z], y_offset=BOTTOM_HALF)
+    assert cache.stats()['intersections'] == 3
+    try:
+        # the inherited caches of a pool worker are trimmed to its share
+        share_iou_cache_budget(4)
+        assert cache.max_mesh_bytes == mesh_iou_cache.MAX_MESH_BYTES // 4
+        assert cache.max_intersections == mesh_iou_cache.MAX_INTERSECTIONS // 4
+        cache.set_budget(cache.max_mesh_bytes, cache.max_mask_bytes, 2)
+        assert cache.stats()['intersections'] == 2
+
+        # so is the cache unpickled in a spawned worker
+        copy = pickle.loads(pickle.dumps(cache))
+        assert copy.shared and copy.max_mask_bytes == mesh_iou_cache.MAX_MASK_BYTES // 4
+    finally:
+        share_iou_cache_budget(1)
+    assert cache.max_intersections == mesh_iou_cache.MAX_INTERSECTIONS
+    # the caches built directly keep their budgets
+    assert not MeshIoUCache(models, CAMERA_MATRIX).shared
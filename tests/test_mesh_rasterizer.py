@@ -0,0 +1,42 @@
+import cv2
+import numpy as np
+
+from mmdet.datasets.mesh_rasterizer import (mask_intersection, paste_mask,
+                                            rasterize_mesh)
+
+
+def _draw_contours(points, triangles, image_shape):
+    mask = np.zeros(image_shape, dtype=np.uint8)
+    for tri in triangles:
+        coord = np.array(points[tri, :2], dtype=np.int32)
+        cv2.drawContours(mask, np.int32([coord]), 0, 1, -1)
+    return mask
+
+
+def test_rasterize_mesh_matches_draw_contours():
+    rng = np.random.RandomState(0)
+    points = rng.uniform(20, 180, size=(60, 2))
+    triangles = rng.randint(0, 60, size=(200, 3))
+
+    mask, offset = rasterize_mesh(points, triangles, (200, 200))
+    full = paste_mask(mask, offset, (200, 200))
+    ref = _draw_contours(points, triangles, (200, 200))
+
+    assert mask.shape[0] < 200 and mask.shape[1] < 200
+    iou = (full & ref).sum() / (full | ref).sum()
+    assert iou > 0.98
+    assert mask_intersection(mask, offset, ref) == (full & ref).sum()
+
+
+def test_rasterize_mesh_clip_and_offset():
+    points = np.array([[-10., 5.], [30., 5.], [30., 40.]])
+    triangles = np.array([[0, 1, 2]])
+
+    mask, offset = rasterize_mesh(points, triangles, (20, 20), y_offset=10)
+    assert offset == (0, 0)
+    assert mask.shape == (20, 20)
+    # the hypotenuse crosses the lower left corner of the window
+    assert mask[0].all() and mask[-1, :3].sum() == 0
+
+    mask, _ = rasterize_mesh(points + 100, triangles, (20, 20))
+    assert mask.size == 0
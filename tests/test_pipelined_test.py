@@ -0,0 +1,85 @@
+import pytest
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Subset
+
+from mmdet.apis.pipelined_test import pipelined_test
+
+
+class _BatchDetector(nn.Module):
+
+    def forward(self, img, return_loss=False, rescale=True):
+        results = [int(v) for v in img[0][:, 0]]
+        return results[0] if len(results) == 1 else results
+
+
+class _ListWriter(object):
+
+    def __init__(self):
+        self.items = []
+
+    def append(self, result, idx):
+        self.items.append((idx, result))
+
+
+def _collate(batch):
+    return dict(img=[torch.tensor(batch, dtype=torch.float32)[:, None]])
+
+
+def _loader(values, batch_size):
+    return DataLoader(values, batch_size=batch_size, collate_fn=_collate)
+
+
+@pytest.mark.parametrize('batch_size', [1, 3])
+def test_pipelined_test_postprocess(batch_size):
+    writer = _ListWriter()
+    done = []
+    stats = pipelined_test(_BatchDetector(), _loader(list(range(10)), batch_size), writer,
+                           postprocess=lambda result, idx: (result, idx * 10), num_workers=3,
+                           queue_size=2, progress=done.append)
+    # the dataset index of every image comes with its post-processed result
+    assert sorted(writer.items) == [(i, (i, i * 10)) for i in range(10)]
+    assert sum(done) == 10
+    summary = stats.summary()
+    assert set(summary['stages']) == {'load', 'forward', 'queue', 'postprocess', 'write'}
+    assert summary['stages']['postprocess']['count'] == 10
+    assert all(0 <= s['occupancy'] <= 1 for s in summary['stages'].values())
+
+
+class _ShardLoader(object):
+    """Batches of one rank, as the distributed sampler pads the dataset with
+    its first images to a multiple of the world size."""
+
+    def __init__(self, dataset, rank, world_size, batch_size):
+        self.dataset = dataset
+        padded = dataset + dataset[:-len(dataset) % world_size]
+        self.batches = list(_loader(padded[rank::world_size], batch_size))
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+def test_pipelined_test_distributed_indices():
+    writer = _ListWriter()
+    pipelined_test(_BatchDetector(), _ShardLoader(list(range(7)), 1, 2, 2), writer, rank=1, world_size=2)
+    # the padding image of the last batch is dropped
+    assert sorted(writer.items) == [(1, 1), (3, 3), (5, 5)]
+
+
+def test_pipelined_test_subset():
+    writer = _ListWriter()
+    # the images left by an interrupted run
+    dataset = Subset(list(range(10)), [2, 5, 6, 9])
+    pipelined_test(_BatchDetector(), DataLoader(dataset, batch_size=3, collate_fn=_collate), writer)
+    assert sorted(writer.items) == [(2, 2), (5, 5), (6, 6), (9, 9)]
+
+
+def test_pipelined_test_error():
+
+    def postprocess(result, idx):
+        if idx == 4:
+            raise ValueError('bad image')
+        return result
+
+    with pytest.raises(ValueError, match='bad image'):
+        pipelined_test(_BatchDetector(), _loader(list(range(10)), 2), _ListWriter(), postprocess=postprocess)
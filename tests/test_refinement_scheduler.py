@@ -0,0 +1,93 @@
+import os.path as osp
+import sys
+
+import numpy as np
+import pycocotools.mask as maskUtils
+import torch
+
+import neural_renderer as nr
+from mmdet.datasets.kaggle_pku_utils import euler_angles_to_quaternions, quaternions_upper_hemisphere
+
+sys.path.insert(0, osp.join(osp.dirname(__file__), '..', 'tools'))
+from finetune_RT_NMR_iou import RefinementScheduler  # noqa: E402
+
+CAMERA_MATRIX = np.array([[2304.5479, 0, 1686.2379],
+                          [0, 2305.8757, 1354.9849],
+                          [0, 0, 1]], dtype=np.float32)
+IMAGE_SIZE = (3384, 2710 - 1480)
+
+
+class _BoxModels(object):
+    """Every car model is a box."""
+
+    def __init__(self):
+        self.corners = np.array([[x, y, z] for x in (-1, 1) for y in (-0.7, 0.7) for z in (-2.2, 2.2)],
+                                dtype=np.float32)
+        self.faces = np.array([[0, 1, 3], [0, 3, 2], [4, 5, 7], [4, 7, 6], [0, 1, 5], [0, 5, 4],
+                               [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 3, 7], [1, 7, 5]], dtype=np.int32)
+
+    def get_mesh(self, name):
+        return self.corners, self.faces
+
+
+class _Dataset(object):
+    camera_matrix = CAMERA_MATRIX
+    unique_car_mode = [2]
+    car_model_dict = _BoxModels()
+
+
+class _Writer(object):
+
+    def __init__(self):
+        self.outputs = dict()
+
+    def append(self, output, idx):
+        self.outputs[idx] = output
+
+
+def _output(translations, scores):
+    """Output of a model whose masks are the silhouettes of the boxes at
+    translations, with the identity rotation."""
+    models = _BoxModels()
+    camera_matrix = CAMERA_MATRIX.copy()
+    camera_matrix[1, 2] -= 1480
+    n = len(translations)
+    renderer = nr.Renderer(image_size=IMAGE_SIZE, orig_size=IMAGE_SIZE, camera_mode='projection',
+                           K=camera_matrix[None], R=torch.eye(3)[None].repeat(n, 1, 1),
+                           t=torch.tensor(translations, dtype=torch.float32), backend='cpu')
+    with torch.no_grad():
+        masks = renderer(torch.from_numpy(models.corners)[None].repeat(n, 1, 1),
+                         torch.from_numpy(models.faces)[None].repeat(n, 1, 1), mode='silhouettes').numpy()
+    bboxes, segms = [], []
+    for mask, score in zip(masks > 0.5, scores):
+        ys, xs = np.nonzero(mask)
+        bboxes.append([xs.min(), ys.min(), xs.max() + 1, ys.max() + 1, score])
+        segms.append(maskUtils.encode(np.asfortranarray(mask.astype(np.uint8))))
+    six_dof = dict(car_cls_score_pred=np.ones((n, 1)),
+                   quaternion_pred=quaternions_upper_hemisphere(euler_angles_to_quaternions(np.zeros((n, 3)))),
+                   trans_pred_world=np.array(translations, dtype=np.float32))
+    return [np.zeros((0, 5), dtype=np.float32)] * 2 + [np.array(bboxes, dtype=np.float32)], [[], [], segms], six_dof
+
+
+def test_refinement_scheduler():
+    t_true = np.array([[-3., 4., 20.], [5., 3., 30.], [0., 4., 25.]], dtype=np.float32)
+    outputs = [_output(t_true, [0.9, 0.9, 0.5]), _output(t_true[:1], [0.5])]
+    # the second car is projected out of its RoI window, it renders nothing
+    t_init = t_true + np.array([[0.3, -0.2, 1.5], [15., 0., 0.], [1., 1., 1.]], dtype=np.float32)
+    outputs[0][2]['trans_pred_world'] = t_init.copy()
+
+    writer = _Writer()
+    scheduler = RefinementScheduler(_Dataset(), writer, batch_size=1, num_epochs=20, lr=2., loss_IoU=0.95,
+                                    backend='cpu')
+    stats = scheduler.run([(0, outputs[0]), (1, outputs[1])])
+
+    # the image without confident car is written as is
+    assert sorted(writer.outputs) == [0, 1]
+    assert stats['cars'] == 2
+    assert scheduler.steps[0] == 20 and stats['steps'] > 20
+    translations = writer.outputs[0][2]['trans_pred_world']
+    # the direction of the car is refined, its depth is hardly constrained by the silhouette
+    direction_error = np.abs(translations[0, :2] / translations[0, 2] - t_true[0, :2] / t_true[0, 2]).sum()
+    assert direction_error < 0.2 * np.abs(t_init[0, :2] / t_init[0, 2] - t_true[0, :2] / t_true[0, 2]).sum()
+    np.testing.assert_allclose(translations[1:], t_init[1:])
+    np.testing.assert_allclose(writer.outputs[1][2]['trans_pred_world'], t_true[:1])
@@ -0,0 +1,73 @@
+import pickle
+
+import numpy as np
+
+from mmdet.utils.result_store import ResultStore, ResultWriter
+
+
+def _output(i, num_cars):
+    rng = np.random.RandomState(i)
+    bboxes = [np.zeros((0, 5), dtype=np.float32) for _ in range(3)]
+    bboxes[2] = rng.rand(num_cars, 5).astype(np.float32)
+    segms = [[], [], [{'size': [10, 10], 'counts': b'abc%d' % k} for k in range(num_cars)]]
+    six_dof = dict(car_cls_score_pred=rng.rand(num_cars, 79),
+                   quaternion_pred=rng.rand(num_cars, 4),
+                   trans_pred_world=rng.rand(num_cars, 3),
+                   file_name='/data/test_images/ID_{:04d}.jpg'.format(i))
+    return bboxes, segms, six_dof
+
+
+def test_result_store(tmpdir):
+    store_dir = str(tmpdir.join('results'))
+    outputs = [_output(i, i % 3) for i in range(7)]
+    world_size = 2
+    # two ranks, the last image of rank 1 is the padded copy of image 0
+    for rank in range(world_size):
+        with ResultWriter(store_dir, 'part_{}'.format(rank), resume=True) as writer:
+            for idx in range(rank, 8, world_size):
+                if idx < len(outputs):
+                    writer.append(outputs[idx], idx)
+
+    store = ResultStore(store_dir)
+    assert len(store) == 7
+    assert store.image_ids == ['ID_{:04d}'.format(i) for i in range(7)]
+    for output, ref in zip(store, outputs):
+        for a, b in zip(output[0], ref[0]):
+            np.testing.assert_array_equal(a, b)
+        assert output[1] == ref[1]
+        assert output[2]['file_name'] == ref[2]['file_name']
+        for k in ('car_cls_score_pred', 'quaternion_pred', 'trans_pred_world'):
+            np.testing.assert_array_equal(output[2][k], ref[2][k])
+
+    np.testing.assert_array_equal(store['ID_0005'][2]['quaternion_pred'], outputs[5][2]['quaternion_pred'])
+    assert 'ID_0010' not in store
+
+    # a record without its index line (interrupted write) is ignored
+    with open(str(tmpdir.join('results', 'part_1.npy')), 'ab') as f:
+        f.write(b'garbage')
+    store = pickle.loads(pickle.dumps(ResultStore(store_dir, load_masks=False)))
+    assert len(store) == 7 and store[3][1] is None
+
+
+def test_result_store_rewrite(tmpdir):
+    store_dir = str(tmpdir.join('results'))
+    outputs = [_output(i, 2) for i in range(3)]
+    with ResultWriter(store_dir) as writer:
+        for idx in range(2):
+            writer.append(outputs[idx], idx)
+
+    # a resumed run appends, the image written again replaces its output
+    with ResultWriter(store_dir, resume=True) as writer:
+        writer.append(outputs[2], 0)
+        writer.append(outputs[2], 2)
+    store = ResultStore(store_dir, load_masks=False)
+    assert [r['idx'] for r in store.records] == [0, 1, 2]
+    np.testing.assert_array_equal(store[0][2]['trans_pred_world'], outputs[2][2]['trans_pred_world'])
+    np.testing.assert_array_equal(store[1][2]['trans_pred_world'], outputs[1][2]['trans_pred_world'])
+
+    # a new run starts from an empty store
+    with ResultWriter(store_dir) as writer:
+        writer.append(outputs[1], 0)
+    store = ResultStore(store_dir, load_masks=False)
+    assert len(store) == 1
+    np.testing.assert_array_equal(store[0][2]['trans_pred_world'], outputs[1][2]['trans_pred_world'])
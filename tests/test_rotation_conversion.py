@@ -0,0 +1,39 @@
+import numpy as np
+
+from mmdet.datasets.kaggle_pku_utils import (euler_angles_to_quaternions,
+                                             get_euler_angles,
+                                             quaternion_to_euler_angle,
+                                             quaternion_upper_hemispher,
+                                             quaternions_to_euler_angles,
+                                             quaternions_upper_hemisphere)
+
+
+def _random_quaternions(n=500):
+    rng = np.random.RandomState(0)
+    q = rng.normal(size=(n, 4))
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    # boundary cases of the upper hemisphere
+    q[:4] = [[0, -1, 0, 0], [0, 0, -1, 0], [0, 0, 0, -1], [0, 0.6, -0.8, 0]]
+    return q
+
+
+def test_batched_conversion_matches_scalar():
+    q = _random_quaternions()
+    ref = np.array([quaternion_upper_hemispher(x.copy()) for x in q])
+    np.testing.assert_allclose(quaternions_upper_hemisphere(q), ref)
+
+    ref = np.array([quaternion_to_euler_angle(x) for x in q])
+    np.testing.assert_allclose(quaternions_to_euler_angles(q), ref, atol=1e-12)
+    assert quaternions_to_euler_angles([]).shape == (0, 3)
+
+    angles = quaternions_to_euler_angles(q)
+    np.testing.assert_allclose(
+        quaternions_upper_hemisphere(euler_angles_to_quaternions(angles)),
+        quaternions_upper_hemisphere(q), atol=1e-9)
+
+
+def test_get_euler_angles_from_quaternions():
+    q = _random_quaternions(5)
+    # a stale 'euler_angle' of another number of cars, e.g. left by a merge
+    six_dof = dict(quaternion_pred=q, euler_angle=np.zeros((3, 3)))
+    np.testing.assert_allclose(get_euler_angles(six_dof), quaternions_to_euler_angles(q))
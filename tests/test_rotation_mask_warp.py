@@ -0,0 +1,74 @@
+import numpy as np
+import pycocotools.mask as maskUtils
+from scipy.spatial.transform import Rotation as R
+
+from mmdet.datasets import KagglePKUDataset
+
+CAMERA_MATRIX = np.array([[2304.5479, 0, 1686.2379],
+                          [0, 2305.8757, 1354.9849],
+                          [0, 0, 1]], dtype=np.float32)
+BOTTOM_HALF = 1480
+
+
+def _dataset():
+    # the attributes used by the rotation augmentation, without the annotations
+    dataset = KagglePKUDataset.__new__(KagglePKUDataset)
+    dataset.camera_matrix = CAMERA_MATRIX
+    dataset.image_shape = (2710, 3384)
+    dataset.bottom_half = BOTTOM_HALF
+    return dataset
+
+
+def _box():
+    vertices = np.array([[x, y, z] for x in (-1, 1) for y in (-0.7, 0.7) for z in (-2.2, 2.2)], dtype=np.float32)
+    triangles = np.array([[0, 1, 3], [0, 3, 2], [4, 5, 7], [4, 7, 6], [0, 1, 5], [0, 5, 4],
+                          [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 3, 7], [1, 7, 5]], dtype=np.int32)
+    return vertices, triangles
+
+
+def _paste(cropped_mask, shape):
+    mask, (x0, y0) = cropped_mask
+    full = np.zeros(shape, dtype=np.uint8)
+    full[y0:y0 + mask.shape[0], x0:x0 + mask.shape[1]] = mask
+    return full
+
+
+def _rotate(dataset, eular_angle, translation, alpha, beta, gamma):
+    # the rotated pose as KagglePKUDataset._parse_ann_info computes it
+    yaw, pitch, roll = eular_angle
+    r1 = R.from_euler('xyz', [-pitch, -yaw, -roll], degrees=False)
+    r2 = R.from_euler('xyz', [beta, -alpha, -gamma], degrees=False)
+    pitch_rot, yaw_rot, roll_rot = (r2 * r1).as_euler('xyz') * (-1)
+    Mat, Rot = dataset.rotateImage(alpha, beta, gamma)
+    translation_rot = np.dot(Rot, list(translation) + [1])[:3]
+    return Mat, np.array([yaw_rot, pitch_rot, roll_rot]), translation_rot
+
+
+def test_warped_mask_matches_rendered_mask():
+    dataset = _dataset()
+    vertices, triangles = _box()
+    eular_angle, translation = np.array([0.1, 0.6, -np.pi]), np.array([-4., 5., 22.])
+    mask_shape = (dataset.image_shape[0] - BOTTOM_HALF, dataset.image_shape[1])
+
+    # the gt RLE, stored bottom half only or full frame
+    _, gt_mask = dataset.get_box_and_mask(eular_angle, translation, vertices, triangles)
+    gt_mask = _paste(gt_mask, mask_shape)
+    rles = [maskUtils.encode(np.asfortranarray(gt_mask)),
+            maskUtils.encode(np.asfortranarray(np.vstack([np.zeros((BOTTOM_HALF, mask_shape[1]), np.uint8),
+                                                          gt_mask])))]
+
+    Mat, eular_angle_rot, translation_rot = _rotate(dataset, eular_angle, translation, 0.04, -0.3, 0.05)
+    bbox, rendered = dataset.get_box_and_mask(eular_angle_rot, translation_rot, vertices, triangles)
+    rendered = _paste(rendered, mask_shape)
+    assert 0 < rendered.sum() and not np.array_equal(rendered, gt_mask)
+
+    warped_masks = []
+    for rle in rles:
+        # the convex hull of a box is its corners
+        warped_bbox, warped = dataset.get_box_and_warped_mask(eular_angle_rot, translation_rot, vertices, rle, Mat)
+        np.testing.assert_allclose(warped_bbox, bbox)
+        warped = _paste(warped, mask_shape)
+        iou = (warped & rendered).sum() / float((warped | rendered).sum())
+        assert iou > 0.97
+        warped_masks.append(warped)
+    np.testing.assert_array_equal(warped_masks[0], warped_masks[1])
@@ -0,0 +1,75 @@
+import os.path as osp
+import pickle
+
+import numpy as np
+
+from mmdet.datasets.mesh_rasterizer import cropped_intersection, project_vertices, rasterize_mesh
+from mmdet.datasets.silhouette_bank import SilhouetteBank
+
+CAMERA_MATRIX = np.array([[2304.5479, 0, 1686.2379],
+                          [0, 2305.8757, 1354.9849],
+                          [0, 0, 1]], dtype=np.float32)
+BOTTOM_HALF = 1480
+
+
+class _BoxModels(object):
+
+    def __init__(self):
+        corners = np.array([[x, y, z] for x in (-1, 1) for y in (-0.7, 0.7) for z in (-2.2, 2.2)])
+        faces = np.array([[0, 1, 3], [0, 3, 2], [4, 5, 7], [4, 7, 6], [0, 1, 5], [0, 5, 4],
+                          [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 3, 7], [1, 7, 5]])
+        self.meshes = {'box': (corners, faces), 'long-box': (corners * [1, 1, 1.5], faces)}
+
+    def get_mesh(self, name):
+        return self.meshes[name]
+
+    def __iter__(self):
+        return iter(self.meshes)
+
+
+def _iou(mask_a, offset_a, mask_b, offset_b):
+    intersection = cropped_intersection(mask_a, offset_a, mask_b, offset_b)
+    return intersection / (mask_a.sum() + mask_b.sum() - intersection)
+
+
+def test_silhouette_bank(tmpdir):
+    models = _BoxModels()
+    bank_dir = str(tmpdir.join('silhouette_bank'))
+    bank = SilhouetteBank(models, bank_dir)
+    assert osp.isfile(osp.join(bank_dir, 'meta.json'))
+    assert len(bank) == 2 and 'long-box' in bank and len(bank.euler_angles) == 13 * 72 * 3
+    assert isinstance(bank.bits, np.memmap)
+
+    # a grid pose at the canonical distance gives the template itself
+    euler_angle = bank.euler_angles[5]
+    camera_matrix = np.array([[bank.focal, 0, 500], [0, bank.focal, 500], [0, 0, 1]])
+    silhouette = bank.project('box', euler_angle, [0, 0, bank.distance], camera_matrix)
+    exact = rasterize_mesh(project_vertices(models.get_mesh('box')[0], euler_angle, [0, 0, bank.distance],
+                                            camera_matrix), models.get_mesh('box')[1])
+    assert _iou(*silhouette, *exact) > 0.99
+
+    # anywhere in the bottom half the templates are turned to the ray of the car
+    rng = np.random.RandomState(0)
+    image_shape = (2710 - BOTTOM_HALF, 3384)
+    template_ious = []
+    for name in ('box', 'long-box'):
+        for _ in range(10):
+            euler_angle = [rng.uniform(0, 0.2), rng.uniform(-np.pi, np.pi), np.pi]
+            z = rng.uniform(10, 40)
+            t = [rng.uniform(-0.6, 0.6) * z, rng.uniform(0.1, 0.4) * z, z]
+            silhouette = bank.project(name, euler_angle, t, CAMERA_MATRIX, image_shape, BOTTOM_HALF)
+            vertices, triangles = models.get_mesh(name)
+            exact = rasterize_mesh(project_vertices(vertices, euler_angle, t, CAMERA_MATRIX), triangles,
+                                   image_shape, y_offset=BOTTOM_HALF)
+            template_ious.append(_iou(*silhouette, *exact))
+
+            ious = bank.ious(*exact, name, [euler_angle, euler_angle], [t, np.array(t) + [3, 0, 0]],
+                             CAMERA_MATRIX, image_shape, BOTTOM_HALF)
+            assert ious[0] == template_ious[-1] and ious[1] < ious[0]
+    assert min(template_ious) > 0.8 and np.mean(template_ious) > 0.9
+
+    # the pickled bank only carries its path and reopens the same files
+    template = bank.template('box', 5)[0]
+    bank = pickle.loads(pickle.dumps(bank))
+    assert bank.bank_dir == bank_dir
+    np.testing.assert_array_equal(bank.template('box', 5)[0], template)
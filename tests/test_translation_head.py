@@ -0,0 +1,51 @@
+import numpy as np
+import torch
+
+from mmdet.models.bbox_heads.translation_head import FCTranslationHead
+
+
+def _head(bboxes_regression, anchors):
+    head = FCTranslationHead(bboxes_regression=bboxes_regression)
+    head._register_anchor_boxes(anchors)
+    return head
+
+
+def _loop_world_coord(anchors, rois, trans_pred, iou_thresh=None):
+    # the former per RoI numpy matching
+    x1, y1, x2, y2 = anchors[:, 0], anchors[:, 1] - 1480, anchors[:, 2], anchors[:, 3] - 1480
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    xyz = anchors[:, 4:]
+    distance = np.sqrt((xyz ** 2).sum(1))
+    out = []
+    for roi, pred in zip(rois, trans_pred):
+        w = np.maximum(0, np.minimum(roi[2], x2) - np.maximum(roi[0], x1) + 1)
+        h = np.maximum(0, np.minimum(roi[3], y2) - np.maximum(roi[1], y1) + 1)
+        overlap = w * h / (area + (roi[2] - roi[0] + 1) * (roi[3] - roi[1] + 1) - w * h)
+        idx = [np.argmax(overlap)]
+        if iou_thresh is not None:
+            idx = np.union1d(idx, np.where(overlap > iou_thresh)[0])
+        world = pred.reshape(-1, 3) * distance[:, None] + xyz
+        out.append(world[idx].mean(0))
+    return np.array(out)
+
+
+def test_translation_head_anchor_matching():
+    rng = np.random.RandomState(0)
+    n_anchors, n_rois = 50, 20
+    ax1, ay1 = rng.uniform(0, 3000, n_anchors), rng.uniform(1480, 2500, n_anchors)
+    anchors = np.stack([ax1, ay1, ax1 + rng.uniform(20, 600, n_anchors), ay1 + rng.uniform(20, 300, n_anchors),
+                        rng.uniform(-20, 20, n_anchors), rng.uniform(2, 10, n_anchors),
+                        rng.uniform(5, 100, n_anchors)], axis=1).astype(np.float32)
+    rx1, ry1 = rng.uniform(0, 3000, n_rois), rng.uniform(0, 1000, n_rois)
+    rois = np.stack([rx1, ry1, rx1 + rng.uniform(20, 600, n_rois), ry1 + rng.uniform(20, 300, n_rois)],
+                    axis=1).astype(np.float32)
+    trans_pred = (rng.randn(n_rois, n_anchors * 3) * 0.1).astype(np.float32)
+
+    head = _head(dict(type='maxIoU', iou_thresh=0.1), anchors)
+    world = head.pred_to_world_coord_SSD(torch.from_numpy(trans_pred), torch.from_numpy(rois) * 2, 2., None)
+    np.testing.assert_allclose(world.numpy(), _loop_world_coord(anchors, rois, trans_pred), rtol=1e-5, atol=1e-4)
+
+    head = _head(dict(type='allIoU', iou_thresh=0.1), anchors)
+    world = head.pred_to_world_coord_SSD(torch.from_numpy(trans_pred), torch.from_numpy(rois) * 2, 2., None)
+    np.testing.assert_allclose(world.numpy(), _loop_world_coord(anchors, rois, trans_pred, 0.1), rtol=1e-5, atol=1e-4)
+    assert head.anchor_boxes.shape == (n_anchors, 4) and 'anchor_world_xyz' in head.state_dict()
@@ -0,0 +1,31 @@
+import time
+
+import pytest
+
+from mmdet.utils import worker_pool, worker_state
+
+
+def _scaled(i):
+    return worker_state()['scale'] * i
+
+
+def _slow_fail(i):
+    if i == 0:
+        raise ValueError('bad image')
+    time.sleep(0.05)
+    return i
+
+
+def test_worker_pool():
+    data = list(range(20))
+    with worker_pool(2, scale=3) as pool:
+        assert list(pool.imap(_scaled, data, chunksize=4)) == [3 * i for i in data]
+
+
+def test_worker_pool_error():
+    start = time.time()
+    with pytest.raises(ValueError, match='bad image'):
+        with worker_pool(2) as pool:
+            list(pool.imap(_slow_fail, range(200)))
+    # the queued chunks are dropped
+    assert time.time() - start < 5
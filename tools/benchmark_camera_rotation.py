@@ -0,0 +1,79 @@
+"""
+Benchmark of the image part of the training pipeline: CameraRotation +
+CropBottom + Resize as three full-frame passes versus the fused
+CameraRotationCropResize single warp, optionally with the reduced JPEG decode.
+
+    python tools/benchmark_camera_rotation.py /data/Kaggle/pku-autonomous-driving/train_images --num-samples 50
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+from scipy.spatial.transform import Rotation as R
+
+from mmdet.datasets.pipelines import Compose
+
+CAMERA_MATRIX = np.array([[2304.5479, 0, 1686.2379],
+                          [0, 2305.8757, 1354.9849],
+                          [0, 0, 1]], dtype=np.float64)
+IMG_SCALE = (1664, 576)
+BOTTOM_HALF = 1480
+
+PIPELINES = dict(
+    sequential=[
+        dict(type='LoadImageFromFile'),
+        dict(type='CameraRotation'),
+        dict(type='CropBottom', bottom_half=BOTTOM_HALF),
+        dict(type='Resize', img_scale=IMG_SCALE, keep_ratio=True),
+    ],
+    fused=[
+        dict(type='LoadImageFromFile'),
+        dict(type='CameraRotationCropResize', bottom_half=BOTTOM_HALF, img_scale=IMG_SCALE, keep_ratio=True),
+    ],
+    fused_bilinear=[
+        dict(type='LoadImageFromFile'),
+        dict(type='CameraRotationCropResize', bottom_half=BOTTOM_HALF, img_scale=IMG_SCALE, keep_ratio=True,
+             interpolation='bilinear'),
+    ],
+    fused_reduced_decode=[
+        dict(type='LoadImageFromFile', decode_scale=IMG_SCALE),
+        dict(type='CameraRotationCropResize', bottom_half=BOTTOM_HALF, img_scale=IMG_SCALE, keep_ratio=True),
+    ],
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the camera rotation augmentation')
+    parser.add_argument('img_dir', help='directory of 3384x2710 JPEG images')
+    parser.add_argument('--num-samples', type=int, default=50)
+    return parser.parse_args()
+
+
+def random_rotation(rng):
+    # the same sampling as the rotation augmentation of KagglePKUDataset
+    alpha = ((rng.random_sample() ** 0.5) * 8 - 5.65) * np.pi / 180.
+    beta = (rng.random_sample() * 50 - 25) * np.pi / 180.
+    gamma = (rng.random_sample() * 6 - 3) * np.pi / 180. + beta / 3
+    rot = R.from_euler('yxz', [-beta, alpha, gamma]).as_matrix()
+    return CAMERA_MATRIX.dot(rot).dot(np.linalg.inv(CAMERA_MATRIX))
+
+
+def main():
+    args = parse_args()
+    filenames = sorted(fn for fn in os.listdir(args.img_dir) if fn.endswith('.jpg'))[:args.num_samples]
+    rng = np.random.RandomState(0)
+    mats = [random_rotation(rng) for _ in filenames]
+
+    for name, pipeline in PIPELINES.items():
+        pipeline = Compose(pipeline)
+        start = time.time()
+        for fn, mat in zip(filenames, mats):
+            results = pipeline(dict(img_prefix=args.img_dir, img_info=dict(filename=fn), Mat=mat))
+        elapsed = time.time() - start
+        print('{:>22}: {:7.2f} samples/sec  {:7.1f} ms/sample  output {}'.format(
+            name, len(filenames) / elapsed, elapsed / len(filenames) * 1000, results['img_shape']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Micro-benchmark of the quaternion -> euler angle conversion: the scalar
+`quaternion_to_euler_angle` list comprehension used before versus the batched
+NumPy version.
+
+    python tools/benchmark_quaternion_conversion.py --num-poses 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle, quaternions_to_euler_angles
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the quaternion to euler angle conversion')
+    parser.add_argument('--num-poses', type=int, default=1000000, help='number of poses to convert')
+    parser.add_argument('--repeat', type=int, default=3, help='best of n runs')
+    return parser.parse_args()
+
+
+def timeit(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        best = min(best, time.time() - start)
+    return best
+
+
+def main():
+    args = parse_args()
+    q = np.random.normal(size=(args.num_poses, 4))
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+
+    results = dict()
+    results['scalar'] = timeit(lambda: np.array([quaternion_to_euler_angle(x) for x in q]), 1)
+    results['numpy'] = timeit(lambda: quaternions_to_euler_angles(q), args.repeat)
+
+    for name, elapsed in results.items():
+        print('{:>10}: {:8.4f} s  {:12.0f} poses/sec  {:7.1f}x'.format(
+            name, elapsed, args.num_poses / elapsed, results['scalar'] / elapsed))
+
+
+if __name__ == '__main__':
+    main()
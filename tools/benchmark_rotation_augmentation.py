@@ -0,0 +1,68 @@
+"""
+Measure the training data throughput (samples/sec) with the camera rotation
+augmentation, rendering the rotated masks from the car meshes versus warping
+the stored gt RLE masks (`rotation_mask_warp`).
+
+    python tools/benchmark_rotation_augmentation.py \
+        configs/htc/htc_hrnetv2p_w48_20e_kaggle_pku_no_semantic_translation_wudi.py --num-samples 200
+"""
+import argparse
+import time
+
+import numpy as np
+from mmcv import Config
+
+from mmdet.datasets import build_dataloader, build_dataset
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the camera rotation augmentation')
+    parser.add_argument('config', help='train config file path')
+    parser.add_argument('--num-samples', type=int, default=200, help='number of samples to time')
+    parser.add_argument('--warmup', type=int, default=10, help='number of samples skipped before timing')
+    parser.add_argument('--workers', type=int, default=None, help='override data.workers_per_gpu')
+    parser.add_argument('--ann-only', action='store_true',
+                        help='only time the annotation parsing, not the whole pipeline')
+    return parser.parse_args()
+
+
+def benchmark(cfg, rotation_mask_warp, args):
+    dataset_cfg = cfg.data.train.copy()
+    dataset_cfg['rotation_augmenation'] = True
+    dataset_cfg['rotation_mask_warp'] = rotation_mask_warp
+    dataset = build_dataset(dataset_cfg)
+    num_samples = min(args.num_samples + args.warmup, len(dataset))
+
+    np.random.seed(0)
+    if args.ann_only:
+        for i in range(args.warmup):
+            dataset.get_ann_info(i)
+        start = time.time()
+        for i in range(args.warmup, num_samples):
+            dataset.get_ann_info(i)
+    else:
+        workers = cfg.data.workers_per_gpu if args.workers is None else args.workers
+        data_loader = build_dataloader(dataset, 1, workers, dist=False, shuffle=False)
+        start = time.time()
+        for i, _ in enumerate(data_loader):
+            if i + 1 == args.warmup:
+                start = time.time()
+            if i + 1 == num_samples:
+                break
+    elapsed = time.time() - start
+    return (num_samples - args.warmup) / elapsed
+
+
+def main():
+    args = parse_args()
+    cfg = Config.fromfile(args.config)
+
+    results = {}
+    for name, warp in (('render', False), ('warp', True)):
+        results[name] = benchmark(cfg, warp, args)
+        print('{:>6}: {:.2f} samples/sec'.format(name, results[name]))
+    print('speed up: {:.2f}x'.format(results['warp'] / results['render']))
+
+
+if __name__ == '__main__':
+    main()
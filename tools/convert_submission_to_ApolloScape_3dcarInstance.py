@@ -6,7 +6,7 @@ from tqdm import tqdm
 import mmcv
 
 
-from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle
+from mmdet.datasets.kaggle_pku_utils import quaternions_to_euler_angles
 
 CAR_IDX = 2
 unique_car_mode = [2, 6, 7, 8, 9, 12, 14, 16, 18,
@@ -41,7 +41,7 @@ def write_pose_to_json(out_pkl, output_dir, thresh=0.1, ignored_mask_binary=None
         quaternion_pred = six_dof['quaternion_pred']
         trans_pred_world = six_dof['trans_pred_world']
         car_labels = np.argmax(car_cls_score_pred, axis=1)
-        euler_angles = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+        euler_angles = quaternions_to_euler_angles(quaternion_pred)
         car_list = []
         if boxes is None or boxes.shape[0] == 0 or max(boxes[:, -1]) < thresh:
             with open(json_file, 'w') as outfile:
@@ -8,12 +8,13 @@ import torch.nn as nn
 import numpy as np
 from skimage.io import imsave
 import tqdm
-import pycocotools.mask as maskUtils
 import neural_renderer as nr
 
-from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle, euler_to_Rot, rot2eul
+from mmdet.datasets.kaggle_pku_utils import quaternions_to_euler_angles, euler_to_Rot, rot2eul, \
+    euler_angles_to_quaternions, quaternions_upper_hemisphere
 
 from mmdet.datasets.car_models import car_id2name
+from mmdet.core.mask.rle import decode_segm
 from mmdet.utils import RotationDistance, TranslationDistance
 import imageio
 import glob
@@ -38,11 +39,14 @@ class Model(nn.Module):
                  camera_matrix,
                  image_size,
                  iou_threshold=0.9,
-                 fix_rot=False):
+                 fix_rot=False,
+                 backend='cuda'):
         super(Model, self).__init__()
+        # backend='cpu' renders with the PyTorch rasterizer of neural_renderer
+        device = 'cpu' if backend == 'cpu' else 'cuda'
 
-        vertices = torch.from_numpy(vertices.astype(np.float32)).cuda()
-        faces = torch.from_numpy(faces.astype(np.int32)).cuda()
+        vertices = torch.from_numpy(vertices.astype(np.float32)).to(device)
+        faces = torch.from_numpy(faces.astype(np.int32)).to(device)
 
         self.register_buffer('vertices', vertices[None, :, :])
         self.register_buffer('faces', faces[None, :, :])
@@ -66,20 +70,22 @@ class Model(nn.Module):
         self.register_buffer('K', torch.from_numpy(camera_matrix))
         # setup renderer
         if fix_rot:
-            R = torch.from_numpy(np.array(Rotation_Matrix[None, :], dtype=np.float32)).cuda()
+            R = torch.from_numpy(np.array(Rotation_Matrix[None, :], dtype=np.float32)).to(device)
             self.register_buffer('R', R)
 
             renderer = nr.Renderer(image_size=image_size,
                                    orig_size=image_size,
                                    camera_mode='projection',
                                    K=camera_matrix[None, :, :],
-                                   R=R)
+                                   R=R,
+                                   backend=backend)
 
         if not fix_rot:
             renderer = nr.Renderer(image_size=image_size,
                                    orig_size=image_size,
                                    camera_mode='projection',
-                                   K=camera_matrix[None, :, :])
+                                   K=camera_matrix[None, :, :],
+                                   backend=backend)
             renderer.R = nn.Parameter(torch.from_numpy(np.array(Rotation_Matrix[None, :], dtype=np.float32)))
         renderer.t = nn.Parameter(torch.from_numpy(np.array(T[None, :], dtype=np.float32)))
         self.renderer = renderer
@@ -118,6 +124,7 @@ def get_updated_RT(vertices,
                    lr=0.05,
                    fix_rot=False,
                    debug=True,
+                   backend='cuda',
                    ):
     model = Model(vertices,
                   faces,
@@ -129,12 +136,13 @@ def get_updated_RT(vertices,
                   image_size=image_size,
                   iou_threshold=iou_threshold,
                   fix_rot=fix_rot,
+                  backend=backend,
                   )
     if draw_flag:
         for name, param in model.named_parameters():
             if param.requires_grad:
                 print(name, param.data)
-    model.cuda()
+    model.to('cpu' if backend == 'cpu' else 'cuda')
 
     optimizer = torch.optim.Adam(model.parameters(), lr=lr)
     
@@ -189,11 +197,13 @@ def finetune_RT(outputs,
                 draw_flag=True,
                 lr=0.1,
                 tmp_save_dir='/data/Kaggle/wudi_data/tmp_output/',
-                fix_rot=False):
+                fix_rot=False,
+                backend='cuda'):
     """
     :param outputs:
     :param dataset:
     :param difference_ratio:
+    :param backend: 'cuda' or 'cpu' rasterizer of neural_renderer
     :return:
     """
     CAR_IDX = 2
@@ -207,19 +217,17 @@ def finetune_RT(outputs,
         car_labels = np.argmax(car_cls_score_pred, axis=1)
         kaggle_car_labels = [dataset.unique_car_mode[x] for x in car_labels]
         car_names = [car_id2name[x].name for x in kaggle_car_labels]
-        euler_angles = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+        euler_angles = quaternions_to_euler_angles(quaternion_pred)
 
         for car_idx in range(len(quaternion_pred)):
             # The the HTC predicted Mask which is served as the GT Mask
             segms_car = segms[CAR_IDX][car_idx]
-            mask = maskUtils.decode(segms_car)
+            mask = decode_segm(segms_car)
             mask_full_size = np.zeros((2710, 3384))
             mask_full_size[1480:, :] = mask
             # Get car mesh--> vertices and faces
             car_name = car_names[car_idx]
-            vertices = np.array(dataset.car_model_dict[car_name]['vertices'])
-            vertices[:, 1] = -vertices[:, 1]
-            faces = np.array(dataset.car_model_dict[car_name]['faces']) - 1
+            vertices, faces = dataset.car_model_dict.get_mesh(car_name)
             # Get prediction of Rotation Matrix and  Translation
             ea = 0.1593, 0.04511, -3.08948
             T = np.array([-6.1449, 20.1106, 120.369])
@@ -252,7 +260,8 @@ def finetune_RT(outputs,
                                                  draw_flag=draw_flag,
                                                  output_gif=output_gif,
                                                  lr=lr,
-                                                 fix_rot=fix_rot)
+                                                 fix_rot=fix_rot,
+                                                 backend=backend)
             if fix_rot:
                 R_update = ea  # we don't change the euler angle here
             else:
@@ -263,7 +272,9 @@ def finetune_RT(outputs,
             euler_angles[car_idx] = R_update
 
         if not fix_rot:
-            outputs_update[img_idx][2]['euler_angle'] = euler_angles
+            # the euler angles of the outputs are converted from quaternion_pred
+            outputs_update[img_idx][2]['quaternion_pred'] = quaternions_upper_hemisphere(
+                euler_angles_to_quaternions(euler_angles))
 
         if not os.path.exists(tmp_save_dir):
             os.mkdir(tmp_save_dir)
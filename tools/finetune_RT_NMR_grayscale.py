@@ -12,12 +12,13 @@ import torch
 import torch.nn as nn
 import numpy as np
 from skimage.io import imsave
-import pycocotools.mask as maskUtils
 import neural_renderer as nr
 
-from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle, euler_to_Rot, rot2eul
+from mmdet.datasets.kaggle_pku_utils import quaternions_to_euler_angles, euler_to_Rot, rot2eul, \
+    euler_angles_to_quaternions, quaternions_upper_hemisphere
 
 from mmdet.datasets.car_models import car_id2name
+from mmdet.core.mask.rle import decode_segm
 from mmdet.utils import RotationDistance, TranslationDistance
 import imageio
 
@@ -280,7 +281,7 @@ def finetune_RT(output,
     car_labels = np.argmax(car_cls_score_pred, axis=1)
     kaggle_car_labels = [dataset.unique_car_mode[x] for x in car_labels]
     car_names = [car_id2name[x].name for x in kaggle_car_labels]
-    euler_angles = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+    euler_angles = quaternions_to_euler_angles(quaternion_pred)
 
     conf = output[0][CAR_IDX][:, -1]  # output [0] is the bbox
     conf_list = conf > conf_thresh
@@ -314,12 +315,10 @@ def finetune_RT(output,
     for car_idx in range(len(quaternion_pred)):
         # The the HTC predicted Mask which is served as the GT Mask
         segms_car = segms[CAR_IDX][car_idx]
-        mask = maskUtils.decode(segms_car)
+        mask = decode_segm(segms_car)
         # Get car mesh--> vertices and faces
         car_name = car_names[car_idx]
-        vertices = np.array(dataset.car_model_dict[car_name]['vertices'])
-        vertices[:, 1] = -vertices[:, 1]
-        faces = np.array(dataset.car_model_dict[car_name]['faces']) - 1
+        vertices, faces = dataset.car_model_dict.get_mesh(car_name)
         # Get prediction of Rotation Matrix and  Translation
         ea = euler_angles[car_idx]
         yaw, pitch, roll = ea[0], ea[1], ea[2]
@@ -413,7 +412,9 @@ def finetune_RT(output,
             euler_angles[i] = R_update
 
         if not fix_rot:
-            outputs_update[0][2]['euler_angle'] = euler_angles
+            # the euler angles of the outputs are converted from quaternion_pred
+            outputs_update[0][2]['quaternion_pred'] = quaternions_upper_hemisphere(
+                euler_angles_to_quaternions(euler_angles))
 
         if not os.path.exists(tmp_save_dir):
             os.mkdir(tmp_save_dir)
@@ -11,13 +11,15 @@ import torch.nn as nn
 import numpy as np
 from skimage.io import imsave
 import tqdm
-import pycocotools.mask as maskUtils
+import cv2
 from scipy.spatial.transform import Rotation as R
 import neural_renderer as nr
 
-from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle, euler_to_Rot, rot2eul
+from mmdet.datasets.kaggle_pku_utils import quaternions_to_euler_angles, euler_to_Rot, rot2eul, \
+    euler_angles_to_quaternions, quaternions_upper_hemisphere
 
 from mmdet.datasets.car_models import car_id2name
+from mmdet.core.mask.rle import decode_segm
 from mmdet.utils import RotationDistance, TranslationDistance
 import imageio
 import glob
@@ -31,6 +33,55 @@ def make_gif(filename):
     writer.close()
 
 
+def get_roi_windows(bboxes, image_size, margin=0.2, min_size=16):
+    """
+    Windows (x0, y0, x1, y1) around the predicted bboxes of the cars, grown by margin times the bbox size
+    on each side and clipped to the image
+    :param bboxes: [n, 4] x1, y1, x2, y2 in the coordinates of the rendered image
+    :param image_size: (width, height) of the rendered image
+    :return: [n, 4] int windows
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float32)[:, :4]
+    w = np.maximum(bboxes[:, 2] - bboxes[:, 0], min_size) * (1 + 2 * margin)
+    h = np.maximum(bboxes[:, 3] - bboxes[:, 1], min_size) * (1 + 2 * margin)
+    cx = (bboxes[:, 0] + bboxes[:, 2]) / 2
+    cy = (bboxes[:, 1] + bboxes[:, 3]) / 2
+    x0 = np.clip(np.floor(cx - w / 2), 0, image_size[0] - 1)
+    y0 = np.clip(np.floor(cy - h / 2), 0, image_size[1] - 1)
+    x1 = np.clip(np.ceil(cx + w / 2), x0 + 1, image_size[0])
+    y1 = np.clip(np.ceil(cy + h / 2), y0 + 1, image_size[1])
+    return np.stack([x0, y0, x1, y1], axis=1).astype(np.int64)
+
+
+def get_roi_camera_matrix(camera_matrix, windows, roi_size):
+    """
+    Camera matrices rendering the windows only, at roi_size (width, height) pixels:
+    the principal point is shifted to the window origin and the focal lengths are scaled to the roi resolution
+    :return: [n, 3, 3] camera matrices, one per window
+    """
+    K = np.repeat(camera_matrix[None].astype(np.float32), len(windows), axis=0)
+    scale_x = roi_size[0] / (windows[:, 2] - windows[:, 0]).astype(np.float32)
+    scale_y = roi_size[1] / (windows[:, 3] - windows[:, 1]).astype(np.float32)
+    K[:, 0, 2] -= windows[:, 0]
+    K[:, 1, 2] -= windows[:, 1]
+    K[:, 0] *= scale_x[:, None]
+    K[:, 1] *= scale_y[:, None]
+    return K
+
+
+def crop_roi_windows(images, windows, roi_size):
+    """
+    Crops the windows resized to roi_size (width, height), from images [n, height, width] (one per window)
+    or from an image [height, width] shared by all the windows
+    :return: [n, roi height, roi width] float32 crops
+    """
+    crops = np.zeros((len(windows), roi_size[1], roi_size[0]), dtype=np.float32)
+    for i, (x0, y0, x1, y1) in enumerate(windows):
+        image = images if images.ndim == 2 else images[i]
+        crops[i] = cv2.resize(image[y0:y1, x0:x1].astype(np.float32), tuple(roi_size), interpolation=cv2.INTER_AREA)
+    return crops
+
+
 class Model(nn.Module):
     def __init__(self,
                  vertices,
@@ -70,7 +121,12 @@ class Model(nn.Module):
 
         # we set the loss threshold to stop perturbation
         self.mask_full_size = mask_full_size
-        self.mask_sum = self.mask_full_size.sum()
+        # with one reference window per car, the cars are compared to their own window
+        self.roi_window = masked_grayscale_img.ndim == 3
+        if self.roi_window:
+            self.mask_sum = self.mask_full_size.reshape(len(mask_full_size), -1).sum(1)
+        else:
+            self.mask_sum = self.mask_full_size.sum()
         self.loss_thresh = loss_thresh
 
         image_ref = torch.from_numpy(mask_full_size.astype(np.float32))
@@ -81,11 +137,11 @@ class Model(nn.Module):
         # camera parameters
         self.register_buffer('K', torch.from_numpy(camera_matrix))
 
-        # initialise the renderer
+        # initialise the renderer, camera_matrix is [n, 3, 3] for one window per car
         renderer = nr.Renderer(image_size=image_size,
                                orig_size=image_size,
                                camera_mode='projection',
-                               K=camera_matrix[None, :, :])
+                               K=camera_matrix if camera_matrix.ndim == 3 else camera_matrix[None, :, :])
 
         if fix_rot:
             R = torch.from_numpy(np.array(Rotation_Matrix, dtype=np.float32)).cuda()
@@ -118,6 +174,12 @@ class Model(nn.Module):
     def forward(self):
         image_rgb = self.renderer(self.vertices, self.faces, self.textures, mode='rgb')
         #print("Rendered RGB max: %.4f" % torch.max(image_rgb))
+        if self.roi_window:
+            # one loss per car window
+            image_gray = image_rgb.sum(dim=1)
+            image_gray = image_gray / image_gray.flatten(1).max(1)[0].clamp(min=1e-6)[:, None, None]
+            loss = torch.sum((image_gray - self.masked_grayscale_img) ** 2, dim=(1, 2))
+            return loss, image_rgb
         image_gray = image_rgb.sum(dim=0).sum(dim=0)
         image_gray = image_gray /image_gray.max()
         loss = torch.sum((image_gray - self.masked_grayscale_img) ** 2)
@@ -174,12 +236,14 @@ def get_updated_lighting(vertices,
     for i in range(num_epochs):
         optimizer.zero_grad()
         loss, image_rgb = model()
+        # the windows of the cars share the lighting
+        loss = loss.sum()
         loss.backward()
         optimizer.step()
         if draw_flag:  # We don't save the images
             image = image_rgb.detach().cpu().numpy()
             imsave('/tmp/_tmp_%04d.png' % i, image.sum(0).sum(0))  ### we print some updates
-            print('Optimizing (loss %.4f)' % (loss.data / model.mask_sum))
+            print('Optimizing (loss %.4f)' % (loss.data / model.mask_sum.sum()))
             # renderer.light_intensity_directional = 0.5
             # renderer.light_intensity_ambient = 0.5
             # renderer.light_direction = [0, -1, 0]
@@ -189,7 +253,7 @@ def get_updated_lighting(vertices,
             print('light_intensity_directional: %.3f, light_intensity_ambient: %.3f, light_direction: %s.'
                   % (light_intensity_directional, light_intensity_ambient, light_direction))
 
-        if loss.item() / model.mask_sum < model.loss_thresh:
+        if loss.item() / model.mask_sum.sum() < model.loss_thresh:
             break
 
     light_intensity_directional = model.renderer.light_intensity_directional.detach().cpu().numpy()
@@ -249,10 +313,17 @@ def get_updated_RT(vertices,
     # optimizer_trans = torch.optim.Adam(model.renderer.t, lr=lr)
     # optimizer_eular_angle = torch.optim.Adam(model.renderer.R, lr=lr*lr_angle_ratio)
 
+    # the cars are refined together, a car stops being updated once its loss is under the threshold
+    num_cars = len(T)
+    converged = np.zeros(num_cars, dtype=bool)
+    updated_translation = np.zeros((num_cars, 3), dtype=np.float32)
+    updated_rot_matrix = np.zeros((num_cars, 3, 3), dtype=np.float32)
     for i in range(num_epochs):
         optimizer.zero_grad()
         loss, image = model()
-        loss.backward()
+        # one loss per car window, or the loss of the whole image for every car
+        loss = loss.reshape(-1).expand(num_cars)
+        loss[torch.from_numpy(~converged).to(loss.device)].sum().backward()
         optimizer.step()
         if draw_flag:  # We don't save the images
             image = image.detach().cpu().numpy()[0].transpose(1, 2, 0)
@@ -265,29 +336,37 @@ def get_updated_RT(vertices,
                 imwrite(image_ref * 255, '/data/Kaggle/wudi_data/NMR_images/ref.jpg')
                 imwrite(image * 255, '/data/Kaggle/wudi_data/NMR_images/r1.jpg')
 
-            print('Optimizing (loss %.4f)' % (loss.data / model.mask_sum))
-            updated_translation = model.renderer.t.detach().cpu().numpy()[0]
-            original_translation = model.translation_original
-            changed_dis = TranslationDistance(original_translation, updated_translation, abs_dist=False)
+            print('Optimizing (loss %.4f)' % (loss.data.sum() / model.mask_sum.sum()))
+            translation = model.renderer.t.detach().cpu().numpy()[0]
+            original_translation = model.translation_original[0]
+            changed_dis = TranslationDistance(original_translation, translation, abs_dist=False)
             print('Origin translation: %s - > updated tranlsation: %s. Changed distance: %.4f' % (
-                np.array2string(np.array(original_translation)), np.array2string(updated_translation), changed_dis))
+                np.array2string(np.array(original_translation)), np.array2string(translation), changed_dis))
             if not fix_rot:
-                updated_rot_matrix = model.renderer.R.detach().cpu().numpy()[0]
-                updated_euler_angle = rot2eul(updated_rot_matrix, model.euler_original)
-                changed_rot = RotationDistance(model.euler_original, updated_euler_angle)
+                rot_matrix = model.renderer.R.detach().cpu().numpy()[0]
+                updated_euler_angle = rot2eul(rot_matrix, model.euler_original[0])
+                changed_rot = RotationDistance(model.euler_original[0], updated_euler_angle)
                 print('Origin eular angle: %s - > updated eular angle: %s. Changed rot: %.4f'
-                      % (np.array2string(np.array(model.euler_original)), np.array2string(updated_euler_angle),
+                      % (np.array2string(np.array(model.euler_original[0])), np.array2string(updated_euler_angle),
                          changed_rot))
 
-        if loss.item() / model.mask_sum < model.loss_thresh:
+        translation = model.renderer.t.detach().cpu().numpy()
+        rot_matrix = model.renderer.R.detach().cpu().numpy()
+        newly_converged = ~converged & (loss.detach().cpu().numpy() / model.mask_sum < model.loss_thresh)
+        updated_translation[newly_converged] = translation[newly_converged]
+        updated_rot_matrix[newly_converged] = rot_matrix[newly_converged]
+        converged |= newly_converged
+        if converged.all():
             break
 
-    updated_translation = model.renderer.t.detach().cpu().numpy()[0]
-    updated_rot_matrix = model.renderer.R.detach().cpu().numpy()[0]
+    updated_translation[~converged] = translation[~converged]
+    updated_rot_matrix[~converged] = rot_matrix[~converged]
     if draw_flag:
         make_gif(output_gif)
 
-    return updated_translation, rot2eul(updated_rot_matrix, model.euler_original)
+    updated_euler_angle = np.stack([rot2eul(rot_matrix, euler_original)
+                                    for rot_matrix, euler_original in zip(updated_rot_matrix, model.euler_original)])
+    return updated_translation, updated_euler_angle
 
 
 def finetune_RT(output,
@@ -301,7 +380,10 @@ def finetune_RT(output,
                 conf_thresh=0.8,
                 tmp_save_dir='/data/Kaggle/wudi_data/tmp_output/',
                 fix_rot=True,
-                num_car_for_light_rendering=2):
+                num_car_for_light_rendering=2,
+                roi_window=True,
+                roi_size=(256, 256),
+                roi_margin=0.2):
     """
     We first get the lighting parameters: using 2 cars gray scale,
     then use grayscale loss and IoU loss to update T, and R(optional)
@@ -324,6 +406,10 @@ def finetune_RT(output,
                                         for P100, we could use 3.
                                         We use the closest (smallest z) for rendering
                                         because the closer, the bigger car and more grayscale information.
+    :param roi_window: render and compare every car in a window around its predicted bbox only,
+                        all the cars in one renderer call, instead of the whole bottom half one car at a time
+    :param roi_size: (width, height) the windows are rendered at
+    :param roi_margin: margin around the bbox in the window, as a ratio of the bbox size
     :return: the modified outputs
     """
     CAR_IDX = 2
@@ -339,7 +425,7 @@ def finetune_RT(output,
     car_labels = np.argmax(car_cls_score_pred, axis=1)
     kaggle_car_labels = [dataset.unique_car_mode[x] for x in car_labels]
     car_names = [car_id2name[x].name for x in kaggle_car_labels]
-    euler_angles = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+    euler_angles = quaternions_to_euler_angles(quaternion_pred)
 
     conf = output[0][CAR_IDX][:, -1]  # output [0] is the bbox
     conf_list = conf > conf_thresh
@@ -373,12 +459,10 @@ def finetune_RT(output,
     for car_idx in range(len(quaternion_pred)):
         # The the HTC predicted Mask which is served as the GT Mask
         segms_car = segms[CAR_IDX][car_idx]
-        mask = maskUtils.decode(segms_car)
+        mask = decode_segm(segms_car)
         # Get car mesh--> vertices and faces
         car_name = car_names[car_idx]
-        vertices = np.array(dataset.car_model_dict[car_name]['vertices'])
-        vertices[:, 1] = -vertices[:, 1]
-        faces = np.array(dataset.car_model_dict[car_name]['faces']) - 1
+        vertices, faces = dataset.car_model_dict.get_mesh(car_name)
         # Get prediction of Rotation Matrix and  Translation
         ea = euler_angles[car_idx]
         yaw, pitch, roll = ea[0], ea[1], ea[2]
@@ -412,6 +496,73 @@ def finetune_RT(output,
     if draw_flag:
         output_gif = tmp_save_dir + '/' + output[2]['file_name'].split('/')[-1][:-4] + '.gif'
 
+    if roi_window:
+        image_size = (3384, 2710 - 1480)
+        windows = get_roi_windows(bboxes[CAR_IDX][:, :4], image_size, roi_margin)
+        camera_matrix_roi = get_roi_camera_matrix(camera_matrix, windows, roi_size)
+        mask_roi = crop_roi_windows(mask_img, windows, roi_size)
+        grayscale_roi = crop_roi_windows(grayscale_image[1480:, :], windows, roi_size) * mask_roi
+        # the lighting compares the grayscale normalized in every window
+        grayscale_max = grayscale_roi.reshape(len(windows), -1).max(1).clip(1e-6)
+        grayscale_roi_light = grayscale_roi / grayscale_max[:, None, None]
+
+        # the cars under conf_thresh are not refined
+        if conf_list.any():
+            light_intensity_directional, light_intensity_ambient, light_direction = get_updated_lighting(
+                vertices=vertices_img_all[idx_conf],
+                faces=faces_img_all[idx_conf],
+                Rotation_Matrix=Rotation_Matrix_img[idx_conf],
+                T=T_img[idx_conf],
+                euler_angle=euler_angles_img[idx_conf],
+                mask_full_size=mask_roi[idx_conf],
+                masked_grayscale_img=grayscale_roi_light[idx_conf],
+                camera_matrix=camera_matrix_roi[idx_conf],
+                image_size=roi_size,
+                loss_thresh=loss_grayscale_light,
+                num_epochs=num_epochs,
+                draw_flag=draw_flag,
+                output_gif=output_gif,
+                lr=lr,
+                fix_rot=True,
+                fix_trans=True,
+                fix_light_source=False)
+
+            # all the confident cars are fine tuned together
+            if draw_flag:
+                output_gif = tmp_save_dir + '/' + output[2]['file_name'].split('/')[-1][:-4] + '_RT.gif'
+            T_update, ea_update = get_updated_RT(vertices=vertices_img_all[conf_list],
+                                                 faces=faces_img_all[conf_list],
+                                                 Rotation_Matrix=Rotation_Matrix_img[conf_list],
+                                                 T=T_img[conf_list],
+                                                 euler_angle=euler_angles_img[conf_list],
+                                                 mask_full_size=mask_roi[conf_list],
+                                                 masked_grayscale_img=grayscale_roi[conf_list],
+                                                 camera_matrix=camera_matrix_roi[conf_list],
+                                                 image_size=roi_size,
+                                                 loss_RT=loss_grayscale_RT,
+                                                 num_epochs=num_epochs,
+                                                 draw_flag=draw_flag,
+                                                 output_gif=output_gif,
+                                                 lr=lr,
+                                                 fix_rot=fix_rot,
+                                                 light_intensity_directional=light_intensity_directional,
+                                                 light_intensity_ambient=light_intensity_ambient,
+                                                 light_direction=light_direction)
+            for i, car_idx in enumerate(np.where(conf_list)[0]):
+                outputs_update[0][2]['trans_pred_world'][car_idx] = T_update[i]
+                if not fix_rot:
+                    euler_angles[car_idx] = -ea_update[i][1], -ea_update[i][0], -ea_update[i][2]
+        if not fix_rot:
+            # the euler angles of the outputs are converted from quaternion_pred
+            outputs_update[0][2]['quaternion_pred'] = quaternions_upper_hemisphere(
+                euler_angles_to_quaternions(euler_angles))
+
+        if not os.path.exists(tmp_save_dir):
+            os.mkdir(tmp_save_dir)
+        output_name = tmp_save_dir + '/' + output[2]['file_name'].split('/')[-1][:-4] + '.pkl'
+        mmcv.dump(outputs_update[0], output_name)
+        return
+
     light_intensity_directional, light_intensity_ambient, light_direction = get_updated_lighting(
         vertices=vertices_img_all[idx_conf],
         faces=faces_img_all[idx_conf],
@@ -443,7 +594,7 @@ def finetune_RT(output,
                                   faces=faces_img_all[None, i],
                                   Rotation_Matrix=Rotation_Matrix_img[None, i],
                                   T=T_img[None, i],
-                                  euler_angle=euler_angles_img[i],
+                                  euler_angle=euler_angles_img[None, i],
                                   mask_full_size=mask_img[None, i],
                                   masked_grayscale_img=masked_grayscale_car,
                                   camera_matrix=camera_matrix,
@@ -463,14 +614,16 @@ def finetune_RT(output,
                 R_update = -euler_angles_img[i][1], -euler_angles_img[i][0], -euler_angles_img[i][2]
             else:
                 # We need to reverse here
-                R_update = -ea_update[1], -ea_update[0], -ea_update[2]
+                R_update = -ea_update[0][1], -ea_update[0][0], -ea_update[0][2]
 
             # outputs_update is a list of length 0
-            outputs_update[0][2]['trans_pred_world'][i] = T_update
+            outputs_update[0][2]['trans_pred_world'][i] = T_update[0]
             euler_angles[i] = R_update
 
         if not fix_rot:
-            outputs_update[0][2]['euler_angle'] = euler_angles
+            # the euler angles of the outputs are converted from quaternion_pred
+            outputs_update[0][2]['quaternion_pred'] = quaternions_upper_hemisphere(
+                euler_angles_to_quaternions(euler_angles))
 
         if not os.path.exists(tmp_save_dir):
             os.mkdir(tmp_save_dir)
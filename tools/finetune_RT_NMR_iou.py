@@ -2,6 +2,7 @@
 Finding camera parameters R, T
 Image per batch --> this is not likely to work!!!
 """
+import collections
 import mmcv
 from mmcv import imwrite, imread
 from skimage import color
@@ -12,15 +13,17 @@ import torch
 import torch.nn as nn
 import numpy as np
 from skimage.io import imsave
-import pycocotools.mask as maskUtils
 import cv2
 import neural_renderer as nr
 
-from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle, euler_to_Rot, rot2eul
+from mmdet.datasets.kaggle_pku_utils import quaternions_to_euler_angles, euler_to_Rot, rot2eul, \
+    euler_angles_to_quaternions, quaternions_upper_hemisphere
 
 from mmdet.datasets.car_models import car_id2name
+from mmdet.core.mask.rle import decode_segm
 from mmdet.utils import RotationDistance, TranslationDistance
 import imageio
+from finetune_RT_NMR_img import get_roi_windows, get_roi_camera_matrix, crop_roi_windows
 
 
 def make_gif(filename, dir_tmp, remove_png=False):
@@ -73,6 +76,8 @@ class Model(nn.Module):
         self.mask_full_size = mask_full_size
         self.mask_sum = self.mask_full_size.sum()
         self.loss_thresh = -loss_thresh
+        # with one reference window per car, the cars are compared to their own window
+        self.roi_window = masked_grayscale_img.ndim == 3
 
         image_ref = torch.from_numpy(mask_full_size.astype(np.float32))
         self.register_buffer('image_ref', image_ref)
@@ -82,11 +87,11 @@ class Model(nn.Module):
         # camera parameters
         self.register_buffer('K', torch.from_numpy(camera_matrix))
 
-        # initialise the renderer
+        # initialise the renderer, camera_matrix is [n, 3, 3] for one window per car
         renderer = nr.Renderer(image_size=image_size,
                                orig_size=image_size,
                                camera_mode='projection',
-                               K=camera_matrix[None, :, :])
+                               K=camera_matrix if camera_matrix.ndim == 3 else camera_matrix[None, :, :])
 
         if fix_rot:
             R = torch.from_numpy(np.array(Rotation_Matrix, dtype=np.float32)).cuda()
@@ -119,6 +124,11 @@ class Model(nn.Module):
     def forward(self):
         image_rgb = self.renderer(self.vertices, self.faces, self.textures, mode='rgb')
         image = self.renderer(self.vertices, self.faces, mode='silhouettes')
+        if self.roi_window:
+            # one IoU per car window
+            interception = torch.sum(torch.abs(image * self.image_ref), dim=(1, 2))
+            union = torch.sum(image, dim=(1, 2)) + torch.sum(self.image_ref, dim=(1, 2)) - interception
+            return - interception / union, image_rgb
         interception = torch.sum(torch.abs(image * self.image_ref[None, :, :]))
         union = torch.sum(image) + torch.sum(self.image_ref) - interception
         loss = - interception / union
@@ -186,30 +196,40 @@ def get_updated_RT(vertices,
             shutil.rmtree(output_gif[:-4])
             os.mkdir(output_gif[:-4])
 
-    # We only keep the best max IoU Result
-    max_iou = -1
+    # We only keep the best max IoU Result, of every car
+    num_cars = len(T)
+    max_iou = np.full(num_cars, -1.)
+    best_translation = np.zeros((num_cars, 3), dtype=np.float32)
+    best_rot_matrix = np.zeros((num_cars, 3, 3), dtype=np.float32)
 
     for i in range(num_epochs):
         optimizer.zero_grad()
         loss, image = model()
-        loss.backward()
+        # one loss per car window, or the loss of the whole image for every car
+        loss = loss.reshape(-1).expand(num_cars)
+        loss.sum().backward()
         optimizer.step()
 
-        if -loss.item() > max_iou:
-            best_translation = model.renderer.t.detach().cpu().numpy()[0]
-            best_rot_matrix = model.renderer.R.detach().cpu().numpy()[0]
-            max_iou = -loss.item()
+        iou = -loss.detach().cpu().numpy()
+        better = iou > max_iou
+        best_translation[better] = model.renderer.t.detach().cpu().numpy()[better]
+        best_rot_matrix[better] = model.renderer.R.detach().cpu().numpy()[better]
+        max_iou[better] = iou[better]
 
         if draw_flag:  # We don't save the images
             image = image.detach().cpu().numpy()[0].transpose(1, 2, 0)
             image = image / image.max()
             image[:, :, 1] += model.image_ref.detach().cpu().numpy()[0] * 0.5
-            image_all = np.zeros((2710, 3384, 3))
-            image_all[1480:, :, :] = image
-            image_all *= 255
-            label_text = loss.detach().cpu().numpy()
-            image_all = cv2.putText(image_all, '%.3f' % -label_text, (500, 500), cv2.FONT_HERSHEY_SIMPLEX, fontScale=15,
-                                    color=(255,255,255), thickness=20)
+            label_text = loss[0].detach().cpu().numpy()
+            if model.roi_window:
+                image_all = cv2.putText(image * 255, '%.3f' % -label_text, (5, 20), cv2.FONT_HERSHEY_SIMPLEX,
+                                        fontScale=0.5, color=(255, 255, 255), thickness=1)
+            else:
+                image_all = np.zeros((2710, 3384, 3))
+                image_all[1480:, :, :] = image
+                image_all *= 255
+                image_all = cv2.putText(image_all, '%.3f' % -label_text, (500, 500), cv2.FONT_HERSHEY_SIMPLEX,
+                                        fontScale=15, color=(255,255,255), thickness=20)
 
             imsave(os.path.join(output_gif[:-4], '_tmp_%04d.png' % i), image_all)
             ### we print some updates
@@ -218,27 +238,29 @@ def get_updated_RT(vertices,
                 imwrite(image_ref * 255, '/data/Kaggle/wudi_data/NMR_images/ref.jpg')
                 imwrite(image * 255, '/data/Kaggle/wudi_data/NMR_images/r1.jpg')
 
-            print('Optimizing (loss %.4f)' % loss.data)
+            print('Optimizing (loss %.4f)' % loss.data[0])
             updated_translation = model.renderer.t.detach().cpu().numpy()[0]
-            original_translation = model.translation_original
+            original_translation = model.translation_original[0]
             changed_dis = TranslationDistance(original_translation, updated_translation, abs_dist=False)
             print('Origin translation: %s - > updated tranlsation: %s. Changed distance: %.4f' % (
                 np.array2string(np.array(original_translation)), np.array2string(updated_translation), changed_dis))
             if not fix_rot:
                 rot_matrix = model.renderer.R.detach().cpu().numpy()[0]
-                updated_euler_angle = rot2eul(rot_matrix, model.euler_original)
-                changed_rot = RotationDistance(model.euler_original, updated_euler_angle)
+                updated_euler_angle = rot2eul(rot_matrix, model.euler_original[0])
+                changed_rot = RotationDistance(model.euler_original[0], updated_euler_angle)
                 print('Origin eular angle: %s - > updated eular angle: %s. Changed rot: %.4f'
-                      % (np.array2string(np.array(model.euler_original)), np.array2string(updated_euler_angle),
+                      % (np.array2string(np.array(model.euler_original[0])), np.array2string(updated_euler_angle),
                          changed_rot))
 
-        if loss.item() < model.loss_thresh:
+        if (loss < model.loss_thresh).all():
             break
 
     if draw_flag:
         make_gif(output_gif, output_gif[:-4])
 
-    return best_translation, rot2eul(best_rot_matrix, model.euler_original)
+    best_euler_angle = np.stack([rot2eul(rot_matrix, euler_original)
+                                 for rot_matrix, euler_original in zip(best_rot_matrix, model.euler_original)])
+    return best_translation, best_euler_angle
 
 
 def finetune_RT(output,
@@ -252,7 +274,10 @@ def finetune_RT(output,
                 conf_thresh=0.8,
                 tmp_save_dir='/data/Kaggle/wudi_data/tmp_output/',
                 fix_rot=True,
-                num_car_for_light_rendering=2):
+                num_car_for_light_rendering=2,
+                roi_window=True,
+                roi_size=(256, 256),
+                roi_margin=0.2):
     """
     We first get the lighting parameters: using 2 cars gray scale,
     then use grayscale loss and IoU loss to update T, and R(optional)
@@ -275,6 +300,10 @@ def finetune_RT(output,
                                         for P100, we could use 3.
                                         We use the closest (smallest z) for rendering
                                         because the closer, the bigger car and more grayscale information.
+    :param roi_window: render and compare every car in a window around its predicted bbox only,
+                        all the cars in one renderer call, instead of the whole bottom half one car at a time
+    :param roi_size: (width, height) the windows are rendered at
+    :param roi_margin: margin around the bbox in the window, as a ratio of the bbox size
     :return: the modified outputs
     """
     CAR_IDX = 2
@@ -290,7 +319,7 @@ def finetune_RT(output,
     car_labels = np.argmax(car_cls_score_pred, axis=1)
     kaggle_car_labels = [dataset.unique_car_mode[x] for x in car_labels]
     car_names = [car_id2name[x].name for x in kaggle_car_labels]
-    euler_angles = np.array([quaternion_to_euler_angle(x) for x in quaternion_pred])
+    euler_angles = quaternions_to_euler_angles(quaternion_pred)
 
     conf = output[0][CAR_IDX][:, -1]  # output [0] is the bbox
     conf_list = conf > conf_thresh
@@ -324,12 +353,10 @@ def finetune_RT(output,
     for car_idx in range(len(quaternion_pred)):
         # The the HTC predicted Mask which is served as the GT Mask
         segms_car = segms[CAR_IDX][car_idx]
-        mask = maskUtils.decode(segms_car)
+        mask = decode_segm(segms_car)
         # Get car mesh--> vertices and faces
         car_name = car_names[car_idx]
-        vertices = np.array(dataset.car_model_dict[car_name]['vertices'])
-        vertices[:, 1] = -vertices[:, 1]
-        faces = np.array(dataset.car_model_dict[car_name]['faces']) - 1
+        vertices, faces = dataset.car_model_dict.get_mesh(car_name)
         # Get prediction of Rotation Matrix and  Translation
         ea = euler_angles[car_idx]
         yaw, pitch, roll = ea[0], ea[1], ea[2]
@@ -363,6 +390,44 @@ def finetune_RT(output,
     if draw_flag:
         output_gif = tmp_save_dir + '/' + output[2]['file_name'].split('/')[-1][:-4] + '.gif'
 
+    if roi_window:
+        windows = get_roi_windows(bboxes[CAR_IDX][:, :4], (3384, 2710 - 1480), roi_margin)
+        camera_matrix_roi = get_roi_camera_matrix(camera_matrix, windows, roi_size)
+        mask_roi = crop_roi_windows(mask_img, windows, roi_size)
+        grayscale_roi = crop_roi_windows(grayscale_image[1480:, :], windows, roi_size) * mask_roi
+
+        # all the confident cars are fine tuned together
+        if conf_list.any():
+            T_update, ea_update = get_updated_RT(vertices=vertices_img_all[conf_list],
+                                                 faces=faces_img_all[conf_list],
+                                                 Rotation_Matrix=Rotation_Matrix_img[conf_list],
+                                                 T=T_img[conf_list],
+                                                 euler_angle=euler_angles_img[conf_list],
+                                                 mask_full_size=mask_roi[conf_list],
+                                                 masked_grayscale_img=grayscale_roi[conf_list],
+                                                 camera_matrix=camera_matrix_roi[conf_list],
+                                                 image_size=roi_size,
+                                                 loss_RT=loss_IoU,
+                                                 num_epochs=num_epochs,
+                                                 draw_flag=draw_flag,
+                                                 output_gif=output_gif,
+                                                 lr=lr,
+                                                 fix_rot=fix_rot)
+            for i, car_idx in enumerate(np.where(conf_list)[0]):
+                outputs_update[0][2]['trans_pred_world'][car_idx] = T_update[i]
+                if not fix_rot:
+                    euler_angles[car_idx] = -ea_update[i][1], -ea_update[i][0], -ea_update[i][2]
+        if not fix_rot:
+            # the euler angles of the outputs are converted from quaternion_pred
+            outputs_update[0][2]['quaternion_pred'] = quaternions_upper_hemisphere(
+                euler_angles_to_quaternions(euler_angles))
+
+        if not os.path.exists(tmp_save_dir):
+            os.mkdir(tmp_save_dir)
+        output_name = tmp_save_dir + '/' + output[2]['file_name'].split('/')[-1][:-4] + '.pkl'
+        mmcv.dump(outputs_update[0], output_name)
+        return
+
     # Now we start to fine tune R, T
     for i, true_flag in enumerate(conf_list):
         if true_flag:
@@ -375,7 +440,7 @@ def finetune_RT(output,
                                                  faces=faces_img_all[None, i],
                                                  Rotation_Matrix=Rotation_Matrix_img[None, i],
                                                  T=T_img[None, i],
-                                                 euler_angle=euler_angles_img[i],
+                                                 euler_angle=euler_angles_img[None, i],
                                                  mask_full_size=mask_img[None, i],
                                                  masked_grayscale_img=masked_grayscale_car,
                                                  camera_matrix=camera_matrix,
@@ -392,17 +457,215 @@ def finetune_RT(output,
                 R_update = -euler_angles_img[i][1], -euler_angles_img[i][0], -euler_angles_img[i][2]
             else:
                 # We need to reverse here
-                R_update = -ea_update[1], -ea_update[0], -ea_update[2]
+                R_update = -ea_update[0][1], -ea_update[0][0], -ea_update[0][2]
 
             # outputs_update is a list of length 0
-            outputs_update[0][2]['trans_pred_world'][i] = T_update
+            outputs_update[0][2]['trans_pred_world'][i] = T_update[0]
             euler_angles[i] = R_update
 
         if not fix_rot:
-            outputs_update[0][2]['euler_angle'] = euler_angles
+            # the euler angles of the outputs are converted from quaternion_pred
+            outputs_update[0][2]['quaternion_pred'] = quaternions_upper_hemisphere(
+                euler_angles_to_quaternions(euler_angles))
 
         if not os.path.exists(tmp_save_dir):
             os.mkdir(tmp_save_dir)
         output_name = tmp_save_dir + '/' + output[2]['file_name'].split('/')[-1][:-4] + '.pkl'
         mmcv.dump(outputs_update[0], output_name)
     return
+
+
+class RefinementScheduler(object):
+    """
+    Fine tunes T, and R (optional), of the confident cars of many images with the IoU loss.
+    The cars are rendered in their RoI windows in batches of batch_size cars, one renderer call per step.
+    Every car has its own convergence: it leaves the batch when its IoU reaches loss_IoU or after num_epochs
+    steps, with its best IoU pose, and its slot is given to the next car in the queue, so the batch stays
+    full whatever the number of cars per image.
+    An image is appended to writer as soon as all its cars are done.
+    The optimizer is SGD as in get_updated_RT, it has no state to reset when a slot changes car.
+    """
+
+    def __init__(self,
+                 dataset,
+                 writer,
+                 batch_size=16,
+                 num_epochs=50,
+                 lr=0.05,
+                 loss_IoU=0.9,
+                 conf_thresh=0.8,
+                 fix_rot=True,
+                 roi_size=(256, 256),
+                 roi_margin=0.2,
+                 backend='cuda'):
+        self.dataset = dataset
+        self.writer = writer
+        self.batch_size = batch_size
+        self.num_epochs = num_epochs
+        self.lr = lr
+        self.loss_IoU = loss_IoU
+        self.conf_thresh = conf_thresh
+        self.fix_rot = fix_rot
+        self.roi_size = roi_size
+        self.roi_margin = roi_margin
+        self.device = 'cpu' if backend == 'cpu' else 'cuda'
+        self.camera_matrix = dataset.camera_matrix.copy()
+        self.camera_matrix[1, 2] -= 1480  # Because we have only bottom half
+
+        self.queue = collections.deque()
+        # idx -> [output, euler angles, number of cars not done]
+        self.images = dict()
+        self.slots = [None] * batch_size
+        self.steps = np.zeros(batch_size, dtype=np.int64)
+        self.max_iou = np.full(batch_size, -1.)
+        self.best_translation = np.zeros((batch_size, 3), dtype=np.float32)
+        self.best_rot_matrix = np.zeros((batch_size, 3, 3), dtype=np.float32)
+        self.num_steps = 0
+        self.num_cars = 0
+
+        # the meshes are padded to the largest car seen so far
+        self.vertices = torch.zeros((batch_size, 0, 3), dtype=torch.float32, device=self.device)
+        self.faces = torch.zeros((batch_size, 0, 3), dtype=torch.int32, device=self.device)
+        self.K = torch.zeros((batch_size, 3, 3), dtype=torch.float32, device=self.device)
+        self.image_ref = torch.zeros((batch_size, roi_size[1], roi_size[0]), dtype=torch.float32, device=self.device)
+        self.t = torch.zeros((batch_size, 3), dtype=torch.float32, device=self.device, requires_grad=True)
+        self.R = torch.zeros((batch_size, 3, 3), dtype=torch.float32, device=self.device, requires_grad=not fix_rot)
+        self.renderer = nr.Renderer(image_size=roi_size,
+                                    orig_size=roi_size,
+                                    camera_mode='projection',
+                                    K=np.eye(3, dtype=np.float32)[None],
+                                    backend=backend)
+
+    def add(self, output, idx):
+        """
+        Queues the confident cars of an image, the image is written as is if it has none
+        """
+        CAR_IDX = 2
+        bboxes, segms, six_dof = output[0], output[1], output[2]
+        conf_list = bboxes[CAR_IDX][:, -1] > self.conf_thresh
+        if not conf_list.any():
+            self.writer.append(output, idx)
+            return
+
+        car_labels = np.argmax(six_dof['car_cls_score_pred'], axis=1)
+        euler_angles = quaternions_to_euler_angles(six_dof['quaternion_pred'])
+        car_idxs = np.where(conf_list)[0]
+        masks = np.stack([decode_segm(segms[CAR_IDX][car_idx]) for car_idx in car_idxs])
+        windows = get_roi_windows(bboxes[CAR_IDX][car_idxs, :4], (3384, 2710 - 1480), self.roi_margin)
+        camera_matrix_roi = get_roi_camera_matrix(self.camera_matrix, windows, self.roi_size)
+        mask_roi = crop_roi_windows(masks, windows, self.roi_size)
+
+        self.images[idx] = [output, euler_angles, len(car_idxs)]
+        for i, car_idx in enumerate(car_idxs):
+            car_name = car_id2name[self.dataset.unique_car_mode[car_labels[car_idx]]].name
+            vertices, faces = self.dataset.car_model_dict.get_mesh(car_name)
+            ea = euler_angles[car_idx]
+            yaw, pitch, roll = -ea[1], -ea[0], -ea[2]
+            self.queue.append(dict(idx=idx,
+                                   car_idx=car_idx,
+                                   vertices=vertices,
+                                   faces=faces,
+                                   Rotation_Matrix=euler_to_Rot(yaw, pitch, roll).T,
+                                   T=six_dof['trans_pred_world'][car_idx],
+                                   euler_angle=np.array([yaw, pitch, roll]),
+                                   K=camera_matrix_roi[i],
+                                   mask=mask_roi[i]))
+
+    def _load(self, slot, car):
+        num_vertices, num_faces = len(car['vertices']), len(car['faces'])
+        with torch.no_grad():
+            if num_vertices > self.vertices.shape[1]:
+                padding = self.vertices.new_zeros((self.batch_size, num_vertices - self.vertices.shape[1], 3))
+                self.vertices = torch.cat([self.vertices, padding], dim=1)
+            if num_faces > self.faces.shape[1]:
+                # the faces are padded with copies of a face, which render nothing more
+                if self.faces.shape[1]:
+                    padding = self.faces[:, :1].expand(-1, num_faces - self.faces.shape[1], -1)
+                else:
+                    padding = self.faces.new_zeros((self.batch_size, num_faces, 3))
+                self.faces = torch.cat([self.faces, padding], dim=1)
+            faces = torch.from_numpy(np.ascontiguousarray(car['faces'], dtype=np.int32))
+            self.faces[slot] = torch.cat([faces, faces[:1].expand(self.faces.shape[1] - num_faces, -1)])
+            self.vertices[slot] = 0
+            self.vertices[slot, :num_vertices] = torch.from_numpy(np.asarray(car['vertices'], dtype=np.float32))
+            self.K[slot] = torch.from_numpy(car['K'])
+            self.image_ref[slot] = torch.from_numpy(car['mask'])
+            self.t[slot] = torch.from_numpy(np.asarray(car['T'], dtype=np.float32))
+            self.R[slot] = torch.from_numpy(np.asarray(car['Rotation_Matrix'], dtype=np.float32))
+        self.slots[slot] = car
+        self.steps[slot] = 0
+        self.max_iou[slot] = -1
+
+    def _finish(self, slot):
+        car = self.slots[slot]
+        self.slots[slot] = None
+        self.num_cars += 1
+        image = self.images[car['idx']]
+        output, euler_angles = image[0], image[1]
+        output[2]['trans_pred_world'][car['car_idx']] = self.best_translation[slot]
+        if not self.fix_rot:
+            ea_update = rot2eul(self.best_rot_matrix[slot], car['euler_angle'])
+            # We need to reverse here
+            euler_angles[car['car_idx']] = -ea_update[1], -ea_update[0], -ea_update[2]
+            # the euler angles of the outputs are converted from quaternion_pred
+            output[2]['quaternion_pred'][car['car_idx']] = quaternions_upper_hemisphere(
+                euler_angles_to_quaternions(euler_angles[car['car_idx']][None]))[0]
+        image[2] -= 1
+        if image[2] == 0:
+            self.writer.append(output, car['idx'])
+            del self.images[car['idx']]
+
+    def step(self):
+        """
+        One optimization step of the cars of the batch, the free slots are given to the queued cars first
+        """
+        for slot in range(self.batch_size):
+            if self.slots[slot] is None and self.queue:
+                self._load(slot, self.queue.popleft())
+        active = [slot for slot in range(self.batch_size) if self.slots[slot] is not None]
+        if not active:
+            return
+
+        image = self.renderer(self.vertices[active], self.faces[active], mode='silhouettes',
+                              K=self.K[active], R=self.R[active], t=self.t[active])
+        image_ref = self.image_ref[active]
+        interception = torch.sum(torch.abs(image * image_ref), dim=(1, 2))
+        union = torch.sum(image, dim=(1, 2)) + torch.sum(image_ref, dim=(1, 2)) - interception
+        loss = - interception / union
+
+        # the best pose of a car is the one its IoU was computed for
+        iou = -loss.detach().cpu().numpy()
+        better = iou > self.max_iou[active]
+        better_slots = np.array(active)[better]
+        self.best_translation[better_slots] = self.t.detach().cpu().numpy()[better_slots]
+        self.best_rot_matrix[better_slots] = self.R.detach().cpu().numpy()[better_slots]
+        self.max_iou[better_slots] = iou[better]
+
+        self.t.grad = None
+        self.R.grad = None
+        # the cars projected out of their RoI windows render no face and have no gradient, the step
+        # still counts for them
+        if loss.requires_grad:
+            loss.sum().backward()
+            with torch.no_grad():
+                self.t -= self.lr * self.t.grad
+                if not self.fix_rot and self.R.grad is not None:
+                    self.R -= self.lr * self.R.grad
+        self.num_steps += 1
+
+        self.steps[active] += 1
+        for slot, car_iou in zip(active, iou):
+            if car_iou > self.loss_IoU or self.steps[slot] >= self.num_epochs:
+                self._finish(slot)
+
+    def run(self, outputs):
+        """
+        Fine tunes the cars of the (idx, output) of outputs, the queue holds about one batch of cars
+        """
+        for idx, output in outputs:
+            self.add(output, idx)
+            while len(self.queue) >= self.batch_size:
+                self.step()
+        while self.queue or self.images:
+            self.step()
+        return dict(cars=self.num_cars, steps=self.num_steps)
@@ -0,0 +1,67 @@
+"""
+Load test of the inference server of interface.py: post the same image from
+several concurrent clients and report the throughput, the client side latency
+and the per-stage latency measured by the server.
+
+    python interface.py --device cpu --max-batch-size 4 --port 5003
+    python tools/load_test_interface.py test.jpg --url http://127.0.0.1:5003 \
+        --num-requests 200 --concurrency 8
+"""
+import argparse
+import base64
+import json
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test the inference server')
+    parser.add_argument('img', help='image file to upload')
+    parser.add_argument('--url', default='http://127.0.0.1:5003')
+    parser.add_argument('--num-requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=120.)
+    return parser.parse_args()
+
+
+def post(url, body, timeout):
+    start = time.time()
+    req = urllib.request.Request(url, data=body, method='POST')
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        json.loads(resp.read().decode('utf-8'))
+    return time.time() - start
+
+
+def main():
+    args = parse_args()
+    with open(args.img, 'rb') as f:
+        body = urllib.parse.urlencode(dict(file=base64.b64encode(f.read()).decode('ascii'))).encode('ascii')
+    url = args.url.rstrip('/')
+
+    # warm up
+    post(url + '/', body, args.timeout)
+
+    start = time.time()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        latencies = list(executor.map(lambda _: post(url + '/', body, args.timeout), range(args.num_requests)))
+    elapsed = time.time() - start
+
+    latencies = np.array(latencies) * 1000.
+    print('{} requests, concurrency {}: {:.2f} requests/sec'.format(
+        args.num_requests, args.concurrency, args.num_requests / elapsed))
+    print('client latency (ms): mean {:.1f}  p50 {:.1f}  p95 {:.1f}  max {:.1f}'.format(
+        latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 95), latencies.max()))
+
+    with urllib.request.urlopen(url + '/stats', timeout=args.timeout) as resp:
+        stats = json.loads(resp.read().decode('utf-8'))
+    print('mean batch size: {:.2f}'.format(stats.get('mean_batch_size', 0)))
+    for stage, s in stats['latency_ms'].items():
+        print('{:>12}: mean {:8.1f}  p50 {:8.1f}  p95 {:8.1f} ms'.format(stage, s['mean'], s['p50'], s['p95']))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,8 +7,7 @@ import shutil
 import tempfile
 import pandas as pd
 import numpy as np
-import random
-import glob
+import multiprocessing
 
 import mmcv
 import torch
@@ -20,11 +19,13 @@ from mmdet.apis import init_dist
 from mmdet.core import wrap_fp16_model
 from mmdet.datasets import build_dataloader, build_dataset
 from mmdet.models import build_detector
+from mmdet.utils import ResultStore, ResultWriter, load_results, worker_pool, worker_state
+from mmdet.utils.result_store import image_id_from_output
 
-from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle, filter_igore_masked_using_RT, filter_output
+from mmdet.datasets.mesh_iou_cache import share_iou_cache_budget
+from mmdet.datasets.kaggle_pku_utils import get_euler_angles, filter_igore_masked_using_RT, filter_outputs_pool
 from tqdm import tqdm
 from tools.evaluations.map_calculation import map_main
-from multiprocessing import Pool
 
 from finetune_RT_NMR import finetune_RT
 
@@ -152,7 +153,7 @@ def write_submission(outputs, args, dataset,
             if False:  # NMR has problem saving 'euler angle' Its
                 eular_angle = output[2]['euler_angle']
             else:
-                eular_angle = np.array([quaternion_to_euler_angle(x) for x in output[2]['quaternion_pred']])
+                eular_angle = get_euler_angles(output[2])
             translation = output[2]['trans_pred_world']
             coords = np.hstack((eular_angle[idx], translation[idx], conf[idx, None]))
 
@@ -173,10 +174,6 @@ def write_submission(outputs, args, dataset,
     return submission
 
 
-def filter_output_pool(t):
-    return filter_output(*t)
-
-
 def write_submission_pool(outputs, args, dataset,
                           conf_thresh=0.1,
                           horizontal_flip=False,
@@ -202,9 +199,7 @@ def write_submission_pool(outputs, args, dataset,
     submission += '.csv'
     predictions = {}
 
-    p = Pool(processes=max_workers)
-    for coords_str, ImageId in p.imap(filter_output_pool,
-                                      [(i, outputs, conf_thresh, img_prefix, dataset) for i in range(len(outputs))]):
+    for coords_str, ImageId in filter_outputs_pool(outputs, conf_thresh, img_prefix, dataset, max_workers):
         predictions[ImageId] = coords_str
 
     pred_dict = {'ImageId': [], 'PredictionString': []}
@@ -242,40 +237,72 @@ def parse_args():
                         help='eval types')
     parser.add_argument('--show', action='store_true', help='show results')
     parser.add_argument('--local_rank', help='show results')
-    parser.add_argument('--tmpdir', default="/data/Kaggle/wudi_data/tmp_results/", help='tmp dir for writing some results')
-    parser.add_argument('--clear', default=False, help='tmp dir for writing some results')
+    parser.add_argument('--results', nargs='+',
+                        default=['/data/Kaggle/wudi_data/test_all_cwxe99_3070100flip05resumme93Dec29-16-28-48_epoch_100_refined.pkl',
+                                 '/data/Kaggle/wudi_data/test_all_cwxe99_3070100flip05resumme93Dec29-16-28-48_epoch_100.pkl'],
+                        help='outputs of the models to merge, pickles or result stores')
+    parser.add_argument('--workers', type=int, default=None, help='number of merging processes, default to all the cpus')
     parser.add_argument('--horizontal_flip', default=False, action='store_true')
-    parser.add_argument('--vote', default=0, help='How many models need to have the same prediction, if set=0, then vote=len(outpus)')
+    parser.add_argument('--vote', type=int, default=0, help='How many models need to have the same prediction, if set=0, then vote=len(outpus)')
     args = parser.parse_args()
     if 'LOCAL_RANK' not in os.environ:
         os.environ['LOCAL_RANK'] = str(args.local_rank)
     return args
 
 
-def output_sorted(outputs):
-    j = len(outputs)
+class AlignedOutputs(object):
+    """Outputs of a model viewed in the ImageId order of the reference model,
+    a result store is only read when an image is accessed."""
 
-    new_outputs = [[] for _ in range(j)]
-    for output in outputs[0]:
-        file_name = output[2]['file_name']
-        new_outputs[0].append(output)
+    def __init__(self, outputs, index, image_ids):
+        self.outputs = outputs
+        self.positions = [index[image_id] for image_id in image_ids]
 
-        for i in range(1, j):
-            for output_i in outputs[i]:
-                if file_name == output_i[2]['file_name']:
-                    new_outputs[i].append(output_i)
-                    break
+    def __len__(self):
+        return len(self.positions)
 
-    return new_outputs
+    def __getitem__(self, i):
+        return self.outputs[self.positions[i]]
 
 
-def create_lock(file_name):
-    f = open(file_name, mode="w", encoding="utf-8")
-    f.close()
+def build_index(outputs):
+    """ImageId -> position hash index of the outputs of a model."""
+    if isinstance(outputs, ResultStore):
+        return dict(outputs.image_id2pos)
+    return {image_id_from_output(output): i for i, output in enumerate(outputs)}
 
 
-def remove_lock(file_name):
-    os.remove(file_name)
+def output_sorted(outputs):
+    """Align the outputs of several models on the ImageIds of the first one."""
+    indexes = [build_index(o) for o in outputs]
+    image_ids = list(indexes[0])
+    for i, index in enumerate(indexes[1:], 1):
+        missing = [image_id for image_id in image_ids if image_id not in index]
+        assert not missing, 'model {} has no output for {}'.format(i, missing[:5])
+    return [AlignedOutputs(o, index, image_ids) for o, index in zip(outputs, indexes)]
+
+
+def _merge_single(i):
+    state = worker_state()
+    return state['dataset'].distributed_visualise_pred_merge_postprocessing_weight_merge(
+        i, state['outputs'], state['args'], vote=state['args'].vote, tmp_dir=None)
+
+
+def merge_outputs(dataset, outputs, args, writer, num_workers=None):
+    """Merge the aligned outputs of the models image by image in a process
+    pool and write the merged outputs, in order, to ``writer``."""
+    num_images = len(outputs[0])
+    num_workers = num_workers or multiprocessing.cpu_count()
+    # small chunks keep the workers balanced, the images have very different
+    # numbers of cars
+    chunksize = max(1, num_images // (num_workers * 8))
+    # the outputs of every model are handed to the workers once, the workers
+    # split the budgets of the IoU caches
+    with worker_pool(num_workers, initializer=share_iou_cache_budget, initargs=(num_workers,), dataset=dataset,
+                     outputs=outputs, args=args) as pool:
+        for i, output_merged in enumerate(tqdm(pool.imap(_merge_single, range(num_images), chunksize=chunksize),
+                                               total=num_images)):
+            writer.append(output_merged, i)
 
 
 def main():
@@ -303,44 +330,20 @@ def main():
 
     dataset = build_dataset(cfg.data.test)
 
-    outputs_1 = mmcv.load(
-        '/data/Kaggle/wudi_data/test_all_cwxe99_3070100flip05resumme93Dec29-16-28-48_epoch_100_refined.pkl')
-    outputs_2 = mmcv.load('/data/Kaggle/wudi_data/test_all_cwxe99_3070100flip05resumme93Dec29-16-28-48_epoch_100.pkl')
-    # outputs_3 = mmcv.load('/data/Kaggle/wudi_data/all_cwxe99_3070100flip05resumme72Dec27-09-40-17ep85.pkl')
-
-    random.shuffle(outputs_1)
-    # outputs = output_sorted([outputs_1, outputs_2, outputs_3])
-    outputs = output_sorted([outputs_1, outputs_2, ])
-
-    for i in range(len(outputs[0])):
-        output = outputs[0][i]
-        lock_file = os.path.join(args.tmpdir, os.path.basename(output[2]['file_name']).replace(".jpg", ".lock"))
-        pkl_file = os.path.join(args.tmpdir, os.path.basename(output[2]['file_name']).replace(".jpg", ".pkl"))
-
-        if os.path.exists(lock_file) or os.path.exists(pkl_file):
-            continue
-
-        create_lock(lock_file)
-        print(pkl_file)
-        dataset.distributed_visualise_pred_merge_postprocessing_weight_merge(i, outputs, args, tmp_dir=args.tmpdir,
-                                                                             vote=args.vote)
-        remove_lock(lock_file)
-
-    pkl_list = glob.glob(os.path.join(args.tmpdir, "*.pkl"))
-
-    if len(pkl_list) == len(outputs[0]):
-        outputs_merged = []
-        for pkl in pkl_list:
-            output = mmcv.load(pkl)
-            outputs_merged.append(output)
+    # either legacy pickles or result stores, the masks are needed for the IoU
+    sources = [load_results(path, load_masks=True) for path in args.results]
+    outputs = output_sorted(sources)
 
-        print("Writing pkl file to: {}".format(args.out))
-        mmcv.dump(outputs_merged, args.out)
+    results_dir = args.out[:-4] + '_results'
+    print("Writing results to: {}".format(results_dir))
+    with ResultWriter(results_dir) as writer:
+        merge_outputs(dataset, outputs, args, writer, args.workers)
+    outputs_merged = ResultStore(results_dir, load_masks=False)
 
-        submission = write_submission(outputs_merged, args, dataset,
-                                      conf_thresh=0.9,
-                                      filter_mask=False,
-                                      horizontal_flip=args.horizontal_flip)
+    submission = write_submission(outputs_merged, args, dataset,
+                                  conf_thresh=0.9,
+                                  filter_mask=False,
+                                  horizontal_flip=args.horizontal_flip)
 
 
 if __name__ == '__main__':
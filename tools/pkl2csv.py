@@ -7,7 +7,7 @@ def write_submission(outputs):
     import pandas as pd
     import numpy as np
     from scipy.special import softmax
-    from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle
+    from mmdet.datasets.kaggle_pku_utils import get_euler_angles
     submission = 'Nov20-18-24-45-epoch_50.csv'
 
     predictions = {}
@@ -17,7 +17,7 @@ def write_submission(outputs):
 
     for idx, output in enumerate(outputs):
         conf = np.max(softmax(output[2]['car_cls_score_pred'], axis=1), axis=1)
-        euler_angle = np.array([quaternion_to_euler_angle(x) for x in output[2]['quaternion_pred']])
+        euler_angle = get_euler_angles(output[2])
         translation = output[2]['trans_pred_world']
         coords = np.hstack((euler_angle, translation, conf[:, None]))
         coords_str = coords2str(coords)
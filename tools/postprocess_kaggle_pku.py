@@ -0,0 +1,83 @@
+"""
+Raw test outputs -> submission csv in a single pass: the restore xyz
+post-processing, the model merge and the submission filtering chained per
+image in a pool of workers. An interrupted run is resumed from its csv.
+"""
+import argparse
+import os
+
+import mmcv
+
+from mmdet.datasets import build_dataset
+from mmdet.datasets.kaggle_pku_postprocess import PostprocessPipeline, run_postprocess_pipeline
+from mmdet.utils import ResultWriter, load_results
+
+from model_merge import build_index, output_sorted
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Kaggle PKU post-processing')
+    parser.add_argument('--config',
+                        default='../configs/htc/htc_hrnetv2p_w48_20e_kaggle_pku_no_semantic_translation_wudi.py',
+                        help='test config file path')
+    parser.add_argument('--results', nargs='+',
+                        default=['/data/Kaggle/wudi_data/test_Jan29-00-02_epoch_261.pkl'],
+                        help='outputs of the branches, pickles or result stores, a path given twice is read once')
+    parser.add_argument('--restore_xyz', type=int, nargs='*', default=[0],
+                        help='branches refined by the restore xyz post-processing')
+    parser.add_argument('--search_pose', type=int, nargs='*', default=[],
+                        help='branches refined by the silhouette template pose search')
+    parser.add_argument('--vote', type=int, default=0,
+                        help='How many models need to have the same prediction, if set=0, then vote=len(outpus)')
+    parser.add_argument('--conf', type=float, default=0.1, help='Confidence threshold for writing submission')
+    parser.add_argument('--filter_mask', default=False, action='store_true', help='drop the cars on ignore masks')
+    parser.add_argument('--out', help='submission csv, default next to the first results')
+    parser.add_argument('--out_results', help='also write the post-processed outputs to this result store')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, default to all the cpus')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    cfg = mmcv.Config.fromfile(args.config)
+    cfg.data.test.test_mode = True
+    dataset = build_dataset(cfg.data.test)
+
+    # every path is loaded once, the masks are needed for the IoU
+    paths = list(dict.fromkeys(args.results))
+    sources = output_sorted([load_results(path, load_masks=True) for path in paths])
+    image_ids = list(build_index(sources[0].outputs))
+
+    branches = []
+    for i, path in enumerate(args.results):
+        stages = []
+        if i in args.restore_xyz:
+            stages.append(dict(type='restore_xyz'))
+        if i in args.search_pose:
+            stages.append(dict(type='search_pose'))
+        branches.append(dict(source=paths.index(path), stages=stages))
+    pipeline = PostprocessPipeline(dataset, branches,
+                                   merge=dict(vote=args.vote) if len(branches) > 1 else None,
+                                   conf_thresh=args.conf,
+                                   filter_mask=args.filter_mask)
+
+    submission = args.out
+    if submission is None:
+        submission = os.path.splitext(args.results[0].rstrip('/'))[0]
+        submission += '_conf_' + str(args.conf)
+        if args.filter_mask:
+            submission += '_filter_mask'
+        submission += '.csv'
+    print("Writing submission csv file to: %s" % submission)
+    if args.out_results:
+        # the store is resumed with the submission
+        with ResultWriter(args.out_results, resume=True) as writer:
+            stats = run_postprocess_pipeline(pipeline, sources, image_ids, submission, writer, args.workers)
+    else:
+        stats = run_postprocess_pipeline(pipeline, sources, image_ids, submission, num_workers=args.workers)
+    print('Post-processed %d images, %d already done' % (stats['images'], stats['done']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Confidence threshold sweep: the raw predictions are loaded once and the
+Kaggle mAP of every threshold, with and without the ignore mask filtering, is
+computed from a single matching. Only the submission of the best threshold is
+written.
+"""
+import argparse
+import os
+
+import mmcv
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from mmdet.datasets import build_dataset
+from mmdet.datasets.kaggle_pku_utils import record_coords_pool
+from mmdet.utils import MapEvaluator, coords2str, load_results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Kaggle PKU confidence threshold sweep')
+    parser.add_argument('--config',
+                        default='../configs/htc/htc_hrnetv2p_w48_20e_kaggle_pku_no_semantic_translation_wudi.py',
+                        help='test config file path')
+    parser.add_argument('--results', default='/data/Kaggle/wudi_data/validation_Jan16-09-20.pkl',
+                        help='outputs of the validation images, a pickle or a result store')
+    parser.add_argument('--gt', default='/data/Kaggle/pku-autonomous-driving/train.csv', help='ground truth csv')
+    parser.add_argument('--conf_thresholds', type=float, nargs='+',
+                        default=[round(c, 2) for c in np.arange(0.05, 1.0, 0.05)],
+                        help='confidence thresholds of the sweep')
+    parser.add_argument('--filter_mask', choices=['off', 'on', 'both'], default='both',
+                        help='sweep without and/or with the ignore mask filtering')
+    parser.add_argument('--horizontal_flip', default=False, action='store_true')
+    parser.add_argument('--workers', type=int, default=20, help='number of ignore mask filtering processes')
+    parser.add_argument('--out', help='submission csv of the best threshold, default next to the results')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    cfg = mmcv.Config.fromfile(args.config)
+    cfg.data.test.test_mode = True
+    dataset = build_dataset(cfg.data.test)
+    outputs = load_results(args.results, load_masks=False)
+
+    # the poses and confidences of all the cars, the ignore mask flags are
+    # computed once for every car whatever the threshold
+    filter_modes = dict(off=[False], on=[True], both=[False, True])[args.filter_mask]
+    pred_coords, keep_masks = dict(), dict()
+    for image_id, (coords, idx_keep_mask) in tqdm(record_coords_pool(outputs, dataset.img_prefix, dataset,
+                                                                     filter_mask=True in filter_modes,
+                                                                     max_workers=args.workers),
+                                                  total=len(outputs)):
+        pred_coords[image_id] = coords
+        keep_masks[image_id] = idx_keep_mask
+
+    gt_df = pd.read_csv(args.gt)
+    gt_df = gt_df[gt_df.ImageId.isin(list(pred_coords))]
+    if args.horizontal_flip:
+        print('flip mode activated')
+    evaluator = MapEvaluator(gt_df, flip_mode=args.horizontal_flip)
+
+    conf_thresholds = np.array(args.conf_thresholds)
+    best = (-1, None, None)
+    for filter_mask in filter_modes:
+        coords = {k: v[keep_masks[k]] for k, v in pred_coords.items()} if filter_mask else pred_coords
+        maps, _ = evaluator.sweep(coords, conf_thresholds)
+        for conf_thresh, mean_ap in zip(conf_thresholds, maps):
+            print('filter_mask: %s, conf: %.3f, mAP: %f' % (filter_mask, conf_thresh, mean_ap))
+        i = int(np.argmax(maps))
+        if maps[i] > best[0]:
+            best = (maps[i], conf_thresholds[i], filter_mask)
+    mean_ap, conf_thresh, filter_mask = best
+    print('best mAP: %f, conf: %.3f, filter_mask: %s' % (mean_ap, conf_thresh, filter_mask))
+
+    submission = args.out
+    if submission is None:
+        submission = os.path.splitext(args.results.rstrip('/'))[0]
+        submission += '_conf_' + str(conf_thresh)
+        if filter_mask:
+            submission += '_filter_mask'
+        if args.horizontal_flip:
+            submission += '_horizontal_flip'
+        submission += '.csv'
+    pred_dict = {'ImageId': [], 'PredictionString': []}
+    for image_id, coords in pred_coords.items():
+        idx = coords[:, -1] > conf_thresh
+        if filter_mask:
+            idx &= keep_masks[image_id]
+        pred_dict['ImageId'].append(image_id)
+        pred_dict['PredictionString'].append(coords2str(coords[idx]))
+    print("Writing submission csv file to: %s" % submission)
+    pd.DataFrame(data=pred_dict).to_csv(submission, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,6 @@ import argparse
 import os
 # os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
-import os.path as osp
-import shutil
-import tempfile
 import pandas as pd
 import numpy as np
 
@@ -13,103 +10,68 @@ import torch
 import torch.distributed as dist
 from mmcv.parallel import MMDataParallel, MMDistributedDataParallel
 from mmcv.runner import get_dist_info, load_checkpoint
+from torch.utils.data import Subset
 
-from mmdet.apis import init_dist
+from mmdet.apis import init_dist, pipelined_test
 from mmdet.core import wrap_fp16_model
 from mmdet.datasets import build_dataloader, build_dataset
 from mmdet.models import build_detector
+from mmdet.utils import ResultStore, ResultWriter
 
-from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle, filter_igore_masked_using_RT, filter_output
+from mmdet.datasets.kaggle_pku_utils import get_euler_angles, filter_igore_masked_using_RT, filter_outputs_pool
 from tqdm import tqdm
 from tools.evaluations.map_calculation import map_main
-from multiprocessing import Pool
 
 # from finetune_RT_NMR import finetune_RT
 from finetune_RT_NMR_img import finetune_RT
 
 
-def single_gpu_test(model, data_loader, show=False):
-    model.eval()
-    results = []
+def _progress(prog_bar):
+    def update(num_imgs):
+        for _ in range(num_imgs):
+            prog_bar.update()
+    return update
+
+
+def single_gpu_test(model, data_loader, writer, show=False, postprocess=None, postprocess_workers=4):
     dataset = data_loader.dataset
     prog_bar = mmcv.ProgressBar(len(dataset))
+    if not show:
+        # loading, forward and post-processing overlap
+        pipelined_test(model, data_loader, writer, postprocess, postprocess_workers, progress=_progress(prog_bar))
+        return
+
+    model.eval()
+    idx = 0
     for i, data in enumerate(data_loader):
         with torch.no_grad():
             result = model(return_loss=False, rescale=not show, **data)
-        results.append(result)
-
-        if show:
-            model.module.show_result(data, result)
+        model.module.show_result(data, result)
 
+        # the model returns a list of results for a batch of several images
         batch_size = data['img'][0].size(0)
-        for _ in range(batch_size):
+        for img_result in (result if batch_size > 1 else [result]):
+            data_idx = dataset.indices[idx] if isinstance(dataset, Subset) else idx
+            writer.append(postprocess(img_result, data_idx) if postprocess else img_result, data_idx)
+            idx += 1
             prog_bar.update()
-    return results
 
 
-def multi_gpu_test(model, data_loader, tmpdir=None):
-    model.eval()
-    results = []
-    dataset = data_loader.dataset
+def multi_gpu_test(model, data_loader, writer, postprocess=None, postprocess_workers=4):
+    """Every rank streams its results to its own shard of the result store,
+    nothing is gathered in memory."""
     rank, world_size = get_dist_info()
-    if rank == 0:
-        prog_bar = mmcv.ProgressBar(len(dataset))
-    for i, data in enumerate(data_loader):
-        with torch.no_grad():
-            result = model(return_loss=False, rescale=True, **data)
-        results.append(result)
-
-        if rank == 0:
-            batch_size = data['img'][0].size(0)
-            for _ in range(batch_size * world_size):
-                prog_bar.update()
+    progress = _progress(mmcv.ProgressBar(len(data_loader.dataset))) if rank == 0 else None
+    pipelined_test(model, data_loader, writer, postprocess, postprocess_workers,
+                   rank=rank, world_size=world_size, progress=progress)
+    dist.barrier()
 
-    # collect results from all ranks
-    results = collect_results(results, len(dataset), tmpdir)
 
-    return results
-
-
-def collect_results(result_part, size, tmpdir=None):
-    rank, world_size = get_dist_info()
-    # create a tmp dir if it is not specified
-    if tmpdir is None:
-        MAX_LEN = 512
-        # 32 is whitespace
-        dir_tensor = torch.full((MAX_LEN,),
-                                32,
-                                dtype=torch.uint8,
-                                device='cuda')
-        if rank == 0:
-            tmpdir = tempfile.mkdtemp()
-            tmpdir = torch.tensor(
-                bytearray(tmpdir.encode()), dtype=torch.uint8, device='cuda')
-            dir_tensor[:len(tmpdir)] = tmpdir
-        dist.broadcast(dir_tensor, 0)
-        tmpdir = dir_tensor.cpu().numpy().tobytes().decode().rstrip()
-    else:
-        mmcv.mkdir_or_exist(tmpdir)
-    # dump the part result to the dir
-    mmcv.dump(result_part, osp.join(tmpdir, 'part_{}.pkl'.format(rank)))
-    dist.barrier()
-    # collect all parts
-    if rank != 0:
-        return None
-    else:
-        # load results of all parts from tmp dir
-        part_list = []
-        for i in range(world_size):
-            part_file = osp.join(tmpdir, 'part_{}.pkl'.format(i))
-            part_list.append(mmcv.load(part_file))
-        # sort the results
-        ordered_results = []
-        for res in zip(*part_list):
-            ordered_results.extend(list(res))
-        # the dataloader may pad some samples
-        ordered_results = ordered_results[:size]
-        # remove tmp dir
-        shutil.rmtree(tmpdir)
-        return ordered_results
+def stored_indices(results_dir):
+    # the images written by an interrupted run, the test resumes with the others
+    if not os.path.isdir(results_dir):
+        return set()
+    return {record['idx'] for record in ResultStore(results_dir, load_masks=False).records}
 
 
 def write_submission(outputs, args, dataset,
@@ -152,7 +114,7 @@ def write_submission(outputs, args, dataset,
             if False:  # NMR has problem saving 'euler angle' Its
                 eular_angle = output[2]['euler_angle']
             else:
-                eular_angle = np.array([quaternion_to_euler_angle(x) for x in output[2]['quaternion_pred']])
+                eular_angle = get_euler_angles(output[2])
             translation = output[2]['trans_pred_world']
             coords = np.hstack((eular_angle[idx], translation[idx], conf[idx, None]))
 
@@ -173,10 +135,6 @@ def write_submission(outputs, args, dataset,
     return submission
 
 
-def filter_output_pool(t):
-    return filter_output(*t)
-
-
 def write_submission_pool(outputs, args, dataset,
                           conf_thresh=0.1,
                           horizontal_flip=False,
@@ -202,9 +160,7 @@ def write_submission_pool(outputs, args, dataset,
     submission += '.csv'
     predictions = {}
 
-    p = Pool(processes=max_workers)
-    for coords_str, ImageId in p.imap(filter_output_pool,
-                                      [(i, outputs, conf_thresh, img_prefix, dataset) for i in range(len(outputs))]):
+    for coords_str, ImageId in filter_outputs_pool(outputs, conf_thresh, img_prefix, dataset, max_workers):
         predictions[ImageId] = coords_str
 
     pred_dict = {'ImageId': [], 'PredictionString': []}
@@ -244,6 +200,9 @@ def parse_args():
     parser.add_argument('--local_rank', type=int, default=0)
     parser.add_argument('--horizontal_flip', default=False, action='store_true')
     parser.add_argument('--world_size', default=8)
+    parser.add_argument('--imgs_per_gpu', type=int, default=1, help='number of test images forwarded together')
+    parser.add_argument('--postprocess_workers', type=int, default=4,
+                        help='threads post-processing the results during the test')
     args = parser.parse_args()
     if 'LOCAL_RANK' not in os.environ:
         os.environ['LOCAL_RANK'] = str(args.local_rank)
@@ -283,10 +242,24 @@ def main():
 
     # build the dataloader
     dataset = build_dataset(cfg.data.test)
-    if not os.path.exists(args.out):
+    # the results are streamed to a sharded store next to the legacy pickle
+    results_dir = args.out[:-4] + '_results'
+    refined_dir = args.out[:-4] + '_refined_results'
+    if cfg.pkl_postprocessing_restore_xyz:
+        # x, y are restored from z by the post-processing workers of the test
+        results_dir = refined_dir
+        postprocess = lambda result, idx: dataset.restore_xyz_withIOU_single(idx, result)
+    else:
+        postprocess = None
+    done = stored_indices(results_dir)
+    if distributed:
+        # every rank splits the same remaining images
+        dist.barrier()
+    if not os.path.exists(args.out) and len(done) < len(dataset):
+        todo = [idx for idx in range(len(dataset)) if idx not in done]
         data_loader = build_dataloader(
-            dataset,
-            imgs_per_gpu=1,
+            Subset(dataset, todo) if done else dataset,
+            imgs_per_gpu=args.imgs_per_gpu,
             workers_per_gpu=cfg.data.workers_per_gpu,
             dist=distributed,
             shuffle=False)
@@ -304,25 +277,29 @@ def main():
         else:
             model.CLASSES = dataset.CLASSES
 
-        if not distributed:
-            model = MMDataParallel(model, device_ids=[0])
-            outputs = single_gpu_test(model, data_loader, args.show)
-        else:
-            model = MMDistributedDataParallel(model.cuda())
-            outputs = multi_gpu_test(model, data_loader, args.tmpdir)
-        mmcv.dump(outputs, args.out)
-
-    else:
-        outputs = mmcv.load(args.out)
+        rank, _ = get_dist_info()
+        with ResultWriter(results_dir, 'part_{}'.format(rank), resume=True) as writer:
+            if not distributed:
+                model = MMDataParallel(model, device_ids=[0])
+                single_gpu_test(model, data_loader, writer, args.show, postprocess, args.postprocess_workers)
+            else:
+                model = MMDistributedDataParallel(model.cuda())
+                multi_gpu_test(model, data_loader, writer, postprocess, args.postprocess_workers)
 
     if distributed:
         rank, _ = get_dist_info()
         if rank != 0:
             return
 
-    if cfg.pkl_postprocessing_restore_xyz:
-        outputs = dataset.pkl_postprocessing_restore_xyz_multiprocessing(outputs)
-        mmcv.dump(outputs, args.out[:-4] + '_refined.pkl')
+    if os.path.exists(args.out):
+        # legacy pickle of all the outputs, refined in a separate pass
+        outputs = mmcv.load(args.out)
+        if cfg.pkl_postprocessing_restore_xyz:
+            with ResultWriter(refined_dir) as writer:
+                dataset.pkl_postprocessing_restore_xyz_multiprocessing(outputs, writer)
+            outputs = ResultStore(refined_dir, load_masks=False)
+    else:
+        outputs = ResultStore(results_dir, load_masks=False)
 
     if cfg.write_submission:
         submission = write_submission(outputs, args, dataset,
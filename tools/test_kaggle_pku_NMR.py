@@ -2,9 +2,6 @@ import argparse
 import os
 os.environ['CUDA_VISIBLE_DEVICES'] = '0'
 
-import os.path as osp
-import shutil
-import tempfile
 import pandas as pd
 import numpy as np
 
@@ -13,32 +10,34 @@ import torch
 import torch.distributed as dist
 from mmcv.parallel import MMDataParallel, MMDistributedDataParallel
 from mmcv.runner import get_dist_info, load_checkpoint
+from torch.utils.data import Subset
 
 from mmdet.apis import init_dist
 from mmdet.core import wrap_fp16_model
 from mmdet.datasets import build_dataloader, build_dataset
 from mmdet.models import build_detector
+from mmdet.utils import ResultStore, ResultWriter
+from mmdet.utils.result_store import image_id_from_output
 
-from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle, filter_igore_masked_using_RT, filter_output
+from mmdet.datasets.kaggle_pku_utils import get_euler_angles, filter_igore_masked_using_RT, filter_outputs_pool
 from tqdm import tqdm
 from tools.evaluations.map_calculation import map_main
-from multiprocessing import Pool
 
 #from finetune_RT_NMR import finetune_RT
 #from finetune_RT_NMR_img import finetune_RT
-from finetune_RT_NMR_iou import finetune_RT
+from finetune_RT_NMR_iou import RefinementScheduler
 #from finetune_RT_NMR_grayscale import finetune_RT
 
 
-def single_gpu_test(model, data_loader, show=False):
+def single_gpu_test(model, data_loader, writer, show=False):
     model.eval()
-    results = []
     dataset = data_loader.dataset
     prog_bar = mmcv.ProgressBar(len(dataset))
     for i, data in enumerate(data_loader):
         with torch.no_grad():
             result = model(return_loss=False, rescale=not show, **data)
-        results.append(result)
+        # one image per gpu, i is the index of the image in the data loader
+        writer.append(result, dataset.indices[i] if isinstance(dataset, Subset) else i)
 
         if show:
             model.module.show_result(data, result)
@@ -46,12 +45,12 @@ def single_gpu_test(model, data_loader, show=False):
         batch_size = data['img'][0].size(0)
         for _ in range(batch_size):
             prog_bar.update()
-    return results
 
 
-def multi_gpu_test(model, data_loader, tmpdir=None):
+def multi_gpu_test(model, data_loader, writer):
+    """Every rank streams its results to its own shard of the result store,
+    nothing is gathered in memory."""
     model.eval()
-    results = []
     dataset = data_loader.dataset
     rank, world_size = get_dist_info()
     if rank == 0:
@@ -59,59 +58,24 @@ def multi_gpu_test(model, data_loader, tmpdir=None):
     for i, data in enumerate(data_loader):
         with torch.no_grad():
             result = model(return_loss=False, rescale=True, **data)
-        results.append(result)
+        # the sampler gives the images rank, rank + world_size... to a rank
+        # and pads the last ones with the first images of the dataset
+        idx = i * world_size + rank
+        if idx < len(dataset):
+            writer.append(result, dataset.indices[idx] if isinstance(dataset, Subset) else idx)
 
         if rank == 0:
             batch_size = data['img'][0].size(0)
             for _ in range(batch_size * world_size):
                 prog_bar.update()
-
-    # collect results from all ranks
-    results = collect_results(results, len(dataset), tmpdir)
-
-    return results
+    dist.barrier()
 
 
-def collect_results(result_part, size, tmpdir=None):
-    rank, world_size = get_dist_info()
-    # create a tmp dir if it is not specified
-    if tmpdir is None:
-        MAX_LEN = 512
-        # 32 is whitespace
-        dir_tensor = torch.full((MAX_LEN,),
-                                32,
-                                dtype=torch.uint8,
-                                device='cuda')
-        if rank == 0:
-            tmpdir = tempfile.mkdtemp()
-            tmpdir = torch.tensor(
-                bytearray(tmpdir.encode()), dtype=torch.uint8, device='cuda')
-            dir_tensor[:len(tmpdir)] = tmpdir
-        dist.broadcast(dir_tensor, 0)
-        tmpdir = dir_tensor.cpu().numpy().tobytes().decode().rstrip()
-    else:
-        mmcv.mkdir_or_exist(tmpdir)
-    # dump the part result to the dir
-    mmcv.dump(result_part, osp.join(tmpdir, 'part_{}.pkl'.format(rank)))
-    dist.barrier()
-    # collect all parts
-    if rank != 0:
-        return None
-    else:
-        # load results of all parts from tmp dir
-        part_list = []
-        for i in range(world_size):
-            part_file = osp.join(tmpdir, 'part_{}.pkl'.format(i))
-            part_list.append(mmcv.load(part_file))
-        # sort the results
-        ordered_results = []
-        for res in zip(*part_list):
-            ordered_results.extend(list(res))
-        # the dataloader may pad some samples
-        ordered_results = ordered_results[:size]
-        # remove tmp dir
-        shutil.rmtree(tmpdir)
-        return ordered_results
+def stored_indices(results_dir):
+    # the images written by an interrupted run, the test resumes with the others
+    if not os.path.isdir(results_dir):
+        return set()
+    return {record['idx'] for record in ResultStore(results_dir, load_masks=False).records}
 
 
 def write_submission(outputs, args, dataset,
@@ -153,7 +117,7 @@ def write_submission(outputs, args, dataset,
             if False:   #NMR has problem saving 'euler angle' Its
                 eular_angle = output[2]['euler_angle']
             else:
-                eular_angle = np.array([quaternion_to_euler_angle(x) for x in output[2]['quaternion_pred']])
+                eular_angle = get_euler_angles(output[2])
             translation = output[2]['trans_pred_world']
             coords = np.hstack((eular_angle[idx], translation[idx], conf[idx, None]))
 
@@ -174,10 +138,6 @@ def write_submission(outputs, args, dataset,
     return submission
 
 
-def filter_output_pool(t):
-    return filter_output(*t)
-
-
 def write_submission_pool(outputs, args, dataset,
                      conf_thresh=0.1,
                      horizontal_flip=False,
@@ -203,8 +163,7 @@ def write_submission_pool(outputs, args, dataset,
     submission += '.csv'
     predictions = {}
 
-    p = Pool(processes=max_workers)
-    for coords_str, ImageId in p.imap(filter_output_pool, [(i, outputs, conf_thresh, img_prefix, dataset) for i in range(len(outputs))]):
+    for coords_str, ImageId in filter_outputs_pool(outputs, conf_thresh, img_prefix, dataset, max_workers):
         predictions[ImageId] = coords_str
 
     pred_dict = {'ImageId': [], 'PredictionString': []}
@@ -246,6 +205,7 @@ def parse_args():
     parser.add_argument('--local_rank', type=int, default=0)
     parser.add_argument('--horizontal_flip',  default=False, action='store_true')
     parser.add_argument('--world_size', default=8)
+    parser.add_argument('--nmr_batch_size', type=int, default=16, help='number of cars refined together')
     args = parser.parse_args()
     if 'LOCAL_RANK' not in os.environ:
         os.environ['LOCAL_RANK'] = str(args.local_rank)
@@ -287,9 +247,16 @@ def main():
     # TODO: support multiple images per gpu (only minor changes are needed)
     dataset = build_dataset(cfg.data.test)
     args.out = '/data/Kaggle/wudi_data/validation_Jan16-09-20.pkl'
-    if not os.path.exists(args.out):
+    # the results are streamed to a sharded store next to the legacy pickle
+    results_dir = args.out[:-4] + '_results'
+    done = stored_indices(results_dir)
+    if distributed:
+        # every rank splits the same remaining images
+        dist.barrier()
+    if not os.path.exists(args.out) and len(done) < len(dataset):
+        todo = [idx for idx in range(len(dataset)) if idx not in done]
         data_loader = build_dataloader(
-            dataset,
+            Subset(dataset, todo) if done else dataset,
             imgs_per_gpu=1,
             workers_per_gpu=cfg.data.workers_per_gpu,
             dist=distributed,
@@ -308,39 +275,42 @@ def main():
         else:
             model.CLASSES = dataset.CLASSES
 
-        if not distributed:
-            model = MMDataParallel(model, device_ids=[0])
-            outputs = single_gpu_test(model, data_loader, args.show)
-        else:
-            model = MMDistributedDataParallel(model.cuda())
-            outputs = multi_gpu_test(model, data_loader, args.tmpdir)
-        mmcv.dump(outputs, args.out)
+        rank, _ = get_dist_info()
+        with ResultWriter(results_dir, 'part_{}'.format(rank), resume=True) as writer:
+            if not distributed:
+                model = MMDataParallel(model, device_ids=[0])
+                single_gpu_test(model, data_loader, writer, args.show)
+            else:
+                model = MMDistributedDataParallel(model.cuda())
+                multi_gpu_test(model, data_loader, writer)
 
-    else:
+    if os.path.exists(args.out):
+        # legacy pickle of all the outputs
         outputs = mmcv.load(args.out)
+    else:
+        outputs = ResultStore(results_dir, load_masks=True)
 
     if distributed:
         rank, _ = get_dist_info()
         if rank != 0:
             return
 
-    outputs = outputs
-    local_rank = args.local_rank
-    world_size = args.world_size
-    for idx, output in enumerate(outputs):
-        #if idx % world_size == local_rank:
-        #if output[2]['file_name'].split('/')[-1] == 'ID_0cec00e6a.jpg':
-        if True:
-            finetune_RT(output, dataset,
-                        draw_flag=True,
-                        num_epochs=20,
-                        loss_grayscale_light=0.02,
-                        loss_grayscale_RT=0.02,
-                        loss_IoU=0.95,
-                        lr=0.05,
-                        conf_thresh=0.8,
-                        fix_rot=False,
-                        tmp_save_dir='/data/Kaggle/wudi_data/tmp_output_grayscale')
+    # the refined outputs are streamed to their own store, an interrupted run is resumed
+    # by skipping the images already refined
+    refined_dir = results_dir + '_NMR'
+    refined = set(ResultStore(refined_dir, load_masks=False).image_ids) if os.path.isdir(refined_dir) else set()
+    todo = ((idx, output) for idx, output in enumerate(outputs)
+            if image_id_from_output(output, str(idx)) not in refined)
+    with ResultWriter(refined_dir, 'part_0', resume=True) as writer:
+        scheduler = RefinementScheduler(dataset, writer,
+                                        batch_size=args.nmr_batch_size,
+                                        num_epochs=20,
+                                        lr=0.05,
+                                        loss_IoU=0.95,
+                                        conf_thresh=0.8,
+                                        fix_rot=False)
+        stats = scheduler.run(tqdm(todo, total=len(outputs) - len(refined)))
+    print('Refined %d cars in %d steps to: %s' % (stats['cars'], stats['steps'], refined_dir))
 
 
 if __name__ == '__main__':
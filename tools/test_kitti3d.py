@@ -19,10 +19,9 @@ from mmdet.core import wrap_fp16_model
 from mmdet.datasets import build_dataloader, build_dataset
 from mmdet.models import build_detector
 
-from mmdet.datasets.kaggle_pku_utils import quaternion_to_euler_angle, filter_igore_masked_using_RT, filter_output
+from mmdet.datasets.kaggle_pku_utils import get_euler_angles, filter_igore_masked_using_RT, filter_outputs_pool
 from tqdm import tqdm
 from tools.evaluations.map_calculation import map_main
-from multiprocessing import Pool
 
 # from finetune_RT_NMR import finetune_RT
 from finetune_RT_NMR_img import finetune_RT
@@ -152,7 +151,7 @@ def write_submission(outputs, args, dataset,
             if False:  # NMR has problem saving 'euler angle' Its
                 eular_angle = output[2]['euler_angle']
             else:
-                eular_angle = np.array([quaternion_to_euler_angle(x) for x in output[2]['quaternion_pred']])
+                eular_angle = get_euler_angles(output[2])
             translation = output[2]['trans_pred_world']
             coords = np.hstack((eular_angle[idx], translation[idx], conf[idx, None]))
 
@@ -173,10 +172,6 @@ def write_submission(outputs, args, dataset,
     return submission
 
 
-def filter_output_pool(t):
-    return filter_output(*t)
-
-
 def write_submission_pool(outputs, args, dataset,
                           conf_thresh=0.1,
                           horizontal_flip=False,
@@ -202,9 +197,7 @@ def write_submission_pool(outputs, args, dataset,
     submission += '.csv'
     predictions = {}
 
-    p = Pool(processes=max_workers)
-    for coords_str, ImageId in p.imap(filter_output_pool,
-                                      [(i, outputs, conf_thresh, img_prefix, dataset) for i in range(len(outputs))]):
+    for coords_str, ImageId in filter_outputs_pool(outputs, conf_thresh, img_prefix, dataset, max_workers):
         predictions[ImageId] = coords_str
 
     pred_dict = {'ImageId': [], 'PredictionString': []}